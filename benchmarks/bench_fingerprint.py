@@ -0,0 +1,64 @@
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+import clustering
+import fingerprint
+import protocols
+
+"""
+指紋のインデックスの作成と検索の速度を計る。
+NEC、SIRC、AEHAのアドレスとコマンドを変えた信号を登録し、ジッターを加えてnormaliseしたものを引く。
+見つからない信号は全プローブを調べて失敗するまでの時間。目標は1回1ms未満。
+実行: python benchmarks/bench_fingerprint.py [信号数]
+"""
+
+
+def signals(count):
+    rnd = random.Random(0)
+    nec, sirc, aeha = protocols.NecDecoder(), protocols.SircDecoder(), protocols.AehaDecoder()
+    result = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            code = {'protocol': 'nec', 'address': (i // 3) >> 8, 'command': (i // 3) & 0xFF, 'bits': 32, 'repeat': 0}
+            result.append(nec.encode(code))
+        elif kind == 1:
+            code = {'protocol': 'sirc', 'address': (i // 3) >> 7, 'command': (i // 3) & 0x7F, 'bits': 20, 'repeat': 2}
+            result.append(sirc.encode(code))
+        else:
+            command = '{0:06x}'.format(rnd.getrandbits(24))
+            code = {'protocol': 'aeha', 'address': rnd.getrandbits(16), 'command': command, 'bits': 40, 'repeat': 0}
+            result.append(aeha.encode(code))
+    return result
+
+
+def prepared(pulses, seed):
+    rnd = random.Random(seed)
+    pulses = [int(x * rnd.uniform(0.95, 1.05)) for x in pulses]
+    clustering.normalise(pulses)
+    return pulses
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    stored = signals(count)
+    index = fingerprint.FingerprintIndex()
+    build = timeit.timeit(lambda: [index.add(i, pulses) for i, pulses in enumerate(stored)], number=1)
+    print('{0} signals indexed in {1:.2f} s ({2:.0f} us/signal)'.format(len(index), build, build / count * 1e6))
+
+    queries = [(i, prepared(stored[i], i)) for i in range(0, count, max(1, count // 200))]
+    misses = [prepared(protocols.NecDecoder().encode(
+        {'protocol': 'nec', 'address': 0xFFFF, 'command': i, 'bits': 32, 'repeat': 0}), i) for i in range(50)]
+    found = sum(index.identify(pulses) == i for i, pulses in queries)
+    print('{0:>10} {1:>8} {2:>12}'.format('lookup', 'count', 'us/lookup'))
+    for name, cases in (('hit', [x for i, x in queries]), ('miss', misses)):
+        seconds = min(timeit.repeat(lambda: [index.identify(x) for x in cases], number=5, repeat=3)) / 5 / len(cases)
+        print('{0:>10} {1:>8} {2:>12.1f}'.format(name, len(cases), seconds * 1e6))
+    print('identified {0}/{1}'.format(found, len(queries)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+import filesystem
+import ir_file
+
+"""
+Filesystemのfsyncの方法(config.FSYNC_MODE)毎に、信号ファイルの保存のスループットと
+ディレクトリのfsyncの回数を比較する。保存はスレッド数を変えて同時に行う。
+SDカード上で計るときはBENCH_DIRに保存先のディレクトリを指定する。
+実行: BENCH_DIR=/data python benchmarks/bench_fsync.py
+"""
+
+MODES = (('none', 0), ('full', 0), ('group', 2), ('group', 10))
+THREADS = (1, 4, 16)
+SAVES = 200
+SIGNAL = {'0': [9000, 4500] + [560, 1690] * 100}
+
+
+def run(directory, mode, window_ms, threads):
+    fs = filesystem.Filesystem(mode, window_ms)
+    data = ir_file.encode(SIGNAL)
+    per_thread = SAVES // threads
+
+    def worker(n):
+        for i in range(per_thread):
+            fs.write_file_atomically(os.path.join(directory, '{0}-{1}.ir'.format(n, i)), data)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed, fs.directory_fsync_count
+
+
+def main():
+    base = tempfile.mkdtemp(dir=os.environ.get('BENCH_DIR'))
+    try:
+        print('{0:>6} {1:>10} {2:>8} {3:>10} {4:>12}'.format('mode', 'window ms', 'threads', 'saves/s', 'dir fsyncs'))
+        for mode, window_ms in MODES:
+            for threads in THREADS:
+                directory = tempfile.mkdtemp(dir=base)
+                rate, fsyncs = run(directory, mode, window_ms, threads)
+                print('{0:>6} {1:>10} {2:>8} {3:>10.0f} {4:>12}'.format(mode, window_ms, threads, rate, fsyncs))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
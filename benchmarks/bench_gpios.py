@@ -0,0 +1,104 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import capture
+import clustering
+import protocols
+from test import helpers
+
+"""
+受信機の数(1〜4)に対するスレッド数とCPU時間を、GPIO毎にコンシューマスレッドを起動する場合と
+EdgeDispatcherの1つのスレッドで処理する場合で比較する。
+pigpioと同じく1つのスレッドが全GPIOのエッジをtick順にリングバッファへ書き込み、
+各GPIOでボタンを押し続けたNECの信号をPRESSES回分、実時間のSPEEDUP倍の速さで送る。
+モニターモードのCaptureSessionで受信し、整形・デコードは含まない。
+実行: python benchmarks/bench_gpios.py
+"""
+
+GPIOS = (17, 18, 22, 27)
+PRESSES = 5
+REPEATS = 10
+SPEEDUP = 20
+REPEAT_GAP_US = 96 * 1000
+RELEASE_GAP_US = 300 * 1000
+
+
+def held_button_edges(offset_us):
+    nec = protocols.NecDecoder()
+    frame = nec.encode({'protocol': 'nec', 'address': 0x04, 'command': 0x08, 'bits': 32, 'repeat': 1})
+    frames = [frame] + [list(nec.repeat_code)] * REPEATS
+    edges = []
+    tick = offset_us
+    for i in range(PRESSES):
+        tick += RELEASE_GAP_US
+        for pulses in frames:
+            level = 0
+            edges.append((level, tick))
+            for pulse in pulses:
+                tick += pulse
+                level ^= 1
+                edges.append((level, tick))
+            tick += REPEAT_GAP_US
+    return edges
+
+
+"""
+GPIO毎のエッジを1つのtick順の列(tick, gpio, level)にする。GPIO毎に少しずつずらす
+"""
+def merged_edges(gpios):
+    merged = []
+    for i, gpio in enumerate(gpios):
+        merged.extend((tick, gpio, level) for level, tick in held_button_edges(i * 7919))
+    merged.sort()
+    return merged
+
+
+def replay(gpios, dispatched):
+    edges = merged_edges(gpios)
+    frames = [0]
+    def on_frame(code, tick):
+        frames[0] += 1
+    sessions = dict((gpio, capture.CaptureSession(helpers.WatchdogPiMock(), gpio, 0, clustering.normalise, on_frame=on_frame))
+                    for gpio in gpios)
+    threads = threading.active_count()
+    cpu = time.process_time()
+    started = time.perf_counter()
+    dispatcher = capture.EdgeDispatcher()
+    for session in sessions.values():
+        if dispatched:
+            dispatcher.add(session)
+        else:
+            session.start()
+    peak = threading.active_count() - threads
+    # pigpioのコールバックスレッドの代わり
+    for tick, gpio, level in edges:
+        ahead = tick / 1e6 / SPEEDUP - (time.perf_counter() - started)
+        if ahead > 0.001:
+            time.sleep(ahead)
+        sessions[gpio].cbf(gpio, level, tick)
+    # 最後のフレームを終わらせる
+    for gpio, session in sessions.items():
+        session.cbf(gpio, capture.TIMEOUT, edges[-1][0])
+    time.sleep(0.05)
+    for session in sessions.values():
+        session.cancel()
+        session.join()
+    return peak, time.process_time() - cpu, time.perf_counter() - started, frames[0]
+
+
+def main():
+    print('{0:>6} {1:>12} {2:>8} {3:>8} {4:>10} {5:>10} {6:>12}'.format(
+        'gpios', 'consumer', 'threads', 'frames', 'cpu ms', 'wall ms', 'cpu us/frame'))
+    for count in range(1, len(GPIOS) + 1):
+        for name, dispatched in (('per-gpio', False), ('dispatcher', True)):
+            peak, cpu, wall, frames = replay(GPIOS[:count], dispatched)
+            print('{0:>6} {1:>12} {2:>8} {3:>8} {4:>10.1f} {5:>10.1f} {6:>12.1f}'.format(
+                count, name, peak, frames, cpu * 1000, wall * 1000, cpu / frames * 1e6))
+
+
+if __name__ == '__main__':
+    main()
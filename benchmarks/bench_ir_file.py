@@ -0,0 +1,78 @@
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+import clustering
+import ir_file
+
+"""
+.irファイルのJSON形式とバイナリ形式を、ファイルサイズ・書き込み時間・読み込み時間で比較する。
+信号はnormalise済み(小数点以下2桁の平均値)のフレームを使う。
+読み込みはJSONがjson.loads、バイナリがmmap + memoryviewで、パルスを1つ読むところまでを計る。
+実行: python benchmarks/bench_ir_file.py
+"""
+
+SIZES = (100, 1000, 10000)
+
+
+def normalised_frame(entries, seed=0):
+    rnd = random.Random(seed)
+    c = [9000, 4500]
+    while len(c) < entries:
+        c.append(560)
+        c.append(rnd.choice([560, 1690]))
+    c = [int(x * rnd.uniform(0.95, 1.05)) for x in c[:entries]]
+    clustering.normalise(c)
+    return {'0': c}
+
+
+def write_json(path, signals):
+    with open(path, 'w') as f:
+        f.write(json.dumps(signals))
+
+
+def write_binary(path, signals):
+    with open(path, 'wb') as f:
+        f.write(ir_file.encode(signals))
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.loads(f.read())['0'][0]
+
+
+def load_binary(path):
+    with ir_file.load(path) as f:
+        return f.records['0'][0]
+
+
+def measure(func, number):
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    return best / number
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'tmp.ir')
+        formats = [('json', write_json, load_json), ('binary', write_binary, load_binary)]
+        print('{0:>8} {1:>8} {2:>10} {3:>12} {4:>12}'.format('edges', 'format', 'bytes', 'write ms', 'load ms'))
+        for size in SIZES:
+            signals = normalised_frame(size)
+            number = max(10, 20000 // size)
+            for name, write, load in formats:
+                write_ms = measure(lambda: write(path, signals), number) * 1000
+                load_ms = measure(lambda: load(path), number) * 1000
+                print('{0:>8} {1:>8} {2:>10} {3:>12.3f} {4:>12.3f}'.format(
+                    size, name, os.path.getsize(path), write_ms, load_ms))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+import metrics
+
+"""
+metrics.pyの計測を入れたときの1回あたりのオーバーヘッドを、無効(既定)と有効で比べる。
+    timer:      with metrics.timer(...)
+    inc:        metrics.inc(...)
+    instrument: metrics.instrumentで包んだメソッドの呼び出し(RedisBoundaryの各メソッド)
+bareは計測を入れない同じ処理。
+実行: python benchmarks/bench_metrics.py
+"""
+
+NUMBER = 200000
+
+
+class Target:
+    def call(self):
+        pass
+
+
+class Instrumented(Target):
+    def call(self):
+        pass
+
+
+metrics.instrument(Instrumented, 'bench_seconds')
+
+
+def with_timer():
+    with metrics.timer('bench_seconds'):
+        pass
+
+
+def per_call_ns(statement):
+    return min(timeit.repeat(statement, number=NUMBER, repeat=5)) / NUMBER * 1e9
+
+
+def main():
+    target = Target()
+    instrumented = Instrumented()
+    cases = (
+        ('timer', with_timer, lambda: None),
+        ('inc', lambda: metrics.inc('bench_total'), lambda: None),
+        ('instrument', instrumented.call, target.call),
+    )
+    print('{0:>12} {1:>10} {2:>12} {3:>12}'.format('', 'bare ns', 'disabled ns', 'enabled ns'))
+    for name, measured, bare in cases:
+        metrics.registry.enabled = False
+        disabled = per_call_ns(measured)
+        metrics.registry.enabled = True
+        enabled = per_call_ns(measured)
+        print('{0:>12} {1:>10.0f} {2:>12.0f} {3:>12.0f}'.format(name, per_call_ns(bare), disabled, enabled))
+    metrics.registry.enabled = False
+
+
+if __name__ == '__main__':
+    main()
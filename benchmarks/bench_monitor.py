@@ -0,0 +1,127 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import capture
+import monitor
+import protocols
+import raspberry_pi_boundary
+from test import helpers
+
+"""
+モニターモードの持続的なフレームレートを計る。
+ボタンを押し続けたNECの信号(フレーム + 108ms周期のリピートコード)をPRESSES回分、
+pigpioのコールバックスレッドの代わりのスレッドから実時間のSPEEDUPS倍の速さでリングバッファへ送り、
+CaptureSessionのフレーム分割、FrameMonitorでの整形・デコードを通した速度と取りこぼしを数える。
+Redisへの書き込みは含まない。実時間ではボタン1つで約9フレーム/秒になる。
+実行: python benchmarks/bench_monitor.py
+"""
+
+PRESSES = 20
+SPEEDUPS = (10, 100, 1000, 10000)
+REPEATS = 20
+REPEAT_GAP_US = 96 * 1000
+RELEASE_GAP_US = 300 * 1000
+
+
+def held_button():
+    nec = protocols.NecDecoder()
+    # 最初のリピートは40ms未満で続くのでフレームと1つになる
+    frame = nec.encode({'protocol': 'nec', 'address': 0x04, 'command': 0x08, 'bits': 32, 'repeat': 1})
+    return [frame] + [list(nec.repeat_code)] * REPEATS
+
+
+def replay_edges(presses):
+    edges = []
+    tick = 0
+    for i in range(presses):
+        tick += RELEASE_GAP_US
+        for frame in held_button():
+            level = 0
+            edges.append((level, tick & 0xFFFFFFFF))
+            for pulse in frame:
+                tick += pulse
+                level ^= 1
+                edges.append((level, tick & 0xFFFFFFFF))
+            tick += REPEAT_GAP_US
+    edges.append((capture.TIMEOUT, tick & 0xFFFFFFFF))
+    return edges
+
+
+"""
+pigpio.piの代わり。callback()が呼ばれるとedgesを待たずに送る
+"""
+class ReplayPi:
+    connected = True
+
+    def __init__(self, edges, speedup):
+        self.edges = edges
+        self.speedup = speedup
+        self.sent = threading.Event()
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_glitch_filter(self, gpio, steady):
+        pass
+
+    def set_watchdog(self, gpio, timeout):
+        pass
+
+    def get_current_tick(self):
+        return 0
+
+    def callback(self, gpio, edge, func):
+        threading.Thread(target=self.__send, args=(gpio, func)).start()
+        return helpers.CallbackMock()
+
+    def __send(self, gpio, func):
+        # tickの間隔をspeedup分の1にして送る。先行しすぎたときだけ待つ
+        started = time.perf_counter()
+        for level, tick in self.edges:
+            ahead = tick / 1e6 / self.speedup - (time.perf_counter() - started)
+            if ahead > 0.001:
+                time.sleep(ahead)
+            func(gpio, level, tick)
+        self.sent.set()
+
+    def stop(self):
+        pass
+
+
+def replay(edges, speedup):
+    expected = PRESSES * (REPEATS + 1)
+    pi = ReplayPi(edges, speedup)
+    boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(lambda: pi))
+    decoded = []
+    frame_monitor = monitor.FrameMonitor(boundary, lambda entries: decoded.extend(e for e in entries if e['code'] != 'null'))
+    frame_monitor.start()
+    started = time.perf_counter()
+    boundary.start_monitoring(frame_monitor.put)
+    pi.sent.wait()
+    sent = time.perf_counter() - started
+    deadline = time.monotonic() + 30
+    while frame_monitor.frames < expected and time.monotonic() < deadline:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    boundary.stop_monitoring()
+    frame_monitor.stop()
+    print('{0:>8} {1:>10} {2:>10} {3:>10} {4:>12,.0f} {5:>12,.0f}'.format(
+        speedup, frame_monitor.frames, len(decoded), expected - frame_monitor.frames,
+        frame_monitor.frames / elapsed, len(edges) / sent))
+
+
+def main():
+    edges = replay_edges(PRESSES)
+    print('{0} edges, {1} frames per replay'.format(len(edges), PRESSES * (REPEATS + 1)))
+    print('{0:>8} {1:>10} {2:>10} {3:>10} {4:>12} {5:>12}'.format(
+        'speedup', 'frames', 'decoded', 'dropped', 'frames/s', 'edges/s'))
+    for speedup in SPEEDUPS:
+        replay(edges, speedup)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import clustering
+from test import helpers
+
+"""
+normaliseの新旧実装を100, 1k, 10kエッジのフレームで比較する。
+複数回押したキャプチャ(PRESSES回)を、レコード毎にnormaliseする場合とnormalise_recordsでまとめる場合も比較する。
+実行: python benchmarks/bench_normalise.py
+"""
+
+SIZES = (100, 1000, 10000)
+PRESSES = 5
+
+
+def measure(func, frame, number):
+    best = min(timeit.repeat(lambda: func(list(frame)), number=number, repeat=3))
+    return best / number
+
+
+def main():
+    toler_min = clustering._toler_min(clustering.TOLERANCE)
+    toler_max = clustering._toler_max(clustering.TOLERANCE)
+    engines = [
+        ('pairwise', clustering.normalise_pairwise),
+        ('sorted-python', lambda c: clustering._normalise_python(c, toler_min, toler_max)),
+    ]
+    if clustering.np is not None:
+        engines.append(('sorted-numpy', lambda c: clustering._normalise_numpy(c, toler_min, toler_max)))
+
+    print('{0:>8} {1:>15} {2:>12}'.format('edges', 'engine', 'ms/frame'))
+    for size in SIZES:
+        frame = helpers.jittered_frame(size)
+        for name, func in engines:
+            number = 1 if name == 'pairwise' and size >= 10000 else max(1, 10000 // size)
+            print('{0:>8} {1:>15} {2:>12.3f}'.format(size, name, measure(func, frame, number) * 1000))
+
+    print()
+    print('{0:>8} {1:>15} {2:>12}'.format('edges', 'presses', 'ms/capture'))
+    for size in SIZES:
+        records = [helpers.jittered_frame(size, seed) for seed in range(PRESSES)]
+        number = max(1, 1000 // size)
+        for name, func in (('per-record', lambda rs: [clustering.normalise(c) for c in rs]),
+                           ('batched', clustering.normalise_records)):
+            best = min(timeit.repeat(lambda: func([list(c) for c in records]), number=number, repeat=3))
+            print('{0:>8} {1:>15} {2:>12.3f}'.format(size, name, best / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
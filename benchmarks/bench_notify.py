@@ -0,0 +1,63 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+import capture
+
+"""
+pigpioの通知レポートの取り込み速度を比較する。
+test/data/ac_cool27.reportsを繰り返したものを、pigpioのコールバックスレッドと同じ
+レポート毎の処理(コールバック方式)とReportDecoderのstruct版・NumPy版で処理する。
+実行: python benchmarks/bench_notify.py
+"""
+
+REPORTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'data', 'ac_cool27.reports')
+REPEAT = 200
+READ_SIZE = 64 * 1024
+
+
+def per_edge_callback(data):
+    # pigpio._callback_threadと同じくレポート毎にunpackしてコールバックを呼ぶ
+    buffer = capture.EdgeRingBuffer(1 << 16)
+    bit = 1 << 17
+    last_level = bit
+    for offset in range(0, len(data), capture.REPORT.size):
+        seqno, flags, tick, level = capture.REPORT.unpack_from(data, offset)
+        if flags == 0:
+            if (level ^ last_level) & bit:
+                buffer.put(17, 1 if level & bit else 0, tick)
+            last_level = level
+        elif flags & capture.NTFY_FLAGS_WDOG and (flags & capture.NTFY_FLAGS_GPIO) == 17:
+            buffer.put(17, capture.TIMEOUT, tick)
+    return len(buffer)
+
+
+def bulk(data):
+    decoder = capture.ReportDecoder(17, 1 << 17)
+    edges = 0
+    for offset in range(0, len(data), READ_SIZE):
+        edges += len(decoder.decode(data[offset:offset + READ_SIZE]))
+    return edges
+
+
+def main():
+    with open(REPORTS_PATH, 'rb') as f:
+        data = f.read() * REPEAT
+    reports = len(data) // capture.REPORT.size
+    np = capture.np
+    engines = [('callback', per_edge_callback), ('bulk-struct', None)]
+    if np is not None:
+        engines.append(('bulk-numpy', None))
+
+    print('{0:>12} {1:>14}'.format('engine', 'reports/s'))
+    for name, func in engines:
+        capture.np = np if name == 'bulk-numpy' else None
+        func = func or bulk
+        best = min(timeit.repeat(lambda: func(data), number=1, repeat=5))
+        print('{0:>12} {1:>14,.0f}'.format(name, reports / best))
+    capture.np = np
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+import clustering
+import protocols
+
+"""
+プロトコル毎のデコードの速度を計る。
+各デコーダでエンコードしたパルス列にジッターを加えてnormaliseしたものを、全デコーダを順に試すprotocols.decodeに通す。
+最後の行は認識できない信号で、全デコーダが失敗するまでの時間。
+実行: python benchmarks/bench_protocols.py
+"""
+
+CODES = [
+    (protocols.NecDecoder(), {'protocol': 'nec', 'address': 0x04, 'command': 0x08, 'bits': 32, 'repeat': 1}),
+    (protocols.SircDecoder(), {'protocol': 'sirc', 'address': 0x01, 'command': 0x15, 'bits': 12, 'repeat': 2}),
+    (protocols.Rc5Decoder(), {'protocol': 'rc5', 'address': 0x05, 'command': 0x35, 'bits': 14, 'repeat': 0}),
+    (protocols.AehaDecoder(), {'protocol': 'aeha', 'address': 0x2002, 'command': '900405', 'bits': 40, 'repeat': 0}),
+    (protocols.MitsubishiAcDecoder(), {'protocol': 'mitsubishi_ac', 'address': None,
+                                       'command': '23cb26010020080309300000000000000000', 'bits': 144, 'repeat': 1}),
+    (protocols.DaikinAcDecoder(), {'protocol': 'daikin_ac', 'address': None,
+                                   'command': '11da2700c5000017-11da270042000054-11da270000393c00a0000006600000c1800060',
+                                   'bits': 280, 'repeat': 0}),
+]
+
+
+def prepared(pulses, seed=0):
+    rnd = random.Random(seed)
+    pulses = [int(x * rnd.uniform(0.95, 1.05)) for x in pulses]
+    clustering.normalise(pulses)
+    return pulses
+
+
+def measure(pulses, number):
+    best = min(timeit.repeat(lambda: protocols.decode(pulses), number=number, repeat=3))
+    return best / number
+
+
+def main():
+    print('{0:>14} {1:>8} {2:>12} {3:>12}'.format('protocol', 'pulses', 'us/decode', 'decodes/s'))
+    cases = [(code['protocol'], prepared(decoder.encode(code))) for decoder, code in CODES]
+    rnd = random.Random(1)
+    cases.append(('unknown', [rnd.randint(300, 3000) for i in range(199)]))
+    for name, pulses in cases:
+        seconds = measure(pulses, 2000)
+        print('{0:>14} {1:>8} {2:>12.1f} {3:>12.0f}'.format(name, len(pulses), seconds * 1e6, 1 / seconds))
+
+
+if __name__ == '__main__':
+    main()
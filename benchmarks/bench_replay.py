@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+import capture
+import edge_trace
+import fake_pigpio
+import raspberry_pi_boundary
+
+"""
+実機で受信したac:cool27(test/data/ac_cool27.reports)をfake_pigpioで再生し、
+コールバックからCaptureSession、normalise、tidy、デコードまでのキャプチャ1回の時間と、
+ジッタ・グリッチ・エッジの取りこぼしを加えたときにデコードできた割合を計る。
+再生は待たずに行い(speed=0)、キャプチャ後の猶予時間(grace_s)は0にする。
+実行: python benchmarks/bench_replay.py
+"""
+
+CAPTURES = 50
+REPORTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'data', 'ac_cool27.reports')
+NOISES = (
+    ('clean', {}),
+    ('jitter 20us', {'jitter_us': 20}),
+    ('jitter 80us', {'jitter_us': 80}),
+    ('glitch 10%', {'glitch_rate': 0.1}),
+    ('glitch 50%', {'glitch_rate': 0.5}),
+    ('drop 1%', {'drop_rate': 0.01}),
+    ('all', {'jitter_us': 40, 'glitch_rate': 0.2, 'drop_rate': 0.01}),
+)
+
+
+def recorded_trace():
+    with open(REPORTS_PATH, 'rb') as f:
+        data = f.read()
+    start_tick = capture.REPORT.unpack_from(data)[2]
+    edges = [(17, level, tick) for level, tick in capture.ReportDecoder(17, 1 << 17).decode(data) if level != capture.TIMEOUT]
+    return edge_trace.Trace((start_tick - 1000 * 1000) & 0xFFFFFFFF, edges)
+
+
+def replay(trace, expected, noise):
+    decoded = 0
+    elapsed = 0.0
+    for seed in range(CAPTURES):
+        pi = fake_pigpio.pi(trace=trace, speed=0, seed=seed, **noise)
+        boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(lambda: pi))
+        boundary.grace_s = 0
+        records = []
+        started = time.perf_counter()
+        boundary.start_capturing_remote_signal(lambda record, cancelled: records.append(record))
+        code = boundary.decode_remote_signal(records[0])
+        elapsed += time.perf_counter() - started
+        boundary.close()
+        decoded += code == expected
+    return elapsed / CAPTURES, decoded / CAPTURES
+
+
+def main():
+    trace = recorded_trace()
+    pi = fake_pigpio.pi(trace=trace, speed=0)
+    boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(lambda: pi))
+    records = []
+    boundary.start_capturing_remote_signal(lambda record, cancelled: records.append(record))
+    expected = boundary.decode_remote_signal(records[0])
+    boundary.close()
+    print('{0} edges, expected {1}'.format(len(trace), expected))
+    print('{0:>12} {1:>12} {2:>10}'.format('noise', 'ms/capture', 'decoded'))
+    for name, noise in NOISES:
+        ms, rate = replay(trace, expected, noise)
+        print('{0:>12} {1:>12.2f} {2:>9.0%}'.format(name, ms * 1000, rate))
+
+
+if __name__ == '__main__':
+    main()
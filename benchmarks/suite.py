@@ -0,0 +1,435 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ir_receiver'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import edge_trace
+import fake_pigpio
+import filesystem
+import library
+import protocols
+import raspberry_pi_boundary
+import sessions
+from test import helpers
+
+"""
+ir_receiverサービス全体のベンチマーク
+MediatorをRedisBoundary経由で動かし、リモコン信号はfake_pigpioで再生したトレースを使うので、
+ラズパイの無いLinuxで実行できる。結果はJSONに書き出し、--compareでコミット間を比べる。
+
+    capture:   start_ir_receivingの送信からstarted_ir_receivingの受信まで(start_ms)と、
+               トレースの最後のエッジからstopped_ir_receiving_valid_signalの受信まで(notify_ms)。実時間で再生する
+    library:   保存済みの信号が10〜10k個のときのsave_ir_signal/delete_ir_signalの処理速度と、起動時のインデックス作成時間
+    normalise: フレーム長毎のnormaliseとtidyの時間
+    rss:       キャプチャ・保存・削除を繰り返したときのRSSの推移
+    archive:   10k個の信号のライブラリの書き出し・読み込みの速度とアーカイブのサイズ。
+               ピークのメモリはtracemallocを有効にした別の実行で計る
+
+Redisはlocalhostのredis-server(--redis-dbのDBを消して使う)か、--fakeredisでfakeredisを使う。
+neochi-coreかRedisが無い場合、Mediatorを使うベンチマークはskippedとして記録する。
+実行: python benchmarks/suite.py --output results.json
+比較: python benchmarks/suite.py --compare old.json new.json
+"""
+
+LIBRARY_SIZES = (10, 100, 1000, 10000)
+FRAME_LENGTHS = (100, 1000, 10000)
+CAPTURES = 20
+OPERATIONS = 50
+RSS_SECONDS = 60
+ARCHIVE_SIZE = 10000
+# 記録を始めてから最初のエッジまで。CaptureSessionはcapture.PRE_US以上空いてからフレームを始める
+TRACE_LEAD_US = 300 * 1000
+
+
+def nec_trace():
+    nec = protocols.NecDecoder()
+    frame = nec.encode({'protocol': 'nec', 'address': 0x04, 'command': 0x08, 'bits': 32, 'repeat': 1})
+    return edge_trace.from_frames([frame], raspberry_pi_boundary.GPIO, lead_us=TRACE_LEAD_US)
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def summary_ms(samples):
+    return {'p50': percentile(samples, 50) * 1000, 'p95': percentile(samples, 95) * 1000,
+            'max': max(samples) * 1000, 'count': len(samples)}
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Linux以外はピークのRSS(KB)しか取れない
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+"""
+fake_pigpio.piに、最後にエッジを送った時刻を記録させる
+"""
+class TimedPi(fake_pigpio.pi):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_edge = None
+
+    def callback(self, gpio, edge=fake_pigpio.RISING_EDGE, func=None):
+        def timed(gpio, level, tick):
+            func(gpio, level, tick)
+            if level != fake_pigpio.TIMEOUT:
+                self.last_edge = time.perf_counter()
+        return super().callback(gpio, edge, timed)
+
+
+"""
+Mediator、RedisBoundary、fake_pigpioのRespberryPiBoundaryを組み立て、通知を購読する
+キャプチャの度にトレースを最初から再生するため、終わったキャプチャのpiは止めて次のキャプチャで接続し直させる
+"""
+class Service:
+    def __init__(self, client_factory, folder, speed):
+        import mediator
+        import redis_boundary
+        from neochi.core.dataflow.notifications import ir_receiver as notification
+        self.__notification = notification
+        mediator.IR_FOLDER_PATH = folder
+        self.folder = folder
+        self.client = client_factory()
+        self.notifications = queue.Queue()
+        self.__pubsub = self.client.pubsub()
+        self.__pubsub.subscribe(**{notification.IrReceiverNeochiApp.channel: self.__on_notification})
+        self.__listener = self.__pubsub.run_in_thread(sleep_time=0.001, daemon=True)
+        trace = nec_trace()
+        self.connection = raspberry_pi_boundary.PigpioConnection(lambda: TimedPi(trace=trace, speed=speed))
+        self.raspberry_pi = raspberry_pi_boundary.RespberryPiBoundary(self.connection)
+        self.filesystem = filesystem.Filesystem()
+        self.sessions = sessions.SessionManager(self.filesystem, folder)
+        self.mediator = mediator.Mediator()
+        self.redis_boundary = redis_boundary.RedisBoundary(self.mediator, client_factory())
+        started = time.perf_counter()
+        self.mediator.initialize(self.redis_boundary, self.filesystem, self.raspberry_pi, self.sessions)
+        self.initialize_s = time.perf_counter() - started
+        self.mediator.start()
+
+    def __on_notification(self, message):
+        self.notifications.put((time.perf_counter(), self.__notification.IrReceiverNeochiApp.data_type.decode(message['data'])))
+
+    def send(self, value):
+        n = self.__notification.NeochiAppIrReceiver
+        self.client.publish(n.channel, n.data_type.encode(value))
+
+    def wait_for(self, title, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            received, value = self.notifications.get(timeout=max(0.001, deadline - time.monotonic()))
+            if value['title'] == title:
+                return received, value
+
+    """
+    1回キャプチャしてセッションIDを返す。start_msとnotify_msの元になる時間も返す
+    """
+    def capture(self):
+        sent = time.perf_counter()
+        self.send({'title': 'start_ir_receiving'})
+        started, value = self.wait_for('started_ir_receiving')
+        done, value = self.wait_for('stopped_ir_receiving_valid_signal')
+        pi = self.connection.pi
+        last_edge = pi.last_edge
+        pi.stop()
+        return value['session'], started - sent, done - last_edge
+
+    def save(self, session_id, name):
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': name, 'sleep': 0,
+                                          'updatesFile': True, 'session': session_id})
+
+    def close(self):
+        self.mediator.stop()
+        self.__listener.stop()
+        self.__pubsub.close()
+
+
+def bench_capture(client_factory, args):
+    folder = tempfile.mkdtemp()
+    service = Service(client_factory, folder, speed=1)
+    try:
+        start_s, notify_s = [], []
+        for i in range(args.captures):
+            session_id, start, notify = service.capture()
+            start_s.append(start)
+            notify_s.append(notify)
+            service.mediator.on_receive_message({'title': 'discard_ir_signal', 'session': session_id})
+    finally:
+        service.close()
+        shutil.rmtree(folder)
+    return {'start_ms': summary_ms(start_s), 'notify_ms': summary_ms(notify_s),
+            'watchdog_ms': raspberry_pi_boundary.capture.POST_MS, 'grace_ms': raspberry_pi_boundary.GRACE_S * 1000}
+
+
+"""
+保存済みの信号をsize個用意する。Mediatorを通さず、fsyncもしない
+"""
+def fill_library(client, folder, size, record):
+    import redis_boundary
+    boundary = redis_boundary.RedisBoundary(None, client)
+    writer = filesystem.Filesystem(fsync_mode='none')
+    data = filesystem.encode_signals(record)
+    for i in range(size):
+        ir_signal_id = boundary.allocate_ir_signal_id()
+        name = '{0}.ir'.format(ir_signal_id)
+        timestamp = writer.write_file_atomically(os.path.join(folder, name), data)
+        boundary.save_ir_signal({'id': ir_signal_id, 'name': 'signal{0}'.format(i), 'sleep': 0,
+                                 'filePath': name, 'fileTimeStamp': timestamp, 'code': None})
+
+
+def bench_library(client_factory, args):
+    nec = protocols.NecDecoder()
+    results = []
+    for size in args.library_sizes:
+        client = client_factory()
+        client.flushdb()
+        folder = tempfile.mkdtemp()
+        try:
+            rnd = random.Random(size)
+            fill_library(client, folder, size, {'0': nec.encode({'protocol': 'nec', 'address': 1, 'command': 2, 'bits': 32, 'repeat': 1})})
+            service = Service(client_factory, folder, speed=0)
+            try:
+                ids = []
+                save_s = 0.0
+                for i in range(args.operations):
+                    session = service.sessions.create()
+                    service.sessions.begin(session.id)
+                    code = {'protocol': 'nec', 'address': rnd.randrange(256), 'command': rnd.randrange(256), 'bits': 32, 'repeat': 1}
+                    service.sessions.store(session.id, {'0': nec.encode(code)}, code)
+                    started = time.perf_counter()
+                    service.save(session.id, 'new{0}'.format(i))
+                    save_s += time.perf_counter() - started
+                    ids.append(service.redis_boundary.get_ir()['signals'][-1]['id'])
+                started = time.perf_counter()
+                for ir_signal_id in ids:
+                    service.mediator.on_receive_message({'title': 'delete_ir_signal', 'id': ir_signal_id})
+                delete_s = time.perf_counter() - started
+                results.append({'size': size, 'initialize_ms': service.initialize_s * 1000,
+                                'saves_per_s': args.operations / save_s, 'deletes_per_s': args.operations / delete_s})
+            finally:
+                service.close()
+        finally:
+            shutil.rmtree(folder)
+            client.flushdb()
+        print('  library {0}: {1}'.format(size, results[-1]))
+    return results
+
+
+"""
+内容の違う信号ファイルを持つ信号をsize個用意する
+"""
+def fill_distinct_library(client, folder, size):
+    import redis_boundary
+    boundary = redis_boundary.RedisBoundary(None, client)
+    writer = filesystem.Filesystem(fsync_mode='none')
+    nec = protocols.NecDecoder()
+    for i in range(size):
+        code = {'protocol': 'nec', 'address': i >> 8 & 0xFF, 'command': i & 0xFF, 'bits': 32, 'repeat': 1}
+        name, timestamp = writer.save_content(folder, filesystem.encode_signals({'0': nec.encode(code)}), sync_directory=False)
+        boundary.save_ir_signal({'id': boundary.allocate_ir_signal_id(), 'name': 'signal{0}'.format(i), 'sleep': 0,
+                                 'filePath': name, 'fileTimeStamp': timestamp, 'code': code})
+
+
+"""
+書き出して、空のRedisと空のフォルダに読み込む。(書き出しの秒数, 読み込みの秒数)を返す
+"""
+def export_and_import(client, source, target, path):
+    import redis_boundary
+    boundary = redis_boundary.RedisBoundary(None, client)
+    started = time.perf_counter()
+    library.export_library(boundary, source, path)
+    export_s = time.perf_counter() - started
+    client.flushdb()
+    started = time.perf_counter()
+    library.import_library(boundary, filesystem.Filesystem(), target, path)
+    return export_s, time.perf_counter() - started
+
+
+def bench_archive(client_factory, args):
+    import signal_store
+    client = client_factory()
+    results = []
+    for traced in (False, True):
+        client.flushdb()
+        source, target = tempfile.mkdtemp(), tempfile.mkdtemp()
+        path = os.path.join(tempfile.mkdtemp(), library.ARCHIVE_NAME)
+        try:
+            fill_distinct_library(client, source, args.archive_size)
+            if traced:
+                tracemalloc.start()
+            export_s, import_s = export_and_import(client, source, target, path)
+            if traced:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            imported = client.zcard(signal_store.INDEX_KEY)
+            results.append((export_s, import_s, peak if traced else os.path.getsize(path), imported))
+        finally:
+            shutil.rmtree(source)
+            shutil.rmtree(target)
+            shutil.rmtree(os.path.dirname(path))
+            client.flushdb()
+    (export_s, import_s, archive_bytes, imported), (_, _, peak_bytes, _) = results
+    return {'size': args.archive_size, 'imported': imported, 'exports_per_s': args.archive_size / export_s,
+            'imports_per_s': args.archive_size / import_s, 'archive_bytes': archive_bytes, 'peak_bytes': peak_bytes}
+
+
+def bench_normalise(args):
+    boundary = raspberry_pi_boundary.RespberryPiBoundary(
+        raspberry_pi_boundary.PigpioConnection(lambda: fake_pigpio.pi(trace=nec_trace())))
+    results = []
+    try:
+        for length in args.frame_lengths:
+            frame = helpers.jittered_frame(length)
+            number = max(1, 10000 // length)
+            normalise_s = tidy_s = 0.0
+            for i in range(number):
+                code = list(frame)
+                started = time.perf_counter()
+                boundary.normalise(code)
+                normalise_s += time.perf_counter() - started
+                records = {'0': code}
+                started = time.perf_counter()
+                boundary.tidy(records)
+                tidy_s += time.perf_counter() - started
+            results.append({'length': length, 'normalise_ms': normalise_s / number * 1000, 'tidy_ms': tidy_s / number * 1000})
+    finally:
+        boundary.close()
+    return results
+
+
+def bench_rss(client_factory, args):
+    folder = tempfile.mkdtemp()
+    service = Service(client_factory, folder, speed=0)
+    samples = []
+    cycles = 0
+    try:
+        started = time.monotonic()
+        next_sample = started
+        while time.monotonic() - started < args.rss_seconds:
+            session_id, start, notify = service.capture()
+            service.save(session_id, 'rss')
+            ir_signal_id = service.redis_boundary.get_ir()['signals'][-1]['id']
+            service.mediator.on_receive_message({'title': 'delete_ir_signal', 'id': ir_signal_id})
+            cycles += 1
+            if time.monotonic() >= next_sample:
+                samples.append((time.monotonic() - started, rss_bytes()))
+                next_sample += 1.0
+    finally:
+        service.close()
+        shutil.rmtree(folder)
+    rss = [x for t, x in samples]
+    return {'cycles': cycles, 'seconds': args.rss_seconds, 'start_bytes': rss[0], 'end_bytes': rss[-1],
+            'max_bytes': max(rss), 'growth_bytes': rss[-1] - rss[0], 'samples': samples}
+
+
+def redis_client_factory(args):
+    if args.fakeredis:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        return lambda: fakeredis.FakeStrictRedis(server=server)
+    import redis
+    return lambda: redis.StrictRedis('localhost', db=args.redis_db)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = {}
+    benchmarks = {
+        'normalise': lambda: bench_normalise(args),
+        'capture': lambda: bench_capture(redis_client_factory(args), args),
+        'library': lambda: bench_library(redis_client_factory(args), args),
+        'rss': lambda: bench_rss(redis_client_factory(args), args),
+        'archive': lambda: bench_archive(redis_client_factory(args), args),
+    }
+    for name in args.only or list(benchmarks):
+        print('{0}...'.format(name))
+        try:
+            results[name] = benchmarks[name]()
+        except ImportError as error:
+            # neochi-core、redis-py、fakeredisが無い
+            results[name] = {'skipped': str(error)}
+        except Exception as error:
+            if type(error).__module__.startswith('redis'):
+                results[name] = {'skipped': 'Redis is not available: {0}'.format(error)}
+            else:
+                raise
+        print('  {0}'.format(json.dumps(results[name])[:200]))
+    return {'commit': git_commit(), 'time': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+            'machine': platform.machine(), 'redis': 'fakeredis' if args.fakeredis else 'redis-server', 'results': results}
+
+
+"""
+2つの結果の数値を並べる。時間とRSSは小さいほど、per_sは大きいほど良い
+"""
+def compare(old, new):
+    def flatten(prefix, value, out):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                flatten('{0}.{1}'.format(prefix, key) if prefix else key, item, out)
+        elif isinstance(value, list) and value and isinstance(value[0], dict):
+            for item in value:
+                key = next(k for k in ('size', 'length') if k in item)
+                flatten('{0}[{1}]'.format(prefix, item[key]), dict((k, v) for k, v in item.items() if k != key), out)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[prefix] = value
+        return out
+    before = flatten('', old['results'], {})
+    after = flatten('', new['results'], {})
+    print('{0} -> {1}'.format(old.get('commit'), new.get('commit')))
+    print('{0:<40} {1:>14} {2:>14} {3:>8}'.format('metric', 'before', 'after', 'change'))
+    for key in sorted(set(before) & set(after)):
+        change = (after[key] - before[key]) / before[key] if before[key] else 0.0
+        print('{0:<40} {1:>14.3f} {2:>14.3f} {3:>+8.1%}'.format(key, before[key], after[key], change))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--only', action='append', choices=['normalise', 'capture', 'library', 'rss', 'archive'])
+    parser.add_argument('--fakeredis', action='store_true', help='redis-serverの代わりにfakeredisを使う')
+    parser.add_argument('--redis-db', type=int, default=15, help='使うredis-serverのDB番号。中身は消える')
+    parser.add_argument('--quick', action='store_true', help='回数とサイズを減らしてすぐに終わらせる')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return
+    args.captures = 5 if args.quick else CAPTURES
+    args.operations = 10 if args.quick else OPERATIONS
+    args.library_sizes = LIBRARY_SIZES[:3] if args.quick else LIBRARY_SIZES
+    args.frame_lengths = FRAME_LENGTHS
+    args.rss_seconds = 5 if args.quick else RSS_SECONDS
+    args.archive_size = ARCHIVE_SIZE // 10 if args.quick else ARCHIVE_SIZE
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote {0}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,530 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import threading
+import config
+import fingerprint
+import library
+import monitor
+import sessions
+from mediator import IR_FOLDER_PATH
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+def _set_result(future, result):
+    # 待つのを止めた後に届いた完了通知は捨てる
+    if not future.done():
+        future.set_result(result)
+
+
+"""
+AsyncMediatorクラス
+Mediatorのasyncio版。Redisのメッセージ、キャプチャの完了をすべて1つのイベントループで処理する。
+ラズパイのキャプチャスレッドからの完了通知はcall_soon_threadsafeでイベントループに渡す。
+pigpiodとの通信(再接続の待ちを含む)やスレッドのjoinなど、ブロックするRespberryPiBoundaryの呼び出しは
+run_in_executorで行い、イベントループを止めない。
+"""
+
+
+class AsyncMediator:
+    def __init__(self):
+        self.__redis_boundary = None
+        self.__filesystem = None
+        self.__raspberry_pi = None
+        # {GPIO: RespberryPiBoundary}。メッセージの'gpio'で受信機を選び、無ければ最初の受信機(__raspberry_pi)を使う
+        self.__receivers = {}
+        self.__default_gpio = None
+        self.__sessions = None
+        # 受信機毎の最後のキャプチャ。同じ受信機のキャプチャは順番に、別の受信機のキャプチャは同時に行う
+        self.__captures = {}
+        # begin_capturing_remote_signalをexecutorで実行中の受信機のGPIOと、その間にstopが来たかどうか
+        self.__beginning = {}
+        # モニターモード中のフレームの書き込みと、モニターモードの受信機のGPIO
+        self.__monitor = None
+        self.__monitoring = set()
+        # 保存済みの信号の指紋。保存・削除の度に更新する
+        self.__index = fingerprint.FingerprintIndex()
+        # 書き出し・読み込みのタスク。終わると結果をpublishし、stopで終わるまで待つ
+        self.__library_tasks = set()
+        self.__library_lock = asyncio.Lock()
+        # 信号ファイルは同じ内容の信号で共有するので、参照の付け替えとファイルの削除の間に他の保存・削除を挟まない
+        # 保守(maintenance.ConsistencyScanner)のスレッドとも共有するのでthreading.Lockを__locked_filesで取る
+        # タスク同士はasyncio.Lockで順番にし、threading.Lockを待つ間もイベントループは止めない
+        self.__files_lock = asyncio.Lock()
+        self.__files_thread_lock = threading.Lock()
+        # 読み込み中のライブラリが保存した信号ファイル。信号を追加し終えるまでは参照が無くても削除しない
+        self.__pinned_files = set()
+        # メッセージのtitle毎の処理
+        self.__handlers = {
+            'start_ir_receiving': self.__start_ir_receiving,
+            'stop_ir_receiving': self.__stop_ir_receiving,
+            'save_ir_signal': self.__save_ir_signal,
+            'discard_ir_signal': self.__discard_ir_signal,
+            'delete_ir_signal': self.__delete_ir_signal,
+            'identify_ir_signal': self.__identify_ir_signal,
+            'start_monitoring': self.__start_monitoring,
+            'stop_monitoring': self.__stop_monitoring,
+            'export_ir_library': self.__export_ir_library,
+            'import_ir_library': self.__import_ir_library,
+        }
+
+    """
+        信号ファイルの参照の付け替えと削除を行う間に取るロック。保守のスレッドに渡す
+    """
+    @property
+    def files_lock(self):
+        return self.__files_thread_lock
+
+    @contextlib.asynccontextmanager
+    async def __locked_files(self):
+        async with self.__files_lock:
+            lock = self.__files_thread_lock
+            if not lock.acquire(blocking=False):
+                acquiring = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+                try:
+                    await asyncio.shield(acquiring)
+                except asyncio.CancelledError:
+                    # 取れた後で放す
+                    acquiring.add_done_callback(lambda _: lock.release())
+                    raise
+            try:
+                yield
+            finally:
+                lock.release()
+
+    """
+        raspberry_piはRespberryPiBoundaryか、raspberry_pi_boundary.receiversの{GPIO: RespberryPiBoundary}
+    """
+    async def initialize(self, redis_boundary, filesystem, raspberry_pi, session_manager=None):
+        self.__redis_boundary = redis_boundary
+        await self.__redis_boundary.set_state('booting')
+        if await self.__redis_boundary.migrate_ir():
+            logger.debug('Migrated ir to per-signal storage')
+        self.__filesystem = filesystem
+        self.__receivers = raspberry_pi if isinstance(raspberry_pi, dict) else {None: raspberry_pi}
+        self.__default_gpio = next(iter(self.__receivers))
+        self.__raspberry_pi = self.__receivers[self.__default_gpio]
+        if session_manager is None:
+            session_manager = sessions.SessionManager(filesystem, IR_FOLDER_PATH)
+        self.__sessions = session_manager
+        await self.__build_index()
+
+    """
+        保存済みの信号ファイルを読んで指紋のインデックスを作る
+        ファイルはexecutorで新しいインデックスに読み、読み終えてから置き換える
+    """
+    async def __build_index(self):
+        signals = (await self.__redis_boundary.get_ir())['signals']
+        self.__index = await asyncio.get_running_loop().run_in_executor(None, self.__load_index, signals)
+        logger.debug('Indexed {0} signals'.format(len(self.__index)))
+
+    def __load_index(self, signals):
+        index = fingerprint.FingerprintIndex()
+        for signal in signals:
+            if signal['filePath'] is None:
+                continue
+            file_path = '{0}/{1}'.format(IR_FOLDER_PATH, signal['filePath'])
+            try:
+                with self.__filesystem.load_signal_file(file_path) as f:
+                    index.add(signal['id'], fingerprint.record_pulses(f.to_dict()))
+            except (OSError, ValueError) as error:
+                logger.error('Indexing {0} failed: {1}'.format(file_path, error))
+        return index
+
+    """
+        Redisデータの受付を開始し、キャンセルされるまでメッセージを処理する
+    """
+    async def run(self):
+        self.__sessions.start_sweeper()
+        await self.__redis_boundary.set_state('ready')
+        if config.MONITOR:
+            await self.__start_monitoring({})
+        async for value in self.__redis_boundary.messages():
+            await self.on_receive_message(value)
+
+    async def stop(self):
+        if self.__captures:
+            self.__sessions.cancel_all()
+            for gpio in self.__captures:
+                self.__stop_capturing(gpio)
+            await asyncio.gather(*self.__captures.values(), return_exceptions=True)
+        if self.__library_tasks:
+            await asyncio.gather(*self.__library_tasks, return_exceptions=True)
+        await self.__close_monitor(self.__monitoring)
+        loop = asyncio.get_running_loop()
+        for raspberry_pi in self.__receivers.values():
+            await loop.run_in_executor(None, raspberry_pi.close)
+        self.__sessions.stop_sweeper()
+        await self.__redis_boundary.close()
+
+    async def on_receive_message(self, value):
+        handler = self.__handlers.get(value['title'])
+        if handler is not None:
+            await handler(value)
+
+    """
+        メッセージの'gpio'の受信機のGPIOを返す。'gpio'が無ければ最初の受信機
+    """
+    def __gpio(self, value):
+        gpio = value.get('gpio')
+        return self.__default_gpio if gpio is None else gpio
+
+    """
+        gpioの受信機が無ければエラーを通知してFalseを返す
+    """
+    async def __has_receiver(self, gpio):
+        if gpio in self.__receivers:
+            return True
+        logger.error('No ir receiver on GPIO {0}'.format(gpio))
+        await self.__redis_boundary.publish_ir_receiver_not_found_error(gpio)
+        return False
+
+    """
+        'gpio'の受信機のGPIOを返す。'gpio'が無ければ全受信機。受信機が無ければエラーを通知して空にする
+    """
+    async def __addressed_gpios(self, value):
+        if value.get('gpio') is None:
+            return list(self.__receivers)
+        return [value['gpio']] if await self.__has_receiver(value['gpio']) else []
+
+    """
+        セッションのキャプチャに使う受信機を返す。セッションが無ければ最初の受信機
+    """
+    def __receiver_of(self, session_id):
+        return self.__receivers[self.__gpio_of(session_id)]
+
+    def __gpio_of(self, session_id):
+        session = self.__sessions.get(session_id)
+        return session.gpio if session is not None else self.__default_gpio
+
+    """
+        gpioの受信機のキャプチャを中止する。begin_capturing_remote_signalの実行中であれば始まった後に中止する
+    """
+    def __stop_capturing(self, gpio):
+        if gpio in self.__beginning:
+            self.__beginning[gpio] = True
+        self.__receivers[gpio].stop_capturing_remote_signal()
+
+    """
+        キャプチャのセッションを作り、ラズパイからリモコン信号のキャプチャを開始する。
+        キャプチャの完了は待たずに戻る。'gpio'の受信機で受信し、同じ受信機で前のセッションのキャプチャ中であればその後に行う。
+    """
+    async def __start_ir_receiving(self, value):
+        gpio = self.__gpio(value)
+        if not await self.__has_receiver(gpio):
+            return
+        session = self.__sessions.create(value.get('presses') or config.CAPTURE_PRESSES, gpio)
+        logger.debug('Received start_ir_receiving. session is {0}'.format(session.id))
+        async with self.__redis_boundary.batch():
+            await self.__redis_boundary.set_state('receiving')
+            await self.__redis_boundary.publish_started_ir_receiving(session.id, gpio)
+        self.__captures[gpio] = asyncio.ensure_future(self.__capture_remote_signal(self.__captures.get(gpio), session.id))
+
+    async def __capture_remote_signal(self, previous, session_id):
+        if previous is not None:
+            # 前のキャプチャが終わるまで待つ
+            await asyncio.gather(previous, return_exceptions=True)
+        if not self.__sessions.begin(session_id):
+            # キャプチャ待ちの間にキャンセルされた
+            await self.remote_signal_received(None, True, session_id)
+            return
+        session = self.__sessions.get(session_id)
+        raspberry_pi = self.__receivers[session.gpio]
+        presses = session.presses
+        codes = []
+        try:
+            while True:
+                record, cancelled = await self.__capture_press(session.gpio, presses == 1)
+                if cancelled or presses == 1:
+                    break
+                codes.append(record['0'])
+                if len(codes) == presses:
+                    record = await asyncio.get_running_loop().run_in_executor(None, raspberry_pi.merge_remote_signals, codes)
+                    break
+                # もう一度押してもらう
+                await self.__redis_boundary.publish_stopped_ir_receiving_more_signal(session_id)
+        except Exception as error:
+            logger.error('Capturing remote signal failed: {0}'.format(error))
+            await self.__invalid_signal_received(session_id)
+            return
+        if record is None:
+            logger.error('Captured {0} presses do not agree'.format(presses))
+            await self.__invalid_signal_received(session_id)
+            return
+        await self.remote_signal_received(record, cancelled, session_id)
+
+    """
+        ボタン1回分をキャプチャし、受信した信号とキャンセルされたかどうかを返す
+    """
+    async def __capture_press(self, gpio, tidy):
+        raspberry_pi = self.__receivers[gpio]
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self.__beginning[gpio] = False
+        try:
+            # pigpiodに接続し直す場合は待つので、イベントループの外で行う
+            session = await loop.run_in_executor(None, raspberry_pi.begin_capturing_remote_signal,
+                                                 lambda session: loop.call_soon_threadsafe(_set_result, done, session))
+        finally:
+            stop_requested = self.__beginning.pop(gpio)
+        if stop_requested:
+            raspberry_pi.stop_capturing_remote_signal()
+        try:
+            await done
+            await asyncio.sleep(raspberry_pi.grace_s)
+        finally:
+            # キャプチャのスレッドをjoinする
+            record, cancelled = await loop.run_in_executor(None, raspberry_pi.finish_capturing_remote_signal, session, tidy)
+        return record, cancelled
+
+    async def __invalid_signal_received(self, session_id):
+        self.__sessions.drop(session_id)
+        async with self.__redis_boundary.batch():
+            await self.__set_state_after_capture()
+            await self.__redis_boundary.publish_stopped_ir_receiving_invalid_signal(session_id)
+
+    """
+        キャプチャ待ちのセッションが無くなったらreadyに戻す
+    """
+    async def __set_state_after_capture(self):
+        await self.__redis_boundary.set_state('receiving' if self.__sessions.pending() else 'ready')
+
+    """
+        リモコンの信号受信を中止する。sessionが無い場合は'gpio'の受信機(無ければ全受信機)でキャプチャ中のものを中止する
+    """
+    async def __stop_ir_receiving(self, value):
+        session_id = value.get('session')
+        if session_id is not None:
+            if self.__sessions.cancel(session_id):
+                return
+            if self.__sessions.is_capturing(session_id):
+                self.__stop_capturing(self.__gpio_of(session_id))
+            return
+        for gpio in await self.__addressed_gpios(value):
+            self.__stop_capturing(gpio)
+
+    """
+        セッションでキャプチャしたリモコン信号を永続化する
+        sessionが無い場合は最後にキャプチャしたセッションを使う
+    """
+    async def __save_ir_signal(self, value):
+        logger.debug('Received save_ir_signal %s', value)
+        ir_signal_id, name, sleep, updates_file = value['id'], value['name'], value['sleep'], value['updatesFile']
+        session = None
+        if updates_file:
+            session = self.__sessions.take(value.get('session'))
+            if session is None:
+                logger.error('No captured signal for session {0}'.format(value.get('session')))
+                await self.__redis_boundary.publish_ir_signal_saving_error()
+                return
+        # 既存の信号はget_ir_signalの後に削除されていれば保存しない(項目の欠けた信号を作らない)
+        only_existing = ir_signal_id is not None
+        if ir_signal_id is None:
+            ir_signal_id = await self.__redis_boundary.allocate_ir_signal_id()
+            signal = {'id': ir_signal_id, 'filePath': None, 'fileTimeStamp': None, 'code': None}
+        elif await self.__redis_boundary.get_ir_signal(ir_signal_id) is not None:
+            signal = {'id': ir_signal_id}
+        else:
+            signal = None
+        loop = asyncio.get_running_loop()
+        if signal is not None:
+            signal['name'] = name
+            signal['sleep'] = sleep
+            async with self.__locked_files():
+                if session is not None:
+                    # 内容のハッシュの名前で保存する。同じ内容のファイルが既にあれば書き込まない
+                    pulses = fingerprint.record_pulses(self.__sessions.signals(session))
+                    if session.spill_path is not None:
+                        new_file_name, timestamp = await loop.run_in_executor(
+                            None, self.__filesystem.move_content, IR_FOLDER_PATH, session.spill_path)
+                    else:
+                        new_file_name, timestamp = await loop.run_in_executor(
+                            None, self.__filesystem.save_content, IR_FOLDER_PATH, session.data)
+                    signal['filePath'] = new_file_name
+                    signal['fileTimeStamp'] = timestamp
+                    signal['code'] = session.code
+                released = []
+                saved = await self.__redis_boundary.save_ir_signal(signal, only_existing=only_existing, released=released)
+                if session is not None:
+                    if saved:
+                        self.__index.add(ir_signal_id, pulses)
+                    elif not await self.__redis_boundary.is_ir_file_referenced(new_file_name):
+                        released.append(new_file_name)
+                await loop.run_in_executor(None, self.__delete_released_files, released)
+        elif session is not None and session.spill_path is not None:
+            await loop.run_in_executor(None, self.__filesystem.delete_file, session.spill_path)
+        await self.__redis_boundary.publish_saved_ir_signal(ir_signal_id)
+
+    """
+        セッションでキャプチャしたリモコン信号を破棄する
+    """
+    async def __discard_ir_signal(self, value):
+        session_id = value.get('session')
+        if self.__sessions.discard(session_id):
+            await self.__redis_boundary.publish_discarded_ir_signal(session_id)
+        else:
+            await self.__redis_boundary.publish_ir_signal_discarding_error()
+
+    """
+        永続化されているリモコン信号ファイルとRedisからデータを削除する
+    """
+    async def __delete_ir_signal(self, value):
+        ir_signal_id = value['id']
+        logger.debug('Received delete_ir_signal {0}'.format(ir_signal_id))
+        async with self.__locked_files():
+            released = []
+            await self.__redis_boundary.delete_ir_signal(ir_signal_id, released)
+            await asyncio.get_running_loop().run_in_executor(None, self.__delete_released_files, released)
+        self.__index.remove(ir_signal_id)
+        await self.__redis_boundary.publish_deleted_ir_signal(ir_signal_id)
+
+    """
+        どの信号からも参照されなくなった信号ファイルを削除する
+    """
+    def __delete_released_files(self, released):
+        for file_name in released:
+            if file_name in self.__pinned_files:
+                # 読み込み中のライブラリの信号が参照する。読み込みの後で__unpin_filesが調べる
+                continue
+            self.__filesystem.delete_file('{0}/{1}'.format(IR_FOLDER_PATH, file_name))
+
+    """
+        ライブラリの読み込みで保存したファイルの固定を外し、どの信号からも参照されていなければ削除する
+    """
+    async def __unpin_files(self):
+        loop = asyncio.get_running_loop()
+        for file_name in list(self.__pinned_files):
+            async with self.__locked_files():
+                self.__pinned_files.discard(file_name)
+                if not await self.__redis_boundary.is_ir_file_referenced(file_name):
+                    await loop.run_in_executor(None, self.__delete_released_files, [file_name])
+
+    """
+        セッションでキャプチャした信号が保存済みのどの信号かを調べる
+        sessionが無い場合は最後にキャプチャしたセッションを使う。セッションはそのまま残す
+    """
+    async def __identify_ir_signal(self, value):
+        session = self.__sessions.peek(value.get('session'))
+        if session is None:
+            await self.__redis_boundary.publish_ir_signal_identifying_error(value.get('session'))
+            return
+        pulses = fingerprint.record_pulses(self.__sessions.signals(session))
+        ir_signal_id = self.__index.identify(pulses)
+        logger.debug('Identified session {0} as {1}'.format(session.id, ir_signal_id))
+        await self.__redis_boundary.publish_identified_ir_signal(ir_signal_id, session.id)
+
+    """
+        書き出し・読み込みをバックグラウンドのタスクで始める。その間も他のメッセージを処理する
+    """
+    def __start_library_task(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.__library_tasks.add(task)
+        task.add_done_callback(self.__library_tasks.discard)
+
+    """
+        全信号を'path'(無ければIR_FOLDER_PATHのlibrary.ARCHIVE_NAME)のアーカイブに書き出す
+    """
+    async def __export_ir_library(self, value):
+        path = value.get('path') or '{0}/{1}'.format(IR_FOLDER_PATH, library.ARCHIVE_NAME)
+        self.__start_library_task(self.__export_library(path))
+
+    async def __export_library(self, path):
+        async with self.__library_lock:
+            try:
+                count = await library.export_library_async(self.__redis_boundary, IR_FOLDER_PATH, path)
+            except Exception as error:
+                logger.error('Exporting ir library to {0} failed: {1}'.format(path, error))
+                await self.__redis_boundary.publish_ir_library_exporting_error(path)
+                return
+        logger.debug('Exported {0} signals to {1}'.format(count, path))
+        await self.__redis_boundary.publish_exported_ir_library(path, count)
+
+    """
+        'path'のアーカイブの信号を新しいIDで追加し、指紋のインデックスを作り直す
+        ファイルのロックは信号ファイル毎と、インデックスを作り直す間だけ取るので、読み込みの間も保存・削除を処理する
+    """
+    async def __import_ir_library(self, value):
+        path = value.get('path') or '{0}/{1}'.format(IR_FOLDER_PATH, library.ARCHIVE_NAME)
+        self.__start_library_task(self.__import_library(path))
+
+    async def __import_library(self, path):
+        async with self.__library_lock:
+            try:
+                try:
+                    count = await library.import_library_async(self.__redis_boundary, self.__filesystem, IR_FOLDER_PATH, path,
+                                                               self.__files_thread_lock, self.__pinned_files)
+                finally:
+                    await self.__unpin_files()
+                async with self.__locked_files():
+                    await self.__build_index()
+            except Exception as error:
+                logger.error('Importing ir library from {0} failed: {1}'.format(path, error))
+                await self.__redis_boundary.publish_ir_library_importing_error(path)
+                return
+        logger.debug('Imported {0} signals from {1}'.format(count, path))
+        await self.__redis_boundary.publish_imported_ir_library(path, count)
+
+    """
+        モニターモードを開始する。受信したフレームはRedis Streamに追加し続ける
+        'gpio'が無ければ全受信機で開始する。フレームの書き込みは全受信機で1つにまとめる
+    """
+    async def __start_monitoring(self, value):
+        gpios = await self.__addressed_gpios(value)
+        if not gpios:
+            return
+        if self.__monitor is None:
+            self.__monitor = monitor.AsyncFrameMonitor(self.__raspberry_pi, self.__redis_boundary.add_monitor_frames)
+            self.__monitor.start()
+        loop = asyncio.get_running_loop()
+        for gpio in gpios:
+            if gpio not in self.__monitoring:
+                self.__monitoring.add(gpio)
+                await loop.run_in_executor(None, self.__receivers[gpio].start_monitoring,
+                                           functools.partial(self.__monitor.put, gpio=gpio))
+        await self.__redis_boundary.publish_started_monitoring()
+
+    async def __stop_monitoring(self, value):
+        gpios = await self.__addressed_gpios(value)
+        if not gpios:
+            return
+        await self.__close_monitor(gpios)
+        await self.__redis_boundary.publish_stopped_monitoring()
+
+    """
+        gpiosの受信機のモニターモードを止め、どの受信機もモニターモードでなくなったら書き込みも止める
+    """
+    async def __close_monitor(self, gpios):
+        loop = asyncio.get_running_loop()
+        for gpio in list(gpios):
+            if gpio in self.__monitoring:
+                self.__monitoring.discard(gpio)
+                # モニターのセッションのスレッドをjoinする
+                await loop.run_in_executor(None, self.__receivers[gpio].stop_monitoring)
+        if self.__monitor is None or self.__monitoring:
+            return
+        await self.__monitor.stop()
+        self.__monitor = None
+
+    """
+        ラズパイから信号受信したときの処理
+        受信した信号はsave_ir_signalかdiscard_ir_signalまでセッションに置いておく
+    """
+    async def remote_signal_received(self, signals, cancelled, session_id=None):
+        logger.debug('Received remote signal')
+        if cancelled:
+            self.__sessions.drop(session_id)
+            async with self.__redis_boundary.batch():
+                await self.__set_state_after_capture()
+                await self.__redis_boundary.publish_stopped_ir_receiving_stop_message(session_id)
+            return
+        code = self.__receiver_of(session_id).decode_remote_signal(signals)
+        if not self.__sessions.store(session_id, signals, code):
+            logger.error('Session {0} was dropped before storing the signal'.format(session_id))
+            await self.__invalid_signal_received(session_id)
+            return
+        async with self.__redis_boundary.batch():
+            await self.__set_state_after_capture()
+            await self.__redis_boundary.publish_stopped_ir_receiving_valid_signal(session_id, code)
@@ -0,0 +1,224 @@
+import contextvars
+import logging
+import redis.asyncio as redis
+from contextlib import asynccontextmanager
+from neochi.core.dataflow.data import ir_receiver as data
+from neochi.core.dataflow.notifications import ir_receiver as notification
+import config
+import metrics
+import signal_store
+from redis_boundary import MONITOR_STREAM_KEY, with_gpio, with_session
+
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+
+"""
+redis.asyncioでRedisとの通信を行うクラス
+RedisBoundaryのasyncio版。neochi-coreのデータ・通知クラスと同じキー、チャンネル、エンコードを使う。
+"""
+
+
+class AsyncRedisBoundary:
+
+    def __init__(self):
+        self._r = redis.StrictRedis('localhost')
+        # batch()中のタスクではそのタスクのパイプラインに書き込む
+        self.__pipe = contextvars.ContextVar('pipe', default=None)
+        self._signals = signal_store.AsyncSignalStore(self._r, data.Ir.key if config.LEGACY_IR_VIEW else None,
+                                                      signal_store.SignalCache() if config.SIGNAL_CACHE else None)
+
+    """
+    with内の状態の設定と通知を1つのMULTI/EXECにまとめて送る。RedisBoundary.batchと同じ
+    """
+    @asynccontextmanager
+    async def batch(self):
+        if self.__pipe.get() is not None:
+            yield
+            return
+        pipe = self._r.pipeline(transaction=True)
+        token = self.__pipe.set(pipe)
+        try:
+            yield
+            await pipe.execute()
+        finally:
+            self.__pipe.reset(token)
+            await pipe.reset()
+
+    def _client(self):
+        pipe = self.__pipe.get()
+        return pipe if pipe is not None else self._r
+
+    async def _get(self, data_class):
+        return data_class.data_type.decode(await self._r.get(data_class.key))
+
+    async def _set(self, data_class, value):
+        await self._client().set(data_class.key, data_class.data_type.encode(value))
+
+    async def _publish(self, value):
+        n = notification.IrReceiverNeochiApp
+        await self._client().publish(n.channel, n.data_type.encode(value))
+
+    """
+    neochi-appからのメッセージを受信する毎に返す非同期ジェネレータ
+    """
+    async def messages(self):
+        n = notification.NeochiAppIrReceiver
+        pubsub = self._r.pubsub()
+        await pubsub.subscribe(n.channel)
+        try:
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    yield n.data_type.decode(message['data'])
+        finally:
+            await pubsub.unsubscribe(n.channel)
+            await pubsub.aclose()
+
+    async def close(self):
+        await self._r.aclose()
+
+    """
+    現在のIr-reciverの状態を取得する
+    """
+    async def get_state(self):
+        return await self._get(data.State)
+
+    """
+    現在のIr-reciverの状態を設定する
+    """
+    async def set_state(self, new_state):
+        await self._set(data.State, new_state)
+
+    """
+    Redisに格納されている最新のIRを{'signals': [...]}の形式で取得する
+    """
+    async def get_ir(self):
+        return await self._signals.get_all()
+
+    """
+    信号のキャッシュのヒット数、ミス数、ヒット率。キャッシュを使わない場合はNone
+    """
+    def get_signal_cache_stats(self):
+        cache = self._signals.cache
+        if cache is None:
+            return None
+        return {'hits': cache.hits, 'misses': cache.misses, 'hit_rate': cache.hit_rate}
+
+    def collect_metrics(self):
+        stats = self.get_signal_cache_stats() or {}
+        return dict(('signal_cache_' + key, value) for key, value in stats.items())
+
+    """
+    Redisに最新のIR情報を設定する。全信号が置き換わる
+    """
+    async def set_ir(self, new_ir):
+        await self._signals.replace_all(new_ir)
+
+    async def get_ir_signal(self, ir_signal_id):
+        return await self._signals.get(ir_signal_id)
+
+    async def allocate_ir_signal_id(self):
+        return await self._signals.allocate_id()
+
+    async def save_ir_signal(self, signal, only_existing=False, released=None):
+        return await self._signals.save(signal, only_existing, released)
+
+    async def delete_ir_signal(self, ir_signal_id, released=None):
+        return await self._signals.delete(ir_signal_id, released)
+
+    async def is_ir_file_referenced(self, file_name):
+        return await self._signals.file_ref(file_name) > 0
+
+    async def scan_ir_signals(self, cursor=-1, count=100):
+        return await self._signals.scan(cursor, count)
+
+    async def import_ir_signals(self, signals):
+        return await self._signals.import_signals(signals)
+
+    async def migrate_ir(self):
+        if await self._signals.exists():
+            return False
+        await self._signals.replace_all(await self._get(data.Ir))
+        return True
+
+    """
+    モニターモードのフレームをStreamに追加する。RedisBoundary.add_monitor_framesと同じ
+    """
+    async def add_monitor_frames(self, entries):
+        pipe = self._r.pipeline(transaction=False)
+        for entry in entries:
+            pipe.xadd(MONITOR_STREAM_KEY, entry, maxlen=config.MONITOR_STREAM_MAXLEN, approximate=True)
+        await pipe.execute()
+
+    async def publish_started_ir_receiving(self, session_id=None, gpio=None):
+        # 信号の確認機能がまだ無いので今の所indexは0しか存在しない
+        await self._publish(with_gpio(with_session({'title': 'started_ir_receiving', 'index': 0}, session_id), gpio))
+
+    async def publish_stopped_ir_receiving_no_signal(self, session_id=None):
+        await self._publish(with_session({'title': 'stopped_ir_receiving_no_signal'}, session_id))
+
+    async def publish_stopped_ir_receiving_invalid_signal(self, session_id=None):
+        await self._publish(with_session({'title': 'stopped_ir_receiving_invalid_signal'}, session_id))
+
+    async def publish_stopped_ir_receiving_valid_signal(self, session_id=None, code=None):
+        value = with_session({'title': 'stopped_ir_receiving_valid_signal'}, session_id)
+        if code is not None:
+            value['code'] = code
+        await self._publish(value)
+
+    async def publish_stopped_ir_receiving_stop_message(self, session_id=None):
+        await self._publish(with_session({'title': 'stopped_ir_receiving_stop_message'}, session_id))
+
+    async def publish_stopped_ir_receiving_more_signal(self, session_id=None):
+        await self._publish(with_session({'title': 'stopped_ir_receiving_more_signal'}, session_id))
+
+    async def publish_saved_ir_signal(self, ir_signal_id):
+        await self._publish({'title': 'saved_ir_signal', 'id': ir_signal_id})
+
+    async def publish_ir_signal_saving_error(self):
+        await self._publish({'title': 'ir_signal_saving_error'})
+
+    async def publish_discarded_ir_signal(self, session_id=None):
+        await self._publish(with_session({'title': 'discarded_ir_signal'}, session_id))
+
+    async def publish_ir_signal_discarding_error(self):
+        await self._publish({'title': 'ir_signal_discarding_error'})
+
+    async def publish_deleted_ir_signal(self, ir_signal_id):
+        await self._publish({'title': 'deleted_ir_signal', 'id': ir_signal_id})
+
+    async def publish_ir_signal_deleting_error(self):
+        await self._publish({'title': 'ir_signal_deleting_error'})
+
+    async def publish_identified_ir_signal(self, ir_signal_id, session_id=None):
+        await self._publish(with_session({'title': 'identified_ir_signal', 'id': ir_signal_id}, session_id))
+
+    async def publish_ir_signal_identifying_error(self, session_id=None):
+        await self._publish(with_session({'title': 'ir_signal_identifying_error'}, session_id))
+
+    async def publish_ir_receiver_not_found_error(self, gpio):
+        await self._publish({'title': 'ir_receiver_not_found_error', 'gpio': gpio})
+
+    async def publish_exported_ir_library(self, path, count):
+        await self._publish({'title': 'exported_ir_library', 'path': path, 'count': count})
+
+    async def publish_ir_library_exporting_error(self, path):
+        await self._publish({'title': 'ir_library_exporting_error', 'path': path})
+
+    async def publish_imported_ir_library(self, path, count):
+        await self._publish({'title': 'imported_ir_library', 'path': path, 'count': count})
+
+    async def publish_ir_library_importing_error(self, path):
+        await self._publish({'title': 'ir_library_importing_error', 'path': path})
+
+    async def publish_started_monitoring(self):
+        await self._publish({'title': 'started_monitoring'})
+
+    async def publish_stopped_monitoring(self):
+        await self._publish({'title': 'stopped_monitoring'})
+
+
+metrics.instrument(AsyncRedisBoundary, 'redis_call_seconds',
+                   exclude=('batch', 'get_signal_cache_stats', 'collect_metrics'))
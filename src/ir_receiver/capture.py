@@ -0,0 +1,436 @@
+import logging
+import struct
+import threading
+from array import array
+import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+リモコン信号1回分のキャプチャを管理するモジュール
+
+pigpioのコールバックスレッドではEdgeRingBuffer.putでtickとlevelを書き込むだけにして、
+フレームの検出と正規化はCaptureSessionのコンシューマスレッドで行う。
+通知パイプを使う場合はコンシューマスレッドがレポートをまとめて読み、ReportDecoderでエッジに変換する。
+複数のGPIOで受信する場合は、EdgeDispatcher(ReportDispatcher)の1つのスレッドが全GPIOのセッションを処理する。
+"""
+
+PRE_US = 200 * 1000
+POST_MS = 50
+POST_US = POST_MS * 1000
+SHORT = 10
+# モニターモードで通知する最短のフレーム。NECのリピートコードは3パルス
+REPEAT_MIN = 3
+RING_SIZE = 4096  # 2のべき乗であること
+TIMEOUT = 2  # pigpio.TIMEOUT。ウォッチドッグのタイムアウト時にlevelとして渡される
+
+# pigpioの通知レポート。H seqno, H flags, I tick, I level
+REPORT = struct.Struct('<HHII')
+NTFY_FLAGS_WDOG = 1 << 5
+NTFY_FLAGS_GPIO = 31
+if np is not None:
+    REPORT_DTYPE = np.dtype([('seqno', '<u2'), ('flags', '<u2'), ('tick', '<u4'), ('level', '<u4')])
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+
+def tick_diff(t1, t2):
+    # pigpio.tickDiffと同じ。tickは32bitで折り返す
+    return (t2 - t1) & 0xFFFFFFFF
+
+
+"""
+エッジ(level, tick)を格納する事前確保済みのリングバッファ
+書き込みはpigpioのコールバックスレッド、読み出しはコンシューマスレッドの1対1でのみ行う。
+各indexはそれぞれ片方のスレッドからしか更新しないのでロックは不要。
+putはreadyをセットするので、コンシューマはreadyをクリアしてからdrainし、空ならreadyを待つ。
+セット済みの間はputでEventのロックを取らない。
+"""
+class EdgeRingBuffer:
+    def __init__(self, size=RING_SIZE, ready=None):
+        if size & (size - 1):
+            raise ValueError('size must be a power of two: {0}'.format(size))
+        self._mask = size - 1
+        self._ticks = array('I', [0]) * size
+        self._levels = array('B', [0]) * size
+        self.write_index = 0
+        self.read_index = 0
+        self.overruns = 0
+        self.ready = ready if ready is not None else threading.Event()
+
+    def put(self, gpio, level, tick):
+        # pigpio.pi.callbackのコールバックとしてそのまま渡せる引数にしている
+        i = self.write_index
+        if i - self.read_index > self._mask:
+            self.overruns += 1
+            return
+        j = i & self._mask
+        self._ticks[j] = tick
+        self._levels[j] = level
+        self.write_index = i + 1
+        if not self.ready.is_set():
+            self.ready.set()
+
+    def drain(self):
+        end = self.write_index
+        i = self.read_index
+        ticks, levels, mask = self._ticks, self._levels, self._mask
+        edges = [(levels[k & mask], ticks[k & mask]) for k in range(i, end)]
+        self.read_index = end
+        return edges
+
+    def __len__(self):
+        return self.write_index - self.read_index
+
+
+"""
+pigpioの通知レポートのバイト列を1つのGPIOのエッジ(level, tick)の列に変換するクラス
+pigpio._callback_threadと同じ規則で、levelが変化したレポートとウォッチドッグのレポートだけを取り出す。
+12バイトに満たない末尾は次のdecodeまで持ち越す。
+"""
+class ReportDecoder:
+    def __init__(self, gpio, level=0):
+        self.gpio = gpio
+        self.bit = 1 << gpio
+        self.last_level = level
+        self.__pending = b''
+
+    def decode(self, data):
+        if self.__pending:
+            data = self.__pending + data
+        end = len(data) - len(data) % REPORT.size
+        self.__pending = data[end:]
+        if np is not None:
+            return self.__decode_numpy(data, end)
+        return self.__decode_struct(data, end)
+
+    def __decode_struct(self, data, end):
+        edges = []
+        bit, gpio, last_level = self.bit, self.gpio, self.last_level
+        for seqno, flags, tick, level in REPORT.iter_unpack(memoryview(data)[:end]):
+            if flags == 0:
+                if (level ^ last_level) & bit:
+                    edges.append((1 if level & bit else 0, tick))
+                last_level = level
+            elif flags & NTFY_FLAGS_WDOG and (flags & NTFY_FLAGS_GPIO) == gpio:
+                edges.append((TIMEOUT, tick))
+        self.last_level = last_level
+        return edges
+
+    def __decode_numpy(self, data, end):
+        reports = np.frombuffer(data, dtype=REPORT_DTYPE, count=end // REPORT.size)
+        flags = reports['flags']
+        is_level = flags == 0
+        is_wdog = ((flags & NTFY_FLAGS_WDOG) != 0) & ((flags & NTFY_FLAGS_GPIO) == self.gpio)
+        levels = reports['level'][is_level]
+        if not levels.size and not is_wdog.any():
+            return []
+        bits = ((levels & self.bit) != 0).astype(np.uint8)
+        previous = np.empty_like(bits)
+        previous[:1] = 1 if self.last_level & self.bit else 0
+        previous[1:] = bits[:-1]
+        changed = np.zeros(len(reports), dtype=bool)
+        changed[is_level] = bits != previous
+        if levels.size:
+            self.last_level = int(levels[-1])
+        selected = changed | is_wdog
+        new_levels = np.where(is_wdog, TIMEOUT, 0)
+        new_levels[is_level] = bits
+        return list(zip(new_levels[selected].tolist(), reports['tick'][selected].tolist()))
+
+
+"""
+キャプチャ1回分の状態を持つクラス
+start()でコンシューマスレッドを起動し、有効なフレームを1つ受信するかcancel()されるまで動く。
+
+on_frameを渡した場合はモニターモードになり、cancel()されるまでフレームを受信し続ける。
+フレーム毎に正規化前のパルス列と先頭のエッジのtickでon_frame(code, tick)をコンシューマスレッドから呼ぶ。
+リモコンのボタンを押し続けたときのリピートも拾えるように、POST_US以上空いたら次のフレームの始まりとする。
+"""
+class CaptureSession:
+    def __init__(self, pi, gpio, start_tick, normalise, ring_size=RING_SIZE, on_done=None, on_frame=None):
+        self.pi = pi
+        self.gpio = gpio
+        self.buffer = EdgeRingBuffer(ring_size)
+        # pigpioのコールバックに登録する関数
+        self.cbf = self.buffer.put
+        self.last_tick = start_tick
+        self.in_code = False
+        self.code = []
+        # 受信中のフレームの先頭のエッジのtick
+        self.code_tick = None
+        self.fetching_code = True
+        self.cancelled = False
+        # 有効なフレームを受信したか、cancel()されたときにセットされる
+        self.done = threading.Event()
+        # doneがセットされたときに一度だけ呼ばれる。コンシューマスレッドかcancel()を呼んだスレッドで実行される
+        self.__on_done = on_done
+        self.__done_lock = threading.Lock()
+        self.__normalise = normalise
+        self.__on_frame = on_frame
+        self.__start_us = POST_US if on_frame is not None else PRE_US
+        self.__thread = None
+        # ディスパッチャーで処理する場合に、ディスパッチャーが処理を終えたときにセットされる
+        self.__dispatched = False
+        self.__detached = threading.Event()
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__consume, daemon=True)
+        self.__thread.start()
+
+    """
+    リングバッファの代わりにpigpioの通知レポートを読んで処理するコンシューマスレッドを起動する。
+    read()は届いているレポートのバイト列を返す。届いていなければb''、ストリームが閉じていればNoneを返す。
+    """
+    def start_reports(self, read, level=0):
+        self.__thread = threading.Thread(target=self.__consume_reports, args=(read, ReportDecoder(self.gpio, level)), daemon=True)
+        self.__thread.start()
+
+    @property
+    def running(self):
+        return self.fetching_code and not self.cancelled
+
+    """
+    コンシューマスレッドを起動する代わりに、ディスパッチャーに処理してもらう。EdgeDispatcher.addから呼ばれる
+    """
+    def attach(self):
+        self.__dispatched = True
+
+    """
+    ディスパッチャーがこのセッションの処理を終えたときに呼ぶ
+    """
+    def detach(self):
+        self.__log_overruns()
+        self.__detached.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.__set_done()
+        # readyを待っているコンシューマ(ディスパッチャー)を起こす
+        self.buffer.ready.set()
+
+    def __set_done(self):
+        with self.__done_lock:
+            if self.done.is_set():
+                return
+            self.done.set()
+        if self.__on_done is not None:
+            self.__on_done(self)
+
+    def join(self, timeout=None):
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+        elif self.__dispatched:
+            self.__detached.wait(timeout)
+
+    def __consume(self):
+        ready = self.buffer.ready
+        while self.fetching_code and not self.cancelled:
+            ready.clear()
+            edges = self.buffer.drain()
+            if not edges:
+                ready.wait()
+                continue
+            for level, tick in edges:
+                self.feed(level, tick)
+                if not self.fetching_code:
+                    break
+        self.__log_overruns()
+
+    def __log_overruns(self):
+        if self.buffer.overruns:
+            metrics.inc('capture_edge_overruns_total', self.buffer.overruns)
+            logger.error('Edge buffer overran on GPIO {0}, {1} edges dropped'.format(self.gpio, self.buffer.overruns))
+
+    def __consume_reports(self, read, decoder):
+        while self.fetching_code and not self.cancelled:
+            data = read()
+            if data is None:
+                break
+            for level, tick in decoder.decode(data):
+                self.feed(level, tick)
+                if not self.fetching_code:
+                    break
+
+    def feed(self, level, tick):
+        if level != TIMEOUT:
+            edge = tick_diff(self.last_tick, tick)
+            self.last_tick = tick
+
+            if (edge > self.__start_us) and (not self.in_code): # Start of a code.
+                self.__start_code(tick)
+
+            elif (edge > POST_US) and self.in_code: # End of a code.
+                self.in_code = False
+                self.pi.set_watchdog(self.gpio, 0) # Cancel watchdog.
+                self.end_of_code()
+                if self.__on_frame is not None:
+                    # モニターモードではこのエッジが次のフレームの始まり
+                    self.__start_code(tick)
+
+            elif self.in_code:
+                self.code.append(edge)
+
+        else:
+            self.pi.set_watchdog(self.gpio, 0) # Cancel watchdog.
+            if self.in_code:
+                self.in_code = False
+                self.end_of_code()
+
+    def __start_code(self, tick):
+        self.in_code = True
+        self.code_tick = tick
+        self.pi.set_watchdog(self.gpio, POST_MS) # Start watchdog.
+
+    def end_of_code(self):
+        if metrics.registry.enabled:
+            self.__count_frame(self.code)
+        with metrics.timer('capture_end_of_code_seconds'):
+            self.__end_of_code()
+
+    def __end_of_code(self):
+        if self.__on_frame is not None:
+            code, self.code = self.code, []
+            if len(code) >= REPEAT_MIN:
+                self.__on_frame(code, self.code_tick)
+            return
+        if len(self.code) > SHORT:
+            self.__normalise(self.code)
+            self.fetching_code = False
+            self.__set_done()
+        else:
+            self.code = []
+            logger.error("Short code, probably a repeat, try again")
+
+    """
+    フレームのエッジの数と頻度を集計する。cbfではエッジ毎に何もしないで済むよう、ここでまとめて行う
+    REPEAT_MIN以上SHORT以下のフレームはリピートコード、それより短いフレームはノイズとして数える
+    """
+    @staticmethod
+    def __count_frame(code):
+        metrics.inc('capture_edges_total', len(code))
+        duration_us = sum(code)
+        if duration_us:
+            metrics.observe('capture_edges_per_second', len(code) * 1e6 / duration_us, buckets=metrics.RATE_BUCKETS)
+        if len(code) < REPEAT_MIN:
+            metrics.inc('capture_short_codes_total')
+        elif len(code) <= SHORT:
+            metrics.inc('capture_repeat_codes_total')
+
+
+"""
+複数のGPIOのCaptureSessionを1つのスレッドで処理するクラス
+pigpioのコールバックスレッドが各セッションのリングバッファに書き込み、このスレッドが順に読んでfeedする。
+GPIOの数が増えてもスレッドは1つで、全セッションのバッファで1つのreadyを共有し、どのバッファも空のときはそれを待つ。
+セッションが無くなるとスレッドは終わり、次にadd()されたときにまた起動する。
+"""
+class EdgeDispatcher:
+    def __init__(self):
+        self.__sessions = []
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__ready = threading.Event()
+
+    def add(self, session):
+        session.attach()
+        # 付け替える前に書き込まれたエッジも次の周で読む
+        session.buffer.ready = self.__ready
+        self.__ready.set()
+        with self.__lock:
+            self.__sessions.append(session)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__sessions)
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                sessions = list(self.__sessions)
+                if not sessions:
+                    self.__thread = None
+                    return
+            self.__ready.clear()
+            busy = False
+            for session in sessions:
+                if session.running:
+                    edges = session.buffer.drain()
+                    busy = busy or bool(edges)
+                    for level, tick in edges:
+                        session.feed(level, tick)
+                        if not session.fetching_code:
+                            break
+                if not session.running:
+                    self.__remove(session)
+                    # 残りのセッションが無ければ待たずにスレッドを終える
+                    busy = True
+            if not busy:
+                self.__ready.wait()
+
+    def __remove(self, session):
+        with self.__lock:
+            self.__sessions.remove(session)
+        session.detach()
+
+
+"""
+1つの通知パイプから複数のGPIOのレポートを読み、GPIO毎のReportDecoderでエッジにしてセッションに渡すクラス
+read()はCaptureSession.start_reportsと同じ。12バイトに満たない末尾はここで持ち越して
+デコーダには揃ったレポートだけを渡すので、途中で加わったGPIOのデコーダもレポートの境界から読める。
+レポートの分割は1回で、GPIO毎の処理はNumPyで一括して行う。
+"""
+class ReportDispatcher:
+    def __init__(self, read):
+        self.__read = read
+        self.__pending = b''
+        self.__sessions = []
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    """
+    levelはpigpio.pi.read_bank_1()の値
+    """
+    def add(self, session, level=0):
+        session.attach()
+        with self.__lock:
+            self.__sessions.append((session, ReportDecoder(session.gpio, level)))
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                sessions = [x for x in self.__sessions if x[0].running]
+                finished = [x for x in self.__sessions if not x[0].running]
+                self.__sessions = sessions
+                if not sessions:
+                    self.__thread = None
+            for session, decoder in finished:
+                session.detach()
+            if not sessions:
+                return
+            data = self.__read()
+            if data is None:
+                # パイプが閉じられた
+                for session, decoder in sessions:
+                    session.cancel()
+                continue
+            if self.__pending:
+                data = self.__pending + data
+            end = len(data) - len(data) % REPORT.size
+            self.__pending = data[end:]
+            data = data[:end]
+            for session, decoder in sessions:
+                for level, tick in decoder.decode(data):
+                    session.feed(level, tick)
+                    if not session.fetching_code:
+                        break
@@ -0,0 +1,178 @@
+import bisect
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+パルス長のクラスタリングを行うモジュール
+
+マーク(偶数index)とスペース(奇数index)を別々に、TOLERANCE以内のパルスを同じクラスタにまとめ、
+クラスタの平均値で置き換える。クラスタの分け方は従来のnormalise(normalise_pairwise)と同じで、
+まだクラスタに入っていない最初のパルスvを基準に、(c*TOLER_MIN) < v < (c*TOLER_MAX)のパルスcをまとめる。
+基準から連鎖はしない。ユニークなパルス長をソートして範囲を二分探索するので、O(n²)の比較は要らない。
+NumPyがある場合はユニーク化と置き換えをNumPyで行う。
+"""
+
+TOLERANCE = 15
+# これ未満のパルス数ではNumPyの呼び出しコストの方が大きいので純Python版を使う
+NUMPY_MIN_ENTRIES = 256
+
+
+def _toler_min(tolerance):
+    return (100 - tolerance) / 100.0
+
+
+def _toler_max(tolerance):
+    return (100 + tolerance) / 100.0
+
+
+"""
+ソート済みのユニークなパルス長と出現回数から、各パルス長のクラスタ番号とクラスタ毎の平均値を求める。
+orderはlengthsのindexを最初に現れた順に並べたもので、クラスタに入っていない最初のパルス長を基準vにして
+(plen * toler_min) < v < (plen * toler_max)のパルス長を同じクラスタにする(従来のnormaliseの判定)。
+クラスタに入ったパルス長はskipで飛ばすので、各パルス長を調べるのは基準の範囲に入ったときの1回だけで済む。
+"""
+def _merge_sorted(lengths, counts, order, toler_min, toler_max):
+    size = len(lengths)
+    labels = [None] * size
+    averages = []
+    # skip[k]はk以降でクラスタに入っていない最初のindexへのリンク
+    skip = list(range(size + 1))
+
+    def find(k):
+        root = k
+        while skip[root] != root:
+            root = skip[root]
+        while skip[k] != root:
+            skip[k], k = root, skip[k]
+        return root
+
+    for i in order:
+        if labels[i] is not None:
+            continue
+        v = lengths[i]
+        label = len(averages)
+        labels[i] = label
+        skip[i] = i + 1
+        tot = v * counts[i]
+        similar = counts[i]
+        # 範囲の下限の1つ前から調べる(浮動小数点の境界は判定式で決める)
+        k = find(max(0, bisect.bisect_left(lengths, v / toler_max) - 1))
+        while k < size and lengths[k] * toler_min < v:
+            if v < lengths[k] * toler_max:
+                labels[k] = label
+                skip[k] = k + 1
+                tot += lengths[k] * counts[k]
+                similar += counts[k]
+            k = find(k + 1)
+        averages.append(round(tot / float(similar), 2))
+    return labels, averages
+
+
+def _cluster_python(values, toler_min, toler_max):
+    # dictは最初に現れた順を保つ
+    ms = {}
+    for plen in values:
+        ms[plen] = ms.get(plen, 0) + 1
+    lengths = sorted(ms)
+    index = dict((plen, i) for i, plen in enumerate(lengths))
+    labels, averages = _merge_sorted(lengths, [ms[plen] for plen in lengths], [index[plen] for plen in ms],
+                                     toler_min, toler_max)
+    for plen, label in zip(lengths, labels):
+        ms[plen] = averages[label]
+    return [ms[plen] for plen in values]
+
+
+def _cluster_numpy(values, toler_min, toler_max):
+    lengths, first, inverse, counts = np.unique(np.asarray(values, dtype=np.float64), return_index=True,
+                                                return_inverse=True, return_counts=True)
+    labels, averages = _merge_sorted(lengths.tolist(), counts.tolist(), np.argsort(first).tolist(), toler_min, toler_max)
+    return np.asarray(averages)[np.asarray(labels)][inverse.reshape(-1)].tolist()
+
+
+def _normalise_python(c, toler_min, toler_max):
+    for base in (0, 1):
+        c[base::2] = _cluster_python(c[base::2], toler_min, toler_max)
+
+
+def _normalise_numpy(c, toler_min, toler_max):
+    pulses = np.asarray(c, dtype=np.float64)
+    out = np.empty(len(c), dtype=np.float64)
+    for base in (0, 1):
+        part = pulses[base::2]
+        if not part.size:
+            continue
+        lengths, first, inverse, counts = np.unique(part, return_index=True, return_inverse=True, return_counts=True)
+        # クラスタ境界の判定はユニークなパルス長(通常は数十個)に対してのみ行う
+        labels, averages = _merge_sorted(lengths.tolist(), counts.tolist(), np.argsort(first).tolist(), toler_min, toler_max)
+        out[base::2] = np.asarray(averages)[np.asarray(labels)][inverse.reshape(-1)]
+    c[:] = out.tolist()
+
+
+def normalise(c, tolerance=TOLERANCE):
+    """
+    cのマークとスペースをそれぞれクラスタリングし、各パルスをクラスタの平均値
+    (小数点以下2桁に丸めたもの)で置き換える。cはその場で書き換える。
+
+    結果は従来のnormalise_pairwiseと同じで、計算量はソートのO(n log n)になる。
+    """
+    toler_min, toler_max = _toler_min(tolerance), _toler_max(tolerance)
+    if np is not None and len(c) >= NUMPY_MIN_ENTRIES:
+        _normalise_numpy(c, toler_min, toler_max)
+    else:
+        _normalise_python(c, toler_min, toler_max)
+
+
+def normalise_records(records, tolerance=TOLERANCE):
+    """
+    複数のレコード(パルス長のリスト)のマークとスペースを、全レコードまとめて1回でクラスタリングする。
+    同じボタンを複数回押したキャプチャを平均するのに使う。各レコードはその場で書き換える。
+    """
+    toler_min, toler_max = _toler_min(tolerance), _toler_max(tolerance)
+    for base in (0, 1):
+        parts = [c[base::2] for c in records]
+        values = [plen for part in parts for plen in part]
+        if np is not None and len(values) >= NUMPY_MIN_ENTRIES:
+            clustered = _cluster_numpy(values, toler_min, toler_max)
+        else:
+            clustered = _cluster_python(values, toler_min, toler_max)
+        offset = 0
+        for c, part in zip(records, parts):
+            c[base::2] = clustered[offset:offset + len(part)]
+            offset += len(part)
+
+
+def normalise_pairwise(c, tolerance=TOLERANCE):
+    """
+    従来のRespberryPiBoundary.normaliseの実装。全パルスを同じ偶奇の後続パルス全てと比較するのでO(n²)。
+    normaliseとの結果比較とベンチマークのために残している。
+    """
+    toler_min = _toler_min(tolerance)
+    toler_max = _toler_max(tolerance)
+    entries = len(c)
+    p = [0]*entries # Set all entries not processed.
+    for i in range(entries):
+        if not p[i]: # Not processed?
+            v = c[i]
+            tot = v
+            similar = 1.0
+
+            # Find all pulses with similar lengths to the start pulse.
+            for j in range(i+2, entries, 2):
+                if not p[j]: # Unprocessed.
+                    if (c[j]*toler_min) < v < (c[j]*toler_max): # Similar.
+                        tot = tot + c[j]
+                        similar += 1.0
+
+            # Calculate the average pulse length.
+            newv = round(tot / similar, 2)
+            c[i] = newv
+
+            # Set all similar pulses to the average value.
+            for j in range(i+2, entries, 2):
+                if not p[j]: # Unprocessed.
+                    if (c[j]*toler_min) < v < (c[j]*toler_max): # Similar.
+                        c[j] = newv
+                        p[j] = 1
@@ -0,0 +1,77 @@
+import os
+
+"""
+環境変数から読み込む設定値
+docker-composeのenvironmentで上書きできる。
+"""
+
+# リモコン信号のキャプチャ方式
+# callback: pigpioのコールバックでエッジを1つずつ受け取る
+# notify: pigpioの通知パイプ(/dev/pigpioN)からレポートをまとめて読む。pigpiodと同じホストで動かす必要がある
+CAPTURE_BACKEND = os.environ.get('IR_RECEIVER_CAPTURE_BACKEND', 'callback')
+
+# 赤外線受信機をつないだGPIO(BCM番号)。カンマ区切りで複数指定すると、1つのpigpiodの接続で全受信機を受信する
+# メッセージの'gpio'で受信機を選ぶ。指定しない場合は最初のGPIOの受信機を使う
+GPIOS = [int(x) for x in os.environ.get('IR_RECEIVER_GPIOS', '17').split(',')]
+
+# キャプチャ完了からコールバックを呼ぶまでの猶予時間(ms)。未設定の場合はウォッチドッグと同じcapture.POST_MS
+CAPTURE_GRACE_MS = int(os.environ['IR_RECEIVER_CAPTURE_GRACE_MS']) if 'IR_RECEIVER_CAPTURE_GRACE_MS' in os.environ else None
+
+# 1つの信号のキャプチャで同じボタンを押してもらう回数。start_ir_receivingの'presses'で上書きできる
+# 2以上の場合、押される度にstopped_ir_receiving_more_signalを通知し、全キャプチャを平均した信号を保存する
+CAPTURE_PRESSES = int(os.environ.get('IR_RECEIVER_CAPTURE_PRESSES', '1'))
+
+# 1にすると起動時からモニターモードにする。start_monitoring/stop_monitoringのメッセージでも切り替えられる
+# モニターモードでは受信したフレームを整形・デコードしてRedis Streamに追加し続ける
+MONITOR = os.environ.get('IR_RECEIVER_MONITOR', '0') == '1'
+# モニターモードのStreamの長さの上限(XADD MAXLEN ~)
+MONITOR_STREAM_MAXLEN = int(os.environ.get('IR_RECEIVER_MONITOR_STREAM_MAXLEN', '10000'))
+
+# 信号を更新する度にneochi-app向けの{'signals': [...]}形式のIrも作り直すかどうか
+LEGACY_IR_VIEW = os.environ.get('IR_RECEIVER_LEGACY_IR_VIEW', '1') == '1'
+
+# 1にすると全信号をメモリにキャッシュし(signal_store.SignalCache)、読み込みはバージョンのGETだけで返す
+# 他のクライアントの書き込みはバージョンが変わったことで検出して読み直す
+SIGNAL_CACHE = os.environ.get('IR_RECEIVER_SIGNAL_CACHE', '1') == '1'
+
+# 新しく保存する.irファイルの形式
+# binary: ir_file.pyのバイナリ形式。読み込みはmmapでコピーせずに行う
+# json: 以前の{レコード名: [パルス長, ...]}のJSON。どちらの形式でも読み込みはできる
+SIGNAL_FILE_FORMAT = os.environ.get('IR_RECEIVER_SIGNAL_FILE_FORMAT', 'binary')
+
+# 信号ファイルを書き込むときのfsyncの方法
+# full: ファイルとディレクトリを書き込み毎にfsyncする。同時に来た書き込みのディレクトリのfsyncは1回にまとめる
+# group: fullに加えて、ディレクトリのfsyncの前にIR_RECEIVER_FSYNC_WINDOW_MSだけ他の書き込みを待ってまとめる
+# none: fsyncしない。os.replaceで置き換えるのでファイルが途中までになることは無いが、電源断で直前の保存が失われうる
+# 各方式のスループットはbenchmarks/bench_fsync.pyで計れる
+FSYNC_MODE = os.environ.get('IR_RECEIVER_FSYNC_MODE', 'full')
+FSYNC_WINDOW_MS = int(os.environ.get('IR_RECEIVER_FSYNC_WINDOW_MS', '2'))
+
+# キャプチャしたまま保存も破棄もされないセッションを破棄するまでの秒数と、それを調べる間隔
+SESSION_TTL_S = float(os.environ.get('IR_RECEIVER_SESSION_TTL_S', '600'))
+SESSION_SWEEP_INTERVAL_S = float(os.environ.get('IR_RECEIVER_SESSION_SWEEP_INTERVAL_S', '30'))
+# キャプチャ済みのセッションの信号をメモリに置く上限(バイト)。超えた分は古いものから破棄する
+SESSION_MEMORY_LIMIT = int(os.environ.get('IR_RECEIVER_SESSION_MEMORY_LIMIT', str(1024 * 1024)))
+# 1にすると上限を超えた分を破棄せずに/dataに書き出す。SDカードへの書き込みが増える
+SESSION_SPILL = os.environ.get('IR_RECEIVER_SESSION_SPILL', '0') == '1'
+
+# /dataの信号ファイルとRedisの信号を突き合わせる保守(maintenance.ConsistencyScanner)の間隔(秒)。0なら行わない
+MAINTENANCE_INTERVAL_S = float(os.environ.get('IR_RECEIVER_MAINTENANCE_INTERVAL_S', '3600'))
+# 1回に調べる信号・ファイルの数と、その間に休む時間(ms)。キャプチャ中は終わるまで休む
+MAINTENANCE_BATCH = int(os.environ.get('IR_RECEIVER_MAINTENANCE_BATCH', '50'))
+MAINTENANCE_PAUSE_MS = int(os.environ.get('IR_RECEIVER_MAINTENANCE_PAUSE_MS', '100'))
+# これより新しいファイルは書き込み中か保存の途中かもしれないので、一時ファイルでも参照されていなくても触らない
+MAINTENANCE_GRACE_S = float(os.environ.get('IR_RECEIVER_MAINTENANCE_GRACE_S', '600'))
+# どの信号からも参照されていないファイルを/data/quarantineに移してから削除するまでの秒数
+QUARANTINE_TTL_S = float(os.environ.get('IR_RECEIVER_QUARANTINE_TTL_S', str(7 * 24 * 3600)))
+
+# 1にするとキャプチャ、normalise/tidy、ファイルの書き込み、Redisの呼び出しの処理時間と回数を集計する(metrics.py)
+# 集計はIR_RECEIVER_METRICS_INTERVAL_S毎にRedisのハッシュ(ir_receiver:metrics)に書き出す
+METRICS = os.environ.get('IR_RECEIVER_METRICS', '0') == '1'
+METRICS_INTERVAL_S = float(os.environ.get('IR_RECEIVER_METRICS_INTERVAL_S', '10'))
+# 0以外にすると、METRICS_HOSTのこのポートでPrometheusのテキスト形式(/metrics)も返す
+METRICS_PORT = int(os.environ.get('IR_RECEIVER_METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('IR_RECEIVER_METRICS_HOST', '127.0.0.1')
+
+# logs/ir_receiver.logに書くログのレベル。INFO以上にするとデバッグログの文字列を作らない
+LOG_LEVEL = os.environ.get('IR_RECEIVER_LOG_LEVEL', 'DEBUG')
@@ -0,0 +1,178 @@
+import argparse
+import struct
+import time
+import pigpio
+
+"""
+pigpioのコールバックに届いたエッジ(gpio, level, tick)をそのまま記録するトレースファイル
+
+    ヘッダ(16バイト、リトルエンディアン)
+        magic       4s  b'IRTR'
+        version     B   FORMAT_VERSION
+        flags       B   予約(0)
+        reserved    H   予約(0)
+        start_tick  I   記録を始めたときのpigpioのtick(us)
+        edge_count  I   エッジ数
+    エッジ(edge_count個、1つ6バイト)
+        gpio        B
+        level       B   0, 1か、ウォッチドッグのタイムアウト(capture.TIMEOUT)
+        tick        I   pigpioのtick(us, 32bitで折り返す)
+
+実機のラズパイでrecordし、fake_pigpioでCaptureSessionに再生する。
+記録: python edge_trace.py record ac.trace --gpio 17 --seconds 10
+"""
+
+MAGIC = b'IRTR'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sBBHII')
+EDGE = struct.Struct('<BBI')
+
+
+"""
+start_tickは記録を始めたときのtick、edgesは[(gpio, level, tick), ...]
+"""
+class Trace:
+    def __init__(self, start_tick, edges):
+        self.start_tick = start_tick
+        self.edges = edges
+
+    @property
+    def gpios(self):
+        return sorted(set(gpio for gpio, level, tick in self.edges))
+
+    def __len__(self):
+        return len(self.edges)
+
+
+def dumps(trace):
+    parts = [HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0, trace.start_tick & 0xFFFFFFFF, len(trace.edges))]
+    parts.extend(EDGE.pack(gpio, level, tick & 0xFFFFFFFF) for gpio, level, tick in trace.edges)
+    return b''.join(parts)
+
+
+def loads(data):
+    if len(data) < HEADER.size:
+        raise ValueError('Trace is too short')
+    magic, version, flags, reserved, start_tick, edge_count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a trace file')
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported trace version {0}'.format(version))
+    end = HEADER.size + edge_count * EDGE.size
+    if len(data) < end:
+        raise ValueError('Trace is truncated: {0} of {1} edges'.format((len(data) - HEADER.size) // EDGE.size, edge_count))
+    return Trace(start_tick, list(EDGE.iter_unpack(memoryview(data)[HEADER.size:end])))
+
+
+"""
+トレースのエッジを、start_tickからの32bitの折り返しを解いたtickで[(tick, gpio, level), ...]にする
+"""
+def unwrap(trace):
+    edges = []
+    last = trace.start_tick
+    tick = trace.start_tick
+    for gpio, level, wrapped in trace.edges:
+        tick += (wrapped - last) & 0xFFFFFFFF
+        last = wrapped
+        edges.append((tick, gpio, level))
+    return edges
+
+
+def save(name, trace):
+    with open(name, 'wb') as f:
+        f.write(dumps(trace))
+
+
+def load(name):
+    with open(name, 'rb') as f:
+        return loads(f.read())
+
+
+"""
+GPIO毎のパルス列を、gap_us空けて続けて送ったトレースにする。記録を始めてからlead_us後に最初のフレームが始まる。
+受信モジュールは待機中Highなので、フレームは立ち下がり(level 0)から始まる。
+"""
+def from_frames(frames, gpio, gap_us=500 * 1000, lead_us=1000 * 1000, start_tick=0):
+    edges = []
+    tick = start_tick + lead_us
+    for pulses in frames:
+        level = 0
+        edges.append((gpio, level, tick & 0xFFFFFFFF))
+        for pulse in pulses:
+            tick += int(pulse)
+            level ^= 1
+            edges.append((gpio, level, tick & 0xFFFFFFFF))
+        tick += gap_us
+    return Trace(start_tick & 0xFFFFFFFF, edges)
+
+
+"""
+pigpioのコールバックでエッジを記録するクラス
+コールバックスレッドではlistに追加するだけにする。グリッチフィルタはpigpiod側で掛かったものが記録される。
+"""
+class TraceRecorder:
+    def __init__(self, pi, gpios):
+        self.__pi = pi
+        self.__gpios = list(gpios)
+        self.__edges = []
+        self.__callbacks = []
+        self.__start_tick = None
+
+    def start(self):
+        self.__start_tick = self.__pi.get_current_tick()
+        for gpio in self.__gpios:
+            self.__pi.set_mode(gpio, pigpio.INPUT)
+            self.__callbacks.append(self.__pi.callback(gpio, pigpio.EITHER_EDGE, self.__record))
+
+    def __record(self, gpio, level, tick):
+        self.__edges.append((gpio, level, tick))
+
+    def stop(self):
+        for cb in self.__callbacks:
+            cb.cancel()
+        self.__callbacks = []
+        return Trace(self.__start_tick, list(self.__edges))
+
+
+def record(name, gpios, seconds, host='localhost', glitch=0):
+    pi = pigpio.pi(host)
+    if not pi.connected:
+        raise OSError('Failed to connect to pigpiod on {0}'.format(host))
+    try:
+        for gpio in gpios:
+            pi.set_glitch_filter(gpio, glitch)
+        recorder = TraceRecorder(pi, gpios)
+        recorder.start()
+        try:
+            time.sleep(seconds)
+        except KeyboardInterrupt:
+            pass
+        trace = recorder.stop()
+    finally:
+        for gpio in gpios:
+            pi.set_glitch_filter(gpio, 0)
+        pi.stop()
+    save(name, trace)
+    return trace
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    recording = subparsers.add_parser('record', help='pigpiodからエッジを記録する')
+    recording.add_argument('file')
+    recording.add_argument('--gpio', type=int, action='append', help='記録するGPIO。複数指定できる(既定: 17)')
+    recording.add_argument('--seconds', type=float, default=10.0)
+    recording.add_argument('--host', default='localhost')
+    recording.add_argument('--glitch', type=int, default=0, help='記録中のグリッチフィルタ(us)。0は生のエッジ')
+    showing = subparsers.add_parser('show', help='トレースの概要を表示する')
+    showing.add_argument('file')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        started = time.monotonic()
+        trace = record(args.file, args.gpio or [17], args.seconds, args.host, args.glitch)
+        print('Recorded {0} edges on GPIO {1} in {2:.1f}s'.format(len(trace), trace.gpios, time.monotonic() - started))
+    else:
+        trace = load(args.file)
+        print('{0} edges on GPIO {1}, start tick {2}'.format(len(trace), trace.gpios, trace.start_tick))
@@ -0,0 +1,259 @@
+import logging
+import random
+import sys
+import threading
+import time
+import edge_trace
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+"""
+トレース(edge_trace.py)を再生するpigpioの代わりのモジュール
+raspberry_pi_boundaryが使うpigpio.piのメソッドだけを持ち、ラズパイが無くてもキャプチャの経路
+(コールバック、CaptureSession、normalise、tidy)を実時間かspeed倍の速さで動かせる。
+
+    pi = fake_pigpio.pi(trace=edge_trace.load('ac.trace'), speed=10)
+    connection = raspberry_pi_boundary.PigpioConnection(lambda: pi)
+
+install()するとimport pigpioでもこのモジュールが使われる。
+再生は最初のcallback()で始まり、その時点で登録されているGPIOのコールバックにだけエッジを渡す(実機と同じく取りこぼす)。
+ウォッチドッグとグリッチフィルタはpigpiodと同じようにトレースのtick上で動かす。
+ただしウォッチドッグのTIMEOUTは、レベルが変化しない間に繰り返さず1回だけ送る。
+通知パイプ(notify backend)には対応していない。
+"""
+
+INPUT = 0
+OUTPUT = 1
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+TIMEOUT = 2
+
+# 注入するグリッチの幅の上限(us)。raspberry_pi_boundary.GLITCHより短いのでフィルタで消える
+GLITCH_US = 30
+# 全エッジを送り終えてウォッチドッグも無くなってから、再生スレッドを終えるまでの秒数
+LINGER_S = 1.0
+
+# install()で設定する、引数を省略したpi()の既定値
+_defaults = {}
+
+
+"""
+トレースにジッタ、グリッチ、エッジの取りこぼしを加えたトレースを返す。
+jitter_us: 各エッジのtickを±jitter_usずらす。
+glitch_rate: エッジ毎にこの確率で、次のエッジまでの間にglitch_us以下の幅の逆向きのパルスを入れる。
+drop_rate: エッジ毎にこの確率でエッジを落とす。
+seedを指定すると同じトレースになる。
+"""
+def perturb(trace, jitter_us=0, glitch_rate=0.0, glitch_us=GLITCH_US, drop_rate=0.0, seed=None):
+    rnd = random.Random(seed)
+    edges = [x for x in edge_trace.unwrap(trace) if x[2] != TIMEOUT]
+    if jitter_us:
+        edges = [(tick + rnd.randint(-jitter_us, jitter_us), gpio, level) for tick, gpio, level in edges]
+        edges.sort()
+    if glitch_rate:
+        glitched = []
+        for i, (tick, gpio, level) in enumerate(edges):
+            glitched.append((tick, gpio, level))
+            following = next((x[0] for x in edges[i + 1:] if x[1] == gpio), tick + 10 * glitch_us)
+            # 前のエッジからglitch_usの4倍以上空ける。近いとグリッチフィルタが前のエッジのtickを遅らせる
+            if following - tick > 6 * glitch_us and rnd.random() < glitch_rate:
+                start = rnd.randint(tick + 4 * glitch_us, following - 2 * glitch_us)
+                glitched.append((start, gpio, level ^ 1))
+                glitched.append((start + rnd.randint(1, glitch_us), gpio, level))
+        edges = sorted(glitched)
+    if drop_rate:
+        edges = [x for x in edges if rnd.random() >= drop_rate]
+    return edge_trace.Trace(trace.start_tick, [(gpio, level, tick & 0xFFFFFFFF) for tick, gpio, level in edges])
+
+
+"""
+pigpiodのグリッチフィルタと同じく、steady us以上続かなかったレベルの変化を取り除く。
+edgesは折り返しを解いた[(tick, gpio, level), ...]。残ったエッジのtickは変化した時点のtick
+"""
+def glitch_filter(edges, steadies):
+    reported = {}
+    pending = {}
+    filtered = []
+    for tick, gpio, level in edges:
+        steady = steadies.get(gpio, 0)
+        if not steady:
+            filtered.append((tick, gpio, level))
+            continue
+        if gpio not in reported:
+            # 最初のエッジの前は逆のレベルだったとする
+            reported[gpio] = level ^ 1
+        change = pending.get(gpio)
+        if change is not None and tick - change[0] >= steady:
+            filtered.append(change)
+            reported[gpio] = change[2]
+            change = pending[gpio] = None
+        if level == reported[gpio]:
+            pending[gpio] = None
+        elif change is None:
+            pending[gpio] = (tick, gpio, level)
+    filtered.extend(change for change in pending.values() if change is not None)
+    filtered.sort()
+    return filtered
+
+
+class _Callback:
+    def __init__(self, pi, gpio, func):
+        self.__pi = pi
+        self.gpio = gpio
+        self.func = func
+
+    def cancel(self):
+        self.__pi._remove_callback(self)
+
+
+"""
+pigpio.piの代わり。host, portは無視する。
+speedは実時間の何倍で再生するか(既定は1)。0の場合は待たずに送る。
+その他の引数はperturbに渡す。省略した引数はinstall()で設定した値になる。
+"""
+class pi:
+    def __init__(self, host='localhost', port=8888, trace=None, speed=None, **perturbation):
+        options = dict(_defaults)
+        if trace is not None:
+            options['trace'] = trace
+        if speed is not None:
+            options['speed'] = speed
+        options.update(perturbation)
+        source = options.pop('trace', None)
+        if source is None:
+            raise ValueError('No trace to replay')
+        self.speed = options.pop('speed', 1.0)
+        self.trace = perturb(source, **options) if options else source
+        self.connected = True
+        self.delivered = 0
+        # 全エッジを送り終えたときにセットされる
+        self.replayed = threading.Event()
+        self.__edges = edge_trace.unwrap(self.trace)
+        self.__now = self.trace.start_tick
+        self.__wall = None
+        self.__callbacks = []
+        self.__filters = {}
+        # {GPIO: (タイムアウト(us), 最後にレベルが変化したtick)}。発火した後はtickをNoneにする
+        self.__watchdogs = {}
+        self.__levels = {}
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__stopped = False
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_glitch_filter(self, gpio, steady):
+        with self.__condition:
+            self.__filters[gpio] = steady
+
+    def set_watchdog(self, gpio, timeout):
+        with self.__condition:
+            if timeout:
+                self.__watchdogs[gpio] = (timeout * 1000, self.__current())
+            else:
+                self.__watchdogs.pop(gpio, None)
+            self.__condition.notify_all()
+
+    def get_current_tick(self):
+        with self.__condition:
+            return self.__current() & 0xFFFFFFFF
+
+    def read_bank_1(self):
+        with self.__condition:
+            return sum(1 << gpio for gpio in self.trace.gpios if self.__levels.get(gpio, 1))
+
+    def callback(self, gpio, edge=RISING_EDGE, func=None):
+        cb = _Callback(self, gpio, func)
+        with self.__condition:
+            self.__callbacks.append(cb)
+            if self.__thread is None:
+                self.__wall = time.perf_counter()
+                self.__thread = threading.Thread(target=self.__replay, daemon=True)
+                self.__thread.start()
+        return cb
+
+    def _remove_callback(self, cb):
+        with self.__condition:
+            if cb in self.__callbacks:
+                self.__callbacks.remove(cb)
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.connected = False
+
+    """
+    トレース上の現在のtick(折り返しなし)。conditionを持って呼ぶ
+    """
+    def __current(self):
+        if self.__wall is None or not self.speed:
+            return self.__now
+        return self.trace.start_tick + int((time.perf_counter() - self.__wall) * 1e6 * self.speed)
+
+    def __next_watchdog(self):
+        deadlines = [(armed + timeout, gpio) for gpio, (timeout, armed) in self.__watchdogs.items() if armed is not None]
+        return min(deadlines) if deadlines else None
+
+    def __replay(self):
+        with self.__condition:
+            edges = glitch_filter(self.__edges, self.__filters)
+        index = 0
+        idle_since = None
+        while True:
+            with self.__condition:
+                if self.__stopped:
+                    return
+                edge = edges[index] if index < len(edges) else None
+                if edge is None:
+                    self.replayed.set()
+                watchdog = self.__next_watchdog()
+                if edge is None and watchdog is None:
+                    # ウォッチドッグが設定されるのを待つ
+                    idle_since = idle_since if idle_since is not None else time.monotonic()
+                    if time.monotonic() - idle_since > LINGER_S:
+                        return
+                    self.__condition.wait(0.01)
+                    continue
+                idle_since = None
+                fires = edge is None or (watchdog is not None and watchdog[0] < edge[0])
+                tick = watchdog[0] if fires else edge[0]
+                if self.speed:
+                    ahead = (tick - self.__current()) / 1e6 / self.speed
+                    if ahead > 0:
+                        self.__condition.wait(min(ahead, 0.05))
+                        continue
+                else:
+                    self.__now = max(self.__now, tick)
+                if fires:
+                    gpio, level = watchdog[1], TIMEOUT
+                    self.__watchdogs[gpio] = (self.__watchdogs[gpio][0], None)
+                else:
+                    gpio, level = edge[1], edge[2]
+                    index += 1
+                    self.__levels[gpio] = level
+                    if gpio in self.__watchdogs:
+                        self.__watchdogs[gpio] = (self.__watchdogs[gpio][0], tick)
+                funcs = [cb.func for cb in self.__callbacks if cb.gpio == gpio]
+            # pigpioと同じく、コールバックは1つのスレッドから順に呼ぶ
+            for func in funcs:
+                func(gpio, level, tick & 0xFFFFFFFF)
+            if not fires:
+                self.delivered += 1
+
+
+"""
+import pigpioでこのモジュールが使われるようにし、pi()の既定値(trace, speed, perturbの引数)を設定する
+raspberry_pi_boundaryより先に呼ぶこと
+"""
+def install(**defaults):
+    _defaults.clear()
+    _defaults.update(defaults)
+    sys.modules['pigpio'] = sys.modules[__name__]
+    return sys.modules[__name__]
@@ -1,10 +1,102 @@
+import hashlib
 import json
 import os
+import tempfile
+import threading
+import time
+import config
+import ir_file
+import metrics
+
+# 書き込み途中の一時ファイルの名前。プロセスが落ちると残るのでremove_stale_temp_filesで消す
+TEMP_PREFIX = '.'
+TEMP_SUFFIX = '.partial'
+
+
+"""
+    ディレクトリのfsyncをまとめて行うクラス(グループコミット)
+    sync()を呼んだ時点までのディレクトリの変更(rename, unlink)が永続化されてから戻る。
+    他のスレッドのfsyncが実行中の場合はその次のfsyncを待ち、待っている間に来た要求は1回のfsyncで済ませる。
+    window_sはfsyncの前に他の要求を待つ時間。
+"""
+class DirectorySyncer:
+    def __init__(self, window_s=0):
+        self.window_s = window_s
+        self.fsync_count = 0
+        self.__condition = threading.Condition()
+        # 要求の通し番号と、fsyncで永続化済みになった番号の上限
+        self.__requested = {}
+        self.__synced = {}
+        self.__syncing = set()
+
+    def sync(self, directory):
+        with self.__condition:
+            ticket = self.__requested.get(directory, 0)
+            self.__requested[directory] = ticket + 1
+            while self.__synced.get(directory, 0) <= ticket:
+                if directory not in self.__syncing:
+                    self.__syncing.add(directory)
+                    break
+                self.__condition.wait()
+            else:
+                return
+        # このスレッドがfsyncし、それまでに来た要求をまとめて永続化済みにする
+        try:
+            if self.window_s:
+                time.sleep(self.window_s)
+            with self.__condition:
+                covered = self.__requested[directory]
+            _fsync_directory(directory)
+            with self.__condition:
+                self.__synced[directory] = max(self.__synced.get(directory, 0), covered)
+                self.fsync_count += 1
+        finally:
+            with self.__condition:
+                self.__syncing.discard(directory)
+                self.__condition.notify_all()
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+"""
+    リモコン信号をconfig.SIGNAL_FILE_FORMATの形式の.irファイルの中身にする
+"""
+def encode_signals(signals):
+    if config.SIGNAL_FILE_FORMAT == 'json':
+        return json.dumps(signals).encode('utf-8')
+    return ir_file.encode(signals)
+
+
+"""
+    信号ファイルの中身から、内容で決まるファイル名(<SHA-256>.ir)を返す。
+    同じパルス列の信号は同じ名前になるので、1つのファイルを共有できる
+"""
+def content_name(data):
+    return hashlib.sha256(data).hexdigest() + '.ir'
+
 
 """
     ファイル操作を行うクラス
+    ファイルの書き込みは同じディレクトリの一時ファイルに書いてfsyncし、os.replaceで置き換えてから
+    ディレクトリをfsyncする。途中で電源が切れても古いファイルか新しいファイルのどちらかが残る。
+    fsyncの方法はconfig.FSYNC_MODEで選ぶ。
 """
 class Filesystem:
+    def __init__(self, fsync_mode=None, fsync_window_ms=None):
+        self.fsync_mode = fsync_mode if fsync_mode is not None else config.FSYNC_MODE
+        window_ms = fsync_window_ms if fsync_window_ms is not None else config.FSYNC_WINDOW_MS
+        self.__syncer = DirectorySyncer(window_ms / 1000.0 if self.fsync_mode == 'group' else 0)
+
+    @property
+    def directory_fsync_count(self):
+        return self.__syncer.fsync_count
+
     def get_file(self, name):
         with open(name) as f:
             return f.read();
@@ -13,20 +105,105 @@ class Filesystem:
         古いファイルがあった場合は上書き。
     """
     def save_temp_file(self, name, signals):
-        with open(name, 'w') as f:
-            f.write(json.dumps(signals))
+        self.write_file_atomically(name, encode_signals(signals))
+
+    """
+        dataを一時ファイルに書いてからnameに置き換える。
+        最終更新日付をエポック時間で返す
+        sync_directoryがFalseの場合はディレクトリをfsyncしない。まとめて書いた後にsync_directory()を呼ぶこと
+    """
+    def write_file_atomically(self, name, data, sync_directory=True):
+        directory = os.path.dirname(os.path.abspath(name))
+        fd, temp_name = tempfile.mkstemp(prefix=TEMP_PREFIX + os.path.basename(name) + '.',
+                                         suffix=TEMP_SUFFIX, dir=directory)
+        try:
+            with metrics.timer('filesystem_write_seconds'):
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    if self.fsync_mode != 'none':
+                        os.fsync(f.fileno())
+                os.replace(temp_name, name)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+        metrics.inc('filesystem_written_bytes_total', len(data))
+        if sync_directory:
+            self.__sync_directory(directory)
+        return os.path.getmtime(name)
+
+    """
+        dataをdirectoryにcontent_nameの名前で保存し、(ファイル名, 最終更新日付)を返す。
+        同じ内容のファイルが既にあれば書き込まずにそのファイルを返す。
+    """
+    def save_content(self, directory, data, sync_directory=True):
+        name = content_name(data)
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return name, os.path.getmtime(path)
+        return name, self.write_file_atomically(path, data, sync_directory)
+
+    """
+        書き出し済みのファイル(セッションの信号を書き出したファイル)をcontent_nameの名前に変え、
+        (ファイル名, 最終更新日付)を返す。同じ内容のファイルが既にあれば元のファイルを削除する。
+    """
+    def move_content(self, directory, name):
+        with open(name, 'rb') as f:
+            new_name = content_name(f.read())
+        path = os.path.join(directory, new_name)
+        if os.path.exists(path):
+            self.delete_file(name)
+            return new_name, os.path.getmtime(path)
+        return new_name, self.rename_tmp_file(name, path)
+
+    """
+        リモコン信号ファイルを読み込んでir_file.IrFileを返す。
+        バイナリ形式とJSON形式のどちらも読める。使い終わったらcloseすること。
+    """
+    def load_signal_file(self, name):
+        return ir_file.load(name)
 
     """
         一時ファイルを永続ファイルにするために名前変更する。
         名前変更後は最終更新日付をエポック時間で返す
+        名前変更がディスクに書かれてから戻るので、戻り値をRedisに保存してよい。
     """
     def rename_tmp_file(self, name, new_name):
-        os.rename(name, new_name)
+        os.replace(name, new_name)
+        self.__sync_directory(os.path.dirname(os.path.abspath(new_name)))
         return os.path.getmtime(new_name)
-        
+
     """
         永続ファイルを削除する。
     """
     def delete_file(self, name):
         if os.path.exists(name):
-            os.remove(name)
\ No newline at end of file
+            os.remove(name)
+            self.__sync_directory(os.path.dirname(os.path.abspath(name)))
+
+    """
+        書き込み途中で落ちたときに残った一時ファイルを削除し、削除したファイル名のリストを返す。
+        起動時に呼ぶ。
+    """
+    def remove_stale_temp_files(self, directory):
+        removed = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(TEMP_PREFIX) and entry.name.endswith(TEMP_SUFFIX) and entry.is_file():
+                    os.remove(entry.path)
+                    removed.append(entry.name)
+        if removed:
+            self.__sync_directory(directory)
+        return removed
+
+    """
+        ディレクトリの変更(rename, unlink)を永続化する
+    """
+    def sync_directory(self, directory):
+        self.__sync_directory(directory)
+
+    def __sync_directory(self, directory):
+        if self.fsync_mode != 'none':
+            with metrics.timer('filesystem_directory_sync_seconds'):
+                self.__syncer.sync(directory)
@@ -0,0 +1,138 @@
+import hashlib
+import math
+import threading
+from array import array
+import clustering
+import protocols
+
+"""
+保存済みの信号から、受信した信号がどれかを引くためのインデックス
+
+信号の最初のフレーム(リピートの回数に左右されないように)を次のように指紋にする。
+    1. clustering.normaliseでマークとスペースをそれぞれTOLERANCE以内のクラスタにまとめる
+    2. 各パルスを、同じ偶奇のクラスタの短い方からの番号(シンボル)に置き換える
+    3. シンボル列のハッシュと、先頭のマークをlog目盛りで量子化したバケットをキーにする
+シンボル列はジッターがあってもクラスタが同じなら変わらない。先頭のマークのバケットは
+境界をまたいでも見つかるように、引くときは隣のバケットも調べる(局所性鋭敏ハッシュ)。
+キーが一致した候補はクラスタの平均値がTOLERANCE以内か確かめ、最も近いものを返す。
+"""
+
+TOLERANCE = clustering.TOLERANCE
+# 先頭のマークのバケットの幅(log目盛り)
+BUCKET_RATIO = 1 + TOLERANCE / 100.0
+
+
+"""
+パルス列の指紋。keyはインデックスのキー、centroidsは(マーク, スペース)それぞれのクラスタの平均値
+"""
+class Fingerprint:
+    def __init__(self, symbols_hash, bucket, centroids):
+        self.symbols_hash = symbols_hash
+        self.bucket = bucket
+        self.centroids = centroids
+
+    @property
+    def key(self):
+        return (self.symbols_hash, self.bucket)
+
+    def probes(self):
+        return [(self.symbols_hash, self.bucket + i) for i in (0, -1, 1)]
+
+    """
+    クラスタの平均値の違いが最も大きいところの比率を返す。クラスタの数が違えばNone
+    """
+    def distance(self, other):
+        worst = 0.0
+        for mine, theirs in zip(self.centroids, other.centroids):
+            if len(mine) != len(theirs):
+                return None
+            for a, b in zip(mine, theirs):
+                worst = max(worst, abs(a - b) / max(a, b))
+        return worst
+
+
+"""
+{レコード名: [パルス長, ...]}の信号のうち、インデックスに使うレコードのパルス列を返す
+"""
+def record_pulses(signals):
+    return signals[min(signals)] if signals else []
+
+
+def fingerprint(pulses, tolerance=TOLERANCE):
+    frames = protocols.split_frames(pulses)
+    if not frames or not frames[0]:
+        return None
+    frame = [float(x) for x in frames[0]]
+    clustering.normalise(frame, tolerance)
+    centroids = []
+    symbols = array('H', bytes(2 * len(frame)))
+    for base in (0, 1):
+        values = sorted(set(frame[base::2]))
+        labels = dict((v, i) for i, v in enumerate(values))
+        symbols[base::2] = array('H', [labels[v] for v in frame[base::2]])
+        centroids.append(tuple(values))
+    symbols_hash = hashlib.blake2b(symbols.tobytes(), digest_size=8).digest()
+    bucket = int(math.floor(math.log(max(frame[0], 1.0)) / math.log(BUCKET_RATIO)))
+    return Fingerprint(symbols_hash, bucket, tuple(centroids))
+
+
+"""
+信号ID毎の指紋を持ち、指紋のキーから信号IDを引くインデックス。
+add/removeで保存・削除の度に更新する。Mediatorのスレッドと初期化時に使うのでロックで守る。
+"""
+class FingerprintIndex:
+    def __init__(self, tolerance=TOLERANCE):
+        self.tolerance = tolerance
+        self.__lock = threading.Lock()
+        self.__buckets = {}
+        self.__fingerprints = {}
+
+    def __len__(self):
+        return len(self.__fingerprints)
+
+    """
+    信号を追加する。同じIDの信号があれば置き換える
+    """
+    def add(self, ir_signal_id, pulses):
+        f = fingerprint(pulses, self.tolerance)
+        with self.__lock:
+            self.__remove(ir_signal_id)
+            if f is None:
+                return
+            self.__fingerprints[ir_signal_id] = f
+            self.__buckets.setdefault(f.key, set()).add(ir_signal_id)
+
+    def remove(self, ir_signal_id):
+        with self.__lock:
+            self.__remove(ir_signal_id)
+
+    def __remove(self, ir_signal_id):
+        f = self.__fingerprints.pop(ir_signal_id, None)
+        if f is None:
+            return
+        ids = self.__buckets[f.key]
+        ids.discard(ir_signal_id)
+        if not ids:
+            del self.__buckets[f.key]
+
+    def clear(self):
+        with self.__lock:
+            self.__buckets.clear()
+            self.__fingerprints.clear()
+
+    """
+    pulsesに最も近い保存済みの信号のIDを返す。TOLERANCE以内のものが無ければNone
+    """
+    def identify(self, pulses):
+        f = fingerprint(pulses, self.tolerance)
+        if f is None:
+            return None
+        limit = self.tolerance / 100.0
+        best = None
+        with self.__lock:
+            for key in f.probes():
+                for ir_signal_id in self.__buckets.get(key, ()):
+                    distance = f.distance(self.__fingerprints[ir_signal_id])
+                    if distance is not None and distance <= limit and (best is None or distance < best[0]):
+                        best = (distance, ir_signal_id)
+        return best[1] if best is not None else None
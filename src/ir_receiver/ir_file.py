@@ -0,0 +1,191 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+"""
+リモコン信号ファイル(.ir)のバイナリ形式
+
+    ヘッダ(16バイト、リトルエンディアン)
+        magic        4s  b'IRSF'
+        version      B   FORMAT_VERSION
+        flags        B   予約(0)
+        quantum_us   H   量子化の単位(us)。パルス長 = 保存値 * quantum_us
+        carrier_hz   I   キャリア周波数(Hz)
+        record_count H   レコード数
+        reserved     H   予約(0)
+    レコード(record_count個)
+        name_length  H   レコード名(UTF-8)のバイト数
+        width        B   パルス1つのバイト数(2: uint16, 4: uint32)
+        reserved     B   予約(0)
+        pulse_count  I   パルス数
+        name             レコード名。4バイト境界までゼロで埋める
+        pulses           パルス長の配列。4バイト境界までゼロで埋める
+
+読み込みはmmapしたファイルをmemoryviewでキャストするだけなので、パルス配列はコピーしない。
+先頭が'{'のファイルは以前のJSON形式として読む。
+"""
+
+MAGIC = b'IRSF'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sBBHIHH')
+RECORD = struct.Struct('<HBBI')
+# raspberry_pi_boundary.FREQ(kHz)と同じ
+CARRIER_HZ = 38000
+QUANTUM_US = 1
+ALIGN = 4
+
+_TYPECODES = {2: 'H', 4: 'I'}
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _padding(n):
+    return -n % ALIGN
+
+
+def is_json(head):
+    return head.lstrip()[:1] == b'{'
+
+
+"""
+{レコード名: [パルス長(us), ...]}をバイナリ形式にする。
+パルス長はquantum_us単位に丸める(normaliseの小数点以下はここで落ちる)。
+"""
+def encode(signals, carrier_hz=CARRIER_HZ, quantum_us=QUANTUM_US):
+    parts = [HEADER.pack(MAGIC, FORMAT_VERSION, 0, quantum_us, int(carrier_hz), len(signals), 0)]
+    for name, pulses in signals.items():
+        values = [int(round(x / quantum_us)) for x in pulses]
+        width = 2 if max(values, default=0) <= 0xFFFF else 4
+        packed = array(_TYPECODES[width], values)
+        if not _LITTLE_ENDIAN:
+            packed.byteswap()
+        encoded_name = name.encode('utf-8')
+        parts.append(RECORD.pack(len(encoded_name), width, 0, len(values)))
+        parts.append(encoded_name + b'\0' * _padding(len(encoded_name)))
+        parts.append(packed.tobytes() + b'\0' * _padding(len(packed) * width))
+    return b''.join(parts)
+
+
+"""
+読み込んだ.irファイル。recordsは{レコード名: パルス長の配列}で、値はquantum_us単位。
+バイナリ形式の場合、配列はファイルをmmapした領域のmemoryviewなので、closeした後は使えない。
+JSON形式の場合はcarrier_hzがNoneで、配列はlistになる。
+"""
+class IrFile:
+    def __init__(self, records, carrier_hz, quantum_us, version, mapped=None, views=()):
+        self.records = records
+        self.carrier_hz = carrier_hz
+        self.quantum_us = quantum_us
+        self.version = version
+        self.__mapped = mapped
+        self.__views = views
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """
+    パルス長をusのlistで返す(コピーする)
+    """
+    def pulses(self, name):
+        return [x * self.quantum_us for x in self.records[name]]
+
+    def to_dict(self):
+        return dict((name, self.pulses(name)) for name in self.records)
+
+    def close(self):
+        # mmapはmemoryviewが残っていると閉じられないので、キャストしたものから順に解放する
+        for view in reversed(self.__views):
+            view.release()
+        self.__views = ()
+        if self.__mapped is not None:
+            self.__mapped.close()
+            self.__mapped = None
+
+
+"""
+bufferのバイナリ形式を読む。パルス配列はbufferのmemoryviewになる。
+mappedを渡した場合はIrFile.closeでmappedも閉じる。
+"""
+def decode(buffer, mapped=None):
+    views = [memoryview(buffer)]
+    try:
+        records, header = _decode_records(views)
+    except Exception:
+        for view in reversed(views):
+            view.release()
+        raise
+    return IrFile(records, header[4], header[3], header[1], mapped, views)
+
+
+def _decode_records(views):
+    view = views[0]
+    if len(view) < HEADER.size:
+        raise ValueError('Truncated ir file header')
+    header = HEADER.unpack_from(view, 0)
+    magic, version, flags, quantum_us, carrier_hz, record_count, reserved = header
+    if magic != MAGIC:
+        raise ValueError('Not an ir file')
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported ir file version {0}'.format(version))
+    records = {}
+    offset = HEADER.size
+    for _ in range(record_count):
+        if offset + RECORD.size > len(view):
+            raise ValueError('Truncated ir file record')
+        name_length, width, reserved, pulse_count = RECORD.unpack_from(view, offset)
+        if width not in _TYPECODES:
+            raise ValueError('Unsupported pulse width {0}'.format(width))
+        offset += RECORD.size
+        if offset + name_length > len(view):
+            raise ValueError('Truncated ir file record')
+        name = bytes(view[offset:offset + name_length]).decode('utf-8')
+        offset += name_length + _padding(name_length)
+        end = offset + pulse_count * width
+        if end > len(view):
+            raise ValueError('Truncated ir file record {0}'.format(name))
+        raw = view[offset:end]
+        if _LITTLE_ENDIAN:
+            pulses = raw.cast(_TYPECODES[width])
+            views.extend((raw, pulses))
+        else:
+            pulses = array(_TYPECODES[width], raw)
+            pulses.byteswap()
+            views.append(raw)
+        records[name] = pulses
+        offset = end + _padding(pulse_count * width)
+    return records, header
+
+
+def _decode_json(data):
+    return IrFile(json.loads(data), None, QUANTUM_US, 0)
+
+
+"""
+メモリ上の.irファイルの中身を読む。バイナリ形式の配列はdataのmemoryviewになる。
+"""
+def loads(data):
+    if is_json(data[:HEADER.size]):
+        return _decode_json(data)
+    return decode(data)
+
+
+"""
+.irファイルを読む。バイナリ形式はmmapして読み、JSON形式はそのまま読む。
+"""
+def load(name):
+    with open(name, 'rb') as f:
+        head = f.read(HEADER.size)
+        if is_json(head):
+            return _decode_json(head + f.read())
+        if len(head) < HEADER.size:
+            raise ValueError('Truncated ir file header')
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return decode(buffer, buffer)
+    except Exception:
+        buffer.close()
+        raise
@@ -0,0 +1,268 @@
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import tarfile
+import threading
+import time
+import filesystem
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+"""
+信号のライブラリ(/dataの信号ファイルとRedisの信号)を1つのtar.gzに書き出し・読み込みするモジュール
+
+    ir_library/manifest.json         {'format': FORMAT_VERSION}
+    ir_library/files/<SHA-256>.ir    信号ファイル。名前はfilesystem.content_nameで、同じ内容のファイルは1つだけ入れる
+    ir_library/signals/<n>.json      信号(name, sleep, filePath, fileTimeStamp, code)。filePathはfiles/の名前
+
+ファイルを全て書いてから信号を書くので、読み込みではファイルを全て保存してからディレクトリを1回だけfsyncし、
+その後の信号を1つのパイプラインでRedisに追加できる。
+書き出し・読み込みともtarfileのストリームモード('w|gz', 'r|gz')で1メンバずつ処理するので、
+メモリに置くのは書き出したファイルのハッシュ(ファイル毎に32バイト)と1つのメンバだけ。
+読み込んだ信号には新しいIDを振り、既存の信号に追加する。
+書き出し・読み込みの間も信号の保存・削除は続くので、書き出しは途中で消えたファイルを飛ばし、
+読み込みはファイル毎にだけロックを取って、保存したファイルを信号を追加し終えるまで削除させない(pinned)。
+"""
+
+FORMAT_VERSION = 1
+ROOT = 'ir_library/'
+MANIFEST = ROOT + 'manifest.json'
+FILES = ROOT + 'files/'
+SIGNALS = ROOT + 'signals/'
+# export_ir_library/import_ir_libraryのメッセージにpathが無い場合に使う、IR_FOLDER_PATHの中の名前
+ARCHIVE_NAME = 'ir_library.tar.gz'
+# 1回にRedisから読む信号の数
+SCAN_COUNT = 200
+# 1つのメンバの上限。信号ファイルはこれより十分小さい
+MAX_MEMBER_BYTES = 16 * 1024 * 1024
+# アーカイブに入れる信号のフィールド(IDは読み込み側で振り直す)
+SIGNAL_FIELDS = ('name', 'sleep', 'filePath', 'fileTimeStamp', 'code')
+
+_CONTENT_NAME = re.compile(r'^[0-9a-f]{64}\.ir$')
+
+
+"""
+アーカイブを書き出すクラス。信号を2回渡す。1回目はadd_fileでファイルを、2回目はadd_signalで信号を書く
+"""
+class LibraryWriter:
+    def __init__(self, out, folder):
+        self.__tar = tarfile.open(fileobj=out, mode='w|gz')
+        self.__folder = folder
+        self.__written = set()
+        self.files = 0
+        self.signals = 0
+        self.__add(MANIFEST, json.dumps({'format': FORMAT_VERSION}).encode('utf-8'))
+
+    def __add(self, name, data, mtime=None):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime if mtime is not None else time.time()
+        self.__tar.addfile(info, io.BytesIO(data))
+        # TarFileはストリームモードでも全メンバのTarInfoを持ち続けるので捨てる
+        self.__tar.members = []
+
+    """
+    信号のファイルの(content_nameの名前, パス)を返す。無ければ(None, None)
+    以前の<id>.irの名前のファイルは読んでハッシュを求める
+    """
+    def __content(self, signal):
+        file_name = signal['filePath']
+        if not isinstance(file_name, str):
+            return None, None
+        path = os.path.join(self.__folder, file_name)
+        if _CONTENT_NAME.match(file_name):
+            return (file_name, path) if os.path.exists(path) else (None, None)
+        try:
+            with open(path, 'rb') as f:
+                return filesystem.content_name(f.read()), path
+        except FileNotFoundError:
+            return None, None
+
+    def add_file(self, signal):
+        name, path = self.__content(signal)
+        if name is None or bytes.fromhex(name[:64]) in self.__written:
+            return
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            # 書き出しの間に信号が削除・更新されて消えた。信号も2回目に無いか、ファイル無しで書く
+            logger.error('Skipped signal file {0} of signal {1} deleted while exporting'.format(name, signal.get('id')))
+            return
+        self.__add(FILES + name, data, mtime)
+        self.__written.add(bytes.fromhex(name[:64]))
+        self.files += 1
+
+    def add_signal(self, signal):
+        name, _ = self.__content(signal)
+        if name is not None and bytes.fromhex(name[:64]) not in self.__written:
+            # 1回目の後にファイルが変わった
+            name = None
+        value = dict((field, signal.get(field)) for field in SIGNAL_FIELDS)
+        value['filePath'] = name
+        if name is None:
+            value['fileTimeStamp'] = None
+        self.__add('{0}{1}.json'.format(SIGNALS, self.signals), json.dumps(value).encode('utf-8'))
+        self.signals += 1
+
+    def close(self):
+        self.__tar.close()
+
+
+"""
+アーカイブを先頭から読み、('file', ファイル名, 中身)か('signal', None, 信号)を順に返す
+"""
+def read_library(source):
+    with tarfile.open(fileobj=source, mode='r|gz') as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            if info.size > MAX_MEMBER_BYTES:
+                raise ValueError('Too large member {0}'.format(info.name))
+            data = tar.extractfile(info).read()
+            if info.name == MANIFEST:
+                manifest = json.loads(data.decode('utf-8'))
+                if manifest.get('format') != FORMAT_VERSION:
+                    raise ValueError('Unsupported library format {0}'.format(manifest.get('format')))
+            elif info.name.startswith(FILES):
+                yield 'file', info.name[len(FILES):], data
+            elif info.name.startswith(SIGNALS):
+                yield 'signal', None, json.loads(data.decode('utf-8'))
+            tar.members = []
+
+
+"""
+read_libraryのファイルをfolderに保存し、信号をRedisに追加する形にして返すジェネレータ
+ファイルはディレクトリをfsyncせずに書き、最初の信号の前に1回だけfsyncする
+ファイルは1つずつlock(Mediator.files_lock)の中で保存し、名前をpinnedに加える。
+保存したファイルは信号を追加するまでどこからも参照されないことがあるので、呼び出し側はpinnedのファイルを削除しない
+"""
+def imported_signals(entries, fs, folder, lock=None, pinned=None):
+    lock = lock if lock is not None else threading.Lock()
+    synced = False
+    for kind, name, value in entries:
+        if kind == 'file':
+            if filesystem.content_name(value) != name:
+                raise ValueError('Signal file {0} is corrupted'.format(name))
+            with lock:
+                if pinned is not None:
+                    pinned.add(name)
+                fs.save_content(folder, value, sync_directory=False)
+            continue
+        if not synced:
+            fs.sync_directory(folder)
+            synced = True
+        signal = dict((field, value.get(field)) for field in SIGNAL_FIELDS)
+        file_name = signal['filePath']
+        if isinstance(file_name, str) and _CONTENT_NAME.match(file_name) and os.path.exists(os.path.join(folder, file_name)):
+            signal['fileTimeStamp'] = os.path.getmtime(os.path.join(folder, file_name))
+        else:
+            signal['filePath'] = signal['fileTimeStamp'] = None
+        yield signal
+    if not synced:
+        fs.sync_directory(folder)
+
+
+def _temp_path(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, filesystem.TEMP_PREFIX + name + filesystem.TEMP_SUFFIX)
+
+
+"""
+全信号をpathのアーカイブに書き出し、書き出した信号数を返す。
+一時ファイルに書いてから置き換えるので、途中で失敗しても前のアーカイブは残る
+"""
+def export_library(redis_boundary, folder, path):
+    temp_path = _temp_path(path)
+    try:
+        with open(temp_path, 'wb') as out:
+            writer = LibraryWriter(out, folder)
+            try:
+                for add in (writer.add_file, writer.add_signal):
+                    cursor = -1
+                    while cursor is not None:
+                        cursor, signals = redis_boundary.scan_ir_signals(cursor, SCAN_COUNT)
+                        for signal in signals:
+                            add(signal)
+            finally:
+                # 失敗してもストリームを閉じる(閉じないとgc時に閉じたoutに書こうとする)
+                writer.close()
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return writer.signals
+
+
+def _add_all(add, signals):
+    for signal in signals:
+        add(signal)
+
+
+"""
+export_libraryのasyncio版。Redisはイベントループで読み、ファイルの読み込みとgzipの圧縮・書き込みはexecutorで行う
+"""
+async def export_library_async(redis_boundary, folder, path):
+    loop = asyncio.get_running_loop()
+    temp_path = _temp_path(path)
+    try:
+        with open(temp_path, 'wb') as out:
+            writer = await loop.run_in_executor(None, LibraryWriter, out, folder)
+            try:
+                for add in (writer.add_file, writer.add_signal):
+                    cursor = -1
+                    while cursor is not None:
+                        cursor, signals = await redis_boundary.scan_ir_signals(cursor, SCAN_COUNT)
+                        await loop.run_in_executor(None, _add_all, add, signals)
+            finally:
+                # 失敗してもストリームを閉じる(閉じないとgc時に閉じたoutに書こうとする)
+                await loop.run_in_executor(None, writer.close)
+        await loop.run_in_executor(None, os.replace, temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return writer.signals
+
+
+"""
+pathのアーカイブの信号ファイルをfolderに保存し、信号を新しいIDでRedisに追加する。追加した信号数を返す
+lockとpinnedはimported_signalsに渡す
+"""
+def import_library(redis_boundary, fs, folder, path, lock=None, pinned=None):
+    with open(path, 'rb') as source:
+        return redis_boundary.import_ir_signals(imported_signals(read_library(source), fs, folder, lock, pinned))
+
+
+"""
+iterableをexecutorでcount個ずつ取り出して返す非同期ジェネレータ。取り出す間の読み込みや書き込みでイベントループを止めない
+"""
+async def _iterate_in_executor(iterable, count=SCAN_COUNT):
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    while True:
+        batch = await loop.run_in_executor(None, list, itertools.islice(iterator, count))
+        if not batch:
+            return
+        for item in batch:
+            yield item
+
+
+"""
+import_libraryのasyncio版。アーカイブの展開と信号ファイルの保存はexecutorで行う
+"""
+async def import_library_async(redis_boundary, fs, folder, path, lock=None, pinned=None):
+    with open(path, 'rb') as source:
+        signals = _iterate_in_executor(imported_signals(read_library(source), fs, folder, lock, pinned))
+        try:
+            return await redis_boundary.import_ir_signals(signals)
+        finally:
+            await signals.aclose()
@@ -1,37 +1,203 @@
+import argparse
+import asyncio
 import logging
+import signal
+import threading
+import config
 import redis_boundary
 import filesystem
+import library
+import maintenance
+import metrics
 import raspberry_pi_boundary
 import mediator
+import sessions
 import time
 
-if __name__ == '__main__':
-    logging.basicConfig(filename='logs/ir_receiver.log', level=logging.DEBUG)
-    logger = logging.getLogger(__name__)
-    sh = logging.StreamHandler()
-    logger.addHandler(sh)
-    
-        #各種コンポーネントの初期化
-    logger.debug('Received ir_receiver service starting')
+
+"""
+config.METRICSが有効なら、集計をRedisのハッシュに書き出すスレッドと、METRICS_PORTが0以外なら/metricsのサーバーを起動する。
+saving_boundaryはスレッドから呼ぶのでRedisBoundary。collecting_boundaryのキャッシュの統計も集計に入れる
+"""
+def start_metrics(saving_boundary, collecting_boundary):
+    if not config.METRICS:
+        return None, None
+    metrics.registry.add_collector(collecting_boundary.collect_metrics)
+    reporter = metrics.Reporter(saving_boundary.save_metrics)
+    reporter.start()
+    server = metrics.serve() if config.METRICS_PORT else None
+    return reporter, server
+
+
+def stop_metrics(reporter, server):
+    if reporter is not None:
+        reporter.stop()
+        # 止める直前までの集計を残す
+        reporter.report()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+"""
+スレッド版のサービス。SIGINTかSIGTERMを受けるまで動き、終了処理をしてから戻る。
+"""
+def run_threaded(logger):
+    #各種コンポーネントの初期化
     __mediator = mediator.Mediator();
     __redis_boundary = redis_boundary.RedisBoundary(__mediator);
     __filesystem = filesystem.Filesystem();
-    __raspberry_pi = raspberry_pi_boundary.RespberryPiBoundary();
-    __mediator.initialize(__redis_boundary, __filesystem, __raspberry_pi)
+    __filesystem.remove_stale_temp_files(mediator.IR_FOLDER_PATH)
+    __sessions = sessions.SessionManager(__filesystem, mediator.IR_FOLDER_PATH)
+    __sessions.remove_spilled_files()
+    __raspberry_pi = raspberry_pi_boundary.receivers(config.GPIOS);
+    __mediator.initialize(__redis_boundary, __filesystem, __raspberry_pi, __sessions)
+    __scanner = maintenance.ConsistencyScanner(__redis_boundary, __filesystem, mediator.IR_FOLDER_PATH,
+                                               busy=__sessions.pending, lock=__mediator.files_lock)
+    __reporter = __server = None
+
+    # SIGINTとSIGTERM(docker stop)のどちらでも終了処理を行う
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopping.set())
 
     try:
         # サービスの開始
         __mediator.start()
+        if config.MAINTENANCE_INTERVAL_S:
+            __scanner.start()
+        __reporter, __server = start_metrics(__redis_boundary, __redis_boundary)
         logger.debug('Received ir_receiver service started')
 
-        while True:
+        while not stopping.is_set():
             time.sleep(0.1)
 
-    except KeyboardInterrupt:
-        logger.debug('KeyboardInterrupt')
+    finally:
+        # 開始の途中で失敗しても保守と集計のスレッドを止め、最後の集計を書き出してから戻る
+        logger.debug('Stopping')
+        __scanner.stop()
         __mediator.stop()
+        stop_metrics(__reporter, __server)
 
         # neochi-core issues #20 待ち
         #__mediator.wait_stop_end()
 
+
+"""
+asyncio版のサービス。SIGINTかSIGTERMを受けるまでメッセージを処理し、終了処理を待ってから戻る。
+"""
+async def run_asyncio(logger):
+    import async_mediator
+    import async_redis_boundary
+
+    #各種コンポーネントの初期化
+    __mediator = async_mediator.AsyncMediator()
+    __redis_boundary = async_redis_boundary.AsyncRedisBoundary()
+    __filesystem = filesystem.Filesystem()
+    __filesystem.remove_stale_temp_files(mediator.IR_FOLDER_PATH)
+    __sessions = sessions.SessionManager(__filesystem, mediator.IR_FOLDER_PATH)
+    __sessions.remove_spilled_files()
+    __raspberry_pi = raspberry_pi_boundary.receivers(config.GPIOS)
+    await __mediator.initialize(__redis_boundary, __filesystem, __raspberry_pi, __sessions)
+    # 保守と集計の書き出しはスレッドで行うので同期版のRedisBoundaryを使う
+    # 保守はAsyncMediatorと同じfiles_lockを取ってから信号の修正とファイルの移動を行う
+    # 集計の書き出しはir_receiver:metricsにしか書かず、信号やファイルには触らないのでロックは要らない
+    __thread_boundary = redis_boundary.RedisBoundary(None)
+    __scanner = maintenance.ConsistencyScanner(__thread_boundary, __filesystem, mediator.IR_FOLDER_PATH,
+                                               busy=__sessions.pending, lock=__mediator.files_lock)
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    # サービスの開始
+    running = asyncio.ensure_future(__mediator.run())
+    waiting = asyncio.ensure_future(stopping.wait())
+    __reporter = __server = None
+    try:
+        if config.MAINTENANCE_INTERVAL_S:
+            __scanner.start()
+        __reporter, __server = start_metrics(__thread_boundary, __redis_boundary)
+        logger.debug('Received ir_receiver service started')
+        await asyncio.wait([running, waiting], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # run()が例外で終わっても保守と集計のスレッドを止めてから戻る
+        logger.debug('Stopping')
+        for task in (running, waiting):
+            task.cancel()
+        await asyncio.gather(running, waiting, return_exceptions=True)
+        if not running.cancelled() and running.exception() is not None:
+            logger.error('Mediator stopped: {0}'.format(running.exception()))
+        await loop.run_in_executor(None, __scanner.stop)
+        await loop.run_in_executor(None, stop_metrics, __reporter, __server)
+        await __mediator.stop()
+
+
+"""
+/dataの信号ファイルとRedisの信号を1回突き合わせて直す。サービスを止めてから実行する
+"""
+def check(logger):
+    __filesystem = filesystem.Filesystem()
+    scanner = maintenance.ConsistencyScanner(redis_boundary.RedisBoundary(None), __filesystem, mediator.IR_FOLDER_PATH,
+                                             pause_s=0)
+    stats = scanner.run_cycle()
+    logger.debug('Checked: {0}'.format(dict(stats)))
+
+
+"""
+全信号をpathのアーカイブに書き出す
+"""
+def export_library(logger, path):
+    count = library.export_library(redis_boundary.RedisBoundary(None), mediator.IR_FOLDER_PATH, path)
+    logger.debug('Exported {0} signals to {1}'.format(count, path))
+
+
+"""
+pathのアーカイブの信号を新しいIDで追加する。
+動いているサービスの指紋のインデックスには入らないので、サービスの再起動かimport_ir_libraryのメッセージを使う
+"""
+def import_library(logger, path):
+    count = library.import_library(redis_boundary.RedisBoundary(None), filesystem.Filesystem(), mediator.IR_FOLDER_PATH, path)
+    logger.debug('Imported {0} signals from {1}'.format(count, path))
+
+
+"""
+以前の形式でRedisに保存されているIRを信号毎のハッシュに移行する
+"""
+def migrate(logger):
+    if redis_boundary.RedisBoundary(None).migrate_ir():
+        logger.debug('Migrated ir to per-signal storage')
+    else:
+        logger.debug('Ir is already migrated')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['serve', 'migrate', 'check', 'export', 'import'], default='serve')
+    parser.add_argument('path', nargs='?', default='{0}/{1}'.format(mediator.IR_FOLDER_PATH, library.ARCHIVE_NAME),
+                        help='export/importのアーカイブのパス')
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread',
+                        help='thread: redis-pyの購読スレッドで動かす。asyncio: 1つのイベントループで動かす')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='logs/ir_receiver.log', level=getattr(logging, config.LOG_LEVEL.upper()))
+    logger = logging.getLogger(__name__)
+    sh = logging.StreamHandler()
+    logger.addHandler(sh)
+
+    if args.command == 'migrate':
+        migrate(logger)
+    elif args.command == 'check':
+        check(logger)
+    elif args.command == 'export':
+        export_library(logger, args.path)
+    elif args.command == 'import':
+        import_library(logger, args.path)
+    else:
+        logger.debug('Received ir_receiver service starting')
+        if args.mode == 'asyncio':
+            asyncio.run(run_asyncio(logger))
+        else:
+            run_threaded(logger)
         logger.debug('Received ir_receiver service ended')
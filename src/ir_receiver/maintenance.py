@@ -0,0 +1,223 @@
+import collections
+import logging
+import os
+import threading
+import time
+import config
+import filesystem
+import sessions
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+# どの信号からも参照されていないファイルを移すディレクトリ。<folder>/quarantine
+QUARANTINE_DIR = 'quarantine'
+# 以前のMediatorがリネーム前に書いていた一時ファイル
+LEGACY_TEMP_NAME = 'tmp.ir'
+# fileTimeStampとmtimeが違うとみなす差(秒)
+TIMESTAMP_TOLERANCE_S = 1e-6
+
+
+class _Stopped(Exception):
+    pass
+
+
+"""
+/dataの信号ファイルとRedisの信号を突き合わせて直すクラス
+1回の検査(run_cycle)は次の順に行う。
+
+    1. Redisの信号をIDの順にbatch_size個ずつ読み(scan_ir_signals)、信号毎に
+        - filePathが1要素のリストなら文字列に直す(以前の__update_current_irの不具合)
+        - ファイルが無ければquarantineから戻す。quarantineにも無ければfilePathとfileTimeStampをNoneにする
+        - fileTimeStampがファイルのmtimeと違えばmtimeに合わせる
+    2. /dataをos.scandirでbatch_size個ずつ調べ、
+        - grace_sより古い一時ファイル(.xxx.partial, tmp.ir)を削除する
+        - grace_sより古く、どの信号からも参照されていない.irファイルをquarantineに移す
+    3. quarantineに移してからquarantine_ttl_s経ったファイルを削除する
+
+batch_size個毎にpause_s休み、busy()がTrue(キャプチャ待ち・キャプチャ中)の間は再開しない。
+スレッドの優先度も下げるので、キャプチャの処理とCPUやSDカードを取り合わない。
+lockを渡すと信号の修正とファイルの移動をそのロックの中で行う(Mediator.files_lock)。
+redis_boundaryはRedisBoundary(スレッドから呼ぶのでasyncio版は使えない)。
+"""
+class ConsistencyScanner:
+    def __init__(self, redis_boundary, fs, folder, batch_size=None, pause_s=None, grace_s=None,
+                 quarantine_ttl_s=None, busy=None, lock=None, clock=time.time):
+        self.__redis_boundary = redis_boundary
+        self.__filesystem = fs
+        self.__folder = folder
+        self.__quarantine = os.path.join(folder, QUARANTINE_DIR)
+        self.batch_size = batch_size if batch_size is not None else config.MAINTENANCE_BATCH
+        self.pause_s = pause_s if pause_s is not None else config.MAINTENANCE_PAUSE_MS / 1000.0
+        self.grace_s = grace_s if grace_s is not None else config.MAINTENANCE_GRACE_S
+        self.quarantine_ttl_s = quarantine_ttl_s if quarantine_ttl_s is not None else config.QUARANTINE_TTL_S
+        self.__busy = busy if busy is not None else lambda: False
+        self.__lock = lock if lock is not None else threading.Lock()
+        self.__clock = clock
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+    """
+    1回検査して、修正した件数などをcollections.Counterで返す
+    """
+    def run_cycle(self):
+        stats = collections.Counter()
+        started = self.__clock()
+        try:
+            referenced = self.__scan_library(stats)
+            self.__scan_files(referenced, started, stats)
+            self.__purge_quarantine(started, stats)
+        except _Stopped:
+            stats['stopped'] += 1
+        return stats
+
+    """
+    interval_s毎にrun_cycle()を呼ぶスレッドを開始する。最初の検査もinterval_s後に行う
+    """
+    def start(self, interval_s=None):
+        interval_s = interval_s if interval_s is not None else config.MAINTENANCE_INTERVAL_S
+        self.__stopping.clear()
+        self.__thread = threading.Thread(target=self.__loop, args=(interval_s,), daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopping.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __loop(self, interval_s):
+        try:
+            # このスレッドだけ優先度を下げる(Linuxではsetpriorityにスレッドのidを渡せる)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError) as error:
+            logger.debug('Lowering maintenance priority failed: {0}'.format(error))
+        while not self.__stopping.wait(interval_s):
+            try:
+                stats = self.run_cycle()
+                logger.debug('Maintenance finished: %s', stats)
+            except Exception as error:
+                logger.error('Maintenance failed: {0}'.format(error))
+
+    """
+    batch_size個毎に呼ぶ。キャプチャが終わるまで待ってからpause_s休む
+    """
+    def __throttle(self):
+        while self.__busy():
+            if self.__stopping.wait(max(self.pause_s, 0.01)):
+                raise _Stopped()
+        if self.__stopping.wait(self.pause_s):
+            raise _Stopped()
+
+    """
+    Redisの信号を検査し、参照されているファイル名の集合を返す
+    """
+    def __scan_library(self, stats):
+        referenced = set()
+        cursor = -1
+        while cursor is not None:
+            self.__throttle()
+            cursor, signals = self.__redis_boundary.scan_ir_signals(cursor, self.batch_size)
+            for signal in signals:
+                stats['signals'] += 1
+                file_name = self.__check_signal(signal, stats)
+                if file_name is not None:
+                    referenced.add(file_name)
+        return referenced
+
+    def __check_signal(self, signal, stats):
+        file_name = signal['filePath']
+        if file_name is None:
+            return None
+        repairs = {}
+        if isinstance(file_name, list) and len(file_name) == 1:
+            file_name = repairs['filePath'] = file_name[0]
+            stats['paths'] += 1
+        if not isinstance(file_name, str):
+            logger.error('Signal {0} has invalid filePath {1}'.format(signal['id'], signal['filePath']))
+            return None
+        path = os.path.join(self.__folder, file_name)
+        if not os.path.exists(path):
+            if self.__restore(file_name):
+                stats['restored'] += 1
+            else:
+                logger.error('Signal file {0} of {1} is missing'.format(file_name, signal['id']))
+                repairs.update({'filePath': None, 'fileTimeStamp': None})
+                stats['dangling'] += 1
+        if repairs.get('filePath', file_name) is not None:
+            mtime = os.path.getmtime(path)
+            if signal['fileTimeStamp'] is None or abs(signal['fileTimeStamp'] - mtime) > TIMESTAMP_TOLERANCE_S:
+                repairs['fileTimeStamp'] = mtime
+                stats['timestamps'] += 1
+        if repairs:
+            self.__repair(signal, repairs)
+        return repairs.get('filePath', file_name)
+
+    """
+    検査した後に信号が更新されていなければ修正を保存する
+    """
+    def __repair(self, signal, repairs):
+        with self.__lock:
+            current = self.__redis_boundary.get_ir_signal(signal['id'])
+            if current is None or current['filePath'] != signal['filePath']:
+                return
+            released = []
+            repairs['id'] = signal['id']
+            self.__redis_boundary.save_ir_signal(repairs, only_existing=True, released=released)
+            for file_name in released:
+                self.__filesystem.delete_file(os.path.join(self.__folder, file_name))
+        logger.debug('Repaired signal %s: %s', signal['id'], repairs)
+
+    def __restore(self, file_name):
+        quarantined = os.path.join(self.__quarantine, file_name)
+        if not os.path.exists(quarantined):
+            return False
+        self.__filesystem.rename_tmp_file(quarantined, os.path.join(self.__folder, file_name))
+        logger.debug('Restored {0} from quarantine'.format(file_name))
+        return True
+
+    def __scan_files(self, referenced, started, stats):
+        with os.scandir(self.__folder) as entries:
+            for i, entry in enumerate(entries):
+                if i % self.batch_size == 0:
+                    self.__throttle()
+                if not entry.is_file():
+                    continue
+                stats['files'] += 1
+                name = entry.name
+                # セッションの書き出しはSessionManagerが消す
+                if name.startswith(sessions.SPILL_PREFIX) or name in referenced:
+                    continue
+                if started - entry.stat().st_mtime <= self.grace_s:
+                    continue
+                if name == LEGACY_TEMP_NAME or (name.startswith(filesystem.TEMP_PREFIX) and name.endswith(filesystem.TEMP_SUFFIX)):
+                    self.__filesystem.delete_file(entry.path)
+                    stats['temp'] += 1
+                elif name.endswith('.ir'):
+                    if self.__quarantine_file(name):
+                        stats['quarantined'] += 1
+
+    """
+    検査の後に参照されていなければquarantineに移す
+    """
+    def __quarantine_file(self, name):
+        with self.__lock:
+            if self.__redis_boundary.is_ir_file_referenced(name):
+                return False
+            os.makedirs(self.__quarantine, exist_ok=True)
+            self.__filesystem.rename_tmp_file(os.path.join(self.__folder, name), os.path.join(self.__quarantine, name))
+        logger.debug('Quarantined {0}'.format(name))
+        return True
+
+    def __purge_quarantine(self, started, stats):
+        if not os.path.isdir(self.__quarantine):
+            return
+        with os.scandir(self.__quarantine) as entries:
+            for i, entry in enumerate(entries):
+                if i % self.batch_size == 0:
+                    self.__throttle()
+                # quarantineに移した時刻(renameでctimeが変わる)から数える
+                if entry.is_file() and started - entry.stat().st_ctime > self.quarantine_ttl_s:
+                    self.__filesystem.delete_file(entry.path)
+                    stats['purged'] += 1
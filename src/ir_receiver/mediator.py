@@ -1,10 +1,17 @@
+import functools
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+import fingerprint
+import library
+import monitor
+import sessions
 
 logger = logging.getLogger(__name__)
 sh = logging.StreamHandler()
 logger.addHandler(sh)
 IR_FOLDER_PATH = '/data' # このパスはDockerコンテナの信号ファイル・ディレクトリのマウント時に揃える必要があるので注意
-TMP_FILE_NAME = 'tmp.ir'
 
 """
 Mediatorクラス
@@ -17,70 +24,256 @@ class Mediator:
         self.__redis_boundary = None
         self.__filesystem = None
         self.__raspberry_pi = None
+        # {GPIO: RespberryPiBoundary}。メッセージの'gpio'で受信機を選び、無ければ最初の受信機(__raspberry_pi)を使う
+        self.__receivers = {}
+        self.__default_gpio = None
+        self.__sessions = None
+        # 保存済みの信号の指紋。保存・削除の度に更新する
+        self.__index = fingerprint.FingerprintIndex()
+        # 信号ファイルは同じ内容の信号で共有するので、参照の付け替えとファイルの削除の間に他の保存・削除を挟まない
+        self.__files_lock = threading.Lock()
+        # 読み込み中のライブラリが保存した信号ファイル。信号を追加し終えるまでは参照が無くても削除しない
+        self.__pinned_files = set()
+        # キャプチャはリモコンが押されるまで終わらないので、Redisの購読スレッドとは別のスレッドで行う
+        # 受信機毎に1つずつで、同じ受信機のキャプチャは順番に、別の受信機のキャプチャは同時に行う
+        self.__capture_executors = {}
+        # ライブラリの書き出し・読み込みは時間がかかるので、メッセージの処理とは別のスレッドで順に行う
+        self.__library_executor = None
+        # モニターモード中のフレームの書き込みと、モニターモードの受信機のGPIO
+        self.__monitor = None
+        self.__monitoring = set()
+        # メッセージのtitle毎の処理
+        self.__handlers = {
+            'start_ir_receiving': self.__start_ir_receiving,
+            'stop_ir_receiving': self.__stop_ir_receiving,
+            'save_ir_signal': self.__save_ir_signal,
+            'discard_ir_signal': self.__discard_ir_signal,
+            'delete_ir_signal': self.__delete_ir_signal,
+            'identify_ir_signal': self.__identify_ir_signal,
+            'start_monitoring': self.__start_monitoring,
+            'stop_monitoring': self.__stop_monitoring,
+            'export_ir_library': self.__export_ir_library,
+            'import_ir_library': self.__import_ir_library,
+        }
 
-    def initialize(self, redis_boundary, filesystem, raspberry_pi):
+    """
+        信号ファイルの保存・削除の間持つロック。maintenance.ConsistencyScannerも修正の間これを持つ
+    """
+    @property
+    def files_lock(self):
+        return self.__files_lock
+
+    """
+        raspberry_piはRespberryPiBoundaryか、raspberry_pi_boundary.receiversの{GPIO: RespberryPiBoundary}
+    """
+    def initialize(self, redis_boundary, filesystem, raspberry_pi, session_manager=None):
         self.__redis_boundary = redis_boundary
         self.__redis_boundary.set_state('booting')
+        if self.__redis_boundary.migrate_ir():
+            logger.debug('Migrated ir to per-signal storage')
         self.__filesystem = filesystem
-        self.__raspberry_pi = raspberry_pi
+        self.__receivers = raspberry_pi if isinstance(raspberry_pi, dict) else {None: raspberry_pi}
+        self.__default_gpio = next(iter(self.__receivers))
+        self.__raspberry_pi = self.__receivers[self.__default_gpio]
+        self.__capture_executors = dict((gpio, ThreadPoolExecutor(max_workers=1)) for gpio in self.__receivers)
+        self.__library_executor = ThreadPoolExecutor(max_workers=1)
+        if session_manager is None:
+            session_manager = sessions.SessionManager(filesystem, IR_FOLDER_PATH)
+        self.__sessions = session_manager
+        self.__build_index()
+
+    """
+        保存済みの信号ファイルを読んで指紋のインデックスを作る
+    """
+    def __build_index(self):
+        self.__index.clear()
+        for signal in self.__redis_boundary.get_ir()['signals']:
+            if signal['filePath'] is None:
+                continue
+            file_path = '{0}/{1}'.format(IR_FOLDER_PATH, signal['filePath'])
+            try:
+                with self.__filesystem.load_signal_file(file_path) as f:
+                    self.__index.add(signal['id'], fingerprint.record_pulses(f.to_dict()))
+            except (OSError, ValueError) as error:
+                logger.error('Indexing {0} failed: {1}'.format(file_path, error))
+        logger.debug('Indexed {0} signals'.format(len(self.__index)))
         
     def start(self):
         # Redisデータの受付開始
+        self.__sessions.start_sweeper()
         self.__redis_boundary.subscribe()
         self.__redis_boundary.set_state('ready')
+        if config.MONITOR:
+            self.__start_monitoring({})
 
     def stop(self):
         self.__redis_boundary.unsubscribe()
+        self.__sessions.cancel_all()
+        for raspberry_pi in self.__receivers.values():
+            raspberry_pi.stop_capturing_remote_signal()
+        for executor in self.__capture_executors.values():
+            executor.shutdown()
+        self.__library_executor.shutdown()
+        self.__close_monitor(self.__monitoring)
+        for raspberry_pi in self.__receivers.values():
+            raspberry_pi.close()
+        self.__sessions.stop_sweeper()
 
     def wait_stop_end(self):
         self.__redis_boundary.waits_subscription_end()
 
     def on_receive_message(self, value):
-        title = value['title']
-        if title == 'start_ir_receiving':
-            self.__start_ir_receiving(value)
-        elif title == 'stop_ir_receiving':
-            self.__stop_ir_receiving(value)
-        elif title == 'save_ir_signal':
-            self.__save_ir_signal(value)
-        elif title == 'discard_ir_signal':
-            self.__discard_ir_signal(value)
-        elif title == 'delete_ir_signal':
-            self.__delete_ir_signal(value)
+        handler = self.__handlers.get(value['title'])
+        if handler is not None:
+            handler(value)
 
     """
-        ラズパイからリモコン信号のキャプチャを開始する。
+        メッセージの'gpio'の受信機のGPIOを返す。'gpio'が無ければ最初の受信機
+    """
+    def __gpio(self, value):
+        gpio = value.get('gpio')
+        return self.__default_gpio if gpio is None else gpio
+
+    """
+        gpioの受信機が無ければエラーを通知してFalseを返す
+    """
+    def __has_receiver(self, gpio):
+        if gpio in self.__receivers:
+            return True
+        logger.error('No ir receiver on GPIO {0}'.format(gpio))
+        self.__redis_boundary.publish_ir_receiver_not_found_error(gpio)
+        return False
+
+    """
+        セッションのキャプチャに使う受信機を返す。セッションが無ければ最初の受信機
+    """
+    def __receiver_of(self, session_id):
+        session = self.__sessions.get(session_id)
+        return self.__receivers[session.gpio] if session is not None else self.__raspberry_pi
+
+    """
+        キャプチャのセッションを作り、ラズパイからリモコン信号のキャプチャを開始する。
+        'gpio'の受信機で受信する。同じ受信機で前のセッションのキャプチャ中であればその後に行う。
     """
     def __start_ir_receiving(self, value):
-        logger.debug('Received start_ir_receiving')
-        self.__redis_boundary.set_state('receiving')
-        self.__redis_boundary.publish_started_ir_receiving()
-        self.__raspberry_pi.start_capturing_remote_signal(self.remote_signal_received)
+        gpio = self.__gpio(value)
+        if not self.__has_receiver(gpio):
+            return
+        session = self.__sessions.create(value.get('presses') or config.CAPTURE_PRESSES, gpio)
+        logger.debug('Received start_ir_receiving. session is {0}'.format(session.id))
+        with self.__redis_boundary.batch():
+            self.__redis_boundary.set_state('receiving')
+            self.__redis_boundary.publish_started_ir_receiving(session.id, gpio)
+        future = self.__capture_executors[gpio].submit(self.__capture, session.id)
+        future.add_done_callback(functools.partial(self.__capture_done, session.id))
+
+    def __capture(self, session_id):
+        if not self.__sessions.begin(session_id):
+            # キャプチャ待ちの間にキャンセルされた
+            self.remote_signal_received(None, True, session_id)
+            return
+        session = self.__sessions.get(session_id)
+        raspberry_pi = self.__receivers[session.gpio]
+        presses = session.presses
+        if presses == 1:
+            raspberry_pi.start_capturing_remote_signal(
+                lambda signals, cancelled: self.remote_signal_received(signals, cancelled, session_id))
+            return
+        codes = []
+        while len(codes) < presses:
+            captured = []
+            raspberry_pi.start_capturing_remote_signal(
+                lambda signals, cancelled: captured.append((signals, cancelled)), tidy=False)
+            signals, cancelled = captured[0]
+            if cancelled:
+                self.remote_signal_received(None, True, session_id)
+                return
+            codes.append(signals['0'])
+            if len(codes) < presses:
+                # もう一度押してもらう
+                self.__redis_boundary.publish_stopped_ir_receiving_more_signal(session_id)
+        signals = raspberry_pi.merge_remote_signals(codes)
+        if signals is None:
+            logger.error('Captured {0} presses do not agree'.format(presses))
+            self.__invalid_signal_received(session_id)
+            return
+        self.remote_signal_received(signals, False, session_id)
+
+    """
+        キャプチャスレッドの終了時に呼ばれる。例外で終了した場合はreadyに戻して通知する。
+    """
+    def __capture_done(self, session_id, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            return
+        logger.error('Capturing remote signal failed: {0}'.format(error))
+        self.__invalid_signal_received(session_id)
+
+    def __invalid_signal_received(self, session_id):
+        self.__sessions.drop(session_id)
+        with self.__redis_boundary.batch():
+            self.__set_state_after_capture()
+            self.__redis_boundary.publish_stopped_ir_receiving_invalid_signal(session_id)
 
     """
-        リモコンの信号受信を中止する
+        キャプチャ待ちのセッションが無くなったらreadyに戻す
+    """
+    def __set_state_after_capture(self):
+        self.__redis_boundary.set_state('receiving' if self.__sessions.pending() else 'ready')
+
+    """
+        リモコンの信号受信を中止する。sessionが無い場合は'gpio'の受信機(無ければ全受信機)でキャプチャ中のものを中止する
     """
     def __stop_ir_receiving(self, value):
-        self.__raspberry_pi.stop_capturing_remote_signal()
+        session_id = value.get('session')
+        if session_id is not None:
+            if self.__sessions.cancel(session_id):
+                return
+            if self.__sessions.is_capturing(session_id):
+                self.__receiver_of(session_id).stop_capturing_remote_signal()
+            return
+        for gpio in self.__addressed_gpios(value):
+            self.__receivers[gpio].stop_capturing_remote_signal()
 
     """
-        一時ファイルに保存されているリモコン信号ファイルを永続化する
+        'gpio'の受信機のGPIOを返す。'gpio'が無ければ全受信機。受信機が無ければエラーを通知して空にする
+    """
+    def __addressed_gpios(self, value):
+        if value.get('gpio') is None:
+            return list(self.__receivers)
+        return [value['gpio']] if self.__has_receiver(value['gpio']) else []
+
+    """
+        セッションでキャプチャしたリモコン信号を永続化する
+        sessionが無い場合は最後にキャプチャしたセッションを使う
     """
     def __save_ir_signal(self, value):
-        logger.debug('Received save_ir_signal {0}'.format(value))
+        logger.debug('Received save_ir_signal %s', value)
         ir_signal_id, name, sleep, updates_file = value['id'], value['name'], value['sleep'], value['updatesFile']
+        session = None
+        if updates_file:
+            session = self.__sessions.take(value.get('session'))
+            if session is None:
+                logger.error('No captured signal for session {0}'.format(value.get('session')))
+                self.__redis_boundary.publish_ir_signal_saving_error()
+                return
         if ir_signal_id is None:
-            ir_signal_id = self.__create_new_ir(name, sleep, updates_file)
+            ir_signal_id = self.__create_new_ir(name, sleep, session)
         else:
-            self.__update_current_ir(ir_signal_id, name, sleep, updates_file)
+            self.__update_current_ir(ir_signal_id, name, sleep, session)
         self.__redis_boundary.publish_saved_ir_signal(ir_signal_id)
 
     """
-        一時ファイルに保存されているリモコン信号ファイルを破棄する
+        セッションでキャプチャしたリモコン信号を破棄する
     """
     def __discard_ir_signal(self, value):
-        # TODO 実装
-        self.__redis_boundary.publish_discarded_ir_signal()
+        session_id = value.get('session')
+        if self.__sessions.discard(session_id):
+            self.__redis_boundary.publish_discarded_ir_signal(session_id)
+        else:
+            self.__redis_boundary.publish_ir_signal_discarding_error()
 
     """
         永続化されているリモコン信号ファイルとRedisからデータを削除する
@@ -88,82 +281,205 @@ class Mediator:
     def __delete_ir_signal(self, value):
         ir_signal_id = value['id']
         logger.debug('Received delete_ir_signal {0}'.format(ir_signal_id))
-        file_path = '{0}/{1}.ir'.format(IR_FOLDER_PATH, ir_signal_id)
-        self.__filesystem.delete_file(file_path)
-        logger.debug('Deleted signal file {0}'.format(file_path))
-        ir = self.__redis_boundary.get_ir()
-        new_ir = [x for x in ir["signals"] if x["id"] != ir_signal_id]
-        self.__redis_boundary.set_ir({'signals': new_ir})
+        with self.__files_lock:
+            released = []
+            self.__redis_boundary.delete_ir_signal(ir_signal_id, released)
+            self.__delete_released_files(released)
+        self.__index.remove(ir_signal_id)
         self.__redis_boundary.publish_deleted_ir_signal(ir_signal_id)
 
+    """
+        セッションでキャプチャした信号が保存済みのどの信号かを調べる
+        sessionが無い場合は最後にキャプチャしたセッションを使う。セッションはそのまま残す
+    """
+    def __identify_ir_signal(self, value):
+        session = self.__sessions.peek(value.get('session'))
+        if session is None:
+            self.__redis_boundary.publish_ir_signal_identifying_error(value.get('session'))
+            return
+        pulses = fingerprint.record_pulses(self.__sessions.signals(session))
+        ir_signal_id = self.__index.identify(pulses)
+        logger.debug('Identified session {0} as {1}'.format(session.id, ir_signal_id))
+        self.__redis_boundary.publish_identified_ir_signal(ir_signal_id, session.id)
+
+    """
+        全信号を'path'(無ければIR_FOLDER_PATHのlibrary.ARCHIVE_NAME)のアーカイブに書き出す
+    """
+    def __export_ir_library(self, value):
+        path = value.get('path') or '{0}/{1}'.format(IR_FOLDER_PATH, library.ARCHIVE_NAME)
+        self.__library_executor.submit(self.__export_library, path)
+
+    def __export_library(self, path):
+        try:
+            count = library.export_library(self.__redis_boundary, IR_FOLDER_PATH, path)
+        except Exception as error:
+            logger.error('Exporting ir library to {0} failed: {1}'.format(path, error))
+            self.__redis_boundary.publish_ir_library_exporting_error(path)
+            return
+        logger.debug('Exported {0} signals to {1}'.format(count, path))
+        self.__redis_boundary.publish_exported_ir_library(path, count)
+
+    """
+        'path'のアーカイブの信号を新しいIDで追加し、指紋のインデックスを作り直す
+        ファイルのロックは信号ファイル毎にだけ取るので、読み込みの間も保存・削除を処理する
+    """
+    def __import_ir_library(self, value):
+        path = value.get('path') or '{0}/{1}'.format(IR_FOLDER_PATH, library.ARCHIVE_NAME)
+        self.__library_executor.submit(self.__import_library, path)
+
+    def __import_library(self, path):
+        try:
+            count = library.import_library(self.__redis_boundary, self.__filesystem, IR_FOLDER_PATH, path,
+                                           self.__files_lock, self.__pinned_files)
+        except Exception as error:
+            logger.error('Importing ir library from {0} failed: {1}'.format(path, error))
+            self.__redis_boundary.publish_ir_library_importing_error(path)
+            return
+        finally:
+            self.__unpin_files()
+        self.__build_index()
+        logger.debug('Imported {0} signals from {1}'.format(count, path))
+        self.__redis_boundary.publish_imported_ir_library(path, count)
+
+    """
+        モニターモードを開始する。受信したフレームはRedis Streamに追加し続ける
+        'gpio'が無ければ全受信機で開始する。フレームの書き込みは全受信機で1つにまとめる
+    """
+    def __start_monitoring(self, value):
+        gpios = self.__addressed_gpios(value)
+        if not gpios:
+            return
+        if self.__monitor is None:
+            self.__monitor = monitor.FrameMonitor(self.__raspberry_pi, self.__redis_boundary.add_monitor_frames)
+            self.__monitor.start()
+        for gpio in gpios:
+            if gpio not in self.__monitoring:
+                self.__monitoring.add(gpio)
+                self.__receivers[gpio].start_monitoring(functools.partial(self.__monitor.put, gpio=gpio))
+        self.__redis_boundary.publish_started_monitoring()
+
+    def __stop_monitoring(self, value):
+        gpios = self.__addressed_gpios(value)
+        if not gpios:
+            return
+        self.__close_monitor(gpios)
+        self.__redis_boundary.publish_stopped_monitoring()
+
+    """
+        gpiosの受信機のモニターモードを止め、どの受信機もモニターモードでなくなったら書き込みも止める
+    """
+    def __close_monitor(self, gpios):
+        for gpio in list(gpios):
+            if gpio in self.__monitoring:
+                self.__monitoring.discard(gpio)
+                self.__receivers[gpio].stop_monitoring()
+        if self.__monitor is None or self.__monitoring:
+            return
+        self.__monitor.stop()
+        self.__monitor = None
+
     """
         ラズパイから信号受信したときのコールバック関数
+        受信した信号はsave_ir_signalかdiscard_ir_signalまでセッションに置いておく
     """
-    def remote_signal_received(self, signals, cancelled):
+    def remote_signal_received(self, signals, cancelled, session_id=None):
         logger.debug('Received remote signal')
-        self.__redis_boundary.set_state('ready')
         if cancelled:
-            self.__redis_boundary.publish_stopped_ir_receiving_stop_message()
+            self.__sessions.drop(session_id)
+            with self.__redis_boundary.batch():
+                self.__set_state_after_capture()
+                self.__redis_boundary.publish_stopped_ir_receiving_stop_message(session_id)
             return
-        tmp_file_path = '{0}/{1}'.format(IR_FOLDER_PATH, TMP_FILE_NAME)
-        self.__filesystem.save_temp_file(tmp_file_path, signals)
-        logger.debug('Signals saved to tmp file {0}'.format(tmp_file_path))
-        self.__redis_boundary.publish_stopped_ir_receiving_valid_signal()
+        code = self.__receiver_of(session_id).decode_remote_signal(signals)
+        if not self.__sessions.store(session_id, signals, code):
+            logger.error('Session {0} was dropped before storing the signal'.format(session_id))
+            self.__invalid_signal_received(session_id)
+            return
+        logger.debug('Signals stored to session %s. code is %s', session_id, code)
+        with self.__redis_boundary.batch():
+            self.__set_state_after_capture()
+            self.__redis_boundary.publish_stopped_ir_receiving_valid_signal(session_id, code)
 
     """
-        一時ファイルに名前をつけて永続化し、RedisにIRデータを追加して更新する
+        どの信号からも参照されなくなった信号ファイルを削除する
     """
-    def __create_new_ir(self, name, sleep, updates_file):
-        ir = self.__redis_boundary.get_ir()
-        logger.debug('Create new ir. Current ir is {0}'.format(ir))
-        ir_signal_id = self.__get_new_ir_signal_id(ir)
+    def __delete_released_files(self, released):
+        for file_name in released:
+            if file_name in self.__pinned_files:
+                # 読み込み中のライブラリの信号が参照する。読み込みの後で__unpin_filesが調べる
+                continue
+            file_path = '{0}/{1}'.format(IR_FOLDER_PATH, file_name)
+            self.__filesystem.delete_file(file_path)
+            logger.debug('Deleted signal file {0}'.format(file_path))
+
+    """
+        ライブラリの読み込みで保存したファイルの固定を外し、どの信号からも参照されていなければ削除する
+    """
+    def __unpin_files(self):
+        for file_name in list(self.__pinned_files):
+            with self.__files_lock:
+                self.__pinned_files.discard(file_name)
+                if not self.__redis_boundary.is_ir_file_referenced(file_name):
+                    self.__delete_released_files([file_name])
+
+    """
+        セッションの信号を内容のハッシュの名前(filesystem.content_name)で永続化し、
+        ファイル名と最終更新日付とインデックスに加えるパルス列を返す。同じ内容のファイルが既にあれば書き込まずにそれを使う
+        インデックスにはRedisへの保存が成功してから加える
+    """
+    def __persist_session(self, session):
+        pulses = fingerprint.record_pulses(self.__sessions.signals(session))
+        if session.spill_path is not None:
+            new_file_name, timestamp = self.__filesystem.move_content(IR_FOLDER_PATH, session.spill_path)
+        else:
+            new_file_name, timestamp = self.__filesystem.save_content(IR_FOLDER_PATH, session.data)
+        return new_file_name, timestamp, pulses
+
+    """
+        セッションの信号に名前をつけて永続化し、RedisにIRデータを追加する
+    """
+    def __create_new_ir(self, name, sleep, session):
+        ir_signal_id = self.__redis_boundary.allocate_ir_signal_id()
+        logger.debug('Create new ir. id is {0}'.format(ir_signal_id))
 
         new_file_name = None
         timestamp = None
-        if updates_file:
-            tmp_file_path = '{0}/{1}'.format(IR_FOLDER_PATH, TMP_FILE_NAME)
-            new_file_name = '{0}.ir'.format(ir_signal_id)
-            new_file_path = '{0}/{1}'.format(IR_FOLDER_PATH, new_file_name)
-            timestamp = self.__filesystem.rename_tmp_file(tmp_file_path, new_file_path)
-        signal = {'id': ir_signal_id, 'name': name, 'sleep': sleep,
-                  'filePath': new_file_name, 'fileTimeStamp': timestamp}
-        if ir is None:
-            ir = {'signals': []}
-        ir['signals'].append(signal)
-        self.__redis_boundary.set_ir(ir)
+        code = None
+        with self.__files_lock:
+            if session is not None:
+                new_file_name, timestamp, pulses = self.__persist_session(session)
+                code = session.code
+            signal = {'id': ir_signal_id, 'name': name, 'sleep': sleep,
+                      'filePath': new_file_name, 'fileTimeStamp': timestamp, 'code': code}
+            self.__redis_boundary.save_ir_signal(signal)
+            if session is not None:
+                self.__index.add(ir_signal_id, pulses)
         return ir_signal_id
         
     """
         Redisに格納されているIRデータを更新する
     """
-    def __update_current_ir(self, ir_signal_id, name, sleep, updates_file):
-        ir = self.__redis_boundary.get_ir()
-        is_signal_updated = False
-        for signal in ir['signals']:
-            if signal["id"] == ir_signal_id:
-                signal["name"] = name
-                signal["sleep"] = sleep
-                if updates_file:
-                    tmp_file_path = '{0}/{1}'.format(IR_FOLDER_PATH, TMP_FILE_NAME)
-                    new_file_name = '{0}.ir'.format(ir_signal_id)
-                    new_file_path = '{0}/{1}'.format(IR_FOLDER_PATH, new_file_name)
-                    timestamp = self.__filesystem.rename_tmp_file(tmp_file_path, new_file_path)
-                    signal['filePath'] = new_file_name,
-                    signal['fileTimeStamp'] = timestamp
-                is_signal_updated = True
-                logger.debug('__update_current_ir() updated. signal:{0}'.format(signal))
-        if is_signal_updated:
-            self.__redis_boundary.set_ir(ir)
-
-
-    """
-        今保存されている信号の一番大きいID+1の値を新しいIDとして割り当てる
-    """
-    def __get_new_ir_signal_id(self, ir):
-        if ir is None:
-            return 0
-        id_list = [x['id'] for x in ir['signals']]
-        if not id_list:
-            return 0
-        return max(id_list) + 1
-
+    def __update_current_ir(self, ir_signal_id, name, sleep, session):
+        if self.__redis_boundary.get_ir_signal(ir_signal_id) is None:
+            if session is not None and session.spill_path is not None:
+                self.__filesystem.delete_file(session.spill_path)
+            return
+        signal = {'id': ir_signal_id, 'name': name, 'sleep': sleep}
+        with self.__files_lock:
+            if session is not None:
+                new_file_name, timestamp, pulses = self.__persist_session(session)
+                signal['filePath'] = new_file_name
+                signal['fileTimeStamp'] = timestamp
+                signal['code'] = session.code
+            # 前のファイルを他の信号が参照していなければ削除する
+            released = []
+            # get_ir_signalの後に削除されていれば保存されない。新しいファイルはどこからも参照されなければ削除する
+            saved = self.__redis_boundary.save_ir_signal(signal, only_existing=True, released=released)
+            if saved:
+                logger.debug('__update_current_ir() updated. signal:%s', signal)
+            if session is not None:
+                if saved:
+                    self.__index.add(ir_signal_id, pulses)
+                elif not self.__redis_boundary.is_ir_file_referenced(new_file_name):
+                    released.append(new_file_name)
+            self.__delete_released_files(released)
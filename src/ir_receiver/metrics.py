@@ -0,0 +1,299 @@
+import bisect
+import functools
+import http.server
+import inspect
+import logging
+import threading
+import time
+import config
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+"""
+ホットパス(キャプチャ、normalise/tidy、ファイルの書き込み、Redisの呼び出し)の処理時間と回数を集計するモジュール
+
+    with metrics.timer('tidy_seconds'):      処理時間をヒストグラムに入れる
+    metrics.inc('capture_cancelled_total')   カウンタを増やす
+    metrics.instrument(RedisBoundary, ...)   クラスの公開メソッドの処理時間を全て計る
+
+集計した値はsnapshot()でRedisのハッシュに書く形({サンプル名: 値})に、prometheus()でPrometheusのテキスト形式にする。
+config.METRICSが無効の間はどの関数もenabledを見てすぐに戻るので、ホットパスに置いてもほとんど遅くならない。
+キャプチャのエッジはpigpioのコールバック(cbf)では数えず、フレームの終わりにまとめて集計する。
+"""
+
+# 処理時間(秒)のヒストグラムのバケットの上限
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# フレーム中のエッジの頻度(エッジ/秒)のバケットの上限
+RATE_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+# Prometheusのメトリクス名に付ける接頭辞
+PREFIX = 'ir_receiver_'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # counts[i]はbuckets[i - 1]より大きくbuckets[i]以下の数。最後は全バケットより大きい数
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, registry, name, label):
+        self.__registry = registry
+        self.__name = name
+        self.__label = label
+
+    def __enter__(self):
+        self.__started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__registry.observe(self.__name, time.perf_counter() - self.__started, self.__label)
+        return False
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, value) for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+"""
+カウンタとヒストグラムを持つクラス
+名前毎に1つのラベル(('method', 'get_ir')のようなタプル)で分けられる。各スレッドから呼んでよい。
+collectorsに登録した関数は、snapshot()とprometheus()の度に呼ばれて{名前: 値}のゲージを返す。
+"""
+class Registry:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.__lock = threading.Lock()
+        # {(名前, ラベル): 値}
+        self.__counters = {}
+        self.__histograms = {}
+        self.__collectors = []
+
+    def inc(self, name, n=1, label=None):
+        if not self.enabled:
+            return
+        key = (name, label)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + n
+
+    def observe(self, name, value, label=None, buckets=TIME_BUCKETS):
+        if not self.enabled:
+            return
+        key = (name, label)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    """
+    withの中の処理時間を計る。無効の場合は何もしない共通のオブジェクトを返す
+    """
+    def timer(self, name, label=None):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, label)
+
+    """
+    関数(コルーチン関数でもよい)の処理時間を計るデコレータ
+    """
+    def timed(self, name, label=None):
+        def decorate(function):
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await function(*args, **kwargs)
+                    started = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    finally:
+                        self.observe(name, time.perf_counter() - started, label)
+            else:
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return function(*args, **kwargs)
+                    started = time.perf_counter()
+                    try:
+                        return function(*args, **kwargs)
+                    finally:
+                        self.observe(name, time.perf_counter() - started, label)
+            return wrapper
+        return decorate
+
+    def add_collector(self, collect):
+        self.__collectors.append(collect)
+
+    def reset(self):
+        with self.__lock:
+            self.__counters.clear()
+            self.__histograms.clear()
+
+    """
+    [(名前, 種類, [(サンプル名, ラベル, 値), ...]), ...]を名前の順に返す。ヒストグラムのバケットは累積
+    """
+    def __families(self):
+        families = {}
+        with self.__lock:
+            for (name, label), value in self.__counters.items():
+                families.setdefault((name, 'counter'), []).append((name, (label,) if label else (), value))
+            for (name, label), histogram in self.__histograms.items():
+                samples = families.setdefault((name, 'histogram'), [])
+                labels = (label,) if label else ()
+                cumulative = 0
+                for le, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    samples.append((name + '_bucket', labels + (('le', _format_value(le)),), cumulative))
+                samples.append((name + '_sum', labels, histogram.sum))
+                samples.append((name + '_count', labels, histogram.count))
+        for collect in self.__collectors:
+            try:
+                gauges = collect() or {}
+            except Exception as error:
+                logger.error('Collecting metrics failed: {0}'.format(error))
+                continue
+            for name, value in gauges.items():
+                if value is not None:
+                    families.setdefault((name, 'gauge'), []).append((name, (), value))
+        return [(name, kind, samples) for (name, kind), samples in sorted(families.items())]
+
+    """
+    {サンプル名(ラベル付き): 値}。Redisのハッシュに書く
+    """
+    def snapshot(self):
+        return dict((name + _format_labels(labels), value)
+                    for _, _, samples in self.__families() for name, labels, value in samples)
+
+    """
+    Prometheusのテキスト形式(version 0.0.4)
+    """
+    def prometheus(self):
+        lines = []
+        for family, kind, samples in self.__families():
+            lines.append('# TYPE {0}{1} {2}'.format(PREFIX, family, kind))
+            for name, labels, value in samples:
+                lines.append('{0}{1}{2} {3}'.format(PREFIX, name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(config.METRICS)
+
+
+def inc(name, n=1, label=None):
+    registry.inc(name, n, label)
+
+
+def observe(name, value, label=None, buckets=TIME_BUCKETS):
+    registry.observe(name, value, label, buckets)
+
+
+def timer(name, label=None):
+    return registry.timer(name, label)
+
+
+"""
+clsの公開メソッドを全てregistry.timedで包む。ヒストグラムはnameの1つで、メソッド名をlabel_keyのラベルにする
+excludeのメソッド(コンテキストマネージャや、購読のように戻らないもの)と非同期ジェネレータは包まない
+"""
+def instrument(cls, name, label_key='method', exclude=(), registry=registry):
+    for attribute, function in list(vars(cls).items()):
+        if attribute.startswith('_') or attribute in exclude or not inspect.isfunction(function):
+            continue
+        if inspect.isasyncgenfunction(function) or inspect.isgeneratorfunction(function):
+            continue
+        setattr(cls, attribute, registry.timed(name, (label_key, attribute))(function))
+    return cls
+
+
+"""
+interval_s毎にregistry.snapshot()をsave(snapshot)に渡すスレッド(RedisBoundary.save_metrics)
+"""
+class Reporter:
+    def __init__(self, save, interval_s=None, registry=registry):
+        self.__save = save
+        self.interval_s = interval_s if interval_s is not None else config.METRICS_INTERVAL_S
+        self.__registry = registry
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+    def report(self):
+        self.__save(self.__registry.snapshot())
+
+    def start(self):
+        self.__stopping.clear()
+        self.__thread = threading.Thread(target=self.__loop, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopping.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __loop(self):
+        while not self.__stopping.wait(self.interval_s):
+            try:
+                self.report()
+            except Exception as error:
+                logger.error('Reporting metrics failed: {0}'.format(error))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # リクエスト毎にstderrに書かない
+        pass
+
+
+"""
+http://host:port/metricsでprometheus()を返すサーバーをスレッドで起動して返す。止めるときはshutdown()とserver_close()
+portが0なら空いているポートを使う(server.server_addressで分かる)
+"""
+def serve(port=None, host=None, registry=registry):
+    port = port if port is not None else config.METRICS_PORT
+    host = host if host is not None else config.METRICS_HOST
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.debug('Serving metrics on {0}:{1}'.format(*server.server_address[:2]))
+    return server
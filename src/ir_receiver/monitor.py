@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+"""
+モニターモードで受信したフレームをRedis Streamに書き込むモジュール
+
+キャプチャのスレッドはput()でキューに入れるだけにして、ボタンを押し続けたときのリピートでも
+エッジの取り込みが止まらないようにする。整形・デコードとXADDは書き込み側でまとめて行い、
+溜まっているフレームはBATCH_SIZE個まで1回のパイプラインで送る。
+"""
+
+BATCH_SIZE = 64
+
+
+"""
+フレームをStreamのエントリにする。
+tickはフレームの先頭のエッジのpigpioのtick(us, 32bitで折り返す)、pulsesは整形したパルス列、
+codeはprotocols.decodeの結果(認識できなければnull)でどちらもJSON。
+gpioは受信した受信機のGPIOで、受信機が1つの場合(None)は付けない。
+"""
+def frame_entry(raspberry_pi, code, tick, gpio=None):
+    record = raspberry_pi.clean_remote_signal(code)
+    decoded = raspberry_pi.decode_remote_signal(record)
+    entry = {'tick': tick, 'pulses': json.dumps(record['0']), 'code': json.dumps(decoded)}
+    if gpio is not None:
+        entry['gpio'] = gpio
+    return entry
+
+
+"""
+スレッド版。append(entries)はRedisBoundary.add_monitor_frames
+"""
+class FrameMonitor:
+    def __init__(self, raspberry_pi, append, batch_size=BATCH_SIZE):
+        self.frames = 0
+        self.__raspberry_pi = raspberry_pi
+        self.__append = append
+        self.__batch_size = batch_size
+        self.__queue = queue.Queue()
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    """
+    キャプチャのスレッドから呼ばれる。RespberryPiBoundary.start_monitoringのon_frameとして渡す
+    受信機が複数の場合はfunctools.partial(put, gpio=GPIO)を渡す
+    """
+    def put(self, code, tick, gpio=None):
+        self.__queue.put((code, tick, gpio))
+
+    """
+    キューに残っているフレームを書き込んでから止める
+    """
+    def stop(self):
+        self.__queue.put(None)
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.__queue.get()]
+            while len(batch) < self.__batch_size:
+                try:
+                    batch.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                self.__write(batch)
+
+    def __write(self, batch):
+        try:
+            self.__append([frame_entry(self.__raspberry_pi, code, tick, gpio) for code, tick, gpio in batch])
+            self.frames += len(batch)
+        except Exception as error:
+            logger.error('Writing {0} monitored frames failed: {1}'.format(len(batch), error))
+
+
+"""
+asyncio版。キャプチャのスレッドからはcall_soon_threadsafeでイベントループのキューに渡す。
+append(entries)はAsyncRedisBoundary.add_monitor_frames
+"""
+class AsyncFrameMonitor:
+    def __init__(self, raspberry_pi, append, batch_size=BATCH_SIZE):
+        self.frames = 0
+        self.__raspberry_pi = raspberry_pi
+        self.__append = append
+        self.__batch_size = batch_size
+        self.__queue = asyncio.Queue()
+        self.__loop = None
+        self.__task = None
+
+    def start(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__task = asyncio.ensure_future(self.__run())
+
+    def put(self, code, tick, gpio=None):
+        self.__loop.call_soon_threadsafe(self.__queue.put_nowait, (code, tick, gpio))
+
+    async def stop(self):
+        self.__queue.put_nowait(None)
+        if self.__task is not None:
+            await self.__task
+            self.__task = None
+
+    async def __run(self):
+        stopping = False
+        while not stopping:
+            batch = [await self.__queue.get()]
+            while len(batch) < self.__batch_size and not self.__queue.empty():
+                batch.append(self.__queue.get_nowait())
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                await self.__write(batch)
+
+    async def __write(self, batch):
+        try:
+            await self.__append([frame_entry(self.__raspberry_pi, code, tick, gpio) for code, tick, gpio in batch])
+            self.frames += len(batch)
+        except Exception as error:
+            logger.error('Writing {0} monitored frames failed: {1}'.format(len(batch), error))
@@ -0,0 +1,403 @@
+"""
+赤外線リモコンのプロトコルのデコーダ
+
+normalise済みのパルス列(マーク、スペースの順でus単位)から既知のプロトコルを認識し、
+{'protocol', 'address', 'command', 'bits', 'repeat'}の形式のコードにする。
+    protocol  プロトコル名
+    address   アドレス(カスタマーコード)。エアコンのように無いものはNone
+    command   コマンド。NEC、SIRC、RC-5は整数。
+              AEHAとエアコンはバイト列の16進文字列で、フレームが複数ある場合は'-'でつなぐ
+    bits      1フレームのビット数。フレームが複数ある場合は合計
+    repeat    最初のフレームの後に続いた同じフレーム(またはリピートコード)の数
+どのプロトコルにも当てはまらない場合はNoneで、生のパルス列だけを使う。
+
+各デコーダはnameとdecode(frames)、encode(code)を持つ。decodeには
+split_framesでフレームに分けたパルス列を渡す。encodeはdecodeの逆でテストとベンチマークに使う。
+"""
+
+# これより長いスペースでフレームを区切る
+FRAME_GAP_US = 7000
+# パルス長の許容誤差(割合)
+TOLERANCE = 0.3
+
+
+def _matches(value, expected):
+    return abs(value - expected) <= expected * TOLERANCE
+
+
+def split_frames(pulses, gap_us=FRAME_GAP_US):
+    frames = []
+    start = 0
+    for i in range(1, len(pulses), 2):
+        if pulses[i] > gap_us:
+            frames.append(pulses[start:i])
+            start = i + 1
+    if start < len(pulses):
+        frames.append(pulses[start:])
+    return frames
+
+
+def _join_frames(frames, gap_us):
+    pulses = []
+    for frame in frames:
+        if pulses:
+            pulses.append(gap_us)
+        pulses.extend(frame)
+    return pulses
+
+
+def _code(protocol, address, command, bits, repeat):
+    return {'protocol': protocol, 'address': address, 'command': command, 'bits': bits, 'repeat': repeat}
+
+
+def _to_int(bits):
+    # LSB first
+    value = 0
+    for i, bit in enumerate(bits):
+        value |= bit << i
+    return value
+
+
+def _to_bits(value, n):
+    return [(value >> i) & 1 for i in range(n)]
+
+
+def _to_bytes(bits):
+    return bytes(_to_int(bits[i:i + 8]) for i in range(0, len(bits), 8))
+
+
+def _from_bytes(data):
+    bits = []
+    for byte in data:
+        bits.extend(_to_bits(byte, 8))
+    return bits
+
+
+"""
+パルス間隔(スペースの長さ)でビットを表すフレームのタイミング
+header: (マーク, スペース)。Noneならヘッダ無し
+"""
+class PulseDistance:
+    def __init__(self, header, mark, zero, one):
+        self.header = header
+        self.mark = mark
+        self.zero = zero
+        self.one = one
+
+    """
+    フレームのビット列(送信順)を返す。このタイミングのフレームでなければNone
+    """
+    def decode(self, frame):
+        start = 0
+        if self.header is not None:
+            if len(frame) < 3 or not (_matches(frame[0], self.header[0]) and _matches(frame[1], self.header[1])):
+                return None
+            start = 2
+        if (len(frame) - start) % 2 != 1 or not _matches(frame[-1], self.mark):
+            return None
+        bits = []
+        for i in range(start, len(frame) - 1, 2):
+            if not _matches(frame[i], self.mark):
+                return None
+            space = frame[i + 1]
+            if _matches(space, self.zero):
+                bits.append(0)
+            elif _matches(space, self.one):
+                bits.append(1)
+            else:
+                return None
+        return bits
+
+    def encode(self, bits):
+        frame = list(self.header) if self.header is not None else []
+        for bit in bits:
+            frame.append(self.mark)
+            frame.append(self.one if bit else self.zero)
+        frame.append(self.mark)
+        return frame
+
+
+"""
+NEC: 32ビット(アドレス、アドレスの反転、コマンド、コマンドの反転)。
+アドレスの反転が合わない場合は拡張NECとして16ビットのアドレスにする。
+続けて押されている間は9000/2250/560のリピートコードを送る。
+"""
+class NecDecoder:
+    name = 'nec'
+    timing = PulseDistance((9000, 4500), 560, 560, 1690)
+    repeat_code = (9000, 2250, 560)
+    gap_us = 40000
+
+    def __is_repeat(self, frame):
+        return len(frame) == 3 and all(_matches(x, y) for x, y in zip(frame, self.repeat_code))
+
+    def decode(self, frames):
+        bits = self.timing.decode(frames[0])
+        if bits is None or len(bits) != 32:
+            return None
+        value = _to_int(bits)
+        command = (value >> 16) & 0xFF
+        if command ^ (value >> 24) != 0xFF:
+            return None
+        address = value & 0xFF
+        if address ^ ((value >> 8) & 0xFF) != 0xFF:
+            address = value & 0xFFFF
+        for frame in frames[1:]:
+            if not self.__is_repeat(frame) and self.timing.decode(frame) != bits:
+                return None
+        return _code(self.name, address, command, 32, len(frames) - 1)
+
+    def encode(self, code):
+        address = code['address']
+        if address > 0xFF:
+            value = address
+        else:
+            value = address | ((address ^ 0xFF) << 8)
+        value |= (code['command'] << 16) | ((code['command'] ^ 0xFF) << 24)
+        frames = [self.timing.encode(_to_bits(value, 32))] + [list(self.repeat_code)] * code['repeat']
+        return _join_frames(frames, self.gap_us)
+
+
+"""
+Sony SIRC: マークの長さでビットを表す。コマンド7ビットとアドレス5、8、13ビットの12、15、20ビット。
+同じフレームを3回以上送る。
+"""
+class SircDecoder:
+    name = 'sirc'
+    header = (2400, 600)
+    zero = 600
+    one = 1200
+    space = 600
+    gap_us = 25000
+    lengths = (12, 15, 20)
+
+    def __decode_frame(self, frame):
+        if len(frame) < 3 or len(frame) % 2 != 1:
+            return None
+        if not (_matches(frame[0], self.header[0]) and _matches(frame[1], self.header[1])):
+            return None
+        bits = []
+        for i in range(2, len(frame), 2):
+            if i + 1 < len(frame) and not _matches(frame[i + 1], self.space):
+                return None
+            if _matches(frame[i], self.zero):
+                bits.append(0)
+            elif _matches(frame[i], self.one):
+                bits.append(1)
+            else:
+                return None
+        return bits if len(bits) in self.lengths else None
+
+    def decode(self, frames):
+        bits = self.__decode_frame(frames[0])
+        if bits is None:
+            return None
+        for frame in frames[1:]:
+            if self.__decode_frame(frame) != bits:
+                return None
+        value = _to_int(bits)
+        return _code(self.name, value >> 7, value & 0x7F, len(bits), len(frames) - 1)
+
+    def encode(self, code):
+        bits = _to_bits(code['command'] | (code['address'] << 7), code['bits'])
+        frame = list(self.header)
+        for bit in bits:
+            frame.append(self.one if bit else self.zero)
+            frame.append(self.space)
+        frame.pop()
+        return _join_frames([frame] * (code['repeat'] + 1), self.gap_us)
+
+
+"""
+Philips RC-5: 889usを半ビットとするマンチェスター符号の14ビット。
+スタートビット2つ(2つ目が0ならRC-5Xでコマンドの7ビット目が1)、トグル、アドレス5ビット、コマンド6ビットをMSBから送る。
+1は前半がスペース、後半がマーク。
+"""
+class Rc5Decoder:
+    name = 'rc5'
+    half_us = 889
+    gap_us = 89000
+
+    def __decode_frame(self, frame):
+        # 最初のスタートビットの前半のスペースは受信できないので補う
+        levels = [0]
+        for i, pulse in enumerate(frame):
+            halves = int(round(pulse / float(self.half_us)))
+            if halves not in (1, 2) or not _matches(pulse, halves * self.half_us):
+                return None
+            levels.extend([1 - i % 2] * halves)
+        if len(levels) % 2:
+            # 最後のビットが0の場合、後半のスペースは受信できない
+            levels.append(0)
+        if len(levels) != 28:
+            return None
+        bits = []
+        for i in range(0, 28, 2):
+            if levels[i:i + 2] == [0, 1]:
+                bits.append(1)
+            elif levels[i:i + 2] == [1, 0]:
+                bits.append(0)
+            else:
+                return None
+        return bits
+
+    def decode(self, frames):
+        bits = self.__decode_frame(frames[0])
+        if bits is None or bits[0] != 1:
+            return None
+        for frame in frames[1:]:
+            repeated = self.__decode_frame(frame)
+            # トグルビットは押し直した時だけ変わる
+            if repeated is None or repeated[:2] + repeated[3:] != bits[:2] + bits[3:]:
+                return None
+        address = 0
+        for bit in bits[3:8]:
+            address = (address << 1) | bit
+        command = 0
+        for bit in bits[8:14]:
+            command = (command << 1) | bit
+        command |= (1 - bits[1]) << 6
+        return _code(self.name, address, command, 14, len(frames) - 1)
+
+    def encode(self, code):
+        command = code['command']
+        bits = [1, 1 - (command >> 6), 0]
+        bits += [(code['address'] >> i) & 1 for i in range(4, -1, -1)]
+        bits += [(command >> i) & 1 for i in range(5, -1, -1)]
+        levels = []
+        for bit in bits:
+            levels += [0, 1] if bit else [1, 0]
+        levels = levels[1:]
+        if levels[-1] == 0:
+            levels.pop()
+        frame = []
+        previous = None
+        for level in levels:
+            if level == previous:
+                frame[-1] += self.half_us
+            else:
+                frame.append(self.half_us)
+            previous = level
+        return _join_frames([frame] * (code['repeat'] + 1), self.gap_us)
+
+
+"""
+家電協(AEHA)フォーマット。Panasonic(Kaseikyo)も同じタイミング。
+T=425usで、ヘッダ8T/4T、0はT/T、1はT/3T。先頭2バイトがカスタマーコードで、以降のデータ長は機器による。
+フレーム毎にカスタマーコードを付けて複数フレームを送る機器もある。リピートは8T/8T/T。
+"""
+class AehaDecoder:
+    name = 'aeha'
+    timing = PulseDistance((3400, 1700), 425, 425, 1275)
+    repeat_code = (3400, 3400, 425)
+    gap_us = 13000
+
+    def _frame_bytes(self, frames):
+        payloads = []
+        repeat = 0
+        for frame in frames:
+            if payloads and len(frame) == 3 and all(_matches(x, y) for x, y in zip(frame, self.repeat_code)):
+                repeat += 1
+                continue
+            bits = self.timing.decode(frame)
+            if bits is None or len(bits) < 16 or len(bits) % 8:
+                return None
+            payloads.append(_to_bytes(bits))
+        return payloads, repeat
+
+    def decode(self, frames):
+        result = self._frame_bytes(frames)
+        if result is None:
+            return None
+        payloads, repeat = result
+        address = payloads[0][0] | (payloads[0][1] << 8)
+        if any(x[:2] != payloads[0][:2] for x in payloads):
+            return None
+        # 同じフレームを繰り返している場合はリピートとして数える
+        while len(payloads) > 1 and payloads[-1] == payloads[0]:
+            payloads.pop()
+            repeat += 1
+        command = '-'.join(x[2:].hex() for x in payloads)
+        return _code(self.name, address, command, sum(len(x) * 8 for x in payloads), repeat)
+
+    def encode(self, code):
+        customer = bytes([code['address'] & 0xFF, code['address'] >> 8])
+        payloads = [customer + bytes.fromhex(x) for x in code['command'].split('-')]
+        frames = [self.timing.encode(_from_bytes(x)) for x in payloads]
+        frames += [self.timing.encode(_from_bytes(payloads[0]))] * code['repeat']
+        return _join_frames(frames, self.gap_us)
+
+
+"""
+エアコンのフォーマット。タイミングはAEHAに近いので、先頭のバイト列(シグネチャ)で見分ける。
+フレームの中身全体をcommandにする。
+"""
+class AirConditionerDecoder:
+    preamble = None
+
+    def decode(self, frames):
+        if self.preamble is not None and len(frames) > 1 and self.preamble.decode(frames[0]) == [0] * 5:
+            frames = frames[1:]
+        payloads = []
+        for frame in frames:
+            bits = self.timing.decode(frame)
+            if bits is None or len(bits) % 8:
+                return None
+            payloads.append(_to_bytes(bits))
+        if not payloads[0].startswith(self.signature) or len(payloads[0]) not in self.lengths:
+            return None
+        repeat = 0
+        while len(payloads) > 1 and payloads[-1] == payloads[0]:
+            payloads.pop()
+            repeat += 1
+        command = '-'.join(x.hex() for x in payloads)
+        return _code(self.name, None, command, sum(len(x) * 8 for x in payloads), repeat)
+
+    def encode(self, code):
+        payloads = [bytes.fromhex(x) for x in code['command'].split('-')]
+        frames = [self.timing.encode(_from_bytes(x)) for x in payloads]
+        frames += [self.timing.encode(_from_bytes(payloads[0]))] * code['repeat']
+        if self.preamble is not None:
+            frames.insert(0, self.preamble.encode([0] * 5))
+        return _join_frames(frames, self.gap_us)
+
+
+"""
+三菱電機のエアコン: 18バイトのフレームを2回送る
+"""
+class MitsubishiAcDecoder(AirConditionerDecoder):
+    name = 'mitsubishi_ac'
+    timing = PulseDistance((3400, 1750), 450, 420, 1300)
+    signature = bytes([0x23, 0xCB, 0x26, 0x01, 0x00])
+    lengths = (18,)
+    gap_us = 17100
+
+
+"""
+ダイキンのエアコン: ヘッダ無しの0を5ビット送ってから、11 DA 27 00で始まるフレームを2つか3つ送る
+"""
+class DaikinAcDecoder(AirConditionerDecoder):
+    name = 'daikin_ac'
+    timing = PulseDistance((3500, 1728), 428, 428, 1280)
+    preamble = PulseDistance(None, 428, 428, 1280)
+    signature = bytes([0x11, 0xDA, 0x27, 0x00])
+    lengths = (8, 19)
+    gap_us = 29400
+
+
+# 上から順に試す。エアコンはAEHAとタイミングが重なるのでAEHAより先に試す
+DECODERS = (NecDecoder(), SircDecoder(), Rc5Decoder(), MitsubishiAcDecoder(), DaikinAcDecoder(), AehaDecoder())
+
+
+"""
+パルス列をデコードしてコードを返す。どのプロトコルにも当てはまらなければNone
+"""
+def decode(pulses, decoders=DECODERS):
+    frames = split_frames(pulses)
+    if not frames or not frames[0]:
+        return None
+    for decoder in decoders:
+        code = decoder.decode(frames)
+        if code is not None:
+            return code
+    return None
@@ -1,30 +1,231 @@
+import os
+import select
+import threading
 import time
 import logging
 import pigpio
+import clustering
+import capture
+import config
+import metrics
+import protocols
 
 GPIO = 17
 GLITCH = 100
 GAP_S = 100 / 1000.0
-PRE_US = 200 * 1000
-POST_MS = 50
-POST_US = POST_MS * 1000
 FREQ = 38.0
-SHORT = 10
 TOLERANCE = 15
 TOLER_MIN =  (100 - TOLERANCE) / 100.0
 TOLER_MAX =  (100 + TOLERANCE) / 100.0
+NOTIFY_READ_SIZE = 64 * 1024
+NOTIFY_WAIT_S = 100 / 1000.0
+RECONNECT_MIN_S = 0.5
+RECONNECT_MAX_S = 30.0
+# 起動時にpigpiodへの接続を試みる回数。全て失敗した場合は最初のキャプチャのときに接続する
+STARTUP_CONNECT_ATTEMPTS = 3
+GRACE_S = (capture.POST_MS if config.CAPTURE_GRACE_MS is None else config.CAPTURE_GRACE_MS) / 1000.0
 
-last_tick = 0
-in_code = False
-code = []
-fetching_code = False
-cancelled = False
 logger = logging.getLogger(__name__)
 sh = logging.StreamHandler()
 logger.addHandler(sh)
 
 
+"""
+pigpioのコールバックでエッジを1つずつ受け取り、CaptureSessionのリングバッファに書き込む。
+コールバックはGPIO毎に登録するが、pigpioはそれらを1つのスレッドから呼び、
+各リングバッファは1つのEdgeDispatcherのスレッドで読む。
+"""
+class CallbackBackend:
+    def __init__(self):
+        self.__callbacks = {}
+        self.__dispatcher = capture.EdgeDispatcher()
+
+    def open(self, pi, session):
+        self.__callbacks[session] = pi.callback(session.gpio, pigpio.EITHER_EDGE, session.cbf)
+        self.__dispatcher.add(session)
+
+    def close(self, pi, session):
+        self.__callbacks.pop(session).cancel()
+
+
+"""
+pigpioの通知パイプ(/dev/pigpioN)から12バイトのレポートをまとめて読む。
+Pythonの呼び出しがエッジ毎ではなく読み込み毎になる。パイプはpigpiodと同じホストでしか読めない。
+キャプチャ中の全GPIOで1つのパイプを共有し、GPIOのビットマスクを付け替える。
+"""
+class NotifyBackend:
+    def __init__(self):
+        self.__handle = None
+        self.__fd = None
+        self.__dispatcher = None
+        self.__sessions = set()
+        self.__lock = threading.Lock()
+
+    def open(self, pi, session):
+        with self.__lock:
+            if self.__handle is None:
+                self.__handle = pi.notify_open()
+                self.__fd = os.open('/dev/pigpio{0}'.format(self.__handle), os.O_RDONLY | os.O_NONBLOCK)
+                self.__dispatcher = capture.ReportDispatcher(self.__read)
+            self.__sessions.add(session)
+            pi.notify_begin(self.__handle, self.__mask())
+            self.__dispatcher.add(session, pi.read_bank_1())
+
+    def __mask(self):
+        mask = 0
+        for session in self.__sessions:
+            mask |= 1 << session.gpio
+        return mask
+
+    def __read(self):
+        readable, _, _ = select.select([self.__fd], [], [], NOTIFY_WAIT_S)
+        if not readable:
+            return b''
+        data = os.read(self.__fd, NOTIFY_READ_SIZE)
+        return data if data else None
+
+    def close(self, pi, session):
+        with self.__lock:
+            self.__sessions.discard(session)
+            if self.__sessions:
+                pi.notify_begin(self.__handle, self.__mask())
+                return
+            pi.notify_close(self.__handle)
+            os.close(self.__fd)
+            self.__handle = None
+            self.__fd = None
+            self.__dispatcher = None
+
+
+BACKENDS = {'callback': CallbackBackend, 'notify': NotifyBackend}
+
+
+"""
+pigpiodへの接続を保持するクラス
+起動時に一度だけ接続してGPIOの入力設定とグリッチフィルタを済ませておき、キャプチャ毎には接続しない。
+接続が切れていた場合は間隔を倍々に延ばしながら再接続する。
+複数のGPIOのRespberryPiBoundaryで共有し、キャプチャ方式(backend)も全GPIOで1つにする。
+"""
+class PigpioConnection:
+    def __init__(self, factory=pigpio.pi):
+        if config.CAPTURE_BACKEND not in BACKENDS:
+            raise ValueError('Unknown capture backend: {0}'.format(config.CAPTURE_BACKEND))
+        self.pi = None
+        self.backend = BACKENDS[config.CAPTURE_BACKEND]()
+        self.__factory = factory
+        self.__gpios = []
+
+    """
+    受信に使うGPIOを加える。接続済みであればすぐに設定する
+    """
+    def add_gpio(self, gpio):
+        if gpio in self.__gpios:
+            raise ValueError('GPIO {0} is already in use'.format(gpio))
+        self.__gpios.append(gpio)
+        if self.pi is not None:
+            self.__setup(self.pi, gpio)
+
+    def __setup(self, pi, gpio):
+        pi.set_mode(gpio, pigpio.INPUT) # IR RX connected to this GPIO.
+        pi.set_glitch_filter(gpio, GLITCH) # Ignore glitches.
+
+    """
+    接続できるまで間隔を空けながら繰り返す。attemptsを指定した場合はその回数で諦めてConnectionErrorを送出する
+    """
+    def connect(self, attempts=None):
+        delay = RECONNECT_MIN_S
+        attempt = 0
+        while True:
+            pi = self.__factory() # Connect to Pi.
+            if pi.connected:
+                break
+            attempt += 1
+            if attempts is not None and attempt >= attempts:
+                raise ConnectionError('Failed to connect to raspberry pi {0} times'.format(attempt))
+            logger.error('Failed to connect to raspberry pi, retrying in {0}s'.format(delay))
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_S)
+        for gpio in self.__gpios:
+            self.__setup(pi, gpio)
+        self.pi = pi
+        return pi
+
+    """
+    接続が生きていればそのまま返し、切れていれば再接続して返す。
+    """
+    def ensure(self, attempts=None):
+        if self.pi is not None and self.pi.connected:
+            try:
+                self.pi.get_current_tick()
+                return self.pi
+            except OSError:
+                logger.error('Lost connection to raspberry pi')
+                self.__stop()
+        return self.connect(attempts)
+
+    """
+    GPIOの受信を止める。最後のGPIOであれば接続も閉じる
+    """
+    def remove_gpio(self, gpio):
+        if len(self.__gpios) == 1:
+            self.close()
+            self.__gpios.remove(gpio)
+            return
+        self.__gpios.remove(gpio)
+        if self.pi is None:
+            return
+        try:
+            self.pi.set_glitch_filter(gpio, 0) # Cancel glitch filter.
+            self.pi.set_watchdog(gpio, 0) # Cancel watchdog.
+        except OSError:
+            pass
+
+    def close(self):
+        if self.pi is None:
+            return
+        try:
+            for gpio in self.__gpios:
+                self.pi.set_glitch_filter(gpio, 0) # Cancel glitch filter.
+                self.pi.set_watchdog(gpio, 0) # Cancel watchdog.
+        except OSError:
+            pass
+        self.__stop()
+
+    def __stop(self):
+        try:
+            self.pi.stop()
+        except OSError:
+            pass
+        self.pi = None
+
+
+"""
+1つのGPIOにつないだ赤外線受信機とのやり取りを行うクラス
+GPIO毎にインスタンスを作り、キャプチャの状態はインスタンス毎に持つ。
+pigpiodへの接続とキャプチャのスレッドはPigpioConnectionを通して全GPIOで共有する。
+"""
 class RespberryPiBoundary:
+
+    def __init__(self, connection=None, decoders=protocols.DECODERS, gpio=GPIO):
+        self.gpio = gpio
+        self.__session = None
+        # モニターモードのセッションとフレーム毎のコールバック。学習のキャプチャ中はセッションを閉じて待つ
+        self.__monitor = None
+        self.__on_frame = None
+        self.__capturing = False
+        self.__monitor_lock = threading.Lock()
+        # キャプチャ完了からコールバックまでの猶予時間
+        self.grace_s = GRACE_S
+        # tidyの後にプロトコルを認識するデコーダ。上から順に試す
+        self.decoders = decoders
+        self.__connection = connection if connection is not None else PigpioConnection()
+        self.__backend = self.__connection.backend
+        self.__connection.add_gpio(gpio)
+        # pigpiodが動いていなくても起動を止めない(Redisの購読を始め、最初のキャプチャで接続し直す)
+        try:
+            self.__connection.ensure(STARTUP_CONNECT_ATTEMPTS)
+        except ConnectionError as error:
+            logger.error('{0}, connecting again on the first capture'.format(error))
     
     def tidy_mark_space(self, records, base):
 
@@ -86,10 +287,9 @@ class RespberryPiBoundary:
              records[rec][i] = ms[records[rec][i]]
 
     def tidy(self, records):
-
-       self.tidy_mark_space(records, 0) # Marks.
-
-       self.tidy_mark_space(records, 1) # Spaces.
+       with metrics.timer('tidy_seconds'):
+          self.tidy_mark_space(records, 0) # Marks.
+          self.tidy_mark_space(records, 1) # Spaces.
     
     def normalise(self, c):
        """
@@ -125,106 +325,151 @@ class RespberryPiBoundary:
 
          M    S   M   S   M   S   M    S   M    S   M
        9000 4500 609 550 609 550 609 1675 609 1675 609
-       """
-
-       entries = len(c)
-       p = [0]*entries # Set all entries not processed.
-       for i in range(entries):
-          if not p[i]: # Not processed?
-             v = c[i]
-             tot = v
-             similar = 1.0
-
-             # Find all pulses with similar lengths to the start pulse.
-             for j in range(i+2, entries, 2):
-                if not p[j]: # Unprocessed.
-                   if (c[j]*TOLER_MIN) < v < (c[j]*TOLER_MAX): # Similar.
-                      tot = tot + c[j]
-                      similar += 1.0
-
-             # Calculate the average pulse length.
-             newv = round(tot / similar, 2)
-             c[i] = newv
-
-             # Set all similar pulses to the average value.
-             for j in range(i+2, entries, 2):
-                if not p[j]: # Unprocessed.
-                   if (c[j]*TOLER_MIN) < v < (c[j]*TOLER_MAX): # Similar.
-                      c[j] = newv
-                      p[j] = 1
-
-    def end_of_code(self):
-       global code, fetching_code
-
-       if len(code) > SHORT:
-          self.normalise(code)
-          fetching_code = False
-       else:
-          code = []
-          logger.error("Short code, probably a repeat, try again")
-    
-    def cbf(self, gpio, level, tick):
-
-       global last_tick, in_code, code, fetching_code
-
-       if level != pigpio.TIMEOUT:
-          edge = pigpio.tickDiff(last_tick, tick)
-          last_tick = tick
-
-          if fetching_code:
 
-             if (edge > PRE_US) and (not in_code): # Start of a code.
-                in_code = True
-                self.pi.set_watchdog(GPIO, POST_MS) # Start watchdog.
-
-             elif (edge > POST_US) and in_code: # End of a code.
-                in_code = False
-                self.pi.set_watchdog(GPIO, 0) # Cancel watchdog.
-                self.end_of_code()
-
-             elif in_code:
-                code.append(edge)
+       Marks and spaces are each sorted once and merged in a single
+       pass (see clustering.normalise), so long frames are handled in
+       O(n log n) rather than by comparing every pair of pulses.
+       """
 
-       else:
-          self.pi.set_watchdog(GPIO, 0) # Cancel watchdog.
-          if in_code:
-             in_code = False
-             self.end_of_code()
+       with metrics.timer('normalise_seconds'):
+          clustering.normalise(c, TOLERANCE)
 
-    
-    def start_capturing_remote_signal(self, callback):
+    """
+    キャプチャを開始してすぐに戻る。
+    on_done(session)はフレームを受信したかキャンセルされたときにキャプチャのスレッドから呼ばれる。
+    """
+    def begin_capturing_remote_signal(self, on_done=None):
         logger.debug('Start capturing remote signal')
-        global code, fetching_code, cancelled
-        
-        self.pi = pigpio.pi() # Connect to Pi.
-
-        if not self.pi.connected:
-           logger.error('Failed to connect to raspberry pi')
-
-        self.pi.set_mode(GPIO, pigpio.INPUT) # IR RX connected to this GPIO.
-        self.pi.set_glitch_filter(GPIO, GLITCH) # Ignore glitches.
-        cb = self.pi.callback(GPIO, pigpio.EITHER_EDGE, self.cbf)
+        with self.__monitor_lock:
+            self.__capturing = True
+            self.__close_monitor()
+        pi = self.__connection.ensure()
+        session = capture.CaptureSession(pi, self.gpio, pi.get_current_tick(), self.normalise, on_done=on_done)
+        self.__session = session
         
         logger.debug('Capturing remote signal...')
-        code = []
-        fetching_code = True
-        cancelled = False
-        while fetching_code and not cancelled:
-           time.sleep(0.1)
-        if cancelled:
+        self.__backend.open(pi, session)
+        return session
+
+    """
+    キャプチャの後始末をして、受信した信号とキャンセルされたかどうかを返す。
+    tidyがFalseの場合は整形しない(複数回のキャプチャをmerge_remote_signalsでまとめて整形する場合)。
+    """
+    def finish_capturing_remote_signal(self, session, tidy=True):
+        if session.fetching_code:
+            session.cancel()
+        session.join()
+        self.__backend.close(session.pi, session)
+        session.pi.set_watchdog(self.gpio, 0) # Cancel watchdog.
+        with self.__monitor_lock:
+            self.__capturing = False
+            if self.__on_frame is not None:
+                self.__open_monitor()
+        if session.cancelled:
+           metrics.inc('capture_cancelled_total')
            logger.debug('Capturing remote signal...cancelled')
         else:
            logger.debug('Capturing remote signal...Done')
-        time.sleep(0.5)
-        
-        self.pi.set_glitch_filter(GPIO, 0) # Cancel glitch filter.
-        self.pi.set_watchdog(GPIO, 0) # Cancel watchdog.
-        record = {'0': code}
-        if not cancelled:
+        record = {'0': session.code}
+        if tidy and not session.cancelled:
             self.tidy(record)
+        return record, session.cancelled
+
+    """
+    tidy済みの信号のプロトコルを認識し、{'protocol', 'address', 'command', 'bits', 'repeat'}を返す。
+    どのデコーダにも当てはまらなければNone(生のパルス列だけを使う)。
+    """
+    def decode_remote_signal(self, record):
+        if not record:
+            return None
+        return protocols.decode(record[min(record)], self.decoders)
+
+    """
+    同じボタンを複数回押してキャプチャした、整形前のパルス列のリストを1つの信号にまとめる。
+    全レコードのマークとスペースを1回でクラスタリングしてからtidyするので、各パルスは全キャプチャの平均になる。
+    各キャプチャの最初のフレームが一致しない(違うボタンか受信エラー)場合はNoneを返す。
+    """
+    def merge_remote_signals(self, codes):
+        records = dict((str(i), list(code)) for i, code in enumerate(codes))
+        with metrics.timer('normalise_seconds'):
+            clustering.normalise_records(list(records.values()), TOLERANCE)
+        self.tidy(records)
+        frames = [protocols.split_frames(code)[:1] for code in records.values()]
+        if not frames or any(frame != frames[0] for frame in frames[1:]):
+            return None
+        return records
+
+    def start_capturing_remote_signal(self, callback, tidy=True):
+        session = self.begin_capturing_remote_signal()
+        try:
+            session.done.wait()
+            time.sleep(self.grace_s)
+        finally:
+            record, cancelled = self.finish_capturing_remote_signal(session, tidy)
         callback(record, cancelled)
         
     def stop_capturing_remote_signal(self):
         logger.debug('Stop capturing remote signal')
-        global cancelled
-        cancelled = True
\ No newline at end of file
+        if self.__session is not None:
+            self.__session.cancel()
+
+    @property
+    def monitoring(self):
+        return self.__on_frame is not None
+
+    """
+    モニターモードを開始する。stop_monitoringまでGPIOを監視し続け、
+    フレームを受信する度にon_frame(code, tick)をキャプチャのスレッドから呼ぶ。codeは整形前のパルス列。
+    学習のキャプチャ中はその後に開始し、モニター中に学習のキャプチャを始めるとその間は止める。
+    """
+    def start_monitoring(self, on_frame):
+        logger.debug('Start monitoring remote signals')
+        with self.__monitor_lock:
+            self.__close_monitor()
+            self.__on_frame = on_frame
+            if not self.__capturing:
+                self.__open_monitor()
+
+    def stop_monitoring(self):
+        logger.debug('Stop monitoring remote signals')
+        with self.__monitor_lock:
+            self.__on_frame = None
+            self.__close_monitor()
+
+    def __open_monitor(self):
+        pi = self.__connection.ensure()
+        self.__monitor = capture.CaptureSession(pi, self.gpio, pi.get_current_tick(), self.normalise, on_frame=self.__on_frame)
+        self.__backend.open(pi, self.__monitor)
+
+    def __close_monitor(self):
+        monitor, self.__monitor = self.__monitor, None
+        if monitor is None:
+            return
+        monitor.cancel()
+        monitor.join()
+        self.__backend.close(monitor.pi, monitor)
+        monitor.pi.set_watchdog(self.gpio, 0) # Cancel watchdog.
+
+    """
+    モニターモードで受信したパルス列を学習のキャプチャと同じように整形して{'0': パルス列}で返す
+    """
+    def clean_remote_signal(self, code):
+        record = {'0': list(code)}
+        self.normalise(record['0'])
+        self.tidy(record)
+        return record
+
+    """
+    このGPIOでの受信を止める。最後のGPIOであればpigpiodとの接続を閉じる。サービス終了時に呼ぶ。
+    """
+    def close(self):
+        self.stop_monitoring()
+        self.__connection.remove_gpio(self.gpio)
+
+
+"""
+gpios毎のRespberryPiBoundaryを1つの接続を共有して作り、{GPIO: RespberryPiBoundary}で返す
+"""
+def receivers(gpios, connection=None, decoders=protocols.DECODERS):
+    connection = connection if connection is not None else PigpioConnection()
+    return dict((gpio, RespberryPiBoundary(connection, decoders, gpio)) for gpio in gpios)
@@ -1,14 +1,43 @@
 import redis
+import redis.utils
 import logging
+import threading
+from contextlib import contextmanager
 from neochi.core.dataflow.data import ir_receiver as data
 from neochi.core.dataflow import data_types
 from neochi.core.dataflow.notifications import ir_receiver as notification
+import config
+import metrics
+import signal_store
 
 
 logger = logging.getLogger(__name__)
 sh = logging.StreamHandler()
 logger.addHandler(sh)
 
+# モニターモードで受信したフレームを追加するStream
+MONITOR_STREAM_KEY = 'ir_receiver:monitor'
+# metrics.Registry.snapshot()を書き出すハッシュ
+METRICS_KEY = 'ir_receiver:metrics'
+
+
+"""
+通知にキャプチャのセッションIDを付ける。セッションIDが無い場合は以前と同じ通知にする
+"""
+def with_session(value, session_id):
+    if session_id is not None:
+        value['session'] = session_id
+    return value
+
+
+"""
+通知に受信機のGPIOを付ける。受信機が1つの場合(None)は以前と同じ通知にする
+"""
+def with_gpio(value, gpio):
+    if gpio is not None:
+        value['gpio'] = gpio
+    return value
+
 
 """
 Redisとの通信を行うクラス
@@ -18,8 +47,18 @@ Redisへのアクセスはこのクラスに閉じている。
 
 class RedisBoundary:
     
-    def __init__(self, mediator):
-        self._r = redis.StrictRedis('localhost')
+    """
+    clientを渡すとlocalhostのRedisの代わりに使う(ベンチマークでDB番号やfakeredisを指定する場合)
+    """
+    def __init__(self, mediator, client=None):
+        # neochi-coreのデータ・通知クラスも含めて、このコネクションプールだけを使う
+        # hiredisがインストールされていればredis-pyが応答の解析に使う
+        self._r = client if client is not None else redis.StrictRedis(connection_pool=redis.ConnectionPool(host='localhost'))
+        logger.debug('hiredis available: {0}'.format(redis.utils.HIREDIS_AVAILABLE))
+        # batch()中のスレッドではそのスレッドのパイプラインに書き込む
+        self.__local = threading.local()
+        self._signals = signal_store.SignalStore(self._r, data.Ir.key if config.LEGACY_IR_VIEW else None,
+                                                 signal_store.SignalCache() if config.SIGNAL_CACHE else None)
         self.__mediator = mediator
         self._neochi_app_ir_receiver = None
         
@@ -37,6 +76,29 @@ class RedisBoundary:
     def waits_subscription_end(self):
         self._neochi_app_ir_receiver.wait_subscription_end()
 
+    """
+    with内の状態の設定と通知を1つのMULTI/EXECにまとめて送る。
+    状態の設定が先にキューされていれば、通知を受けたクライアントからは必ず新しい状態が見える。
+    with内では書き込みだけを行うこと(読み込みはパイプラインを通らない)。
+    """
+    @contextmanager
+    def batch(self):
+        if getattr(self.__local, 'pipe', None) is not None:
+            yield
+            return
+        pipe = self._r.pipeline(transaction=True)
+        self.__local.pipe = pipe
+        try:
+            yield
+            pipe.execute()
+        finally:
+            self.__local.pipe = None
+            pipe.reset()
+
+    def _client(self):
+        pipe = getattr(self.__local, 'pipe', None)
+        return pipe if pipe is not None else self._r
+
     """
     現在のIr-reciverの状態を取得する
     """
@@ -48,68 +110,210 @@ class RedisBoundary:
     現在のIr-reciverの状態を設定する
     """
     def set_state(self, new_state):
-        state = data.State(self._r)
+        state = data.State(self._client())
         state.value = new_state
         
     """
-    Redisに格納されている最新のIRを取得する
+    Redisに格納されている最新のIRを{'signals': [...]}の形式で取得する
     """
     def get_ir(self):
-        ir = data.Ir(self._r)
-        return ir.value
+        return self._signals.get_all()
     
     """
-    Redisに最新のIR情報を設定する
+    信号のキャッシュのヒット数、ミス数、ヒット率。キャッシュを使わない場合はNone
+    """
+    def get_signal_cache_stats(self):
+        cache = self._signals.cache
+        if cache is None:
+            return None
+        return {'hits': cache.hits, 'misses': cache.misses, 'hit_rate': cache.hit_rate}
+
+    """
+    metrics.Registryのcollectorとして、信号のキャッシュの統計をゲージにして返す
+    """
+    def collect_metrics(self):
+        stats = self.get_signal_cache_stats() or {}
+        return dict(('signal_cache_' + key, value) for key, value in stats.items())
+
+    """
+    metrics.Registry.snapshot()でハッシュを置き換える。無くなったサンプルが残らないよう、消してから書く
+    """
+    def save_metrics(self, snapshot):
+        pipe = self._r.pipeline(transaction=True)
+        pipe.delete(METRICS_KEY)
+        if snapshot:
+            pipe.hset(METRICS_KEY, mapping=snapshot)
+        pipe.execute()
+
+    """
+    Redisに最新のIR情報を設定する。全信号が置き換わる
     """
     def set_ir(self, new_ir):
-        ir = data.Ir(self._r)
-        ir.value = new_ir
+        self._signals.replace_all(new_ir)
+
+    """
+    信号を1つ取得する。無ければNone
+    """
+    def get_ir_signal(self, ir_signal_id):
+        return self._signals.get(ir_signal_id)
+
+    """
+    新しい信号IDを採番する
+    """
+    def allocate_ir_signal_id(self):
+        return self._signals.allocate_id()
+
+    """
+    信号を1つ保存する。only_existingがTrueの場合は保存済みの信号だけを更新し、無ければFalseを返す
+    保存・削除でどの信号からも参照されなくなった信号ファイルの名前はreleasedのリストに追加する
+    """
+    def save_ir_signal(self, signal, only_existing=False, released=None):
+        return self._signals.save(signal, only_existing, released)
+
+    def delete_ir_signal(self, ir_signal_id, released=None):
+        return self._signals.delete(ir_signal_id, released)
 
-    def publish_started_ir_receiving(self):
-        n = notification.IrReceiverNeochiApp(self._r)
+    """
+    信号をIDの順にcount個ずつ読む。(次のcursor, [信号, ...])を返し、最後まで読んだら次のcursorはNone
+    """
+    def scan_ir_signals(self, cursor=-1, count=100):
+        return self._signals.scan(cursor, count)
+
+    """
+    信号ファイルをいずれかの信号が参照しているか(参照数が1以上か)
+    """
+    def is_ir_file_referenced(self, file_name):
+        return self._signals.file_ref(file_name) > 0
+
+    """
+    signals(信号のiterable。ジェネレータでよい)を新しいIDで追加し、追加した数を返す。
+    1つのパイプラインに500個ずつまとめて書き込み(メモリを一定にするため)、互換ビューは最後に1回だけ作り直す。
+    filePathのファイルは保存済みであること
+    """
+    def import_ir_signals(self, signals):
+        return self._signals.import_signals(signals)
+
+    """
+    以前の{'signals': [...]}をまるごと保存する形式のデータを、信号毎のハッシュに移行する。
+    既に移行済みの場合は何もせずFalseを返す
+    """
+    def migrate_ir(self):
+        if self._signals.exists():
+            return False
+        self._signals.replace_all(data.Ir(self._r).value)
+        return True
+
+    """
+    モニターモードで受信したフレームのエントリ(monitor.frame_entry)をStreamに追加する。
+    古いエントリはconfig.MONITOR_STREAM_MAXLENを目安に削られる。1回のパイプラインで送る
+    """
+    def add_monitor_frames(self, entries):
+        pipe = self._r.pipeline(transaction=False)
+        for entry in entries:
+            pipe.xadd(MONITOR_STREAM_KEY, entry, maxlen=config.MONITOR_STREAM_MAXLEN, approximate=True)
+        pipe.execute()
+
+    """
+    gpioはキャプチャする受信機のGPIO。受信機が1つの場合(None)は付けない
+    """
+    def publish_started_ir_receiving(self, session_id=None, gpio=None):
+        n = notification.IrReceiverNeochiApp(self._client())
         # 信号の確認機能がまだ無いので今の所indexは0しか存在しない
-        n.value = {'title': 'started_ir_receiving', 'index': 0}
+        n.value = with_gpio(with_session({'title': 'started_ir_receiving', 'index': 0}, session_id), gpio)
 
-    def publish_stopped_ir_receiving_no_signal(self):
-        n = notification.IrReceiverNeochiApp(self._r)
-        n.value = {'title': 'stopped_ir_receiving_no_signal'}
+    def publish_stopped_ir_receiving_no_signal(self, session_id=None):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = with_session({'title': 'stopped_ir_receiving_no_signal'}, session_id)
 
-    def publish_stopped_ir_receiving_invalid_signal(self):
-        n = notification.IrReceiverNeochiApp(self._r)
-        n.value = {'title': 'stopped_ir_receiving_invalid_signal'}
+    def publish_stopped_ir_receiving_invalid_signal(self, session_id=None):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = with_session({'title': 'stopped_ir_receiving_invalid_signal'}, session_id)
 
-    def publish_stopped_ir_receiving_valid_signal(self):
-        n = notification.IrReceiverNeochiApp(self._r)
-        n.value = {'title': 'stopped_ir_receiving_valid_signal'}
+    """
+    codeは認識したプロトコルのコード。認識できなかった場合は付けない
+    """
+    def publish_stopped_ir_receiving_valid_signal(self, session_id=None, code=None):
+        n = notification.IrReceiverNeochiApp(self._client())
+        value = with_session({'title': 'stopped_ir_receiving_valid_signal'}, session_id)
+        if code is not None:
+            value['code'] = code
+        n.value = value
 
-    def publish_stopped_ir_receiving_stop_message(self):
-        n = notification.IrReceiverNeochiApp(self._r)
-        n.value = {'title': 'stopped_ir_receiving_stop_message'}
+    def publish_stopped_ir_receiving_stop_message(self, session_id=None):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = with_session({'title': 'stopped_ir_receiving_stop_message'}, session_id)
 
-    def publish_stopped_ir_receiving_more_signal(self):
-        n = notification.IrReceiverNeochiApp(self._r)
-        n.value = {'title': 'stopped_ir_receiving_more_signal'}
+    def publish_stopped_ir_receiving_more_signal(self, session_id=None):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = with_session({'title': 'stopped_ir_receiving_more_signal'}, session_id)
 
     def publish_saved_ir_signal(self, ir_signal_id):
-        n = notification.IrReceiverNeochiApp(self._r)
+        n = notification.IrReceiverNeochiApp(self._client())
         n.value = {'title': 'saved_ir_signal', 'id': ir_signal_id}
 
     def publish_ir_signal_saving_error(self):
-        n = notification.IrReceiverNeochiApp(self._r)
+        n = notification.IrReceiverNeochiApp(self._client())
         n.value = {'title': 'ir_signal_saving_error'}
 
-    def publish_discarded_ir_signal(self):
-        n = notification.IrReceiverNeochiApp(self._r)
-        n.value = {'title': 'discarded_ir_signal'}
+    def publish_discarded_ir_signal(self, session_id=None):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = with_session({'title': 'discarded_ir_signal'}, session_id)
 
     def publish_ir_signal_discarding_error(self):
-        n = notification.IrReceiverNeochiApp(self._r)
+        n = notification.IrReceiverNeochiApp(self._client())
         n.value = {'title': 'ir_signal_discarding_error'}
 
     def publish_deleted_ir_signal(self, ir_signal_id):
-        n = notification.IrReceiverNeochiApp(self._r)
+        n = notification.IrReceiverNeochiApp(self._client())
         n.value = {'title': 'deleted_ir_signal', 'id': ir_signal_id}
 
     def publish_ir_signal_deleting_error(self):
-        n = notification.IrReceiverNeochiApp(self._r)
+        n = notification.IrReceiverNeochiApp(self._client())
         n.value = {'title': 'ir_signal_deleting_error'}
+
+    """
+    ir_signal_idは見つかった信号のID。保存済みの信号に無ければNone
+    """
+    def publish_identified_ir_signal(self, ir_signal_id, session_id=None):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = with_session({'title': 'identified_ir_signal', 'id': ir_signal_id}, session_id)
+
+    def publish_ir_signal_identifying_error(self, session_id=None):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = with_session({'title': 'ir_signal_identifying_error'}, session_id)
+
+    """
+    メッセージの'gpio'の受信機が無い
+    """
+    def publish_ir_receiver_not_found_error(self, gpio):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = {'title': 'ir_receiver_not_found_error', 'gpio': gpio}
+
+    def publish_exported_ir_library(self, path, count):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = {'title': 'exported_ir_library', 'path': path, 'count': count}
+
+    def publish_ir_library_exporting_error(self, path):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = {'title': 'ir_library_exporting_error', 'path': path}
+
+    def publish_imported_ir_library(self, path, count):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = {'title': 'imported_ir_library', 'path': path, 'count': count}
+
+    def publish_ir_library_importing_error(self, path):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = {'title': 'ir_library_importing_error', 'path': path}
+
+    def publish_started_monitoring(self):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = {'title': 'started_monitoring'}
+
+    def publish_stopped_monitoring(self):
+        n = notification.IrReceiverNeochiApp(self._client())
+        n.value = {'title': 'stopped_monitoring'}
+
+
+metrics.instrument(RedisBoundary, 'redis_call_seconds',
+                   exclude=('subscribe', 'unsubscribe', 'waits_subscription_end', 'batch', 'get_signal_cache_stats',
+                            'collect_metrics', 'save_metrics'))
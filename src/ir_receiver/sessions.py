@@ -0,0 +1,330 @@
+import collections
+import logging
+import os
+import threading
+import time
+import uuid
+import config
+import filesystem
+import ir_file
+
+logger = logging.getLogger(__name__)
+sh = logging.StreamHandler()
+logger.addHandler(sh)
+
+# spillする場合に、メモリに置ききれないキャプチャを書き出すファイル名。<folder>/session-<id>.ir
+SPILL_PREFIX = 'session-'
+
+QUEUED = 'queued'
+CAPTURING = 'capturing'
+CAPTURED = 'captured'
+CANCELLED = 'cancelled'
+
+
+"""
+1回のstart_ir_receivingに対応するキャプチャのセッション
+dataは保存前の信号ファイルの中身。メモリ上限を超えてディスクに書き出した場合はspill_pathに移る。
+touchedはキャプチャした時刻。codeはprotocols.decodeで認識したコード。
+pressesは同じボタンを押してもらう回数で、その回数分のキャプチャを平均した信号を保存する。
+gpioはキャプチャする受信機のGPIO。受信機が1つの場合はNone。
+"""
+class Session:
+    def __init__(self, session_id, now, presses=1, gpio=None):
+        self.id = session_id
+        self.presses = presses
+        self.gpio = gpio
+        self.state = QUEUED
+        self.touched = now
+        self.data = None
+        self.code = None
+        self.spill_path = None
+        self.spilling = False
+
+
+"""
+キャプチャのセッションを管理するクラス
+キャプチャ自体は受信機毎に順番に行うが、キャプチャした信号はセッション毎に保存・破棄できる。
+
+キャプチャ済みの信号はsave_ir_signalで永続化されるまでメモリ上のLRUキャッシュに置き、SDカードには書かない。
+    - 信号の合計がmemory_limitバイトを超えると、最も長く使われていないものから追い出す
+      (spillがTrueの場合は追い出さずにディスクに書き出す)
+    - ttl_s秒間使われなかったものはsweep()で破棄する
+キャッシュは使った順(キャプチャとget/peek)のOrderedDictで、最新の取り出し用にキャプチャした順のOrderedDictも持つ。
+IDを指定した取り出し・破棄と最新の取り出しはO(1)で、追い出しとsweep()は先頭から必要な分だけ見る。
+Mediatorのスレッド、キャプチャのスレッド、掃除のスレッドから呼ばれるのでロックで守る。
+"""
+class SessionManager:
+    def __init__(self, fs, folder, ttl_s=None, memory_limit=None, spill=None, clock=time.monotonic):
+        self.__filesystem = fs
+        self.__folder = folder
+        self.ttl_s = ttl_s if ttl_s is not None else config.SESSION_TTL_S
+        self.memory_limit = memory_limit if memory_limit is not None else config.SESSION_MEMORY_LIMIT
+        self.spill = spill if spill is not None else config.SESSION_SPILL
+        self.evictions = 0
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        # キャプチャ待ち・キャプチャ中のセッションと、キャプチャ済みのセッション(使った順とキャプチャした順)
+        self.__pending = {}
+        self.__captured = collections.OrderedDict()
+        self.__capture_order = collections.OrderedDict()
+        self.__memory = 0
+        self.__stopping = threading.Event()
+        self.__sweeper = None
+
+    @property
+    def memory(self):
+        return self.__memory
+
+    """
+    新しいセッションを作り、キャプチャ待ちにする
+    """
+    def create(self, presses=1, gpio=None):
+        with self.__lock:
+            session = Session(uuid.uuid4().hex, self.__clock(), presses, gpio)
+            self.__pending[session.id] = session
+            return session
+
+    def get(self, session_id):
+        with self.__lock:
+            session = self.__pending.get(session_id)
+            if session is not None:
+                return session
+            return self.__touch(self.__captured.get(session_id))
+
+    """
+    キャプチャを開始する。キャンセル済みならFalseを返す
+    """
+    def begin(self, session_id):
+        with self.__lock:
+            session = self.__pending.get(session_id)
+            if session is None or session.state != QUEUED:
+                self.__pending.pop(session_id, None)
+                return False
+            session.state = CAPTURING
+            return True
+
+    def is_capturing(self, session_id):
+        with self.__lock:
+            session = self.__pending.get(session_id)
+            return session is not None and session.state == CAPTURING
+
+    """
+    キャプチャ待ちのセッションをキャンセルする。キャプチャ待ちでなければFalseを返す
+    """
+    def cancel(self, session_id):
+        with self.__lock:
+            session = self.__pending.get(session_id)
+            if session is None or session.state != QUEUED:
+                return False
+            session.state = CANCELLED
+            return True
+
+    """
+    キャプチャ待ちのセッションを全てキャンセルする。終了時に呼ぶ
+    """
+    def cancel_all(self):
+        with self.__lock:
+            for session in self.__pending.values():
+                if session.state == QUEUED:
+                    session.state = CANCELLED
+
+    """
+    キャプチャ待ちかキャプチャ中のセッション数
+    """
+    def pending(self):
+        with self.__lock:
+            return len(self.__pending)
+
+    """
+    キャプチャした信号と認識したコードをセッションに保存する。
+    セッションが無くなっていたか、信号だけでmemory_limitを超えて追い出された場合はFalseを返す
+    """
+    def store(self, session_id, signals, code=None):
+        data = filesystem.encode_signals(signals)
+        with self.__lock:
+            session = self.__pending.pop(session_id, None)
+            if session is None:
+                return False
+            session.state = CAPTURED
+            session.data = data
+            session.code = code
+            session.touched = self.__clock()
+            self.__captured[session.id] = session
+            self.__capture_order[session.id] = session
+            self.__memory += len(data)
+            spilled = self.__evict()
+            stored = session.id in self.__captured
+        for victim in spilled:
+            self.__spill(victim)
+        return stored
+
+    """
+    memory_limitを超えた分を最も長く使われていないものから追い出す。spillの場合は書き出すものを返す
+    """
+    def __evict(self):
+        if not self.spill:
+            while self.__memory > self.memory_limit and self.__captured:
+                session = self.__pop(next(iter(self.__captured.values())))
+                self.evictions += 1
+                logger.debug('Evicted session {0}'.format(session.id))
+            return []
+        # 書き出しは追い出さないので、書き出し済み・書き出し中のものを飛ばして先頭から見る
+        spilled = []
+        memory = self.__memory
+        for session in self.__captured.values():
+            if memory <= self.memory_limit:
+                break
+            if session.data is None or session.spilling:
+                continue
+            memory -= len(session.data)
+            session.spilling = True
+            spilled.append((session, session.data))
+        return spilled
+
+    def __spill(self, victim):
+        session, data = victim
+        spill_path = os.path.join(self.__folder, '{0}{1}.ir'.format(SPILL_PREFIX, session.id))
+        try:
+            self.__filesystem.write_file_atomically(spill_path, data)
+        except Exception:
+            session.spilling = False
+            raise
+        with self.__lock:
+            session.spilling = False
+            if session.data is data and self.__captured.get(session.id) is session:
+                session.spill_path = spill_path
+                session.data = None
+                self.__memory -= len(data)
+                spill_path = None
+        if spill_path is not None:
+            # 書き出している間に保存か破棄された
+            self.__filesystem.delete_file(spill_path)
+        else:
+            logger.debug('Spilled session {0} to disk'.format(session.id))
+
+    """
+    キャプチャ済みのセッションを取り出す。session_idがNoneなら最後にキャプチャしたセッション。
+    無ければNone
+    """
+    def take(self, session_id=None):
+        with self.__lock:
+            session = self.__find(session_id)
+            if session is None:
+                return None
+            return self.__pop(session)
+
+    """
+    キャプチャ済みのセッションを取り出さずに返す。session_idがNoneなら最後にキャプチャしたセッション。
+    無ければNone
+    """
+    def peek(self, session_id=None):
+        with self.__lock:
+            return self.__touch(self.__find(session_id))
+
+    """
+    セッションの信号を{レコード名: [パルス長, ...]}で返す
+    """
+    def signals(self, session):
+        data = session.data
+        f = ir_file.loads(data) if data is not None else ir_file.load(session.spill_path)
+        with f:
+            return f.to_dict()
+
+    """
+    キャプチャ済みのセッションを破棄する。session_idがNoneなら最後にキャプチャしたセッション。
+    無ければFalseを返す
+    """
+    def discard(self, session_id=None):
+        with self.__lock:
+            session = self.__find(session_id)
+            if session is None:
+                return False
+            self.__pop(session)
+        self.__remove_spill(session)
+        return True
+
+    """
+    キャンセルされたか失敗したキャプチャのセッションを状態に関わらず削除する
+    """
+    def drop(self, session_id):
+        with self.__lock:
+            session = self.__pending.pop(session_id, None)
+            if session is None:
+                session = self.__captured.get(session_id)
+                if session is None:
+                    return
+                self.__pop(session)
+        self.__remove_spill(session)
+
+    def __find(self, session_id):
+        if session_id is None:
+            return next(reversed(self.__capture_order.values()), None)
+        return self.__captured.get(session_id)
+
+    """
+    キャプチャ済みのセッションを最近使ったものにする。sweep()の順番が変わらないようtouchedも更新する
+    """
+    def __touch(self, session):
+        if session is not None:
+            session.touched = self.__clock()
+            self.__captured.move_to_end(session.id)
+        return session
+
+    def __pop(self, session):
+        del self.__captured[session.id]
+        del self.__capture_order[session.id]
+        if session.data is not None:
+            self.__memory -= len(session.data)
+        return session
+
+    def __remove_spill(self, session):
+        if session.spill_path is not None:
+            self.__filesystem.delete_file(session.spill_path)
+
+    """
+    ttl_s秒間使われていないキャプチャ済みのセッションを破棄し、破棄したセッションIDのリストを返す
+    """
+    def sweep(self):
+        expired = []
+        with self.__lock:
+            deadline = self.__clock() - self.ttl_s
+            while self.__captured:
+                session = next(iter(self.__captured.values()))
+                if session.touched >= deadline:
+                    break
+                expired.append(self.__pop(session))
+        for session in expired:
+            self.__remove_spill(session)
+            logger.debug('Session {0} expired'.format(session.id))
+        return [x.id for x in expired]
+
+    """
+    前回の実行で書き出したまま残っているファイルを削除する
+    """
+    def remove_spilled_files(self):
+        with os.scandir(self.__folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(SPILL_PREFIX) and entry.name.endswith('.ir'):
+                    self.__filesystem.delete_file(entry.path)
+
+    """
+    interval_s毎にsweep()を呼ぶスレッドを開始する
+    """
+    def start_sweeper(self, interval_s=None):
+        interval_s = interval_s if interval_s is not None else config.SESSION_SWEEP_INTERVAL_S
+        self.__stopping.clear()
+        self.__sweeper = threading.Thread(target=self.__sweep_loop, args=(interval_s,), daemon=True)
+        self.__sweeper.start()
+
+    def stop_sweeper(self):
+        self.__stopping.set()
+        if self.__sweeper is not None:
+            self.__sweeper.join()
+            self.__sweeper = None
+
+    def __sweep_loop(self, interval_s):
+        while not self.__stopping.wait(interval_s):
+            try:
+                self.sweep()
+            except Exception as error:
+                logger.error('Sweeping sessions failed: {0}'.format(error))
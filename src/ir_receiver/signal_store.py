@@ -0,0 +1,613 @@
+import json
+import threading
+
+"""
+リモコン信号の情報をRedisに1信号1ハッシュで保存するクラス
+
+    ir_receiver:signal:<id>          信号毎のハッシュ。各フィールドの値はJSONエンコードした文字列
+    ir_receiver:signals              信号IDのsorted set(scoreはID)
+    ir_receiver:signal_id            ID採番用のカウンタ。INCRの値-1を新しいIDにする
+    ir_receiver:signals_version      信号を書き換える度にINCRするバージョン。SignalCacheが他の書き込みを検出するのに使う
+    ir_receiver:file_refs            信号ファイル(filePath)毎の参照数のハッシュ
+
+信号ファイルは内容のハッシュの名前で保存し(filesystem.content_name)、同じ内容の信号は1つのファイルを共有する。
+参照数は信号の保存・削除と同じLuaスクリプトの中で増減し、0になったファイル名を返すので、呼び出し側で削除する。
+参照数が無いファイル(以前の<id>.ir)は1つの信号だけが参照しているものとして扱う。
+
+neochi-appはIrのキーに{'signals': [...]}の形式で全信号が入っていることを前提にしているので、
+更新の度にLuaスクリプトの中でIrのキーも作り直す(互換ビュー)。
+各フィールドの値はJSON文字列のまま連結するので、Pythonで保存した値がそのまま見える。
+
+1つのRedis(レプリカは可)で使う前提で、Redis Clusterでは動かない。
+1信号の保存・削除のスクリプトは触るキーを全てKEYSで渡すが、互換ビューの作り直し(_BUILD_VIEW)、
+全信号の入れ替え(_REPLACE)と読み込み(_LOAD)はINDEX_KEYから読んだIDでSIGNAL_KEY_PREFIX..idのキーを作る。
+これらのキーは実行前に分からず、ハッシュタグも無いので別々のスロットに入りうる。
+Clusterで使う場合は全キーを1つのハッシュタグ(例えば{ir_receiver})に入れる移行が要る。
+"""
+
+SIGNAL_KEY_PREFIX = 'ir_receiver:signal:'
+INDEX_KEY = 'ir_receiver:signals'
+ID_COUNTER_KEY = 'ir_receiver:signal_id'
+VERSION_KEY = 'ir_receiver:signals_version'
+FILE_REFS_KEY = 'ir_receiver:file_refs'
+# codeはprotocols.decodeで認識したコード。認識できなかった信号と以前の信号はNone
+FIELDS = ('id', 'name', 'sleep', 'filePath', 'fileTimeStamp', 'code')
+
+# KEYS[1]: INDEX_KEY, KEYS[2]: 互換ビューのキー(空文字ならビューを作らない)
+# ARGV[1]: SIGNAL_KEY_PREFIX
+_BUILD_VIEW = '''
+local function build_view(index_key, view_key, prefix)
+    if view_key == '' then
+        return
+    end
+    local ids = redis.call('ZRANGE', index_key, 0, -1)
+    local parts = {}
+    for i, id in ipairs(ids) do
+        local values = redis.call('HMGET', prefix .. id, %s)
+        parts[i] = '{' .. %s .. '}'
+    end
+    redis.call('SET', view_key, '{"signals": [' .. table.concat(parts, ', ') .. ']}')
+end
+''' % (
+    ', '.join("'{0}'".format(field) for field in FIELDS),
+    " .. ', ' .. ".join("'\"{0}\": ' .. (values[{1}] or 'null')".format(field, i + 1) for i, field in enumerate(FIELDS)),
+)
+
+# filePathの参照をoldからnewに付け替え、参照数が0になったファイル名(無ければfalse)を返す。
+# 値はJSON文字列のまま渡す。文字列でないfilePathは参照として数えない
+_FILE_REFS = '''
+local function file_of(value)
+    if not value then
+        return nil
+    end
+    local ok, path = pcall(cjson.decode, value)
+    if ok and type(path) == 'string' then
+        return path
+    end
+    return nil
+end
+
+local function move_ref(refs_key, old, new)
+    old = file_of(old)
+    new = file_of(new)
+    if old == new then
+        return false
+    end
+    if new then
+        redis.call('HINCRBY', refs_key, new, 1)
+    end
+    if old and redis.call('HINCRBY', refs_key, old, -1) <= 0 then
+        redis.call('HDEL', refs_key, old)
+        return old
+    end
+    return false
+end
+'''
+
+# Pythonで作った互換ビューがあり、書き込み前のバージョンがそのビューの元にしたバージョンと同じならそれをSETする。
+# 他のクライアントが間に書き込んでいた場合はサーバーで作り直す
+_WRITE_VIEW = _BUILD_VIEW + _FILE_REFS + '''
+local function write_view(index_key, view_key, prefix, expected, view, version)
+    if view_key ~= '' and view ~= '' and tonumber(expected) == version - 1 then
+        redis.call('SET', view_key, view)
+    else
+        build_view(index_key, view_key, prefix)
+    end
+end
+'''
+
+# KEYS[3]: VERSION_KEY, KEYS[4]: FILE_REFS_KEY, KEYS[5]: 信号のハッシュのキー(SIGNAL_KEY_PREFIX..信号ID)
+# ARGV[2]: 信号ID, ARGV[3]: 1なら既存の信号のみ更新する, ARGV[4]: 互換ビューの元にしたバージョン,
+# ARGV[5]: Pythonで作った互換ビュー(空文字ならサーバーで作る), ARGV[6..]: フィールド名と値の組
+# {保存したら1, 書き込み後のバージョン, 参照されなくなったファイル名}を返す
+_SAVE = _WRITE_VIEW + '''
+local key = KEYS[5]
+if ARGV[3] == '1' and redis.call('EXISTS', key) == 0 then
+    return {0, tonumber(redis.call('GET', KEYS[3]) or '0'), false}
+end
+local released = false
+for i = 6, #ARGV, 2 do
+    if ARGV[i] == 'filePath' then
+        released = move_ref(KEYS[4], redis.call('HGET', key, 'filePath'), ARGV[i + 1])
+    end
+end
+redis.call('HSET', key, unpack(ARGV, 6))
+redis.call('ZADD', KEYS[1], tonumber(ARGV[2]), ARGV[2])
+local version = redis.call('INCR', KEYS[3])
+write_view(KEYS[1], KEYS[2], ARGV[1], ARGV[4], ARGV[5], version)
+return {1, version, released}
+'''
+
+# KEYS: _SAVEと同じ。ARGV[2]: 信号ID, ARGV[3], ARGV[4]: _SAVEのARGV[4], ARGV[5]と同じ
+_DELETE = _WRITE_VIEW + '''
+local key = KEYS[5]
+local released = move_ref(KEYS[4], redis.call('HGET', key, 'filePath'), false)
+if redis.call('DEL', key) == 0 then
+    return {0, tonumber(redis.call('GET', KEYS[3]) or '0'), false}
+end
+redis.call('ZREM', KEYS[1], ARGV[2])
+local version = redis.call('INCR', KEYS[3])
+write_view(KEYS[1], KEYS[2], ARGV[1], ARGV[3], ARGV[4], version)
+return {1, version, released}
+'''
+
+# 全信号を入れ替え、ファイルの参照数も数え直す。KEYS[3]: ID_COUNTER_KEY, KEYS[4]: VERSION_KEY, KEYS[5]: FILE_REFS_KEY
+# ARGV[2]: 新しいIDカウンタの値, ARGV[3]: 信号数, 以降は信号毎にフィールド数とフィールド名・値の組
+_REPLACE = _BUILD_VIEW + _FILE_REFS + '''
+for _, id in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    redis.call('DEL', ARGV[1] .. id)
+end
+redis.call('DEL', KEYS[1], KEYS[5])
+local i = 4
+for _ = 1, tonumber(ARGV[3]) do
+    local id = ARGV[i]
+    local n = tonumber(ARGV[i + 1])
+    redis.call('HSET', ARGV[1] .. id, unpack(ARGV, i + 2, i + 1 + n * 2))
+    redis.call('ZADD', KEYS[1], tonumber(id), id)
+    for j = i + 2, i + n * 2, 2 do
+        if ARGV[j] == 'filePath' then
+            move_ref(KEYS[5], false, ARGV[j + 1])
+        end
+    end
+    i = i + 2 + n * 2
+end
+redis.call('SET', KEYS[3], ARGV[2])
+redis.call('INCR', KEYS[4])
+build_view(KEYS[1], KEYS[2], ARGV[1])
+return 1
+'''
+
+# import_signalsの後にバージョンを上げ、互換ビューを1回だけ作り直す。KEYS[1..3]: _SAVEと同じ
+_REBUILD = _BUILD_VIEW + '''
+redis.call('INCR', KEYS[3])
+build_view(KEYS[1], KEYS[2], ARGV[1])
+return 1
+'''
+
+# 全信号をバージョンと一緒に読む。KEYS[1]: INDEX_KEY, KEYS[2]: VERSION_KEY, ARGV[1]: SIGNAL_KEY_PREFIX
+# {バージョン, {ID, ...}, {{フィールドの値, ...}, ...}}を返す
+_LOAD = '''
+local ids = redis.call('ZRANGE', KEYS[1], 0, -1)
+local rows = {}
+for i, id in ipairs(ids) do
+    rows[i] = redis.call('HMGET', ARGV[1] .. id, %s)
+end
+return {tonumber(redis.call('GET', KEYS[2]) or '0'), ids, rows}
+''' % ', '.join("'{0}'".format(field) for field in FIELDS)
+
+
+def encode_fields(signal):
+    args = []
+    for field in FIELDS:
+        if field in signal:
+            args.extend((field, json.dumps(signal[field])))
+    return args
+
+
+def _save_args(signal, only_existing, expected=None, view=''):
+    return [SIGNAL_KEY_PREFIX, signal['id'], 1 if only_existing else 0,
+            expected if expected is not None else -1, view] + encode_fields(signal)
+
+
+def _replace_args(ir):
+    signals = ir['signals'] if ir is not None else []
+    args = [SIGNAL_KEY_PREFIX, max([x['id'] for x in signals], default=-1) + 1, len(signals)]
+    for signal in signals:
+        fields = encode_fields(signal)
+        args.extend([signal['id'], len(fields) // 2] + fields)
+    return args
+
+
+def decode_fields(values):
+    # 保存されていないフィールドは互換ビューと同じくNoneにする
+    return dict((field, json.loads(value) if value is not None else None) for field, value in zip(FIELDS, values))
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+"""
+Redisの全信号をメモリに持つキャッシュ
+読み込みの度にVERSION_KEYだけをGETし、覚えているバージョンと同じならメモリから返す(ヒット)。
+違う場合は他のクライアント(neochi-appや別のプロセス)が書き込んだので、_LOADで全信号を読み直す(ミス)。
+このプロセスの書き込みは、書き込み後のバージョンが覚えているバージョン+1(間に他の書き込みが無い)なら
+メモリにも反映し(write-through)、そうでなければ次の読み込みで読み直す。
+互換ビューは信号毎のJSON断片を覚えておき、書き込みの度にPythonで連結してLuaスクリプトに渡す。
+Redis側で全信号をHMGETして作り直さないので、保存・削除の時間が信号数でほとんど増えない。
+同じプロセスの複数のスレッドから使える。
+"""
+class SignalCache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # 読み込んだ時点のバージョン。Noneなら読み直す
+        self.version = None
+        self.__lock = threading.Lock()
+        # IDの昇順(互換ビューの順)
+        self.__ids = []
+        # {ID: (フィールド毎のJSON文字列, デコードした信号, 互換ビューの断片)}
+        self.__signals = {}
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    @staticmethod
+    def __entry(encoded):
+        values = [encoded.get(field) for field in FIELDS]
+        fragment = '{' + ', '.join('"{0}": {1}'.format(field, value if value is not None else 'null')
+                                   for field, value in zip(FIELDS, values)) + '}'
+        return encoded, decode_fields(values), fragment
+
+    """
+    Redisのバージョンと比べてヒット・ミスを数える。ミスの場合はFalseを返すので_LOADの結果をload()に渡す
+    """
+    def check(self, version):
+        version = int(version) if version is not None else 0
+        with self.__lock:
+            if self.version == version:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def load(self, result):
+        version, ids, rows = result
+        signals = {}
+        for ir_signal_id, values in zip(ids, rows):
+            encoded = dict((field, _text(value)) for field, value in zip(FIELDS, values) if value is not None)
+            signals[int(ir_signal_id)] = self.__entry(encoded)
+        with self.__lock:
+            self.__signals = signals
+            self.__ids = sorted(signals)
+            self.version = int(version)
+
+    def invalidate(self):
+        with self.__lock:
+            self.version = None
+
+    def get(self, ir_signal_id):
+        with self.__lock:
+            entry = self.__signals.get(ir_signal_id)
+        return dict(entry[1]) if entry is not None else None
+
+    def ids(self):
+        with self.__lock:
+            return list(self.__ids)
+
+    def get_all(self):
+        with self.__lock:
+            return {'signals': [dict(self.__signals[x][1]) for x in self.__ids]}
+
+    def __view(self, ir_signal_id, entry):
+        ids = self.__ids
+        if ir_signal_id not in self.__signals and entry is not None:
+            ids = sorted(ids + [ir_signal_id])
+        fragments = []
+        for x in ids:
+            if x == ir_signal_id:
+                if entry is not None:
+                    fragments.append(entry[2])
+            else:
+                fragments.append(self.__signals[x][2])
+        return '{"signals": [' + ', '.join(fragments) + ']}'
+
+    def __merged(self, signal):
+        entry = self.__signals.get(signal['id'])
+        encoded = dict(entry[0]) if entry is not None else {}
+        fields = encode_fields(signal)
+        encoded.update(zip(fields[::2], fields[1::2]))
+        return self.__entry(encoded)
+
+    """
+    signalを保存した後の互換ビューを作り、(元にしたバージョン, ビュー)を返す。作れない場合のビューは空文字
+    """
+    def view_after_save(self, signal, only_existing):
+        with self.__lock:
+            if self.version is None or (only_existing and signal['id'] not in self.__signals):
+                return None, ''
+            return self.version, self.__view(signal['id'], self.__merged(signal))
+
+    def view_after_delete(self, ir_signal_id):
+        with self.__lock:
+            if self.version is None:
+                return None, ''
+            return self.version, self.__view(ir_signal_id, None)
+
+    def saved(self, signal, version):
+        with self.__lock:
+            if self.version is None or version != self.version + 1:
+                self.version = None
+                return
+            if signal['id'] not in self.__signals:
+                self.__ids = sorted(self.__ids + [signal['id']])
+            self.__signals[signal['id']] = self.__merged(signal)
+            self.version = version
+
+    def deleted(self, ir_signal_id, version):
+        with self.__lock:
+            if self.version is None or version != self.version + 1:
+                self.version = None
+                return
+            self.__signals.pop(ir_signal_id, None)
+            self.__ids = [x for x in self.__ids if x != ir_signal_id]
+            self.version = version
+
+
+"""
+rはredis-pyのクライアント。view_keyは互換ビューを書き込むキーで、Noneならビューを作らない。
+cacheにSignalCacheを渡すと、読み込みはキャッシュから返し、書き込みはキャッシュにも反映する。
+"""
+class SignalStore:
+    def __init__(self, r, view_key, cache=None):
+        self._r = r
+        self._view_key = view_key if view_key is not None else ''
+        self.cache = cache
+        self._save = r.register_script(_SAVE)
+        self._delete = r.register_script(_DELETE)
+        self._replace = r.register_script(_REPLACE)
+        self._load = r.register_script(_LOAD)
+        self._rebuild = r.register_script(_REBUILD)
+
+    def _views(self):
+        # 互換ビューを作らない場合はPythonでも連結しない
+        return self.cache is not None and self._view_key != ''
+
+    def _save_keys(self, ir_signal_id=None):
+        keys = [INDEX_KEY, self._view_key, VERSION_KEY, FILE_REFS_KEY]
+        if ir_signal_id is not None:
+            keys.append(SIGNAL_KEY_PREFIX + str(ir_signal_id))
+        return keys
+
+    def _replace_keys(self):
+        return [INDEX_KEY, self._view_key, ID_COUNTER_KEY, VERSION_KEY, FILE_REFS_KEY]
+
+    """
+    スクリプトの結果をキャッシュに反映し、参照されなくなったファイル名をreleasedに追加する
+    """
+    def _saved(self, result, signal, released):
+        saved, version, freed = result
+        if saved and self.cache is not None:
+            self.cache.saved(signal, version)
+        if freed is not None and released is not None:
+            released.append(_text(freed))
+        return saved == 1
+
+    def _deleted(self, result, ir_signal_id, released):
+        removed, version, freed = result
+        if removed and self.cache is not None:
+            self.cache.deleted(ir_signal_id, version)
+        if freed is not None and released is not None:
+            released.append(_text(freed))
+        return removed == 1
+
+    """
+    新しい信号IDを採番する
+    """
+    def allocate_id(self):
+        return self._r.incr(ID_COUNTER_KEY) - 1
+
+    """
+    信号を保存する。signalにはidと更新するフィールドを入れる。
+    only_existingがTrueの場合、保存されていない信号は作らずにFalseを返す。
+    filePathを変えたことでどの信号からも参照されなくなったファイル名はreleasedのリストに追加する。
+    """
+    def save(self, signal, only_existing=False, released=None):
+        expected, view = self.cache.view_after_save(signal, only_existing) if self._views() else (None, '')
+        result = self._save(keys=self._save_keys(signal['id']), args=_save_args(signal, only_existing, expected, view))
+        return self._saved(result, signal, released)
+
+    """
+    信号を削除する。削除した場合はTrueを返す。参照されなくなったファイル名はreleasedに追加する
+    """
+    def delete(self, ir_signal_id, released=None):
+        expected, view = self.cache.view_after_delete(ir_signal_id) if self._views() else (None, '')
+        result = self._delete(keys=self._save_keys(ir_signal_id),
+                              args=[SIGNAL_KEY_PREFIX, ir_signal_id, expected if expected is not None else -1, view])
+        return self._deleted(result, ir_signal_id, released)
+
+    """
+    キャッシュをRedisのバージョンに合わせる
+    """
+    def _refresh(self):
+        if not self.cache.check(self._r.get(VERSION_KEY)):
+            self.cache.load(self._load(keys=[INDEX_KEY, VERSION_KEY], args=[SIGNAL_KEY_PREFIX]))
+
+    def get(self, ir_signal_id):
+        if self.cache is not None:
+            self._refresh()
+            return self.cache.get(ir_signal_id)
+        values = self._r.hmget(SIGNAL_KEY_PREFIX + str(ir_signal_id), FIELDS)
+        if all(value is None for value in values):
+            return None
+        return decode_fields(values)
+
+    def ids(self):
+        if self.cache is not None:
+            self._refresh()
+            return self.cache.ids()
+        return [int(x) for x in self._r.zrange(INDEX_KEY, 0, -1)]
+
+    """
+    全信号を{'signals': [...]}の形式で返す
+    """
+    def get_all(self):
+        if self.cache is not None:
+            self._refresh()
+            return self.cache.get_all()
+        pipe = self._r.pipeline(transaction=False)
+        for ir_signal_id in self.ids():
+            pipe.hmget(SIGNAL_KEY_PREFIX + str(ir_signal_id), FIELDS)
+        return {'signals': [decode_fields(values) for values in pipe.execute()]}
+
+    """
+    全信号を{'signals': [...]}の内容で置き換える。IDカウンタは最大のID+1にする。
+    """
+    def replace_all(self, ir):
+        self._replace(keys=self._replace_keys(), args=_replace_args(ir))
+        if self.cache is not None:
+            self.cache.invalidate()
+
+    """
+    signals(信号のiterable)を新しいIDで追加し、追加した数を返す。signalsのidは無視する。
+    1つのパイプラインにchunk個ずつ書き込んで送るので、signalsがジェネレータなら信号数に関わらずメモリは一定。
+    互換ビューは最後に1回だけ作り直す。追加の途中の信号は他のクライアントからも見える。
+    """
+    def import_signals(self, signals, chunk=500):
+        pipe = self._r.pipeline(transaction=False)
+        count = 0
+        batch = []
+        for signal in signals:
+            batch.append(signal)
+            if len(batch) == chunk:
+                count += self._import_batch(pipe, batch, self._r.incrby(ID_COUNTER_KEY, len(batch)))
+                pipe.execute()
+                batch = []
+        if batch:
+            count += self._import_batch(pipe, batch, self._r.incrby(ID_COUNTER_KEY, len(batch)))
+            pipe.execute()
+        self._rebuild(keys=self._save_keys()[:3], args=[SIGNAL_KEY_PREFIX])
+        if self.cache is not None:
+            self.cache.invalidate()
+        return count
+
+    """
+    batchをパイプラインに書き込む。counterはIDカウンタをlen(batch)だけINCRBYした値で、
+    allocate_idと同じくcounter - len(batch)からcounter - 1までをIDにする
+    """
+    @staticmethod
+    def _import_batch(pipe, batch, counter):
+        for ir_signal_id, signal in enumerate(batch, counter - len(batch)):
+            fields = encode_fields(dict(signal, id=ir_signal_id))
+            pipe.hset(SIGNAL_KEY_PREFIX + str(ir_signal_id), mapping=dict(zip(fields[::2], fields[1::2])))
+            pipe.zadd(INDEX_KEY, {ir_signal_id: ir_signal_id})
+            if isinstance(signal.get('filePath'), str):
+                pipe.hincrby(FILE_REFS_KEY, signal['filePath'], 1)
+        return len(batch)
+
+    def exists(self):
+        return self._r.exists(INDEX_KEY, ID_COUNTER_KEY) > 0
+
+    """
+    ファイル名毎の参照数
+    """
+    def file_refs(self):
+        return dict((_text(name), int(count)) for name, count in self._r.hgetall(FILE_REFS_KEY).items())
+
+    def file_ref(self, name):
+        count = self._r.hget(FILE_REFS_KEY, name)
+        return int(count) if count is not None else 0
+
+    """
+    IDがcursorより大きい信号をcount個までID順に返す。(次のcursor, [信号, ...])で、最後まで返したら次のcursorはNone
+    キャッシュを使わずにRedisから読む。全信号を一度に読まないので、信号数に関わらず1回の処理は短い
+    """
+    def scan(self, cursor=-1, count=100):
+        ids = [int(x) for x in self._r.zrangebyscore(INDEX_KEY, '({0}'.format(cursor), '+inf', start=0, num=count)]
+        pipe = self._r.pipeline(transaction=False)
+        for ir_signal_id in ids:
+            pipe.hmget(SIGNAL_KEY_PREFIX + str(ir_signal_id), FIELDS)
+        signals = [decode_fields(values) for values in pipe.execute() if any(value is not None for value in values)]
+        return (ids[-1] if len(ids) == count else None), signals
+
+
+async def _aiter(iterable):
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+"""
+redis.asyncioのクライアントを使うSignalStore
+"""
+class AsyncSignalStore(SignalStore):
+    async def allocate_id(self):
+        return await self._r.incr(ID_COUNTER_KEY) - 1
+
+    async def save(self, signal, only_existing=False, released=None):
+        expected, view = self.cache.view_after_save(signal, only_existing) if self._views() else (None, '')
+        result = await self._save(keys=self._save_keys(signal['id']), args=_save_args(signal, only_existing, expected, view))
+        return self._saved(result, signal, released)
+
+    async def delete(self, ir_signal_id, released=None):
+        expected, view = self.cache.view_after_delete(ir_signal_id) if self._views() else (None, '')
+        result = await self._delete(keys=self._save_keys(ir_signal_id),
+                                    args=[SIGNAL_KEY_PREFIX, ir_signal_id, expected if expected is not None else -1, view])
+        return self._deleted(result, ir_signal_id, released)
+
+    async def _refresh(self):
+        if not self.cache.check(await self._r.get(VERSION_KEY)):
+            self.cache.load(await self._load(keys=[INDEX_KEY, VERSION_KEY], args=[SIGNAL_KEY_PREFIX]))
+
+    async def get(self, ir_signal_id):
+        if self.cache is not None:
+            await self._refresh()
+            return self.cache.get(ir_signal_id)
+        values = await self._r.hmget(SIGNAL_KEY_PREFIX + str(ir_signal_id), FIELDS)
+        if all(value is None for value in values):
+            return None
+        return decode_fields(values)
+
+    async def ids(self):
+        if self.cache is not None:
+            await self._refresh()
+            return self.cache.ids()
+        return [int(x) for x in await self._r.zrange(INDEX_KEY, 0, -1)]
+
+    async def get_all(self):
+        if self.cache is not None:
+            await self._refresh()
+            return self.cache.get_all()
+        pipe = self._r.pipeline(transaction=False)
+        for ir_signal_id in await self.ids():
+            pipe.hmget(SIGNAL_KEY_PREFIX + str(ir_signal_id), FIELDS)
+        return {'signals': [decode_fields(values) for values in await pipe.execute()]}
+
+    async def replace_all(self, ir):
+        await self._replace(keys=self._replace_keys(), args=_replace_args(ir))
+        if self.cache is not None:
+            self.cache.invalidate()
+
+    async def scan(self, cursor=-1, count=100):
+        ids = [int(x) for x in await self._r.zrangebyscore(INDEX_KEY, '({0}'.format(cursor), '+inf', start=0, num=count)]
+        pipe = self._r.pipeline(transaction=False)
+        for ir_signal_id in ids:
+            pipe.hmget(SIGNAL_KEY_PREFIX + str(ir_signal_id), FIELDS)
+        signals = [decode_fields(values) for values in await pipe.execute() if any(value is not None for value in values)]
+        return (ids[-1] if len(ids) == count else None), signals
+
+    """
+    signalsは非同期のiterableでもよい
+    """
+    async def import_signals(self, signals, chunk=500):
+        pipe = self._r.pipeline(transaction=False)
+        count = 0
+        batch = []
+        async for signal in _aiter(signals):
+            batch.append(signal)
+            if len(batch) == chunk:
+                count += self._import_batch(pipe, batch, await self._r.incrby(ID_COUNTER_KEY, len(batch)))
+                await pipe.execute()
+                batch = []
+        if batch:
+            count += self._import_batch(pipe, batch, await self._r.incrby(ID_COUNTER_KEY, len(batch)))
+            await pipe.execute()
+        await self._rebuild(keys=self._save_keys()[:3], args=[SIGNAL_KEY_PREFIX])
+        if self.cache is not None:
+            self.cache.invalidate()
+        return count
+
+    async def exists(self):
+        return await self._r.exists(INDEX_KEY, ID_COUNTER_KEY) > 0
+
+    async def file_refs(self):
+        return dict((_text(name), int(count)) for name, count in (await self._r.hgetall(FILE_REFS_KEY)).items())
+
+    async def file_ref(self, name):
+        count = await self._r.hget(FILE_REFS_KEY, name)
+        return int(count) if count is not None else 0
@@ -0,0 +1,169 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import random
+import filesystem
+import ir_file
+
+"""
+テストとベンチマークで共有するフィクスチャとモック
+ベンチマークからはリポジトリのルートをsys.pathに加えて from test import helpers で使う。
+"""
+
+
+"""
+パルス毎に±jitterの誤差を加える
+"""
+def jittered(pulses, jitter, seed):
+    rnd = random.Random(seed)
+    return [int(x * rnd.uniform(1 - jitter, 1 + jitter)) for x in pulses]
+
+
+"""
+NECフォーマットに近いフレームをジッター付きで生成する
+"""
+def jittered_frame(entries, seed=0, jitter=0.05):
+    rnd = random.Random(seed)
+    c = [9000, 4500]
+    while len(c) < entries:
+        c.append(560)
+        c.append(rnd.choice([560, 1690]))
+    return [int(x * rnd.uniform(1 - jitter, 1 + jitter)) for x in c[:entries]]
+
+
+"""
+ウォッチドッグの設定だけを記録するpigpio.piの代わり
+"""
+class WatchdogPiMock:
+    def __init__(self):
+        self.watchdogs = []
+
+    def set_watchdog(self, gpio, timeout):
+        self.watchdogs.append((gpio, timeout))
+
+
+"""
+pigpio.pi.callbackが返すオブジェクトの代わり
+"""
+class CallbackMock:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+"""
+信号とファイルの参照をメモリ上に持つRedisBoundaryの信号部分のモック
+"""
+class SignalsMock:
+    def __init__(self, signals=()):
+        self.signals = dict((x['id'], x) for x in signals)
+        self.next_id = 0
+
+    def get_ir(self):
+        return {'signals': [self.signals[x] for x in sorted(self.signals)]}
+
+    def get_ir_signal(self, ir_signal_id):
+        signal = self.signals.get(ir_signal_id)
+        return dict(signal) if signal is not None else None
+
+    def allocate_ir_signal_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def save_ir_signal(self, signal, only_existing=False, released=None):
+        if only_existing and signal['id'] not in self.signals:
+            return False
+        old = self.signals.get(signal['id'], {}).get('filePath')
+        self.signals.setdefault(signal['id'], {}).update(signal)
+        self.release(old, released)
+        return True
+
+    def delete_ir_signal(self, ir_signal_id, released=None):
+        signal = self.signals.pop(ir_signal_id, None)
+        if signal is None:
+            return False
+        self.release(signal.get('filePath'), released)
+        return True
+
+    def is_ir_file_referenced(self, file_name):
+        return any(x.get('filePath') == file_name for x in self.signals.values())
+
+    """
+    どの信号からも参照されなくなったファイルをreleasedに追加する
+    """
+    def release(self, file_path, released):
+        # 非同期のモックはis_ir_file_referencedをコルーチンにするので呼ばない
+        if isinstance(file_path, str) and released is not None and all(x.get('filePath') != file_path for x in self.signals.values()):
+            released.append(file_path)
+
+    def scan_ir_signals(self, cursor=-1, count=100):
+        ids = sorted(x for x in self.signals if x > cursor)[:count]
+        return (ids[-1] if len(ids) == count else None), [dict(self.signals[x]) for x in ids]
+
+    def import_ir_signals(self, signals):
+        count = 0
+        for signal in signals:
+            ir_signal_id = max(self.signals, default=-1) + 1
+            self.signals[ir_signal_id] = dict(signal, id=ir_signal_id)
+            count += 1
+        return count
+
+
+"""
+信号ファイルをメモリ上に持つFilesystemのモック
+"""
+class FilesystemMock:
+    def __init__(self):
+        self.files = {}
+
+    def save_temp_file(self, name, signals):
+        self.files[name] = signals
+
+    def write_file_atomically(self, name, data):
+        self.files[name] = data
+        return 0.0
+
+    def rename_tmp_file(self, name, new_name):
+        self.files[new_name] = self.files.pop(name)
+        return 0.0
+
+    def delete_file(self, name):
+        self.files.pop(name, None)
+
+    def save_content(self, directory, data):
+        name = filesystem.content_name(data)
+        self.files.setdefault('{0}/{1}'.format(directory, name), data)
+        return name, 0.0
+
+    def move_content(self, directory, name):
+        data = self.files.pop(name)
+        new_name = filesystem.content_name(data)
+        self.files.setdefault('{0}/{1}'.format(directory, new_name), data)
+        return new_name, 0.0
+
+    def load_signal_file(self, name):
+        if name not in self.files:
+            raise FileNotFoundError(name)
+        return ir_file.loads(self.files[name])
@@ -0,0 +1,409 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio
+import contextlib
+import threading
+import unittest
+from unittest import mock
+import filesystem
+import ir_file
+import async_mediator
+import sessions
+from test import helpers
+
+test_signal = {'0': [8970, 4475, 586, 544, 586, 1669, 586]}
+test_signal_file = filesystem.encode_signals(test_signal)
+test_file_name = filesystem.content_name(test_signal_file)
+test_code = {'protocol': 'nec', 'address': 0, 'command': 1, 'bits': 32, 'repeat': 0}
+
+
+"""
+AsyncRedisBoundaryの代わりに状態と通知をメモリ上に記録するモック
+信号の操作はhelpers.SignalsMockをコルーチンで包む
+"""
+class AsyncRedisBoundaryMock(helpers.SignalsMock):
+    def __init__(self):
+        super().__init__()
+        self.state = None
+        self.published = []
+        self.frames = []
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    async def messages(self):
+        while True:
+            yield await self.queue.get()
+
+    async def close(self):
+        self.closed = True
+
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        yield
+
+    async def get_state(self):
+        return self.state
+
+    async def set_state(self, new_state):
+        self.state = new_state
+
+    async def get_ir(self):
+        return super().get_ir()
+
+    async def migrate_ir(self):
+        return False
+
+    async def get_ir_signal(self, ir_signal_id):
+        return super().get_ir_signal(ir_signal_id)
+
+    async def allocate_ir_signal_id(self):
+        return super().allocate_ir_signal_id()
+
+    async def save_ir_signal(self, signal, only_existing=False, released=None):
+        return super().save_ir_signal(signal, only_existing, released)
+
+    async def delete_ir_signal(self, ir_signal_id, released=None):
+        return super().delete_ir_signal(ir_signal_id, released)
+
+    async def is_ir_file_referenced(self, file_name):
+        return super().is_ir_file_referenced(file_name)
+
+    async def add_monitor_frames(self, entries):
+        self.frames.extend(entries)
+
+    def __getattr__(self, name):
+        if not name.startswith('publish_'):
+            raise AttributeError(name)
+        async def publish(*args):
+            self.published.append((name[len('publish_'):], args))
+        return publish
+
+
+class SessionMock:
+    cancelled = False
+
+
+"""
+release()かstop_capturing_remote_signal()が呼ばれると、別スレッドからon_doneを呼ぶモック
+"""
+class RespberryPiBoundaryMock:
+    grace_s = 0
+
+    def __init__(self):
+        self.session = None
+        self.on_frame = None
+        self.on_done = None
+        self.started = threading.Event()
+        self.closed = False
+
+    def begin_capturing_remote_signal(self, on_done=None):
+        self.session = SessionMock()
+        self.on_done = on_done
+        self.started.set()
+        return self.session
+
+    def finish_capturing_remote_signal(self, session, tidy=True):
+        return test_signal, session.cancelled
+
+    def release(self):
+        threading.Thread(target=self.on_done, args=(self.session,)).start()
+
+    def decode_remote_signal(self, record):
+        return test_code
+
+    def merge_remote_signals(self, codes):
+        return dict((str(i), code) for i, code in enumerate(codes))
+
+    def start_monitoring(self, on_frame):
+        self.on_frame = on_frame
+
+    def stop_monitoring(self):
+        self.on_frame = None
+
+    def clean_remote_signal(self, code):
+        return {'0': list(code)}
+
+    def stop_capturing_remote_signal(self):
+        if self.session is not None:
+            self.session.cancelled = True
+            self.release()
+
+    def close(self):
+        self.closed = True
+
+
+class TestAsyncMediator(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.redis_boundary = AsyncRedisBoundaryMock()
+        self.filesystem = helpers.FilesystemMock()
+        self.raspberry_pi = RespberryPiBoundaryMock()
+        self.sessions = sessions.SessionManager(self.filesystem, async_mediator.IR_FOLDER_PATH)
+        self.mediator = async_mediator.AsyncMediator()
+        await self.mediator.initialize(self.redis_boundary, self.filesystem, self.raspberry_pi, self.sessions)
+        self.running = asyncio.ensure_future(self.mediator.run())
+
+    async def asyncTearDown(self):
+        self.running.cancel()
+        await asyncio.gather(self.running, return_exceptions=True)
+        await self.mediator.stop()
+        assert self.raspberry_pi.closed
+        assert self.redis_boundary.closed
+
+    async def send(self, value):
+        await self.redis_boundary.queue.put(value)
+        while not self.redis_boundary.queue.empty():
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    async def wait_for_publish(self, title):
+        for i in range(500):
+            if self.redis_boundary.published and self.redis_boundary.published[-1][0] == title:
+                return
+            await asyncio.sleep(0.01)
+        self.fail('{0} was not published: {1}'.format(title, self.redis_boundary.published))
+
+    async def test_capture_and_save(self):
+        await self.send({'title': 'start_ir_receiving'})
+        await self.wait_for_publish('started_ir_receiving')
+        assert self.redis_boundary.state == 'receiving'
+
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_valid_signal')
+        assert self.redis_boundary.state == 'ready'
+        assert self.filesystem.files == {}
+        session_id = self.redis_boundary.published[-1][1][0]
+        assert self.redis_boundary.published[0] == ('started_ir_receiving', (session_id, None))
+
+        await self.send({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200, 'updatesFile': True,
+                         'session': session_id})
+        await self.wait_for_publish('saved_ir_signal')
+        assert await self.redis_boundary.get_ir() == {'signals': [{'id': 0, 'name': 'tv', 'sleep': 200, 'filePath': test_file_name, 'fileTimeStamp': 0.0, 'code': test_code}]}
+        assert self.filesystem.files['/data/' + test_file_name] == test_signal_file
+
+        await self.send({'title': 'delete_ir_signal', 'id': 0})
+        await self.wait_for_publish('deleted_ir_signal')
+        assert await self.redis_boundary.get_ir() == {'signals': []}
+        assert '/data/' + test_file_name not in self.filesystem.files
+
+    async def test_stop_ir_receiving_during_capture(self):
+        await self.send({'title': 'start_ir_receiving'})
+        await self.wait_for_publish('started_ir_receiving')
+        await self.send({'title': 'stop_ir_receiving'})
+        await self.wait_for_publish('stopped_ir_receiving_stop_message')
+        assert self.redis_boundary.state == 'ready'
+
+    async def test_save_ir_signal_deleted_while_saving(self):
+        self.redis_boundary.signals[5] = {'id': 5, 'name': 'tv', 'sleep': 0, 'filePath': None, 'fileTimeStamp': None, 'code': None}
+        get_ir_signal = self.redis_boundary.get_ir_signal
+
+        async def get_then_delete(ir_signal_id):
+            signal = await get_ir_signal(ir_signal_id)
+            await self.redis_boundary.delete_ir_signal(ir_signal_id)
+            return signal
+
+        self.redis_boundary.get_ir_signal = get_then_delete
+        await self.send({'title': 'start_ir_receiving'})
+        await self.wait_for_publish('started_ir_receiving')
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_valid_signal')
+        await self.send({'title': 'save_ir_signal', 'id': 5, 'name': 'tv2', 'sleep': 200, 'updatesFile': True})
+        await self.wait_for_publish('saved_ir_signal')
+        # 削除された信号を項目の欠けたまま作り直さず、書いたファイルも残さない
+        assert self.redis_boundary.signals == {}
+        assert self.filesystem.files == {}
+
+    async def test_stop_ir_receiving_while_beginning(self):
+        # pigpiodへの接続を待っている(begin_capturing_remote_signalがまだ戻らない)間にstopが届く
+        beginning, begun, stopped = threading.Event(), threading.Event(), threading.Event()
+        begin, stop = self.raspberry_pi.begin_capturing_remote_signal, self.raspberry_pi.stop_capturing_remote_signal
+
+        def slow_begin(on_done=None):
+            beginning.set()
+            begun.wait(5)
+            return begin(on_done)
+
+        def stop_capturing():
+            stop()
+            stopped.set()
+
+        self.raspberry_pi.begin_capturing_remote_signal = slow_begin
+        self.raspberry_pi.stop_capturing_remote_signal = stop_capturing
+        loop = asyncio.get_running_loop()
+        await self.send({'title': 'start_ir_receiving'})
+        await loop.run_in_executor(None, beginning.wait, 5)
+        await self.send({'title': 'stop_ir_receiving'})
+        await loop.run_in_executor(None, stopped.wait, 5)
+        begun.set()
+        await self.wait_for_publish('stopped_ir_receiving_stop_message')
+        assert self.redis_boundary.state == 'ready'
+
+    async def test_save_waits_for_files_lock_of_other_thread(self):
+        await self.send({'title': 'start_ir_receiving'})
+        await self.wait_for_publish('started_ir_receiving')
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_valid_signal')
+        # 保守のスレッドがロックを持っている間は保存しないが、イベントループは止めない
+        self.mediator.files_lock.acquire()
+        try:
+            await self.send({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200, 'updatesFile': True})
+            await asyncio.wait_for(asyncio.sleep(0.05), 1)
+            assert self.filesystem.files == {}
+        finally:
+            self.mediator.files_lock.release()
+        await self.wait_for_publish('saved_ir_signal')
+        assert self.filesystem.files['/data/' + test_file_name] == test_signal_file
+
+    async def test_too_large_signal_is_not_kept(self):
+        self.sessions.memory_limit = 1
+        await self.send({'title': 'start_ir_receiving'})
+        await self.wait_for_publish('started_ir_receiving')
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_invalid_signal')
+        assert self.redis_boundary.state == 'ready'
+
+    async def test_discard_ir_signal(self):
+        await self.send({'title': 'start_ir_receiving'})
+        await self.wait_for_publish('started_ir_receiving')
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_valid_signal')
+        session_id = self.redis_boundary.published[-1][1][0]
+        await self.send({'title': 'discard_ir_signal', 'session': session_id})
+        await self.wait_for_publish('discarded_ir_signal')
+        assert self.redis_boundary.published[-1] == ('discarded_ir_signal', (session_id,))
+        await self.send({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200, 'updatesFile': True,
+                         'session': session_id})
+        await self.wait_for_publish('ir_signal_saving_error')
+
+    async def test_identify_ir_signal(self):
+        await self.send({'title': 'start_ir_receiving'})
+        await self.wait_for_publish('started_ir_receiving')
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_valid_signal')
+        await self.send({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200, 'updatesFile': True})
+        await self.wait_for_publish('saved_ir_signal')
+
+        self.raspberry_pi.started.clear()
+        await self.send({'title': 'start_ir_receiving'})
+        await self.wait_for_publish('started_ir_receiving')
+        while not self.raspberry_pi.started.is_set():
+            await asyncio.sleep(0.01)
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_valid_signal')
+        session_id = self.redis_boundary.published[-1][1][0]
+        await self.send({'title': 'identify_ir_signal', 'session': session_id})
+        await self.wait_for_publish('identified_ir_signal')
+        assert self.redis_boundary.published[-1] == ('identified_ir_signal', (0, session_id))
+
+        await self.send({'title': 'delete_ir_signal', 'id': 0})
+        await self.wait_for_publish('deleted_ir_signal')
+        await self.send({'title': 'identify_ir_signal', 'session': session_id})
+        await self.wait_for_publish('identified_ir_signal')
+        assert self.redis_boundary.published[-1] == ('identified_ir_signal', (None, session_id))
+
+    async def test_multi_press_capture(self):
+        await self.send({'title': 'start_ir_receiving', 'presses': 2})
+        await self.wait_for_publish('started_ir_receiving')
+        session_id = self.redis_boundary.published[-1][1][0]
+        self.raspberry_pi.started.clear()
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_more_signal')
+        assert self.redis_boundary.published[-1] == ('stopped_ir_receiving_more_signal', (session_id,))
+        while not self.raspberry_pi.started.is_set():
+            await asyncio.sleep(0.01)
+        self.raspberry_pi.release()
+        await self.wait_for_publish('stopped_ir_receiving_valid_signal')
+        assert self.redis_boundary.state == 'ready'
+        await self.send({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200, 'updatesFile': True,
+                         'session': session_id})
+        await self.wait_for_publish('saved_ir_signal')
+        with ir_file.loads(self.filesystem.files['/data/' + self.redis_boundary.signals[0]['filePath']]) as f:
+            assert f.to_dict() == {'0': test_signal['0'], '1': test_signal['0']}
+
+    async def test_monitoring(self):
+        await self.send({'title': 'start_monitoring'})
+        await self.wait_for_publish('started_monitoring')
+        on_frame = self.raspberry_pi.on_frame
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, lambda: [on_frame(test_signal['0'], tick) for tick in range(100)])
+        await self.send({'title': 'stop_monitoring'})
+        await self.wait_for_publish('stopped_monitoring')
+        assert self.raspberry_pi.on_frame is None
+        assert [entry['tick'] for entry in self.redis_boundary.frames] == list(range(100))
+
+    async def test_export_runs_in_background(self):
+        exporting = asyncio.Event()
+
+        async def export_library_async(redis_boundary, folder, path):
+            await exporting.wait()
+            return 3
+
+        with mock.patch.object(async_mediator.library, 'export_library_async', export_library_async):
+            await self.send({'title': 'export_ir_library', 'path': '/tmp/library.tar.gz'})
+            # 書き出しの間も他のメッセージを処理する
+            await self.send({'title': 'start_ir_receiving'})
+            await self.wait_for_publish('started_ir_receiving')
+            exporting.set()
+            await self.wait_for_publish('exported_ir_library')
+        assert self.redis_boundary.published[-1] == ('exported_ir_library', ('/tmp/library.tar.gz', 3))
+
+    async def test_unknown_title_is_ignored(self):
+        await self.send({'title': 'unknown'})
+        assert self.redis_boundary.published == []
+
+
+class TestAsyncMediatorWithReceivers(unittest.IsolatedAsyncioTestCase):
+
+    async def test_receivers_capture_concurrently(self):
+        redis_boundary = AsyncRedisBoundaryMock()
+        receivers = {17: RespberryPiBoundaryMock(), 18: RespberryPiBoundaryMock()}
+        mediator = async_mediator.AsyncMediator()
+        await mediator.initialize(redis_boundary, helpers.FilesystemMock(), receivers)
+        running = asyncio.ensure_future(mediator.run())
+        try:
+            await redis_boundary.queue.put({'title': 'start_ir_receiving', 'gpio': 17})
+            await redis_boundary.queue.put({'title': 'start_ir_receiving', 'gpio': 18})
+            await redis_boundary.queue.put({'title': 'start_ir_receiving', 'gpio': 22})
+            for i in range(500):
+                if receivers[17].started.is_set() and receivers[18].started.is_set():
+                    break
+                await asyncio.sleep(0.01)
+            first = redis_boundary.published[0][1][0]
+            second = redis_boundary.published[1][1][0]
+            assert redis_boundary.published == [('started_ir_receiving', (first, 17)), ('started_ir_receiving', (second, 18)),
+                                                ('ir_receiver_not_found_error', (22,))]
+            # 17のキャプチャ中でも18のキャプチャは終わる
+            receivers[18].release()
+            for i in range(500):
+                if redis_boundary.published[-1][0] == 'stopped_ir_receiving_valid_signal':
+                    break
+                await asyncio.sleep(0.01)
+            assert redis_boundary.published[-1] == ('stopped_ir_receiving_valid_signal', (second, test_code))
+            assert redis_boundary.state == 'receiving'
+        finally:
+            running.cancel()
+            await asyncio.gather(running, return_exceptions=True)
+            await mediator.stop()
+        assert redis_boundary.published[-1] == ('stopped_ir_receiving_stop_message', (first,))
+        assert all(receiver.closed for receiver in receivers.values())
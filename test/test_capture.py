@@ -0,0 +1,307 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import io
+import os
+import threading
+import time
+import unittest
+import capture
+import clustering
+from test import helpers
+
+REPORTS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'ac_cool27.reports')
+test_signal = [8970, 4475, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 39710, 8970, 2265, 586]
+
+
+"""
+pulsesをstart_tickから1秒後に始まるエッジ列(level, tick)にする。最後にウォッチドッグのタイムアウトを付ける。
+"""
+def to_edges(pulses, start_tick=0xFFFF0000):
+    tick = (start_tick + 1000 * 1000) & 0xFFFFFFFF
+    level = 0
+    edges = [(level, tick)]
+    for pulse in pulses:
+        tick = (tick + pulse) & 0xFFFFFFFF
+        level ^= 1
+        edges.append((level, tick))
+    edges.append((capture.TIMEOUT, tick))
+    return edges
+
+
+"""
+framesをgap_us空けて続けて送ったエッジ列(level, tick)と、各フレームの先頭のtickのリストを返す。
+ボタンを押し続けたときのフレームとリピートコードのように、間にウォッチドッグのタイムアウトを入れない。
+"""
+def held_button_edges(frames, gap_us, start_tick=0):
+    tick = (start_tick + 1000 * 1000) & 0xFFFFFFFF
+    edges = []
+    ticks = []
+    for frame in frames:
+        level = 0
+        edges.append((level, tick))
+        ticks.append(tick)
+        for pulse in frame:
+            tick = (tick + pulse) & 0xFFFFFFFF
+            level ^= 1
+            edges.append((level, tick))
+        tick = (tick + gap_us) & 0xFFFFFFFF
+    edges.append((capture.TIMEOUT, tick))
+    return edges, ticks
+
+
+class TestEdgeRingBuffer(unittest.TestCase):
+
+    def test_wraps_around(self):
+        buffer = capture.EdgeRingBuffer(8)
+        for tick in range(20):
+            buffer.put(17, tick % 2, tick)
+            assert buffer.drain() == [(tick % 2, tick)]
+        assert buffer.overruns == 0
+
+    def test_overrun_drops_newest_edges(self):
+        buffer = capture.EdgeRingBuffer(4)
+        for tick in range(6):
+            buffer.put(17, 1, tick)
+        assert buffer.overruns == 2
+        assert [tick for level, tick in buffer.drain()] == [0, 1, 2, 3]
+
+    def test_put_sets_ready(self):
+        buffer = capture.EdgeRingBuffer(8)
+        assert not buffer.ready.is_set()
+        buffer.put(17, 1, 0)
+        assert buffer.ready.is_set()
+
+    def test_size_must_be_power_of_two(self):
+        with self.assertRaises(ValueError):
+            capture.EdgeRingBuffer(100)
+
+
+"""
+test/data/ac_cool27.reportsはGPIO17でac:cool27を受信したときのpigpio通知レポート。
+フレームの前後とフレーム中に他のGPIOの変化、keep alive、他のGPIOのウォッチドッグを含む。
+"""
+def read_reports():
+    with open(REPORTS_PATH, 'rb') as f:
+        return f.read()
+
+
+def chunked_reader(data, size):
+    stream = io.BytesIO(data)
+    def read():
+        chunk = stream.read(size)
+        return chunk if chunk else None
+    return read
+
+
+class TestReportDecoder(unittest.TestCase):
+
+    def decode_in_chunks(self, size):
+        decoder = capture.ReportDecoder(17, 1 << 17)
+        read = chunked_reader(read_reports(), size)
+        edges = []
+        data = read()
+        while data is not None:
+            edges.extend(decoder.decode(data))
+            data = read()
+        return edges
+
+    def test_extracts_gpio_edges(self):
+        edges = self.decode_in_chunks(4096)
+        assert len(edges) == len(test_signal) + 2
+        assert edges[-1][0] == capture.TIMEOUT
+        pulses = [capture.tick_diff(a[1], b[1]) for a, b in zip(edges[:-2], edges[1:-1])]
+        assert pulses == test_signal
+        assert [level for level, tick in edges[:4]] == [0, 1, 0, 1]
+
+    def test_partial_reports_are_carried_over(self):
+        assert self.decode_in_chunks(7) == self.decode_in_chunks(4096)
+
+    def test_struct_fallback(self):
+        np = capture.np
+        try:
+            capture.np = None
+            edges = self.decode_in_chunks(4096)
+        finally:
+            capture.np = np
+        assert edges == self.decode_in_chunks(4096)
+
+
+class TestCaptureSession(unittest.TestCase):
+
+    def test_captures_one_frame_from_callback_thread(self):
+        pi = helpers.WatchdogPiMock()
+        start_tick = 0xFFFF0000  # tickの折り返しを跨ぐ
+        session = capture.CaptureSession(pi, 17, start_tick, clustering.normalise)
+        session.start()
+        producer = threading.Thread(target=lambda: [session.cbf(17, level, tick) for level, tick in to_edges(test_signal, start_tick)])
+        producer.start()
+        producer.join()
+        session.join(5)
+
+        expected = list(test_signal)
+        clustering.normalise(expected)
+        assert not session.fetching_code
+        assert session.code == expected
+        assert pi.watchdogs[0] == (17, capture.POST_MS)
+
+    def test_short_code_is_discarded(self):
+        session = capture.CaptureSession(helpers.WatchdogPiMock(), 17, 0, clustering.normalise)
+        for level, tick in to_edges(test_signal[:capture.SHORT], 0):
+            session.feed(level, tick)
+        assert session.fetching_code
+        assert session.code == []
+
+    def test_cancel_stops_consumer(self):
+        session = capture.CaptureSession(helpers.WatchdogPiMock(), 17, 0, clustering.normalise)
+        session.start()
+        session.cancel()
+        session.join(5)
+        assert session.cancelled
+        assert session.fetching_code
+
+    def test_idle_consumer_waits_for_edges(self):
+        session = capture.CaptureSession(helpers.WatchdogPiMock(), 17, 0, clustering.normalise)
+        drain = session.buffer.drain
+        drains = []
+        session.buffer.drain = lambda: drains.append(None) or drain()
+        session.start()
+        time.sleep(0.1)
+        # エッジが来るまでは読みに行かない
+        assert len(drains) == 1
+        for level, tick in to_edges(test_signal, 0):
+            session.cbf(17, level, tick)
+        session.join(5)
+        assert not session.fetching_code
+
+    def test_monitor_reports_every_frame(self):
+        repeat = [8970, 2265, 586]
+        frames = [test_signal, repeat, repeat, [600], repeat]
+        edges, ticks = held_button_edges(frames, capture.POST_US + 40000, 0xFFFF0000)
+        received = []
+        session = capture.CaptureSession(helpers.WatchdogPiMock(), 17, 0xFFFF0000, clustering.normalise,
+                                         on_frame=lambda code, tick: received.append((code, tick)))
+        session.start()
+        producer = threading.Thread(target=lambda: [session.cbf(17, level, tick) for level, tick in edges])
+        producer.start()
+        producer.join()
+        for i in range(500):
+            if len(received) == 4:
+                break
+            time.sleep(0.01)
+        # モニターモードではフレームを受信しても終わらない
+        assert not session.done.is_set()
+        session.cancel()
+        session.join(5)
+
+        # 3パルス未満のノイズは通知しない。パルス列は正規化しない
+        assert received == [(test_signal, ticks[0]), (repeat, ticks[1]), (repeat, ticks[2]), (repeat, ticks[4])]
+
+    def test_captures_one_frame_from_reports(self):
+        pi = helpers.WatchdogPiMock()
+        data = read_reports()
+        start_tick = capture.REPORT.unpack_from(data)[2]
+        session = capture.CaptureSession(pi, 17, start_tick, clustering.normalise)
+        session.start_reports(chunked_reader(data, 100), 1 << 17)
+        session.join(5)
+
+        expected = list(test_signal)
+        clustering.normalise(expected)
+        assert not session.fetching_code
+        assert session.code == expected
+
+
+"""
+GPIO毎のエッジ列{GPIO: [(level, tick), ...]}を、tick順に混ぜた1つの通知パイプのレポートにする。
+levelはレポートの最初のGPIOバンクの状態。ウォッチドッグのタイムアウトはそのGPIOのウォッチドッグのレポートにする
+"""
+def to_reports(gpio_edges, level=0):
+    merged = sorted((tick, gpio, i, edge_level) for gpio, edges in gpio_edges.items()
+                    for i, (edge_level, tick) in enumerate(edges))
+    data = []
+    for seqno, (tick, gpio, i, edge_level) in enumerate(merged):
+        if edge_level == capture.TIMEOUT:
+            data.append(capture.REPORT.pack(seqno & 0xFFFF, capture.NTFY_FLAGS_WDOG | gpio, tick, level))
+            continue
+        level = (level | (1 << gpio)) if edge_level else (level & ~(1 << gpio))
+        data.append(capture.REPORT.pack(seqno & 0xFFFF, 0, tick, level))
+    return b''.join(data)
+
+
+class TestDispatchers(unittest.TestCase):
+
+    def test_one_thread_for_many_gpios(self):
+        dispatcher = capture.EdgeDispatcher()
+        gpios = (17, 18, 22, 27)
+        sessions = [capture.CaptureSession(helpers.WatchdogPiMock(), gpio, 0, clustering.normalise) for gpio in gpios]
+        threads = threading.active_count()
+        for session in sessions:
+            dispatcher.add(session)
+        assert threading.active_count() == threads + 1
+        assert len(dispatcher) == len(gpios)
+        for i, session in enumerate(sessions):
+            for level, tick in to_edges(test_signal[:67 - 2 * i], 0):
+                session.cbf(session.gpio, level, tick)
+        for i, session in enumerate(sessions):
+            session.join(5)
+            expected = list(test_signal[:67 - 2 * i])
+            clustering.normalise(expected)
+            assert session.code == expected
+        for i in range(500):
+            if threading.active_count() == threads:
+                break
+            time.sleep(0.01)
+        assert len(dispatcher) == 0
+        assert threading.active_count() == threads
+
+    def test_cancelled_session_is_released(self):
+        dispatcher = capture.EdgeDispatcher()
+        captured = capture.CaptureSession(helpers.WatchdogPiMock(), 17, 0, clustering.normalise)
+        cancelled = capture.CaptureSession(helpers.WatchdogPiMock(), 18, 0, clustering.normalise)
+        dispatcher.add(captured)
+        dispatcher.add(cancelled)
+        cancelled.cancel()
+        cancelled.join(5)
+        assert len(dispatcher) == 1
+        for level, tick in to_edges(test_signal, 0):
+            captured.cbf(17, level, tick)
+        captured.join(5)
+        assert not captured.fetching_code
+        assert cancelled.fetching_code
+
+    def test_reports_for_many_gpios(self):
+        frames = {17: test_signal, 18: test_signal[:41]}
+        gpio_edges = dict((gpio, to_edges(pulses, 0)) for gpio, pulses in frames.items())
+        # 2つのフレームが重なるように18を少し遅らせる
+        gpio_edges[18] = [(level, tick + 1234) for level, tick in gpio_edges[18]]
+        # 受信モジュールは待機中High。13バイトずつ読み、レポートの途中で分割されるようにする
+        idle = (1 << 17) | (1 << 18)
+        dispatcher = capture.ReportDispatcher(chunked_reader(to_reports(gpio_edges, idle), 13))
+        sessions = dict((gpio, capture.CaptureSession(helpers.WatchdogPiMock(), gpio, 0, clustering.normalise)) for gpio in frames)
+        for session in sessions.values():
+            dispatcher.add(session, idle)
+        for gpio, session in sessions.items():
+            session.join(5)
+            expected = list(frames[gpio])
+            clustering.normalise(expected)
+            assert session.code == expected, gpio
@@ -0,0 +1,100 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import unittest
+import clustering
+from test import helpers
+
+test_signal = [8970, 4475, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 39710, 8970, 2265, 586]
+docstring_signal = [9000, 4500, 600, 540, 620, 560, 590, 1660, 620, 1690, 615]
+
+
+class TestNormalise(unittest.TestCase):
+
+    def assert_same_as_pairwise(self, c):
+        expected = list(c)
+        clustering.normalise_pairwise(expected)
+        actual = list(c)
+        clustering.normalise(actual)
+        assert actual == expected
+
+    def test_fixtures(self):
+        self.assert_same_as_pairwise(test_signal)
+        self.assert_same_as_pairwise(docstring_signal)
+
+    def test_docstring_example(self):
+        c = list(docstring_signal)
+        clustering.normalise(c)
+        assert c == [9000, 4500, 609, 550, 609, 550, 609, 1675, 609, 1675, 609]
+
+    def test_jittered_frames(self):
+        for entries in (11, 100, 1000):
+            self.assert_same_as_pairwise(helpers.jittered_frame(entries, entries))
+
+    def test_python_fallback(self):
+        c = helpers.jittered_frame(1000, 0)
+        expected = list(c)
+        clustering.normalise_pairwise(expected)
+        clustering._normalise_python(c, clustering._toler_min(clustering.TOLERANCE), clustering._toler_max(clustering.TOLERANCE))
+        assert c == expected
+
+    def test_high_jitter_is_grouped_around_first_pulse(self):
+        # 最初のパルス600を基準に、540と680のどちらも600の±15%に入るので1つのクラスタになる
+        # (ソートして最短の540を基準にすると680は入らない)
+        c = [100, 600, 100, 540, 100, 680]
+        clustering.normalise(c)
+        assert c == [100, 606.67, 100, 606.67, 100, 606.67]
+        # 基準からの範囲だけで決め、範囲に入ったパルスからは連鎖しない
+        c = [100, 500, 100, 560, 100, 630]
+        clustering.normalise(c)
+        assert c == [100, 530, 100, 530, 100, 630]
+        for seed in range(200):
+            for entries in (67, 300):
+                self.assert_same_as_pairwise(helpers.jittered_frame(entries, seed, jitter=0.2))
+
+    def test_records_are_clustered_together(self):
+        records = [helpers.jittered_frame(67, seed) for seed in (1, 1, 1)]
+        records[1] = [int(x * 1.02) for x in records[1]]
+        records[2] = [int(x * 0.98) for x in records[2]]
+        clustering.normalise_records(records)
+        assert records[0] == records[1] == records[2]
+        # ヘッダのマークは3回分の平均になる
+        header = helpers.jittered_frame(67, 1)[0]
+        assert records[0][0] == round((header + int(header * 1.02) + int(header * 0.98)) / 3.0, 2)
+
+    def test_records_numpy_and_python(self):
+        records = [helpers.jittered_frame(301, seed) for seed in range(3)]
+        expected = [list(c) for c in records]
+        numpy_min_entries = clustering.NUMPY_MIN_ENTRIES
+        clustering.NUMPY_MIN_ENTRIES = float('inf')
+        try:
+            clustering.normalise_records(expected)
+        finally:
+            clustering.NUMPY_MIN_ENTRIES = numpy_min_entries
+        clustering.normalise_records(records)
+        assert records == expected
+
+    def test_empty(self):
+        c = []
+        clustering.normalise(c)
+        assert c == []
@@ -0,0 +1,73 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import edge_trace
+import fake_pigpio
+
+test_signal = [8970, 4475, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 39710, 8970, 2265, 586]
+
+
+class TestEdgeTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        # tickの折り返しを跨ぐ
+        trace = edge_trace.from_frames([test_signal, test_signal[:3]], 17, start_tick=0xFFF00000)
+        path = os.path.join(self.directory, 'ac.trace')
+        edge_trace.save(path, trace)
+        assert os.path.getsize(path) == edge_trace.HEADER.size + len(trace) * edge_trace.EDGE.size
+        loaded = edge_trace.load(path)
+        assert loaded.start_tick == trace.start_tick
+        assert loaded.edges == trace.edges
+        assert loaded.gpios == [17]
+
+        ticks = [tick for tick, gpio, level in edge_trace.unwrap(loaded)]
+        assert ticks == sorted(ticks)
+        assert ticks[0] == 0xFFF00000 + 1000 * 1000
+        assert ticks[len(test_signal)] - ticks[0] == sum(test_signal)
+
+    def test_invalid_files(self):
+        data = edge_trace.dumps(edge_trace.from_frames([test_signal], 17))
+        for broken in (data[:10], b'XXXX' + data[4:], data[:-1]):
+            with self.assertRaises(ValueError):
+                edge_trace.loads(broken)
+
+    def test_recorder(self):
+        trace = edge_trace.from_frames([test_signal, test_signal], 17, gap_us=200 * 1000)
+        pi = fake_pigpio.pi(trace=trace, speed=0)
+        recorder = edge_trace.TraceRecorder(pi, [17])
+        recorder.start()
+        assert pi.replayed.wait(5)
+        recorded = recorder.stop()
+        pi.stop()
+        assert recorded.start_tick == trace.start_tick
+        assert recorded.edges == trace.edges
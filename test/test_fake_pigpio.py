@@ -0,0 +1,110 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import unittest
+import capture
+import edge_trace
+import fake_pigpio
+import raspberry_pi_boundary
+
+REPORTS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'ac_cool27.reports')
+test_code = {'protocol': 'nec', 'address': 0, 'command': 1, 'bits': 32, 'repeat': 1}
+
+
+"""
+test/data/ac_cool27.reportsのGPIO17のエッジを、記録開始から約1秒後に始まるトレースにする
+"""
+def recorded_trace():
+    with open(REPORTS_PATH, 'rb') as f:
+        data = f.read()
+    start_tick = capture.REPORT.unpack_from(data)[2]
+    edges = [(17, level, tick) for level, tick in capture.ReportDecoder(17, 1 << 17).decode(data) if level != capture.TIMEOUT]
+    return edge_trace.Trace((start_tick - 1000 * 1000) & 0xFFFFFFFF, edges)
+
+
+class TestPerturb(unittest.TestCase):
+
+    def test_same_seed_same_trace(self):
+        trace = recorded_trace()
+        options = {'jitter_us': 20, 'glitch_rate': 0.1, 'drop_rate': 0.05, 'seed': 3}
+        assert fake_pigpio.perturb(trace, **options).edges == fake_pigpio.perturb(trace, **options).edges
+        assert fake_pigpio.perturb(trace, **options).edges != trace.edges
+
+    def test_jitter_and_drop(self):
+        trace = recorded_trace()
+        original = edge_trace.unwrap(trace)
+        jittered = edge_trace.unwrap(fake_pigpio.perturb(trace, jitter_us=20, seed=1))
+        assert len(jittered) == len(original)
+        assert all(abs(a[0] - b[0]) <= 20 for a, b in zip(original, jittered))
+        dropped = fake_pigpio.perturb(trace, drop_rate=0.5, seed=1)
+        assert 0 < len(dropped) < len(trace)
+
+    def test_glitch_filter_removes_injected_glitches(self):
+        trace = recorded_trace()
+        glitched = fake_pigpio.perturb(trace, glitch_rate=1.0, seed=2)
+        assert len(glitched) > len(trace)
+        filtered = fake_pigpio.glitch_filter(edge_trace.unwrap(glitched), {17: raspberry_pi_boundary.GLITCH})
+        assert filtered == edge_trace.unwrap(trace)
+        assert fake_pigpio.glitch_filter(edge_trace.unwrap(glitched), {}) == edge_trace.unwrap(glitched)
+
+
+class TestFakePigpio(unittest.TestCase):
+
+    def capture(self, pi, glitch=raspberry_pi_boundary.GLITCH):
+        boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(lambda: pi))
+        pi.set_glitch_filter(17, glitch)
+        records = []
+        boundary.start_capturing_remote_signal(lambda record, cancelled: records.append((record, cancelled)))
+        boundary.close()
+        assert not pi.connected
+        record, cancelled = records[0]
+        assert not cancelled
+        return boundary.decode_remote_signal(record)
+
+    def test_replays_recorded_signal(self):
+        assert self.capture(fake_pigpio.pi(trace=recorded_trace(), speed=0)) == test_code
+
+    def test_replays_in_real_time_with_watchdog(self):
+        # 最後のフレームはウォッチドッグのタイムアウトで終わる
+        assert self.capture(fake_pigpio.pi(trace=recorded_trace(), speed=10)) == test_code
+
+    def test_noisy_capture(self):
+        noisy = {'jitter_us': 40, 'glitch_rate': 0.3, 'seed': 5}
+        assert self.capture(fake_pigpio.pi(trace=recorded_trace(), speed=0, **noisy)) == test_code
+        # グリッチフィルタが無ければ認識できない
+        assert self.capture(fake_pigpio.pi(trace=recorded_trace(), speed=0, **noisy), glitch=0) is None
+
+    def test_install(self):
+        trace = recorded_trace()
+        module = fake_pigpio.install(trace=trace, speed=0)
+        try:
+            import pigpio
+            assert pigpio is fake_pigpio
+            pi = pigpio.pi()
+            assert pi.trace is trace
+            assert pi.get_current_tick() == trace.start_tick
+        finally:
+            del fake_pigpio.sys.modules['pigpio']
+            fake_pigpio._defaults.clear()
+        assert module is fake_pigpio
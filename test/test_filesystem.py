@@ -0,0 +1,196 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import unittest
+from unittest import mock
+import filesystem
+import ir_file
+
+SOURCE_PATH = os.path.dirname(os.path.abspath(filesystem.__file__))
+old_signal = {'0': [9000, 4500, 560, 560, 560, 1690, 560]}
+REPEAT = 20000
+new_signal = {'0': [4500, 4500] + [560, 1690] * REPEAT}
+
+
+"""
+別プロセスで信号ファイルを保存し、保存の途中でSIGKILLする
+kill_at_fsyncがTrueの場合は一時ファイルを書き終えてfsyncしたところで自分を止める
+"""
+def run_writer(path, kill_at_fsync):
+    script = textwrap.dedent('''
+        import os, signal, sys
+        sys.path.insert(0, {source!r})
+        import filesystem
+        if {kill_at_fsync!r}:
+            os.fsync = lambda fd: os.kill(os.getpid(), signal.SIGKILL)
+        fs = filesystem.Filesystem('full')
+        sys.stdout.write('ready\\n')
+        sys.stdout.flush()
+        while True:
+            fs.save_temp_file({path!r}, {{'0': [4500, 4500] + [560, 1690] * {repeat!r}}})
+    ''').format(source=SOURCE_PATH, kill_at_fsync=kill_at_fsync, path=path, repeat=REPEAT)
+    return subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE)
+
+
+class TestFilesystem(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fs = filesystem.Filesystem('full')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def assert_no_temp_files(self):
+        assert [x for x in os.listdir(self.directory) if x.endswith(filesystem.TEMP_SUFFIX)] == []
+
+    def load(self, name):
+        with ir_file.load(self.path(name)) as f:
+            return f.to_dict()
+
+    def test_save_replaces_file(self):
+        self.fs.save_temp_file(self.path('tmp.ir'), old_signal)
+        self.fs.save_temp_file(self.path('tmp.ir'), new_signal)
+        assert self.load('tmp.ir') == new_signal
+        self.assert_no_temp_files()
+        assert self.fs.directory_fsync_count == 2
+
+    def test_failed_write_leaves_old_file(self):
+        self.fs.save_temp_file(self.path('tmp.ir'), old_signal)
+        with mock.patch('os.fsync', side_effect=OSError('disk error')):
+            with self.assertRaises(OSError):
+                self.fs.save_temp_file(self.path('tmp.ir'), new_signal)
+        assert self.load('tmp.ir') == old_signal
+        self.assert_no_temp_files()
+
+    def test_rename_and_delete(self):
+        self.fs.save_temp_file(self.path('tmp.ir'), old_signal)
+        timestamp = self.fs.rename_tmp_file(self.path('tmp.ir'), self.path('0.ir'))
+        assert timestamp == os.path.getmtime(self.path('0.ir'))
+        assert not os.path.exists(self.path('tmp.ir'))
+        self.fs.delete_file(self.path('0.ir'))
+        self.fs.delete_file(self.path('0.ir'))
+        assert os.listdir(self.directory) == []
+        assert self.fs.directory_fsync_count == 3
+
+    def test_save_content_shares_file(self):
+        data = filesystem.encode_signals(old_signal)
+        name, timestamp = self.fs.save_content(self.directory, data)
+        assert name == filesystem.content_name(data)
+        assert self.load(name) == old_signal
+        # 同じ内容は書き込まずに同じファイルを返す
+        with mock.patch('os.fsync') as fsync:
+            assert self.fs.save_content(self.directory, data) == (name, timestamp)
+        fsync.assert_not_called()
+        other, _ = self.fs.save_content(self.directory, filesystem.encode_signals(new_signal))
+        assert other != name
+        assert sorted(os.listdir(self.directory)) == sorted([name, other])
+
+    def test_move_content(self):
+        self.fs.save_temp_file(self.path('spill1.ir'), old_signal)
+        self.fs.save_temp_file(self.path('spill2.ir'), old_signal)
+        name, _ = self.fs.move_content(self.directory, self.path('spill1.ir'))
+        assert self.fs.move_content(self.directory, self.path('spill2.ir'))[0] == name
+        assert os.listdir(self.directory) == [name]
+        assert self.load(name) == old_signal
+
+    def test_none_mode_does_not_fsync(self):
+        fs = filesystem.Filesystem('none')
+        with mock.patch('os.fsync') as fsync:
+            fs.save_temp_file(self.path('tmp.ir'), old_signal)
+        fsync.assert_not_called()
+        assert fs.directory_fsync_count == 0
+        assert self.load('tmp.ir') == old_signal
+
+    def test_group_commit(self):
+        """
+        ディレクトリのfsync中に来た保存は次の1回のfsyncにまとめられる
+        """
+        syncing = threading.Event()
+        release = threading.Event()
+
+        def slow_fsync(directory):
+            syncing.set()
+            release.wait(5)
+
+        fs = filesystem.Filesystem('group', 0)
+        with mock.patch('filesystem._fsync_directory', side_effect=slow_fsync):
+            first = threading.Thread(target=fs.save_temp_file, args=(self.path('a.ir'), old_signal))
+            first.start()
+            syncing.wait(5)
+            others = [threading.Thread(target=fs.save_temp_file, args=(self.path('{0}.ir'.format(i)), old_signal))
+                      for i in range(8)]
+            for thread in others:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in [first] + others:
+                thread.join(5)
+        assert fs.directory_fsync_count == 2
+        assert len(os.listdir(self.directory)) == 9
+
+    def test_remove_stale_temp_files(self):
+        self.fs.save_temp_file(self.path('tmp.ir'), old_signal)
+        with open(self.path('.tmp.ir.abc.partial'), 'wb') as f:
+            f.write(b'IRSF')
+        assert self.fs.remove_stale_temp_files(self.directory) == ['.tmp.ir.abc.partial']
+        assert os.listdir(self.directory) == ['tmp.ir']
+
+    def test_writer_killed_before_replace(self):
+        self.fs.save_temp_file(self.path('tmp.ir'), old_signal)
+        writer = run_writer(self.path('tmp.ir'), True)
+        assert writer.wait(10) == -signal.SIGKILL
+        writer.stdout.close()
+        assert self.load('tmp.ir') == old_signal
+        assert self.fs.remove_stale_temp_files(self.directory) != []
+        assert os.listdir(self.directory) == ['tmp.ir']
+
+    def test_writer_killed_at_random_points(self):
+        self.fs.save_temp_file(self.path('tmp.ir'), old_signal)
+        for delay in (0.0, 0.01, 0.03, 0.07):
+            writer = run_writer(self.path('tmp.ir'), False)
+            writer.stdout.readline()
+            time.sleep(delay)
+            writer.kill()
+            writer.wait(10)
+            writer.stdout.close()
+            # 古い信号か新しい信号のどちらかが完全に残っている
+            assert self.load('tmp.ir') in (old_signal, new_signal)
+            self.fs.remove_stale_temp_files(self.directory)
+            assert os.listdir(self.directory) == ['tmp.ir']
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import unittest
+import fingerprint
+import protocols
+from test import helpers
+
+nec = protocols.NecDecoder()
+sirc = protocols.SircDecoder()
+
+
+def nec_signal(command, repeat=0):
+    return nec.encode({'protocol': 'nec', 'address': 0x04, 'command': command, 'bits': 32, 'repeat': repeat})
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.index = fingerprint.FingerprintIndex()
+        for command in range(16):
+            self.index.add(command, nec_signal(command))
+        self.index.add('sirc', sirc.encode({'protocol': 'sirc', 'address': 1, 'command': 0x15, 'bits': 12, 'repeat': 2}))
+
+    def test_identify_jittered_capture(self):
+        for command in range(16):
+            for seed in range(5):
+                with self.subTest(command=command, seed=seed):
+                    assert self.index.identify(helpers.jittered(nec_signal(command), 0.08, seed)) == command
+
+    def test_repeat_count_is_ignored(self):
+        assert self.index.identify(nec_signal(3, repeat=4)) == 3
+
+    def test_unknown_signal(self):
+        assert self.index.identify(nec_signal(100)) is None
+        assert self.index.identify([]) is None
+        # 形は同じでもパルス長が違う
+        assert self.index.identify([x * 2 for x in nec_signal(3)]) is None
+
+    def test_header_on_bucket_boundary(self):
+        pulses = nec_signal(5)
+        ratio = fingerprint.BUCKET_RATIO
+        for scale in (1 / ratio, ratio, 0.97, 1.03):
+            with self.subTest(scale=scale):
+                assert self.index.identify([int(x * scale) for x in pulses]) == 5
+
+    def test_add_replaces_and_remove(self):
+        assert len(self.index) == 17
+        self.index.add(0, nec_signal(100))
+        assert len(self.index) == 17
+        assert self.index.identify(nec_signal(0)) is None
+        assert self.index.identify(nec_signal(100)) == 0
+        self.index.remove(0)
+        self.index.remove(0)
+        assert self.index.identify(nec_signal(100)) is None
+        assert len(self.index) == 16
+        self.index.clear()
+        assert len(self.index) == 0
+        assert self.index.identify(nec_signal(1)) is None
+
+    def test_record_pulses(self):
+        assert fingerprint.record_pulses({}) == []
+        assert fingerprint.record_pulses({'1': [2], '0': [1]}) == [1]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import filesystem
+import ir_file
+
+test_signal = {"ac:cool27": [8970, 4475, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 39710, 8970, 2265, 586]}
+
+
+class TestIrFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_round_trip(self):
+        with ir_file.decode(ir_file.encode(test_signal)) as f:
+            assert f.carrier_hz == ir_file.CARRIER_HZ
+            assert f.version == ir_file.FORMAT_VERSION
+            assert f.to_dict() == test_signal
+            assert isinstance(f.records['ac:cool27'], memoryview)
+
+    def test_normalised_values_are_rounded(self):
+        with ir_file.decode(ir_file.encode({'0': [9000.0, 4500.0, 609.33, 550.67]})) as f:
+            assert f.pulses('0') == [9000, 4500, 609, 551]
+
+    def test_width_and_quantum(self):
+        signals = {'short': [100, 200], 'long': [70000, 5, 10]}
+        data = ir_file.encode(signals, carrier_hz=40000, quantum_us=5)
+        with ir_file.decode(data) as f:
+            assert f.carrier_hz == 40000
+            assert f.records['short'].itemsize == 2
+            assert list(f.records['short']) == [20, 40]
+            assert f.to_dict() == signals
+        with ir_file.decode(ir_file.encode({'long': [70000]})) as f:
+            assert f.records['long'].itemsize == 4
+            assert f.pulses('long') == [70000]
+
+    def test_records_are_aligned(self):
+        data = ir_file.encode({'a': [1, 2, 3], 'bcdef': [4]})
+        assert len(data) % ir_file.ALIGN == 0
+        with ir_file.decode(data) as f:
+            assert f.to_dict() == {'a': [1, 2, 3], 'bcdef': [4]}
+
+    def test_invalid_files(self):
+        data = ir_file.encode(test_signal)
+        with self.assertRaises(ValueError):
+            ir_file.decode(b'XXXX' + data[4:])
+        with self.assertRaises(ValueError):
+            ir_file.decode(data[:4] + bytes([ir_file.FORMAT_VERSION + 1]) + data[5:])
+        with self.assertRaises(ValueError):
+            ir_file.decode(data[:-8])
+        with self.assertRaises(ValueError):
+            ir_file.decode(data[:8])
+
+    def test_truncated_record(self):
+        data = ir_file.encode(test_signal)
+        # レコードのヘッダーの途中、名前の途中で切れたファイル
+        for end in (ir_file.HEADER.size + 3, ir_file.HEADER.size + ir_file.RECORD.size + 2):
+            with self.assertRaisesRegex(ValueError, 'Truncated ir file record'):
+                ir_file.loads(data[:end])
+
+    def test_load_binary_with_mmap(self):
+        with open(self.path('0.ir'), 'wb') as f:
+            f.write(ir_file.encode(test_signal))
+        f = ir_file.load(self.path('0.ir'))
+        assert f.to_dict() == test_signal
+        f.close()
+        with self.assertRaises(ValueError):
+            f.records['ac:cool27'][0]
+
+    def test_load_json(self):
+        with open(self.path('0.ir'), 'w') as f:
+            f.write(json.dumps(test_signal))
+        with ir_file.load(self.path('0.ir')) as f:
+            assert f.carrier_hz is None
+            assert f.to_dict() == test_signal
+
+    def test_filesystem_formats(self):
+        fs = filesystem.Filesystem()
+        fs.save_temp_file(self.path('tmp.ir'), test_signal)
+        with open(self.path('tmp.ir'), 'rb') as f:
+            assert f.read(4) == ir_file.MAGIC
+        with fs.load_signal_file(self.path('tmp.ir')) as f:
+            assert f.to_dict() == test_signal
+        with mock.patch('config.SIGNAL_FILE_FORMAT', 'json'):
+            fs.save_temp_file(self.path('tmp.ir'), test_signal)
+        assert json.loads(fs.get_file(self.path('tmp.ir'))) == test_signal
+        with fs.load_signal_file(self.path('tmp.ir')) as f:
+            assert f.to_dict() == test_signal
+
+
+if __name__ == "__main__":
+    unittest.main()
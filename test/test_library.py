@@ -0,0 +1,207 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from unittest import mock
+import filesystem
+import library
+from test import helpers
+
+
+def signal_data(i):
+    return filesystem.encode_signals({'0': [9000, 4500, 560, 560 + i]})
+
+
+"""
+AsyncRedisBoundaryのモック。import_ir_signalsには非同期のiterableが渡る
+"""
+class AsyncRedisBoundaryMock(helpers.SignalsMock):
+    async def scan_ir_signals(self, cursor=-1, count=100):
+        return super().scan_ir_signals(cursor, count)
+
+    async def import_ir_signals(self, signals):
+        return super().import_ir_signals([signal async for signal in signals])
+
+
+class TestLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        self.archive = os.path.join(tempfile.mkdtemp(), 'library.tar.gz')
+        self.fs = filesystem.Filesystem('none')
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.target)
+        shutil.rmtree(os.path.dirname(self.archive))
+
+    def signal(self, i, data, file_name=None):
+        if file_name is None:
+            file_name, timestamp = self.fs.save_content(self.source, data)
+        else:
+            timestamp = self.fs.write_file_atomically(os.path.join(self.source, file_name), data)
+        return {'id': i, 'name': 'signal{0}'.format(i), 'sleep': i * 10, 'filePath': file_name, 'fileTimeStamp': timestamp,
+                'code': {'protocol': 'nec', 'address': 0, 'command': i, 'bits': 32, 'repeat': 1}}
+
+    def test_round_trip(self):
+        shared = signal_data(0)
+        signals = [self.signal(3, shared), self.signal(5, shared), self.signal(8, signal_data(1)),
+                   # 以前の<id>.irの名前のファイルは内容の名前で書き出す
+                   self.signal(9, signal_data(2), '9.ir'),
+                   dict(self.signal(10, signal_data(3)), filePath=None, fileTimeStamp=None),
+                   dict(self.signal(11, signal_data(4)), filePath='missing.ir')]
+        source = helpers.SignalsMock(signals)
+        assert library.export_library(source, self.source, self.archive) == 6
+        with tarfile.open(self.archive) as tar:
+            names = tar.getnames()
+        assert names[0] == library.MANIFEST
+        # ファイルは同じ内容を1つだけ、全て信号より前に入れる
+        files = [x for x in names if x.startswith(library.FILES)]
+        assert len(files) == 3
+        assert max(names.index(x) for x in files) < min(names.index(x) for x in names if x.startswith(library.SIGNALS))
+
+        target = helpers.SignalsMock([{'id': 0, 'name': 'existing', 'sleep': 0, 'filePath': None, 'fileTimeStamp': None, 'code': None}])
+        with mock.patch.object(self.fs, 'sync_directory') as sync_directory:
+            assert library.import_library(target, self.fs, self.target, self.archive) == 6
+        sync_directory.assert_called_once_with(self.target)
+        imported = [target.signals[x] for x in sorted(target.signals)][1:]
+        assert [x['name'] for x in imported] == [x['name'] for x in signals]
+        assert [x['code'] for x in imported] == [x['code'] for x in signals]
+        assert imported[0]['filePath'] == imported[1]['filePath'] == filesystem.content_name(shared)
+        assert imported[3]['filePath'] == filesystem.content_name(signal_data(2))
+        assert imported[4]['filePath'] is None and imported[5]['filePath'] is None
+        assert sorted(os.listdir(self.target)) == sorted(x['filePath'] for x in imported[1:4])
+        for signal in imported[:4]:
+            path = os.path.join(self.target, signal['filePath'])
+            assert signal['fileTimeStamp'] == os.path.getmtime(path)
+            with open(path, 'rb') as f:
+                assert filesystem.content_name(f.read()) == signal['filePath']
+
+    def test_async_round_trip_writes_files_off_the_loop(self):
+        signals = [self.signal(i, signal_data(i)) for i in range(3)]
+        target = AsyncRedisBoundaryMock()
+        loop_threads = set()
+        save_content = self.fs.save_content
+
+        def save_content_in_thread(*args, **kwargs):
+            loop_threads.add(threading.current_thread())
+            return save_content(*args, **kwargs)
+
+        async def round_trip():
+            loop_threads.clear()
+            assert await library.export_library_async(AsyncRedisBoundaryMock(signals), self.source, self.archive) == 3
+            with mock.patch.object(self.fs, 'save_content', save_content_in_thread):
+                count = await library.import_library_async(target, self.fs, self.target, self.archive)
+            return count, threading.current_thread()
+
+        count, loop_thread = asyncio.run(round_trip())
+        assert count == 3
+        assert [x['name'] for x in target.signals.values()] == [x['name'] for x in signals]
+        assert sorted(os.listdir(self.target)) == sorted(x['filePath'] for x in signals)
+        assert loop_threads and loop_thread not in loop_threads
+
+    def test_import_locks_per_file(self):
+        signals = [self.signal(i, signal_data(i)) for i in range(3)]
+        library.export_library(helpers.SignalsMock(signals), self.source, self.archive)
+        lock = threading.Lock()
+        pinned = set()
+        save_content = self.fs.save_content
+        target = helpers.SignalsMock()
+        import_ir_signals = target.import_ir_signals
+
+        def save_content_locked(*args, **kwargs):
+            assert lock.locked()
+            return save_content(*args, **kwargs)
+
+        def import_unlocked(signals):
+            # 信号の追加の間はロックを持たないので、他の保存・削除を待たせない
+            signals = list(signals)
+            assert not lock.locked()
+            return import_ir_signals(signals)
+
+        target.import_ir_signals = import_unlocked
+        with mock.patch.object(self.fs, 'save_content', save_content_locked):
+            assert library.import_library(target, self.fs, self.target, self.archive, lock, pinned) == 3
+        assert pinned == set(x['filePath'] for x in signals)
+
+    def test_export_skips_file_deleted_while_exporting(self):
+        signals = [self.signal(i, signal_data(i)) for i in range(3)]
+        deleted = os.path.join(self.source, signals[1]['filePath'])
+        os.remove(deleted)
+        # 存在を確かめた後、読む前に消えた
+        with mock.patch.object(library.os.path, 'exists', return_value=True):
+            assert library.export_library(helpers.SignalsMock(signals), self.source, self.archive) == 3
+        with tarfile.open(self.archive) as tar:
+            files = [x for x in tar.getnames() if x.startswith(library.FILES)]
+        assert sorted(files) == sorted(library.FILES + x['filePath'] for x in (signals[0], signals[2]))
+        target = helpers.SignalsMock()
+        library.import_library(target, self.fs, self.target, self.archive)
+        assert [x['filePath'] for x in target.signals.values()] == [signals[0]['filePath'], None, signals[2]['filePath']]
+
+    def test_corrupted_file_is_rejected(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w|gz') as tar:
+            for name, data in ((library.MANIFEST, b'{"format": 1}'), (library.FILES + filesystem.content_name(b'a'), b'b')):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        buffer.seek(0)
+        with self.assertRaises(ValueError):
+            list(library.imported_signals(library.read_library(buffer), self.fs, self.target))
+        assert os.listdir(self.target) == []
+
+    def test_failed_export_keeps_previous_archive(self):
+        source = helpers.SignalsMock([self.signal(0, signal_data(0))])
+        library.export_library(source, self.source, self.archive)
+        with open(self.archive, 'rb') as f:
+            previous = f.read()
+        with mock.patch.object(source, 'scan_ir_signals', side_effect=OSError('redis is down')):
+            with self.assertRaises(OSError):
+                library.export_library(source, self.source, self.archive)
+        with open(self.archive, 'rb') as f:
+            assert f.read() == previous
+        assert os.listdir(os.path.dirname(self.archive)) == ['library.tar.gz']
+
+    def test_memory_does_not_grow_with_library_size(self):
+        peaks = []
+        for size in (50, 500):
+            source = helpers.SignalsMock([self.signal(i, signal_data(i)) for i in range(size)])
+            tracemalloc.start()
+            library.export_library(source, self.source, self.archive)
+            # 読み込んだ信号は数えるだけにする
+            target = mock.Mock(import_ir_signals=lambda signals: sum(1 for _ in signals))
+            count = library.import_library(target, self.fs, self.target, self.archive)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            assert count == size
+        # 増えるのは書き出したファイルのハッシュの分だけ
+        assert peaks[1] < peaks[0] * 2
@@ -0,0 +1,133 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import filesystem
+import maintenance
+from test import helpers
+
+test_data = filesystem.encode_signals({'0': [8970, 4475, 586, 544, 586, 1669, 586]})
+test_file_name = filesystem.content_name(test_data)
+OLD = time.time() - 3600
+
+
+class TestConsistencyScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fs = filesystem.Filesystem('none')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def write(self, name, data=test_data, mtime=OLD):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+        os.utime(self.path(name), (mtime, mtime))
+
+    def scanner(self, signals, **options):
+        self.redis_boundary = helpers.SignalsMock(signals)
+        options.setdefault('grace_s', 60)
+        return maintenance.ConsistencyScanner(self.redis_boundary, self.fs, self.directory, batch_size=2, pause_s=0,
+                                              **options)
+
+    def test_consistent_library_is_not_changed(self):
+        self.write(test_file_name)
+        signals = [{'id': i, 'name': 'tv', 'sleep': 0, 'filePath': test_file_name, 'fileTimeStamp': OLD} for i in range(5)]
+        stats = self.scanner(signals).run_cycle()
+        assert stats == {'signals': 5, 'files': 1}
+        assert list(self.redis_boundary.signals.values()) == signals
+
+    def test_repairs_signals(self):
+        self.write(test_file_name)
+        self.write('3.ir', b'{"0": [1, 2]}')
+        stats = self.scanner([
+            # 以前の__update_current_irが保存した1要素のリスト
+            {'id': 1, 'name': 'tv', 'sleep': 0, 'filePath': ['3.ir'], 'fileTimeStamp': OLD},
+            {'id': 2, 'name': 'ac', 'sleep': 0, 'filePath': test_file_name, 'fileTimeStamp': OLD - 10},
+            {'id': 4, 'name': 'light', 'sleep': 0, 'filePath': 'missing.ir', 'fileTimeStamp': OLD},
+            {'id': 5, 'name': 'fan', 'sleep': 0, 'filePath': None, 'fileTimeStamp': None},
+        ]).run_cycle()
+        assert stats['paths'] == 1 and stats['timestamps'] == 1 and stats['dangling'] == 1
+        signals = self.redis_boundary.signals
+        assert signals[1]['filePath'] == '3.ir'
+        assert signals[2]['fileTimeStamp'] == os.path.getmtime(self.path(test_file_name))
+        assert signals[4]['filePath'] is None and signals[4]['fileTimeStamp'] is None
+        assert signals[5]['filePath'] is None
+        assert sorted(os.listdir(self.directory)) == sorted(['3.ir', test_file_name])
+
+    def test_quarantines_orphans_and_removes_stale_temp_files(self):
+        self.write(test_file_name)
+        self.write('orphan.ir')
+        self.write('tmp.ir')
+        self.write('.1.ir.abc.partial')
+        # 新しいファイルは書き込み中かもしれないので触らない
+        self.write('.2.ir.def.partial', mtime=time.time())
+        self.write('new.ir', mtime=time.time())
+        self.write('session-abc.ir')
+        self.write('notes.txt')
+        scanner = self.scanner([{'id': 0, 'name': 'tv', 'sleep': 0, 'filePath': test_file_name, 'fileTimeStamp': OLD}])
+        stats = scanner.run_cycle()
+        assert stats['temp'] == 2 and stats['quarantined'] == 1
+        assert sorted(os.listdir(self.directory)) == sorted(
+            [test_file_name, '.2.ir.def.partial', 'new.ir', 'session-abc.ir', 'notes.txt', maintenance.QUARANTINE_DIR])
+        assert os.listdir(self.path(maintenance.QUARANTINE_DIR)) == ['orphan.ir']
+
+        # quarantineに移したファイルを参照する信号があれば戻す
+        self.redis_boundary.signals[1] = {'id': 1, 'name': 'ac', 'sleep': 0, 'filePath': 'orphan.ir', 'fileTimeStamp': OLD}
+        stats = scanner.run_cycle()
+        assert stats['restored'] == 1
+        assert os.path.exists(self.path('orphan.ir'))
+        assert self.redis_boundary.signals[1]['filePath'] == 'orphan.ir'
+
+    def test_purges_quarantine(self):
+        self.write('orphan.ir')
+        scanner = self.scanner([], quarantine_ttl_s=0)
+        assert scanner.run_cycle()['quarantined'] == 1
+        time.sleep(0.01)
+        assert scanner.run_cycle()['purged'] == 1
+        assert os.listdir(self.path(maintenance.QUARANTINE_DIR)) == []
+
+    def test_waits_while_busy(self):
+        self.write('orphan.ir')
+        busy = threading.Event()
+        busy.set()
+        scanner = self.scanner([], busy=busy.is_set)
+        scanner.start(0.01)
+        time.sleep(0.1)
+        assert os.path.exists(self.path('orphan.ir'))
+        busy.clear()
+        for i in range(500):
+            if not os.path.exists(self.path('orphan.ir')):
+                break
+            time.sleep(0.01)
+        scanner.stop()
+        assert os.listdir(self.path(maintenance.QUARANTINE_DIR)) == ['orphan.ir']
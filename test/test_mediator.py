@@ -0,0 +1,461 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import contextlib
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+import filesystem
+import ir_file
+import mediator
+from test import helpers
+
+test_signal = {'0': [8970, 4475, 586, 544, 586, 1669, 586]}
+test_signal_file = filesystem.encode_signals(test_signal)
+test_file_name = filesystem.content_name(test_signal_file)
+test_code = {'protocol': 'nec', 'address': 0, 'command': 1, 'bits': 32, 'repeat': 0}
+
+
+"""
+Redisの代わりに状態と通知をメモリ上に記録するモック
+"""
+class RedisBoundaryMock(helpers.SignalsMock):
+    def __init__(self):
+        super().__init__()
+        self.state = None
+        self.published = []
+        self.frames = []
+        self.batches = 0
+
+    def subscribe(self):
+        pass
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.batches += 1
+        yield
+
+    def unsubscribe(self):
+        pass
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, new_state):
+        self.state = new_state
+
+    def migrate_ir(self):
+        return False
+
+    def add_monitor_frames(self, entries):
+        self.frames.extend(entries)
+
+    def __getattr__(self, name):
+        # publish_xxx(*args)は(xxx, args)として記録する
+        if not name.startswith('publish_'):
+            raise AttributeError(name)
+        return lambda *args: self.published.append((name[len('publish_'):], args))
+
+
+"""
+release()かstop_capturing_remote_signal()が呼ばれるまでキャプチャが終わらないモック
+キャプチャ毎にrelease()が1回必要
+"""
+class BlockingRespberryPiBoundaryMock:
+    def __init__(self):
+        self.started = threading.Event()
+        self.on_frame = None
+        self.finished = threading.Event()
+        self.__released = threading.Event()
+        self.__cancelled = False
+
+    def start_capturing_remote_signal(self, callback, tidy=True):
+        self.started.set()
+        self.__released.wait(5)
+        self.__released.clear()
+        cancelled, self.__cancelled = self.__cancelled, False
+        callback(test_signal, cancelled)
+        self.finished.set()
+
+    def release(self):
+        self.__released.set()
+
+    def decode_remote_signal(self, record):
+        return test_code
+
+    def merge_remote_signals(self, codes):
+        if any(code != codes[0] for code in codes):
+            return None
+        return dict((str(i), code) for i, code in enumerate(codes))
+
+    def start_monitoring(self, on_frame):
+        self.on_frame = on_frame
+
+    def stop_monitoring(self):
+        self.on_frame = None
+
+    def clean_remote_signal(self, code):
+        return {'0': list(code)}
+
+    def stop_capturing_remote_signal(self):
+        self.__cancelled = True
+        self.__released.set()
+
+    def close(self):
+        pass
+
+
+class TestMediator(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_boundary = RedisBoundaryMock()
+        self.filesystem = helpers.FilesystemMock()
+        self.raspberry_pi = BlockingRespberryPiBoundaryMock()
+        self.mediator = mediator.Mediator()
+        self.mediator.initialize(self.redis_boundary, self.filesystem, self.raspberry_pi)
+        self.mediator.start()
+
+    def tearDown(self):
+        self.mediator.stop()
+
+    def wait_for_publish(self, message):
+        for i in range(500):
+            if message in self.redis_boundary.published:
+                return
+            time.sleep(0.01)
+        self.fail('{0} was not published: {1}'.format(message, self.redis_boundary.published))
+
+    """
+        キャプチャが始まるのを待ってから1回分のキャプチャを終わらせる
+    """
+    def press(self):
+        assert self.raspberry_pi.started.wait(5)
+        self.raspberry_pi.started.clear()
+        self.raspberry_pi.release()
+
+    def start_session(self):
+        self.mediator.on_receive_message({'title': 'start_ir_receiving'})
+        title, (session_id, gpio) = self.redis_boundary.published[-1]
+        assert title == 'started_ir_receiving'
+        assert gpio is None
+        return session_id
+
+    def test_messages_are_handled_during_capture(self):
+        self.redis_boundary.signals = {0: {'id': 0, 'name': 'tv', 'sleep': 0, 'filePath': '0.ir', 'fileTimeStamp': 0.0}}
+        session_id = self.start_session()
+        assert self.raspberry_pi.started.wait(5)
+        assert self.redis_boundary.state == 'receiving'
+        assert self.redis_boundary.batches == 1
+
+        self.mediator.on_receive_message({'title': 'delete_ir_signal', 'id': 0})
+        assert self.redis_boundary.get_ir() == {'signals': []}
+        assert self.redis_boundary.published[-1] == ('deleted_ir_signal', (0,))
+
+        self.raspberry_pi.release()
+        assert self.raspberry_pi.finished.wait(5)
+        assert self.redis_boundary.state == 'ready'
+        assert self.redis_boundary.published[-1] == ('stopped_ir_receiving_valid_signal', (session_id, test_code))
+        assert self.filesystem.files == {}
+        assert self.redis_boundary.batches == 2
+
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200,
+                                          'updatesFile': True, 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('saved_ir_signal', (0,))
+        assert self.filesystem.files == {'/data/' + test_file_name: test_signal_file}
+        assert self.redis_boundary.signals[0]['filePath'] == test_file_name
+        assert self.redis_boundary.signals[0]['code'] == test_code
+
+    def test_concurrent_sessions(self):
+        first = self.start_session()
+        second = self.start_session()
+        assert first != second
+        self.raspberry_pi.release()
+        self.wait_for_publish(('stopped_ir_receiving_valid_signal', (first, test_code)))
+        # 2つ目のセッションのキャプチャ待ち
+        assert self.redis_boundary.state == 'receiving'
+        self.raspberry_pi.release()
+        self.wait_for_publish(('stopped_ir_receiving_valid_signal', (second, test_code)))
+        assert self.redis_boundary.state == 'ready'
+
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200,
+                                          'updatesFile': True, 'session': second})
+        assert self.filesystem.files == {'/data/' + test_file_name: test_signal_file}
+        self.mediator.on_receive_message({'title': 'discard_ir_signal', 'session': first})
+        assert self.redis_boundary.published[-1] == ('discarded_ir_signal', (first,))
+        self.mediator.on_receive_message({'title': 'discard_ir_signal', 'session': first})
+        assert self.redis_boundary.published[-1] == ('ir_signal_discarding_error', ())
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200,
+                                          'updatesFile': True, 'session': first})
+        assert self.redis_boundary.published[-1] == ('ir_signal_saving_error', ())
+
+    def test_same_signal_shares_file(self):
+        for name in ('tv1', 'tv2'):
+            session_id = self.start_session()
+            self.raspberry_pi.release()
+            self.wait_for_publish(('stopped_ir_receiving_valid_signal', (session_id, test_code)))
+            self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': name, 'sleep': 200,
+                                              'updatesFile': True, 'session': session_id})
+        assert self.redis_boundary.signals[0]['filePath'] == self.redis_boundary.signals[1]['filePath'] == test_file_name
+        assert self.filesystem.files == {'/data/' + test_file_name: test_signal_file}
+        # 他の信号が参照している間はファイルを残す
+        self.mediator.on_receive_message({'title': 'delete_ir_signal', 'id': 0})
+        assert self.filesystem.files == {'/data/' + test_file_name: test_signal_file}
+        self.mediator.on_receive_message({'title': 'delete_ir_signal', 'id': 1})
+        assert self.filesystem.files == {}
+
+    def test_save_without_session_uses_latest_capture(self):
+        self.start_session()
+        self.raspberry_pi.release()
+        assert self.raspberry_pi.finished.wait(5)
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200,
+                                          'updatesFile': True})
+        assert self.redis_boundary.published[-1] == ('saved_ir_signal', (0,))
+        assert self.filesystem.files == {'/data/' + test_file_name: test_signal_file}
+
+    def test_save_ir_signal_deleted_while_saving(self):
+        self.redis_boundary.signals[5] = {'id': 5, 'name': 'tv', 'sleep': 0, 'filePath': None, 'fileTimeStamp': None, 'code': None}
+        get_ir_signal = self.redis_boundary.get_ir_signal
+
+        def get_then_delete(ir_signal_id):
+            signal = get_ir_signal(ir_signal_id)
+            self.redis_boundary.delete_ir_signal(ir_signal_id)
+            return signal
+
+        self.redis_boundary.get_ir_signal = get_then_delete
+        session_id = self.start_session()
+        self.raspberry_pi.release()
+        self.wait_for_publish(('stopped_ir_receiving_valid_signal', (session_id, test_code)))
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': 5, 'name': 'tv2', 'sleep': 200,
+                                          'updatesFile': True, 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('saved_ir_signal', (5,))
+        # 削除された信号を作り直さず、書いたファイルも残さず、インデックスにも加えない
+        assert self.redis_boundary.signals == {}
+        assert self.filesystem.files == {}
+        session_id = self.start_session()
+        self.raspberry_pi.release()
+        self.wait_for_publish(('stopped_ir_receiving_valid_signal', (session_id, test_code)))
+        self.mediator.on_receive_message({'title': 'identify_ir_signal', 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('identified_ir_signal', (None, session_id))
+
+    def test_delete_during_import_keeps_imported_file(self):
+        self.redis_boundary.signals[0] = {'id': 0, 'name': 'tv', 'sleep': 0, 'filePath': test_file_name, 'fileTimeStamp': 0.0, 'code': None}
+        self.filesystem.files['/data/' + test_file_name] = test_signal_file
+        self.filesystem.files['/data/unused.ir'] = test_signal_file
+        importing, deleted = threading.Event(), threading.Event()
+
+        def import_library(redis_boundary, fs, folder, path, lock, pinned):
+            # アーカイブのファイルを保存した後、信号を追加する前に他の信号が削除される
+            for name in (test_file_name, 'unused.ir'):
+                with lock:
+                    pinned.add(name)
+            importing.set()
+            assert deleted.wait(5)
+            return redis_boundary.import_ir_signals([{'name': 'tv2', 'sleep': 0, 'filePath': test_file_name,
+                                                      'fileTimeStamp': 0.0, 'code': None}])
+
+        with mock.patch.object(mediator.library, 'import_library', import_library):
+            self.mediator.on_receive_message({'title': 'import_ir_library', 'path': '/tmp/library.tar.gz'})
+            assert importing.wait(5)
+            # 読み込みの間もファイルのロックを待たずに削除できる
+            self.mediator.on_receive_message({'title': 'delete_ir_signal', 'id': 0})
+            assert self.redis_boundary.published[-1] == ('deleted_ir_signal', (0,))
+            assert '/data/' + test_file_name in self.filesystem.files
+            deleted.set()
+            self.wait_for_publish(('imported_ir_library', ('/tmp/library.tar.gz', 1)))
+        # 読み込んだ信号が参照するファイルは残し、参照されないファイルは削除する
+        assert self.filesystem.files == {'/data/' + test_file_name: test_signal_file}
+
+    def test_identify_ir_signal(self):
+        self.start_session()
+        self.raspberry_pi.release()
+        assert self.raspberry_pi.finished.wait(5)
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200,
+                                          'updatesFile': True})
+        session_id = self.start_session()
+        self.raspberry_pi.release()
+        self.wait_for_publish(('stopped_ir_receiving_valid_signal', (session_id, test_code)))
+        self.mediator.on_receive_message({'title': 'identify_ir_signal', 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('identified_ir_signal', (0, session_id))
+        # 調べたセッションはそのまま保存・破棄できる
+        self.mediator.on_receive_message({'title': 'discard_ir_signal', 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('discarded_ir_signal', (session_id,))
+
+        self.mediator.on_receive_message({'title': 'identify_ir_signal', 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('ir_signal_identifying_error', (session_id,))
+
+    def test_identify_after_delete_and_restart(self):
+        self.start_session()
+        self.raspberry_pi.release()
+        assert self.raspberry_pi.finished.wait(5)
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200,
+                                          'updatesFile': True})
+        # 再起動しても保存済みのファイルからインデックスを作る
+        self.mediator.stop()
+        self.raspberry_pi = BlockingRespberryPiBoundaryMock()
+        self.mediator = mediator.Mediator()
+        self.mediator.initialize(self.redis_boundary, self.filesystem, self.raspberry_pi)
+        self.mediator.start()
+        session_id = self.start_session()
+        self.raspberry_pi.release()
+        self.wait_for_publish(('stopped_ir_receiving_valid_signal', (session_id, test_code)))
+        self.mediator.on_receive_message({'title': 'identify_ir_signal', 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('identified_ir_signal', (0, session_id))
+
+        self.mediator.on_receive_message({'title': 'delete_ir_signal', 'id': 0})
+        self.mediator.on_receive_message({'title': 'identify_ir_signal', 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('identified_ir_signal', (None, session_id))
+
+    def test_multi_press_capture(self):
+        self.mediator.on_receive_message({'title': 'start_ir_receiving', 'presses': 3})
+        session_id = self.redis_boundary.published[-1][1][0]
+        self.press()
+        self.wait_for_publish(('stopped_ir_receiving_more_signal', (session_id,)))
+        assert self.redis_boundary.state == 'receiving'
+        self.press()
+        self.press()
+        self.wait_for_publish(('stopped_ir_receiving_valid_signal', (session_id, test_code)))
+        assert self.redis_boundary.published.count(('stopped_ir_receiving_more_signal', (session_id,))) == 2
+        assert self.redis_boundary.state == 'ready'
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200,
+                                          'updatesFile': True, 'session': session_id})
+        with ir_file.loads(self.filesystem.files['/data/' + self.redis_boundary.signals[0]['filePath']]) as f:
+            assert f.to_dict() == {'0': test_signal['0'], '1': test_signal['0'], '2': test_signal['0']}
+
+    def test_multi_press_disagreement(self):
+        self.raspberry_pi.merge_remote_signals = lambda codes: None
+        self.mediator.on_receive_message({'title': 'start_ir_receiving', 'presses': 2})
+        session_id = self.redis_boundary.published[-1][1][0]
+        self.press()
+        self.press()
+        self.wait_for_publish(('stopped_ir_receiving_invalid_signal', (session_id,)))
+        assert self.redis_boundary.state == 'ready'
+        self.mediator.on_receive_message({'title': 'save_ir_signal', 'id': None, 'name': 'tv', 'sleep': 200,
+                                          'updatesFile': True, 'session': session_id})
+        assert self.redis_boundary.published[-1] == ('ir_signal_saving_error', ())
+
+    def test_monitoring(self):
+        self.mediator.on_receive_message({'title': 'start_monitoring'})
+        assert self.redis_boundary.published[-1] == ('started_monitoring', ())
+        on_frame = self.raspberry_pi.on_frame
+        producer = threading.Thread(target=lambda: [on_frame(test_signal['0'], tick) for tick in range(100)])
+        producer.start()
+        producer.join()
+        self.mediator.on_receive_message({'title': 'stop_monitoring'})
+        assert self.redis_boundary.published[-1] == ('stopped_monitoring', ())
+        assert self.raspberry_pi.on_frame is None
+        # 止める前に受信したフレームは全て書き込まれている
+        assert [entry['tick'] for entry in self.redis_boundary.frames] == list(range(100))
+        assert self.redis_boundary.frames[0]['code'] == json.dumps(test_code)
+
+    def test_stop_queued_session(self):
+        first = self.start_session()
+        second = self.start_session()
+        self.mediator.on_receive_message({'title': 'stop_ir_receiving', 'session': second})
+        self.raspberry_pi.release()
+        self.wait_for_publish(('stopped_ir_receiving_stop_message', (second,)))
+        assert ('stopped_ir_receiving_valid_signal', (first, test_code)) in self.redis_boundary.published
+        assert self.redis_boundary.state == 'ready'
+
+    def test_stop_ir_receiving_during_capture(self):
+        self.mediator.on_receive_message({'title': 'start_ir_receiving'})
+        assert self.raspberry_pi.started.wait(5)
+        self.mediator.on_receive_message({'title': 'stop_ir_receiving'})
+        self.mediator.stop()
+        assert self.redis_boundary.state == 'ready'
+        assert self.redis_boundary.published[-1][0] == 'stopped_ir_receiving_stop_message'
+
+    def test_capture_error_returns_to_ready(self):
+        def fail(callback):
+            raise OSError('pigpio connection lost')
+        self.raspberry_pi.start_capturing_remote_signal = fail
+        self.mediator.on_receive_message({'title': 'start_ir_receiving'})
+        self.mediator.stop()
+        assert self.redis_boundary.state == 'ready'
+        assert self.redis_boundary.published[-1][0] == 'stopped_ir_receiving_invalid_signal'
+
+
+class TestMediatorWithReceivers(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_boundary = RedisBoundaryMock()
+        self.receivers = {17: BlockingRespberryPiBoundaryMock(), 18: BlockingRespberryPiBoundaryMock()}
+        self.mediator = mediator.Mediator()
+        self.mediator.initialize(self.redis_boundary, helpers.FilesystemMock(), self.receivers)
+        self.mediator.start()
+
+    def tearDown(self):
+        self.mediator.stop()
+
+    def start_session(self, gpio=None):
+        value = {'title': 'start_ir_receiving'}
+        if gpio is not None:
+            value['gpio'] = gpio
+        self.mediator.on_receive_message(value)
+        title, (session_id, started_gpio) = self.redis_boundary.published[-1]
+        assert title == 'started_ir_receiving'
+        return session_id, started_gpio
+
+    def wait_for_publish(self, message):
+        for i in range(500):
+            if message in self.redis_boundary.published:
+                return
+            time.sleep(0.01)
+        self.fail('{0} was not published: {1}'.format(message, self.redis_boundary.published))
+
+    def test_receivers_capture_concurrently(self):
+        first, gpio = self.start_session()
+        # gpioが無ければ最初の受信機
+        assert gpio == 17
+        second, gpio = self.start_session(18)
+        assert gpio == 18
+        # 17のキャプチャ中でも18のキャプチャは始まる
+        assert self.receivers[17].started.wait(5)
+        assert self.receivers[18].started.wait(5)
+        self.receivers[18].release()
+        self.wait_for_publish(('stopped_ir_receiving_valid_signal', (second, test_code)))
+        assert self.redis_boundary.state == 'receiving'
+        self.mediator.on_receive_message({'title': 'stop_ir_receiving', 'session': first})
+        self.wait_for_publish(('stopped_ir_receiving_stop_message', (first,)))
+        assert self.redis_boundary.state == 'ready'
+
+    def test_unknown_receiver(self):
+        self.mediator.on_receive_message({'title': 'start_ir_receiving', 'gpio': 22})
+        assert self.redis_boundary.published == [('ir_receiver_not_found_error', (22,))]
+        assert self.redis_boundary.state == 'ready'
+        self.mediator.on_receive_message({'title': 'start_monitoring', 'gpio': 22})
+        assert self.redis_boundary.published[-1] == ('ir_receiver_not_found_error', (22,))
+        assert all(receiver.on_frame is None for receiver in self.receivers.values())
+
+    def test_monitoring_tags_frames_with_gpio(self):
+        self.mediator.on_receive_message({'title': 'start_monitoring'})
+        self.receivers[17].on_frame(test_signal['0'], 0)
+        self.receivers[18].on_frame(test_signal['0'], 1)
+        # 1つの受信機だけ止めても書き込みは続ける
+        self.mediator.on_receive_message({'title': 'stop_monitoring', 'gpio': 17})
+        assert self.receivers[17].on_frame is None
+        self.receivers[18].on_frame(test_signal['0'], 2)
+        self.mediator.on_receive_message({'title': 'stop_monitoring'})
+        assert self.receivers[18].on_frame is None
+        assert [(entry['tick'], entry['gpio']) for entry in self.redis_boundary.frames] == [(0, 17), (1, 18), (2, 18)]
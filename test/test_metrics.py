@@ -0,0 +1,191 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+import capture
+import filesystem
+import metrics
+
+
+class Boundary:
+    def get_ir(self):
+        return {'signals': []}
+
+    def batch(self):
+        return 'batch'
+
+    async def get_ir_signal(self, ir_signal_id):
+        return {'id': ir_signal_id}
+
+    async def messages(self):
+        yield 'message'
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry(enabled=True)
+
+    def test_disabled_registry_records_nothing(self):
+        registry = metrics.Registry()
+        registry.inc('count_total')
+        registry.observe('time_seconds', 1.0)
+        with registry.timer('time_seconds') as timer:
+            pass
+        assert timer is registry.timer('other_seconds')
+        assert registry.snapshot() == {}
+
+    def test_snapshot(self):
+        self.registry.inc('frames_total')
+        self.registry.inc('frames_total', 2)
+        self.registry.inc('calls_total', label=('method', 'get_ir'))
+        for value in (0.0001, 0.003, 0.003, 10):
+            self.registry.observe('write_seconds', value)
+        self.registry.add_collector(lambda: {'cache_hit_rate': 0.5, 'cache_hits': None})
+        snapshot = self.registry.snapshot()
+        assert snapshot['frames_total'] == 3
+        assert snapshot['calls_total{method="get_ir"}'] == 1
+        assert snapshot['cache_hit_rate'] == 0.5
+        assert 'cache_hits' not in snapshot
+        # バケットは累積で、上限と同じ値はそのバケットに入る
+        assert snapshot['write_seconds_bucket{le="0.0001"}'] == 1
+        assert snapshot['write_seconds_bucket{le="0.0025"}'] == 1
+        assert snapshot['write_seconds_bucket{le="0.005"}'] == 3
+        assert snapshot['write_seconds_bucket{le="2.5"}'] == 3
+        assert snapshot['write_seconds_bucket{le="+Inf"}'] == 4
+        assert snapshot['write_seconds_count'] == 4
+        assert abs(snapshot['write_seconds_sum'] - 10.0061) < 1e-9
+        self.registry.reset()
+        assert self.registry.snapshot() == {'cache_hit_rate': 0.5}
+
+    def test_prometheus(self):
+        self.registry.inc('cancelled_total')
+        self.registry.observe('rate', 300, label=('gpio', 17), buckets=(250, 500))
+        assert self.registry.prometheus() == '\n'.join([
+            '# TYPE ir_receiver_cancelled_total counter',
+            'ir_receiver_cancelled_total 1',
+            '# TYPE ir_receiver_rate histogram',
+            'ir_receiver_rate_bucket{gpio="17",le="250"} 0',
+            'ir_receiver_rate_bucket{gpio="17",le="500"} 1',
+            'ir_receiver_rate_bucket{gpio="17",le="+Inf"} 1',
+            'ir_receiver_rate_sum{gpio="17"} 300.0',
+            'ir_receiver_rate_count{gpio="17"} 1',
+        ]) + '\n'
+
+    def test_instrument(self):
+        class Instrumented(Boundary):
+            pass
+        for name in ('get_ir', 'batch', 'get_ir_signal', 'messages'):
+            setattr(Instrumented, name, vars(Boundary)[name])
+        metrics.instrument(Instrumented, 'call_seconds', exclude=('batch',), registry=self.registry)
+        boundary = Instrumented()
+        assert boundary.get_ir() == {'signals': []}
+        assert boundary.batch() == 'batch'
+        assert asyncio.run(boundary.get_ir_signal(3)) == {'id': 3}
+
+        async def consume():
+            return [x async for x in boundary.messages()]
+        assert asyncio.run(consume()) == ['message']
+        counts = dict((key, value) for key, value in self.registry.snapshot().items() if '_count{' in key)
+        assert counts == {'call_seconds_count{method="get_ir"}': 1, 'call_seconds_count{method="get_ir_signal"}': 1}
+        # 無効にすると元の関数をそのまま呼ぶ
+        self.registry.enabled = False
+        boundary.get_ir()
+        assert self.registry.snapshot()['call_seconds_count{method="get_ir"}'] == 1
+
+    def test_reporter(self):
+        saved = []
+        self.registry.inc('frames_total')
+        reporter = metrics.Reporter(saved.append, interval_s=0.01, registry=self.registry)
+        reporter.start()
+        reporter.stop()
+        reporter.report()
+        assert saved[-1] == {'frames_total': 1}
+
+    def test_serve(self):
+        self.registry.inc('frames_total')
+        server = metrics.serve(0, '127.0.0.1', registry=self.registry)
+        try:
+            url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+            with urllib.request.urlopen(url + '/metrics') as response:
+                assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+                assert response.read().decode('utf-8') == self.registry.prometheus()
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + '/')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestHotPathMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry(enabled=True)
+        patcher = mock.patch.object(metrics, 'registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def frame(self, session, code, tick):
+        # フレームの前にPRE_USより長く空けて、最後はウォッチドッグのタイムアウトで終わらせる
+        tick += capture.PRE_US + 1
+        session.feed(1, tick)
+        for edge in code:
+            tick += edge
+            session.feed(len(code) % 2, tick)
+        session.feed(capture.TIMEOUT, tick)
+        return tick
+
+    def test_capture(self):
+        normalised = []
+        session = capture.CaptureSession(mock.Mock(), 17, 0, normalised.append)
+        tick = self.frame(session, [500, 500], 0)
+        tick = self.frame(session, [9000, 2250, 560], tick)
+        self.frame(session, [500] * 20, tick)
+        assert len(normalised) == 1
+        snapshot = self.registry.snapshot()
+        assert snapshot['capture_short_codes_total'] == 1
+        assert snapshot['capture_repeat_codes_total'] == 1
+        assert snapshot['capture_edges_total'] == 25
+        assert snapshot['capture_edges_per_second_count'] == 3
+        # 500us毎のエッジは2000エッジ/秒
+        assert snapshot['capture_edges_per_second_bucket{le="1000"}'] == 1
+        assert snapshot['capture_edges_per_second_bucket{le="2000"}'] == 3
+        assert snapshot['capture_end_of_code_seconds_count'] == 3
+
+    def test_filesystem(self):
+        folder = tempfile.mkdtemp()
+        try:
+            filesystem.Filesystem('full').write_file_atomically(os.path.join(folder, 'a.ir'), b'abc')
+        finally:
+            shutil.rmtree(folder)
+        snapshot = self.registry.snapshot()
+        assert snapshot['filesystem_written_bytes_total'] == 3
+        assert snapshot['filesystem_write_seconds_count'] == 1
+        assert snapshot['filesystem_directory_sync_seconds_count'] == 1
@@ -0,0 +1,95 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio
+import json
+import unittest
+import monitor
+
+test_code = {'protocol': 'nec', 'address': 0, 'command': 1, 'bits': 32, 'repeat': 0}
+
+
+"""
+整形は切り捨てだけ、デコードはパルス数が3を超えればtest_codeを返すモック
+"""
+class RespberryPiBoundaryMock:
+    def clean_remote_signal(self, code):
+        return {'0': [int(x) for x in code]}
+
+    def decode_remote_signal(self, record):
+        return test_code if len(record['0']) > 3 else None
+
+
+class TestFrameMonitor(unittest.TestCase):
+
+    def test_writes_all_frames_in_batches(self):
+        batches = []
+        frame_monitor = monitor.FrameMonitor(RespberryPiBoundaryMock(), batches.append, batch_size=8)
+        # 書き込みスレッドの開始前に溜まったフレームもまとめて書く
+        for tick in range(20):
+            frame_monitor.put([9000.4, 4500, 560, 560], tick)
+        frame_monitor.put([9000, 2250, 560], 20)
+        frame_monitor.start()
+        frame_monitor.stop()
+
+        assert [len(batch) for batch in batches] == [8, 8, 5]
+        entries = [entry for batch in batches for entry in batch]
+        assert [entry['tick'] for entry in entries] == list(range(21))
+        assert entries[0] == {'tick': 0, 'pulses': '[9000, 4500, 560, 560]', 'code': json.dumps(test_code)}
+        assert entries[-1]['code'] == 'null'
+        assert frame_monitor.frames == 21
+
+    def test_write_error_does_not_stop_monitor(self):
+        written = []
+        def append(entries):
+            if not written:
+                written.append(None)
+                raise ConnectionError('redis is down')
+            written.extend(entries)
+        frame_monitor = monitor.FrameMonitor(RespberryPiBoundaryMock(), append, batch_size=1)
+        frame_monitor.put([9000, 2250, 560], 0)
+        frame_monitor.put([9000, 2250, 560], 1)
+        frame_monitor.start()
+        frame_monitor.stop()
+        assert [entry['tick'] for entry in written[1:]] == [1]
+        assert frame_monitor.frames == 1
+
+
+class TestAsyncFrameMonitor(unittest.IsolatedAsyncioTestCase):
+
+    async def test_writes_frames_from_other_thread(self):
+        batches = []
+        async def append(entries):
+            batches.append(entries)
+        frame_monitor = monitor.AsyncFrameMonitor(RespberryPiBoundaryMock(), append)
+        frame_monitor.start()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, lambda: [frame_monitor.put([9000, 4500, 560, 560], tick) for tick in range(100)])
+        await frame_monitor.stop()
+        entries = [entry for batch in batches for entry in batch]
+        assert [entry['tick'] for entry in entries] == list(range(100))
+        assert frame_monitor.frames == 100
+
+
+if __name__ == "__main__":
+    unittest.main()
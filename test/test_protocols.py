@@ -0,0 +1,93 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import unittest
+import clustering
+import protocols
+from test import helpers
+
+test_signal = [8970, 4475, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 39710, 8970, 2265, 586]
+
+mitsubishi_command = '23cb26010020080309300000000000000000'
+test_codes = [
+    (protocols.NecDecoder(), {'protocol': 'nec', 'address': 0x04, 'command': 0x08, 'bits': 32, 'repeat': 0}),
+    (protocols.NecDecoder(), {'protocol': 'nec', 'address': 0x7F01, 'command': 0xA5, 'bits': 32, 'repeat': 3}),
+    (protocols.SircDecoder(), {'protocol': 'sirc', 'address': 0x01, 'command': 0x15, 'bits': 12, 'repeat': 2}),
+    (protocols.SircDecoder(), {'protocol': 'sirc', 'address': 0x97, 'command': 0x2A, 'bits': 15, 'repeat': 2}),
+    (protocols.SircDecoder(), {'protocol': 'sirc', 'address': 0x1A3A, 'command': 0x7F, 'bits': 20, 'repeat': 2}),
+    (protocols.Rc5Decoder(), {'protocol': 'rc5', 'address': 0x05, 'command': 0x35, 'bits': 14, 'repeat': 0}),
+    (protocols.Rc5Decoder(), {'protocol': 'rc5', 'address': 0x1F, 'command': 0x40, 'bits': 14, 'repeat': 1}),
+    (protocols.AehaDecoder(), {'protocol': 'aeha', 'address': 0x2002, 'command': '900405', 'bits': 40, 'repeat': 0}),
+    (protocols.AehaDecoder(), {'protocol': 'aeha', 'address': 0x4004, 'command': '0100bcbd-0d0080', 'bits': 88, 'repeat': 1}),
+    (protocols.MitsubishiAcDecoder(), {'protocol': 'mitsubishi_ac', 'address': None, 'command': mitsubishi_command, 'bits': 144, 'repeat': 1}),
+    (protocols.DaikinAcDecoder(), {'protocol': 'daikin_ac', 'address': None,
+                                   'command': '11da2700c5000017-11da270042000054-11da270000393c00a0000006600000c1800060',
+                                   'bits': 280, 'repeat': 0}),
+]
+
+
+class TestProtocols(unittest.TestCase):
+
+    def test_fixture(self):
+        assert protocols.decode(test_signal) == {'protocol': 'nec', 'address': 0, 'command': 1, 'bits': 32, 'repeat': 1}
+
+    def test_round_trip(self):
+        for decoder, code in test_codes:
+            with self.subTest(code=code):
+                pulses = decoder.encode(code)
+                assert decoder.decode(protocols.split_frames(pulses)) == code
+                assert protocols.decode(pulses) == code
+
+    def test_round_trip_with_jitter(self):
+        for decoder, code in test_codes:
+            for seed in range(5):
+                with self.subTest(code=code, seed=seed):
+                    pulses = helpers.jittered(decoder.encode(code), 0.08, seed)
+                    assert protocols.decode(pulses) == code
+                    clustering.normalise(pulses)
+                    assert protocols.decode(pulses) == code
+
+    def test_unknown_signal_is_raw(self):
+        assert protocols.decode([]) is None
+        assert protocols.decode([5000, 5000, 5000]) is None
+        # NECのコマンドの反転が合わない
+        broken = list(test_signal)
+        broken[2 + 16 * 2 + 1] = 544
+        assert protocols.decode(broken) is None
+        # 途中で切れたフレーム
+        assert protocols.decode(test_signal[:41]) is None
+
+    def test_decoders_are_pluggable(self):
+        nec = protocols.NecDecoder().encode({'protocol': 'nec', 'address': 1, 'command': 2, 'bits': 32, 'repeat': 0})
+        assert protocols.decode(nec, (protocols.SircDecoder(),)) is None
+        assert protocols.decode(nec, (protocols.NecDecoder(),))['protocol'] == 'nec'
+
+    def test_ac_before_aeha(self):
+        decoder, code = test_codes[-2]
+        aeha = protocols.decode(decoder.encode(code), (protocols.AehaDecoder(),))
+        assert aeha['protocol'] == 'aeha'
+        assert protocols.decode(decoder.encode(code))['protocol'] == 'mitsubishi_ac'
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,259 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import threading
+import time
+import unittest
+from unittest import mock
+import capture
+import clustering
+import edge_trace
+import fake_pigpio
+import raspberry_pi_boundary
+from test import helpers
+
+test_signal = [8970, 4475, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 544, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 1669, 586, 39710, 8970, 2265, 586]
+
+
+"""
+pigpio.piの代わり。callback()が呼ばれるとtest_signalのエッジを別スレッドから送る。
+"""
+class PiMock:
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.callbacks = []
+        self.glitch_filters = []
+        self.glitch_filter_by_gpio = {}
+        self.stopped = False
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_glitch_filter(self, gpio, steady):
+        self.glitch_filters.append(steady)
+        self.glitch_filter_by_gpio[gpio] = steady
+
+    def set_watchdog(self, gpio, timeout):
+        pass
+
+    def get_current_tick(self):
+        return 0
+
+    def callback(self, gpio, edge, func):
+        cb = helpers.CallbackMock()
+        self.callbacks.append(cb)
+        threading.Thread(target=self.__send, args=(gpio, func)).start()
+        return cb
+
+    def __send(self, gpio, func):
+        tick = 1000 * 1000
+        func(gpio, 0, tick)
+        for pulse in test_signal:
+            tick += pulse
+            func(gpio, 1, tick)
+        func(gpio, capture.TIMEOUT, tick)
+
+    def stop(self):
+        self.stopped = True
+
+
+class PiFactoryMock:
+    def __init__(self, *pis):
+        self.pis = list(pis)
+
+    def __call__(self):
+        return self.pis.pop(0)
+
+
+class TestRespberryPiBoundary(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+
+    def received(self, record, cancelled):
+        self.records.append((record, cancelled))
+
+    def test_connects_once_for_many_captures(self):
+        pi = PiMock()
+        boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(PiFactoryMock(pi)))
+        boundary.start_capturing_remote_signal(self.received)
+        boundary.start_capturing_remote_signal(self.received)
+
+        expected = list(test_signal)
+        clustering.normalise(expected)
+        expected = {'0': expected}
+        boundary.tidy(expected)
+        assert self.records == [(expected, False), (expected, False)]
+        assert len(pi.callbacks) == 2
+        assert all(cb.cancelled for cb in pi.callbacks)
+        # グリッチフィルタは接続時に一度だけ設定し、キャプチャ毎には解除しない
+        assert pi.glitch_filters == [raspberry_pi_boundary.GLITCH]
+
+        boundary.close()
+        assert pi.stopped
+        assert pi.glitch_filters[-1] == 0
+
+    def test_decodes_captured_signal(self):
+        pi = PiMock()
+        boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(PiFactoryMock(pi)))
+        boundary.start_capturing_remote_signal(self.received)
+        record, cancelled = self.records[0]
+        assert boundary.decode_remote_signal(record) == {'protocol': 'nec', 'address': 0, 'command': 1, 'bits': 32, 'repeat': 1}
+        boundary.decoders = ()
+        assert boundary.decode_remote_signal(record) is None
+        assert boundary.decode_remote_signal({}) is None
+
+    def test_merges_multiple_presses(self):
+        pi = PiMock()
+        boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(PiFactoryMock(pi)))
+        for i in range(3):
+            boundary.start_capturing_remote_signal(self.received, tidy=False)
+        codes = [record['0'] for record, cancelled in self.records]
+        codes[1] = [x * 1.05 for x in codes[1]]
+        codes[2] = [x * 0.95 for x in codes[2]]
+        record = boundary.merge_remote_signals(codes)
+        assert sorted(record) == ['0', '1', '2']
+        assert record['0'] == record['1'] == record['2']
+        assert all(isinstance(x, int) for x in record['0'])
+        assert boundary.decode_remote_signal(record)['command'] == 1
+
+        # 最初のフレームが違うボタン
+        other = list(codes[0])
+        other[2 + 16 * 2 + 1], other[2 + 17 * 2 + 1] = other[2 + 17 * 2 + 1], other[2 + 16 * 2 + 1]
+        assert boundary.merge_remote_signals([codes[0], other]) is None
+        # リピートの回数は違ってもよい
+        assert boundary.merge_remote_signals([codes[0], codes[1][:67]]) is not None
+
+    def test_monitoring_pauses_for_learning(self):
+        pi = PiMock()
+        boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(PiFactoryMock(pi)))
+        frames = []
+        boundary.start_monitoring(lambda code, tick: frames.append((code, tick)))
+        assert boundary.monitoring
+        for i in range(500):
+            if frames:
+                break
+            time.sleep(0.01)
+        assert frames[0][0] == test_signal
+
+        # 学習のキャプチャの間はモニターのコールバックを外し、終わったら付け直す
+        boundary.start_capturing_remote_signal(self.received)
+        assert len(self.records) == 1
+        assert [cb.cancelled for cb in pi.callbacks] == [True, True, False]
+        for i in range(500):
+            if len(frames) == 2:
+                break
+            time.sleep(0.01)
+        assert len(frames) == 2
+
+        boundary.stop_monitoring()
+        assert not boundary.monitoring
+        assert all(cb.cancelled for cb in pi.callbacks)
+        boundary.close()
+
+    def test_clean_remote_signal(self):
+        boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(PiFactoryMock(PiMock())))
+        record = boundary.clean_remote_signal([int(x * 1.03) for x in test_signal])
+        assert boundary.decode_remote_signal(record) == {'protocol': 'nec', 'address': 0, 'command': 1, 'bits': 32, 'repeat': 1}
+        assert all(isinstance(x, int) for x in record['0'])
+
+    def test_receivers_share_one_connection(self):
+        pi = PiMock()
+        connection = raspberry_pi_boundary.PigpioConnection(PiFactoryMock(pi))
+        receivers = raspberry_pi_boundary.receivers([17, 18], connection)
+        assert sorted(receivers) == [17, 18]
+        assert pi.glitch_filter_by_gpio == {17: raspberry_pi_boundary.GLITCH, 18: raspberry_pi_boundary.GLITCH}
+
+        records = dict((gpio, []) for gpio in receivers)
+        threads = [threading.Thread(target=receiver.start_capturing_remote_signal,
+                                    args=(lambda record, cancelled, gpio=gpio: records[gpio].append(record),))
+                   for gpio, receiver in receivers.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert records[17] == records[18]
+        assert receivers[18].decode_remote_signal(records[18][0])['command'] == 1
+
+        with self.assertRaises(ValueError):
+            raspberry_pi_boundary.RespberryPiBoundary(connection, gpio=17)
+
+        # 最後のGPIOを閉じるまで接続は閉じない
+        receivers[17].close()
+        assert pi.glitch_filter_by_gpio[17] == 0
+        assert pi.glitch_filter_by_gpio[18] == raspberry_pi_boundary.GLITCH
+        assert not pi.stopped
+        receivers[18].close()
+        assert pi.glitch_filter_by_gpio[18] == 0
+        assert pi.stopped
+
+    def test_reconnects_with_backoff(self):
+        delays = []
+        sleep = raspberry_pi_boundary.time.sleep
+        raspberry_pi_boundary.time.sleep = delays.append
+        try:
+            pi = PiMock()
+            connection = raspberry_pi_boundary.PigpioConnection(PiFactoryMock(PiMock(False), PiMock(False), pi))
+            assert connection.ensure() is pi
+        finally:
+            raspberry_pi_boundary.time.sleep = sleep
+        assert delays == [raspberry_pi_boundary.RECONNECT_MIN_S, raspberry_pi_boundary.RECONNECT_MIN_S * 2]
+        assert connection.ensure() is pi
+
+    def test_startup_does_not_wait_for_pigpiod(self):
+        delays = []
+        sleep = raspberry_pi_boundary.time.sleep
+        raspberry_pi_boundary.time.sleep = delays.append
+        try:
+            pi = PiMock()
+            attempts = raspberry_pi_boundary.STARTUP_CONNECT_ATTEMPTS
+            connection = raspberry_pi_boundary.PigpioConnection(PiFactoryMock(*([PiMock(False)] * attempts + [pi])))
+            boundary = raspberry_pi_boundary.RespberryPiBoundary(connection)
+            assert connection.pi is None
+            assert len(delays) == attempts - 1
+            # 最初のキャプチャで接続する
+            records = []
+            boundary.start_capturing_remote_signal(lambda record, cancelled: records.append(record))
+        finally:
+            raspberry_pi_boundary.time.sleep = sleep
+        assert connection.pi is pi
+        assert records[0]['0']
+
+    def test_capture_latency(self):
+        """
+        フレームの最後のエッジを受けてからコールバックが呼ばれるまでに待つのはGRACE_Sの1回だけで、ポーリングしない。
+        以前は0.1秒毎のポーリングと0.5秒の待ち時間で必ず0.5秒以上かかっていた。
+        fake_pigpioをspeed=0で再生し、time.sleepを記録するので実時間には依らない。
+        """
+        with mock.patch.object(raspberry_pi_boundary, 'time') as clock:
+            for i in range(20):
+                pi = fake_pigpio.pi(trace=edge_trace.from_frames([test_signal], raspberry_pi_boundary.GPIO), speed=0)
+                boundary = raspberry_pi_boundary.RespberryPiBoundary(raspberry_pi_boundary.PigpioConnection(PiFactoryMock(pi)))
+                boundary.start_capturing_remote_signal(self.received)
+                boundary.close()
+                assert clock.sleep.call_args_list == [mock.call(raspberry_pi_boundary.GRACE_S)] * (i + 1)
+        expected = list(test_signal)
+        clustering.normalise(expected)
+        expected = {'0': expected}
+        boundary.tidy(expected)
+        assert self.records == [(expected, False)] * 20
@@ -0,0 +1,153 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import filesystem
+import ir_file
+import sessions
+
+test_signal = {'0': [8970, 4475, 586, 544, 586, 1669, 586]}
+test_signal_file = filesystem.encode_signals(test_signal)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSessionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clock = Clock()
+        self.fs = filesystem.Filesystem('none')
+        self.manager = sessions.SessionManager(self.fs, self.directory, ttl_s=60,
+                                               memory_limit=len(test_signal_file) * 2, clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def capture(self):
+        session = self.manager.create()
+        assert self.manager.begin(session.id)
+        assert self.manager.store(session.id, test_signal)
+        self.clock.now += 1
+        return session
+
+    def test_take_and_discard(self):
+        first = self.capture()
+        second = self.capture()
+        assert self.manager.pending() == 0
+        assert self.manager.take(first.id).data == test_signal_file
+        assert self.manager.take(first.id) is None
+        assert self.manager.discard() is True
+        assert self.manager.discard(second.id) is False
+        assert self.manager.memory == 0
+
+    def test_take_latest(self):
+        self.capture()
+        second = self.capture()
+        assert self.manager.take() is second
+
+    def test_cancel_queued(self):
+        capturing = self.manager.create()
+        queued = self.manager.create()
+        assert self.manager.begin(capturing.id)
+        assert self.manager.cancel(capturing.id) is False
+        assert self.manager.cancel(queued.id) is True
+        assert self.manager.pending() == 2
+        assert self.manager.begin(queued.id) is False
+        self.manager.drop(capturing.id)
+        assert self.manager.pending() == 0
+
+    def test_evict_least_recently_captured(self):
+        first = self.capture()
+        second = self.capture()
+        third = self.capture()
+        assert self.manager.evictions == 1
+        assert self.manager.memory == len(test_signal_file) * 2
+        assert self.manager.take(first.id) is None
+        assert self.manager.take() is third
+        assert self.manager.take() is second
+        assert os.listdir(self.directory) == []
+
+    def test_evict_least_recently_used(self):
+        first = self.capture()
+        second = self.capture()
+        # peekかgetしたセッションは追い出さない
+        assert self.manager.peek(first.id) is first
+        self.clock.now += 1
+        third = self.capture()
+        assert self.manager.get(second.id) is None
+        assert self.manager.get(first.id) is first
+        # 最新の取り出しは使った順ではなくキャプチャした順
+        assert self.manager.take() is third
+        assert self.manager.take() is first
+
+    def test_store_too_large_signal(self):
+        self.capture()
+        session = self.manager.create()
+        assert self.manager.begin(session.id)
+        assert self.manager.store(session.id, {'0': test_signal['0'] * 10}) is False
+        assert self.manager.peek(session.id) is None
+        assert self.manager.memory == 0
+
+    def test_spill_oldest_to_disk(self):
+        self.manager.spill = True
+        first = self.capture()
+        self.capture()
+        assert os.listdir(self.directory) == []
+        self.capture()
+        spill_path = os.path.join(self.directory, 'session-{0}.ir'.format(first.id))
+        assert first.spill_path == spill_path and first.data is None
+        assert self.manager.memory == len(test_signal_file) * 2
+        with ir_file.load(spill_path) as f:
+            assert f.to_dict() == test_signal
+        assert self.manager.take(first.id) is first
+        assert self.manager.discard() is True
+        self.manager.remove_spilled_files()
+        assert os.listdir(self.directory) == []
+
+    def test_sweep_expired_sessions(self):
+        self.manager.spill = True
+        first = self.capture()
+        self.capture()
+        self.capture()
+        queued = self.manager.create()
+        self.clock.now += 58
+        assert self.manager.sweep() == [first.id]
+        assert os.listdir(self.directory) == []
+        self.clock.now += 10
+        assert len(self.manager.sweep()) == 2
+        assert self.manager.memory == 0
+        assert self.manager.begin(queued.id)
+
+
+if __name__ == "__main__":
+    unittest.main()
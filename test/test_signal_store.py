@@ -0,0 +1,218 @@
+# MIT License
+#
+# Copyright (c) 2019 Morning Project Samurai (MPS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import unittest
+import redis
+import signal_store
+
+VIEW_KEY = 'test:ir_receiver:ir'
+
+
+# localhostのRedisに繋がるか。繋がらない場合の再試行に数秒かかるので最初の1回だけ調べる
+_redis_running = None
+
+
+"""
+localhostのRedis(DB 15)に繋ぐ。動いていなければfakeredis(Luaの実行にlupaが要る)を使い、それも無ければテストを飛ばす
+"""
+def connect():
+    global _redis_running
+    r = redis.StrictRedis('localhost', db=15)
+    if _redis_running is None:
+        try:
+            _redis_running = r.ping()
+        except redis.ConnectionError:
+            _redis_running = False
+    if _redis_running:
+        return r
+    try:
+        import fakeredis
+    except ImportError:
+        raise unittest.SkipTest('Redis is not running on localhost and fakeredis is not installed')
+    return fakeredis.FakeStrictRedis()
+
+
+class TestSignalStore(unittest.TestCase):
+
+    def setUp(self):
+        self.r = connect()
+        self.r.flushdb()
+        self.store = signal_store.SignalStore(self.r, VIEW_KEY)
+
+    def tearDown(self):
+        self.r.flushdb()
+
+    def view(self):
+        return json.loads(self.r.get(VIEW_KEY))
+
+    def test_migrates_legacy_document(self):
+        legacy = {'signals': [{'id': 3, 'name': 'tv', 'sleep': 200, 'filePath': '3.ir', 'fileTimeStamp': 1555000000.1234567},
+                              {'id': 1, 'name': 'ac', 'sleep': 0, 'filePath': None, 'fileTimeStamp': None}]}
+        assert not self.store.exists()
+        self.store.replace_all(legacy)
+        assert self.store.exists()
+        expected = {'signals': [dict(x, code=None) for x in sorted(legacy['signals'], key=lambda x: x['id'])]}
+        assert self.store.get_all() == expected
+        assert self.view() == expected
+        assert self.store.allocate_id() == 4
+
+    def test_save_update_delete(self):
+        assert self.store.allocate_id() == 0
+        assert self.store.allocate_id() == 1
+        signal = {'id': 1, 'name': 'tv', 'sleep': 200, 'filePath': '1.ir', 'fileTimeStamp': 1555000000.5,
+                  'code': {'protocol': 'nec', 'address': 0, 'command': 1, 'bits': 32, 'repeat': 1}}
+        assert self.store.save(signal)
+        assert self.view() == {'signals': [signal]}
+
+        assert not self.store.save({'id': 5, 'name': 'light', 'sleep': 0}, only_existing=True)
+        assert self.store.get(5) is None
+        assert self.store.save({'id': 1, 'name': 'tv2', 'sleep': 300}, only_existing=True)
+        signal.update({'name': 'tv2', 'sleep': 300})
+        assert self.store.get(1) == signal
+        assert self.view() == {'signals': [signal]}
+
+        assert self.store.delete(1)
+        assert not self.store.delete(1)
+        assert self.store.get_all() == {'signals': []}
+        assert self.view() == {'signals': []}
+
+    def test_file_refs(self):
+        released = []
+        self.store.save({'id': 0, 'name': 'tv1', 'sleep': 0, 'filePath': 'a.ir'}, released=released)
+        self.store.save({'id': 1, 'name': 'tv2', 'sleep': 0, 'filePath': 'a.ir'}, released=released)
+        assert self.store.file_refs() == {'a.ir': 2}
+        # ファイルを変えない更新は参照数を変えない
+        self.store.save({'id': 1, 'name': 'tv3', 'sleep': 0}, only_existing=True, released=released)
+        self.store.save({'id': 1, 'filePath': 'a.ir'}, only_existing=True, released=released)
+        assert self.store.file_refs() == {'a.ir': 2}
+        assert self.store.delete(0, released)
+        assert released == []
+        self.store.save({'id': 1, 'filePath': 'b.ir'}, only_existing=True, released=released)
+        assert released == ['a.ir']
+        assert self.store.file_refs() == {'b.ir': 1}
+        assert self.store.delete(1, released)
+        assert not self.store.delete(1, released)
+        assert released == ['a.ir', 'b.ir']
+        assert self.store.file_refs() == {}
+
+    def test_legacy_files_are_released(self):
+        self.store.replace_all({'signals': [{'id': 0, 'name': 'tv', 'sleep': 0, 'filePath': '0.ir', 'fileTimeStamp': 0.0},
+                                            {'id': 1, 'name': 'ac', 'sleep': 0, 'filePath': None, 'fileTimeStamp': None}]})
+        assert self.store.file_refs() == {'0.ir': 1}
+        # 参照数が無い以前のファイルも、信号が参照しなくなれば返す
+        self.r.delete(signal_store.FILE_REFS_KEY)
+        released = []
+        self.store.save({'id': 0, 'filePath': 'c.ir'}, only_existing=True, released=released)
+        assert released == ['0.ir']
+        assert self.store.file_refs() == {'c.ir': 1}
+
+    def test_scan(self):
+        for i in (5, 1, 3, 8, 2):
+            self.store.save({'id': i, 'name': 'signal{0}'.format(i), 'sleep': 0})
+        cursor, signals = self.store.scan(count=2)
+        assert [x['id'] for x in signals] == [1, 2]
+        # 読んでいる間に追加・削除されても、まだ読んでいない範囲だけが変わる
+        self.store.delete(3)
+        self.store.save({'id': 9, 'name': 'signal9', 'sleep': 0})
+        scanned = signals
+        while cursor is not None:
+            cursor, signals = self.store.scan(cursor, 2)
+            scanned.extend(signals)
+        assert [x['id'] for x in scanned] == [1, 2, 5, 8, 9]
+
+    def test_import_signals(self):
+        self.store.save({'id': self.store.allocate_id(), 'name': 'tv', 'sleep': 0, 'filePath': 'a.ir'})
+        self.store.get_all()
+        imported = [{'name': 'signal{0}'.format(i), 'sleep': i, 'filePath': 'a.ir' if i % 2 else None,
+                     'fileTimeStamp': 1555000000.5 if i % 2 else None, 'code': None} for i in range(5)]
+        assert self.store.import_signals(iter(imported), chunk=2) == 5
+        expected = [{'id': 0, 'name': 'tv', 'sleep': 0, 'filePath': 'a.ir', 'fileTimeStamp': None, 'code': None}]
+        expected += [dict(x, id=i + 1) for i, x in enumerate(imported)]
+        assert self.store.get_all() == {'signals': expected}
+        assert self.view() == {'signals': expected}
+        assert self.store.file_refs() == {'a.ir': 3}
+        assert self.store.allocate_id() == 6
+        assert self.store.import_signals(iter([])) == 0
+
+    def test_without_view(self):
+        store = signal_store.SignalStore(self.r, None)
+        store.save({'id': 0, 'name': 'tv', 'sleep': 0})
+        assert self.r.get(VIEW_KEY) is None
+        assert store.ids() == [0]
+
+
+class TestCachedSignalStore(TestSignalStore):
+
+    def setUp(self):
+        super().setUp()
+        self.store = signal_store.SignalStore(self.r, VIEW_KEY, signal_store.SignalCache())
+
+    def test_reads_are_served_from_cache(self):
+        self.store.save({'id': 0, 'name': 'tv', 'sleep': 0})
+        self.store.get_all()
+        misses = self.store.cache.misses
+        for _ in range(3):
+            assert self.store.get(0)['name'] == 'tv'
+        assert self.store.cache.misses == misses
+        assert self.store.cache.hits >= 3
+        # 返した信号を書き換えてもキャッシュは変わらない
+        self.store.get(0)['name'] = 'changed'
+        assert self.store.get_all()['signals'][0]['name'] == 'tv'
+
+    def test_sees_writes_of_other_clients(self):
+        other = signal_store.SignalStore(self.r, VIEW_KEY)
+        self.store.save({'id': 0, 'name': 'tv', 'sleep': 0})
+        assert self.store.get(0)['name'] == 'tv'
+        other.save({'id': 0, 'name': 'tv2'}, only_existing=True)
+        other.save({'id': 1, 'name': 'ac', 'sleep': 100})
+        assert self.store.get(0)['name'] == 'tv2'
+        assert self.store.ids() == [0, 1]
+        other.delete(0)
+        assert self.store.get(0) is None
+        other.replace_all({'signals': [{'id': 7, 'name': 'light', 'sleep': 0}]})
+        assert self.store.ids() == [7]
+
+    def test_view_is_same_as_built_by_redis(self):
+        self.store.get_all()
+        self.store.save({'id': 2, 'name': 'tv', 'sleep': 0, 'code': {'protocol': 'nec', 'command': 1}})
+        self.store.save({'id': 0, 'name': '照明', 'sleep': 100, 'filePath': '0.ir', 'fileTimeStamp': 1.5})
+        self.store.save({'id': 1, 'name': 'ac', 'sleep': 0})
+        self.store.save({'id': 2, 'name': 'tv2'}, only_existing=True)
+        self.store.delete(0)
+        # 間に他の書き込みが無いので、全てキャッシュに反映してPythonで作ったビューを書き込んでいる
+        assert self.store.cache.version == int(self.r.get(signal_store.VERSION_KEY))
+        cached_view = self.r.get(VIEW_KEY)
+        # キャッシュを使わない書き込みではRedisで作り直す
+        signal_store.SignalStore(self.r, VIEW_KEY).save({'id': 1, 'name': 'ac', 'sleep': 0})
+        assert self.r.get(VIEW_KEY) == cached_view
+
+    def test_rebuilds_view_after_write_of_other_client(self):
+        other = signal_store.SignalStore(self.r, VIEW_KEY)
+        self.store.save({'id': 0, 'name': 'tv', 'sleep': 0})
+        self.store.get_all()
+        other.save({'id': 1, 'name': 'ac', 'sleep': 0})
+        # キャッシュはid=1を知らないが、バージョンが合わないのでビューはRedisで作り直す
+        self.store.save({'id': 0, 'name': 'tv2', 'sleep': 0})
+        assert [x['name'] for x in self.view()['signals']] == ['tv2', 'ac']
+        assert [x['name'] for x in self.store.get_all()['signals']] == ['tv2', 'ac']